@@ -19,7 +19,6 @@ import md5
 import base64
 import getpass
 import imaplib
-import cPickle
 import email
 
 def md5hash(m):
@@ -33,11 +32,23 @@ class IMAPproxy(pop3d.POP3Server):
 
     It then delivers it to the POP3 mail box.
     """
-    def __init__(self, localaddr, ser, passwd):
-        "Server and Mixminion must be specified"
+    def __init__(self, localaddr, ser, passwd, backend=None, store=None):
+        """Server and Mixminion must be specified.
+
+        'backend' and 'store' are as for minionSMTP: by default, an
+        in-process mixminion backend, and a GatewayStore in the current
+        directory. Pass the same store to both proxies, so that replies
+        can find the reply blocks we extract here.
+        """
         self.__server = ser
         print 'IMAP login on %s' % (ser)
         self.__pass = passwd
+        if backend == None:
+            backend = mmUtils.InProcessBackend(passwd)
+        if store == None:
+            store = mmUtils.GatewayStore()
+        self.__backend = backend
+        self.__store = store
         pop3d.POP3Server.__init__(self,localaddr)
         self.__cachedIDs = []
         
@@ -68,16 +79,8 @@ class IMAPproxy(pop3d.POP3Server):
             return []
 
 
-        # Implement a list of previously seen messages.
-        # The list of messages confirmed by the mail client
-        if 'seen_files.dat' in os.listdir('.'):
-            print 'loading seen file'
-            seenlist = cPickle.load(file('seen_files.dat','r'))
-        else:
-            seenlist = []
-
-        # Filter out messages that are already seen.
-        ms = filter(lambda x:not md5hash(x) in seenlist,ms)
+        # Filter out messages that the mail client has already seen.
+        ms = filter(lambda x,s=self.__store:not s.isSeen(md5hash(x)),ms)
         self.__cachedIDs = map(lambda x: md5hash(x), ms)
 
         # Decodes the anonymous messages
@@ -89,17 +92,11 @@ class IMAPproxy(pop3d.POP3Server):
         # How to recognise a SURB:
         surbPat = re.compile('(?:- )?(-----BEGIN TYPE III REPLY BLOCK-----)([^\-]*)(?:- )?(-----END TYPE III REPLY BLOCK-----)',re.S)
 
-         # The list of surbs cached by the client.
-        if 'surb_file.dat' in os.listdir('.'):
-            surb_file = cPickle.load(file('surb_file.dat','r'))
-        else:
-            surb_file = {}
-
         ms2 = []
         for m in ms:
             msg = email.message_from_string(m)
             # Decode the body of the message
-            bx = mmUtils.decode(msg.get_payload(),passd)
+            bx = self.__backend.decode(msg.get_payload())
 
             # By default allow no reply.
             reply_addrs = '%s@nym.taz' % 'anonymous'
@@ -110,7 +107,7 @@ class IMAPproxy(pop3d.POP3Server):
 
             if len(rs) > 0:
                 bx = surbPat.sub('',bx)
-                surb_file[md5hash(rs[0])[:10]] = rs
+                self.__store.addSURBs(md5hash(rs[0])[:10], rs)
                 reply_addrs = '%s@nym.taz' % md5hash(rs[0])[:10]
 
             # Set the reply addresses with none@nym.taz or the SURB IDs.
@@ -125,25 +122,16 @@ class IMAPproxy(pop3d.POP3Server):
         # Add '\r\n' back at the end of each line!
         m2 = map(lambda x:re.sub('\n','\r\n',x),ms2)
 
-        # Save the SURBs
-        cPickle.dump(surb_file,file('surb_file.dat','w'))
-
         return m2
 
     def set_pop3_messages(self, user, msgs):
-        # Loads the list of seen (by the client) messages 
-        seenlist = []
-        if 'seen_files.dat' in os.listdir('.'):
-            seenlist = cPickle.load(file('seen_files.dat','r'))
-        else:
-            seenlist = []
-
-        # Stores the IDs of seen messages
+        # Stores the IDs of messages seen by the client
+        seen = []
         for (i,(d,m)) in zip(range(len(msgs)),msgs):
             if d:
-                seenlist += [self.__cachedIDs[i]]
+                seen += [self.__cachedIDs[i]]
 
-        cPickle.dump(seenlist,file('seen_files.dat','w'))
+        self.__store.markSeen(seen)
         self.__cachedIDs =[]
         return None # No errors
 
@@ -33,13 +33,14 @@ address of the form "xxxxxx@nym.taz" can be used to reply. Otherwise
 it is not possible to reply (and the reply address is
 "anonymous@nym.taz")
 
-You need to have the mixminion program on your path for minionProxy
-to work. Download it at: http://mixminion.net
+You need to have the mixminion Python package on your Python path for
+minionProxy to work. Download it at: http://mixminion.net
 For comments and BUGS contact "George.Danezis@cl.cam.ac.uk" """
 
 from IMAPproxy import *
 from minionSMTP import *
 import getpass
+import mmUtils
 
 import asyncore
 
@@ -91,9 +92,14 @@ if __name__ == '__main__':
 
     print 'Mixminion password:'
     mm_Pass = getpass.getpass()
+    # Both proxies share one mixminion backend, and one store, so that
+    # replies can use the reply blocks that arrive over IMAP.
+    backend = mmUtils.InProcessBackend(mm_Pass)
+    store = mmUtils.GatewayStore()
     if imap_address != None:
-        proxy1 = IMAPproxy((local_host, imap_port),imap_address,mm_Pass)
-    proxy2 = minionSMTP((local_host,smtp_port),mm_Pass)
+        proxy1 = IMAPproxy((local_host, imap_port),imap_address,mm_Pass,
+                           backend,store)
+    proxy2 = minionSMTP((local_host,smtp_port),mm_Pass,backend,store)
     
     try:
         asyncore.loop()
@@ -23,8 +23,11 @@ nicknames.
 MIME is supported but only the text/plain parts are relayed. The
 others contain too much information to be safe.
 
-You need to have installed mixminion and the program also needs 
-to be on your path. See http://mixminion.net for more information.
+You need to have installed mixminion, and its Python package needs
+to be on your Python path: the proxy uses the mixminion client code
+directly (see mmUtils.InProcessBackend) rather than running the
+program for every message. See http://mixminion.net for more
+information.
 
 Bugs and comments to "George.Danezis@cl.cam.ac.uk"
 """
@@ -41,15 +44,24 @@ import re
 
 import mmUtils
 import getpass
-import cPickle
 
 program = sys.argv[0]
 __version__ = 'Mixminion SMTP proxy - 0.0.1'
 
 class minionSMTP(smtpd.SMTPServer):
 
-    def __init__(self, localaddr,passwd):
-        self.__passwd = passwd
+    def __init__(self, localaddr,passwd,backend=None,store=None):
+        """ 'backend' does the mixminion work (see mmUtils); by default we
+        use an in-process backend unlocked with 'passwd'. 'store' is a
+        mmUtils.GatewayStore holding the reply blocks for nym.taz
+        addresses; by default it lives in the current directory.
+        """
+        if backend == None:
+            backend = mmUtils.InProcessBackend(passwd)
+        if store == None:
+            store = mmUtils.GatewayStore()
+        self.__backend = backend
+        self.__store = store
         smtpd.SMTPServer.__init__(self,localaddr,localaddr)
         print '%s started at %s\n\tLocal addr: %s\n\t' % (
             self.__class__.__name__, time.ctime(time.time()),
@@ -108,19 +120,10 @@ class minionSMTP(smtpd.SMTPServer):
             return "501 no text/plain body found"
 
         if retaddrs != None:
-            surb = mmUtils.getSURB(retaddrs,nickname,self.__passwd)
-            print surb,retaddrs,nickname,self.__passwd
-            body = body +'\n'+surb[0]
-
-        # Base mixminion command
-        cmd = []
-        
-        # Augment the command with a nickname
-        if nickname != '':
-            cmd.append('--from=\"%s\"' % nickname)
-
-        if subject != '':
-            cmd.append('--subject=\"%s\"' % subject)
+            surb = self.__backend.generateSURB(retaddrs,nickname)
+            if surb == None:
+                return "502 Mixminion could not generate a reply block"
+            body = body +'\n'+surb
 
         for address in rcpttos:
             taz = re.findall('([^@]*)@nym.taz',address)
@@ -132,36 +135,23 @@ class minionSMTP(smtpd.SMTPServer):
                     # TODO: send back an error message
                     print 'Cannot send to anonymous'
                     continue
-                surb_file = {}
-                if 'surb_file.dat' in os.listdir('.'):
-                    surb_file = cPickle.load(file('surb_file.dat','r'))
 
-                if surb_file.has_key(surb_id):
-                    surb_list = surb_file[surb_id]
-                    if len(surb_list) == 0:
+                if self.__store.hasSURBs(surb_id):
+                    surb = self.__store.peekSURB(surb_id)
+                    if surb == None:
                         # Send back an error message
                         print 'No more SURBs available'
-                        del surb_file[surb_id]
+                        self.__store.useSURB(surb_id)
+                    elif not self.__backend.reply(body,surb,subject,nickname):
+                        return "502 Mixminion did not confirm sending"
                     else:
-                        result = mmUtils.reply(body,surb_list[0],cmd)
-                        print result
-                        m = re.search("sent", result)
-            
-                        if m == None:
-                            return "502 Mixminion did not confirm sending"
-                        else:
-                            surb_file[surb_id] = surb_list[1:]
-                            print "Done"
-
-                    cPickle.dump(surb_file,file('surb_file.dat','w'))
+                        self.__store.useSURB(surb_id)
+                        print "Done"
                 else:
                     print 'No address known for: %s@nym.taz'%taz[0]
             else:
                 # For each address it sends the message using mixminion.
-                result = mmUtils.send(body,address,cmd)
-                m = re.search("sent", result)
-            
-                if m == None:
+                if not self.__backend.send(body,address,subject,nickname):
                     return "502 Mixminion did not confirm sending"
                 else:
                     print "Done"
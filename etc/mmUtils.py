@@ -72,6 +72,270 @@ def reply(msg,surb,cmd):
     return rs
     # Delete files !!
 
+# ----------------------------------------------------------------------
+# Gateway backends.
+#
+# The proxies talk to mixminion through a "backend" object with four
+# methods:
+#    generateSURB(address, identity) -> armored reply block, or None
+#    decode(text) -> the decoded message text, or ''
+#    send(message, address, subject='', nickname='') -> 1 if sent or queued
+#    reply(message, surb, subject='', nickname='') -> 1 if sent or queued
+#
+# CLIBackend runs the 'mixminion' program for each operation, as we always
+# used to.  InProcessBackend does the work inside the proxy process, and
+# keeps the configuration, directory, keyring and queue loaded between
+# messages.
+
+class CLIBackend:
+    """Backend that runs the 'mixminion' command for every operation."""
+    def __init__(self, passwd):
+        self.passwd = passwd
+
+    def generateSURB(self, address, identity=''):
+        rs = getSURB(address, identity, self.passwd)
+        if rs:
+            return rs[0]
+        return None
+
+    def decode(self, text):
+        return decode(text, self.passwd)
+
+    def _headerArgs(self, subject, nickname):
+        cmd = []
+        if nickname != '':
+            cmd.append('--from=\"%s\"' % nickname)
+        if subject != '':
+            cmd.append('--subject=\"%s\"' % subject)
+        return cmd
+
+    def send(self, message, address, subject='', nickname=''):
+        result = send(message, address, self._headerArgs(subject, nickname))
+        return re.search("sent", result) != None
+
+    def reply(self, message, surb, subject='', nickname=''):
+        result = reply(message, surb, self._headerArgs(subject, nickname))
+        return re.search("sent", result) != None
+
+class InProcessBackend:
+    """Backend that uses the mixminion client code directly.
+
+       The first operation loads the configuration, the server directory
+       and the keyring; later ones reuse them.  If 'queueOnly' is true, we
+       put packets in the client queue instead of sending them (use
+       'mixminion flush' to send them later).
+    """
+    def __init__(self, passwd, configFile=None, queueOnly=0):
+        import mixminion.ClientAgent
+        import mixminion.ClientUtils
+        # The keyring is unlocked with 'passwd'; we never ask for a
+        # passphrase on the terminal.
+        pwdManager = mixminion.ClientUtils.AgentPasswordManager(
+            mixminion.ClientUtils.CLIPasswordManager())
+        pwdManager.setPassword("ClientKeyring", passwd)
+        pwdManager.detach()
+        self.env = mixminion.ClientAgent.AgentEnv(configFile, pwdManager)
+        self.queueOnly = queueOnly
+        self.initialized = 0
+
+    def _init(self):
+        """Set up the mixminion subsystems, once."""
+        if self.initialized:
+            return
+        import mixminion.ClientMain, mixminion.Common, mixminion.Crypto
+        config = self.env.config
+        mixminion.Common.LOG.configure(config)
+        mixminion.Common.configureShredCommand(config)
+        mixminion.Common.configureFileParanoia(config)
+        mixminion.Crypto.init_crypto(config)
+        mixminion.ClientMain.configureClientLock(
+            os.path.join(config['User']['UserDir'], "lock"))
+        self.initialized = 1
+
+    def _getDirectory(self):
+        """Return our ClientDirectory, downloading a fresh directory if the
+           one we have is out of date."""
+        import mixminion.ClientMain
+        self._init()
+        directory = self.env.getDirectory()
+        mixminion.ClientMain.clientLock()
+        try:
+            directory.update()
+        finally:
+            mixminion.ClientMain.clientUnlock()
+        directory._installAsKeyIDResolver()
+        self.env.commandDone()
+        return directory
+
+    def _getPath(self, pathName, isReply=0, isSURB=0):
+        """Return (pathSpec, startAt, endAt) for the path named 'pathName'
+           in the configuration file."""
+        import time
+        import mixminion.ClientDirectory
+        from mixminion.Common import previousMidnight
+        config = self.env.config
+        if isSURB:
+            duration = int(config['Security']['SURBLifetime'])
+        else:
+            duration = 24*60*60
+        startAt = time.time()
+        endAt = previousMidnight(startAt+duration)
+        pathSpec = mixminion.ClientDirectory.parsePath(
+            config, config['Security'].get(pathName, "~5"),
+            isReply=isReply, isSURB=isSURB)
+        return pathSpec, startAt, endAt
+
+    def generateSURB(self, address, identity=''):
+        import mixminion.ClientDirectory
+        from mixminion.Common import MixError
+        try:
+            directory = self._getDirectory()
+            exitAddress = mixminion.ClientDirectory.parseAddress(address)
+            pathSpec, startAt, endAt = self._getPath('SURBPath', isSURB=1)
+            directory.validatePath(pathSpec, exitAddress, startAt, endAt)
+            _, path = directory.generatePaths(1, pathSpec, exitAddress,
+                                              startAt, endAt)[0]
+            surb = self.env.getClient().generateReplyBlock(
+                exitAddress, path, name=identity, expiryTime=endAt)
+        except MixError, e:
+            print "Couldn't generate reply block: %s" % e
+            return None
+        return surb.packAsText()
+
+    def decode(self, text):
+        from mixminion.Common import MixError
+        self._init()
+        decPat = re.compile('-----BEGIN TYPE III ANONYMOUS MESSAGE-----\r?\nMessage-type: (plaintext|encrypted)(.*)-----END TYPE III ANONYMOUS MESSAGE-----\r?\n',re.S)
+        mtc = decPat.search(text)
+        if mtc == None:
+            return ''
+        try:
+            res = self.env.getClient().decodeMessage(mtc.group(0))
+        except MixError, e:
+            print "Couldn't decode message: %s" % e
+            return ''
+        return "".join(res)+'\n'
+
+    def _prepare(self, message, subject, nickname, exitAddress):
+        """Return 'message' with its headers encoded, and tell
+           'exitAddress' about them."""
+        from mixminion.Packet import encodeMailHeaders, parseMessageAndHeaders
+        headerStr = encodeMailHeaders(subject=subject, fromAddr=nickname)
+        exitAddress.setHeaders(parseMessageAndHeaders(headerStr+"\n")[1])
+        message = headerStr + message
+        exitAddress.setExitSize(len(message))
+        return message
+
+    def send(self, message, address, subject='', nickname=''):
+        import mixminion.ClientDirectory
+        from mixminion.Common import MixError
+        try:
+            directory = self._getDirectory()
+            exitAddress = mixminion.ClientDirectory.parseAddress(address)
+            pathSpec, startAt, endAt = self._getPath('ForwardPath')
+            message = self._prepare(message, subject, nickname, exitAddress)
+            self.env.getClient().sendForwardMessage(
+                directory, exitAddress, pathSpec, message, startAt, endAt,
+                forceQueue=self.queueOnly)
+        except MixError, e:
+            print "Couldn't send message: %s" % e
+            return 0
+        return 1
+
+    def reply(self, message, surb, subject='', nickname=''):
+        import mixminion.ClientDirectory
+        from mixminion.Common import MixError
+        from mixminion.Packet import parseTextReplyBlocks
+        try:
+            directory = self._getDirectory()
+            surbs = parseTextReplyBlocks(surb)
+            exitAddress = mixminion.ClientDirectory.ExitAddress(isReply=1)
+            pathSpec, startAt, endAt = self._getPath('ReplyPath', isReply=1)
+            message = self._prepare(message, subject, nickname, exitAddress)
+            self.env.getClient().sendReplyMessage(
+                directory, exitAddress, pathSpec, surbs, message,
+                startAt, endAt, forceQueue=self.queueOnly)
+        except MixError, e:
+            print "Couldn't send reply: %s" % e
+            return 0
+        return 1
+
+# ----------------------------------------------------------------------
+# The gateway store.
+
+class GatewayStore:
+    """Remembers which messages the mail client has already seen, and the
+       reply blocks we've received, keyed by the ID we hand out in
+       <ID>@nym.taz addresses.
+
+       Each is kept in its own database file, so looking up or changing one
+       entry doesn't mean reading and rewriting everything, as it did when
+       we kept them in seen_files.dat and surb_file.dat.  If those files
+       are present, we import them once.
+    """
+    def __init__(self, location='.'):
+        import mixminion.Filestore
+        self.seen = mixminion.Filestore.DBBase(
+            os.path.join(location, 'gateway_seen'), "seen messages")
+        self.surbs = mixminion.Filestore.DBBase(
+            os.path.join(location, 'gateway_surbs'), "reply blocks")
+        self._importOld(location)
+
+    def _importOld(self, location):
+        """Import the old pickled files in 'location', if there are any."""
+        import cPickle
+        fn = os.path.join(location, 'seen_files.dat')
+        if os.path.exists(fn):
+            for h in cPickle.load(open(fn, 'rb')):
+                self.seen[h] = '1'
+            self.seen.sync()
+            os.rename(fn, fn+'.imported')
+        fn = os.path.join(location, 'surb_file.dat')
+        if os.path.exists(fn):
+            for id, surbs in cPickle.load(open(fn, 'rb')).items():
+                self.addSURBs(id, surbs)
+            os.rename(fn, fn+'.imported')
+
+    def isSeen(self, msgHash):
+        return self.seen.has_key(msgHash)
+
+    def markSeen(self, hashes):
+        for h in hashes:
+            self.seen[h] = '1'
+        self.seen.sync()
+
+    def hasSURBs(self, id):
+        return self.surbs.has_key(id)
+
+    def addSURBs(self, id, surbs):
+        """Store the armored reply blocks in the list 'surbs' for 'id',
+           replacing any we already had.  (The IMAP proxy finds the same
+           reply blocks every time it reads a message.)"""
+        self.surbs[id] = '\0'.join(surbs)
+        self.surbs.sync()
+
+    def peekSURB(self, id):
+        """Return the first unused reply block for 'id', or None."""
+        val = self.surbs.get(id, '')
+        if not val:
+            return None
+        return val.split('\0', 1)[0]
+
+    def useSURB(self, id):
+        """Forget the first reply block for 'id', once we've used it."""
+        if not self.surbs.has_key(id):
+            return
+        rest = self.surbs[id].split('\0', 1)[1:]
+        if rest:
+            self.surbs[id] = rest[0]
+        else:
+            del self.surbs[id]
+        self.surbs.sync()
+
+    def close(self):
+        self.seen.close()
+        self.surbs.close()
+
 # Old debugging information
 if __name__ == '__main__':
     import getpass
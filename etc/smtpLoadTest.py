@@ -0,0 +1,198 @@
+#! /usr/bin/env python
+# Copyright (c) 2003-2004 George Danezis; see LICENSE for copying info.
+
+"""Load test for the SMTP mixminion proxy
+
+Syntax: smtpLoadTest [-h] [-n messages] [-c clients] [-p port] [--queue]
+-h, --help          - prints this help message
+-n, --messages=N    - number of messages to send (default 200)
+-c, --clients=N     - number of SMTP clients sending at once (default 4)
+-p, --port=N        - local port for the proxy (default 20125)
+--queue             - use a real in-process mixminion backend, queueing
+                      the packets instead of delivering them
+
+Starts a minionSMTP proxy on 127.0.0.1, and feeds it messages with
+smtplib: some to ordinary addresses, some with a return address (so
+that the proxy attaches a reply block), and some to nym.taz addresses
+whose reply blocks we put in the store first.
+
+By default the proxy talks to a dummy backend that only counts what it
+is asked to do, so the test measures the proxy itself. With --queue,
+it uses mmUtils.InProcessBackend with your usual mixminion
+configuration: you'll be asked for your keyring password, and the
+packets end up in your client queue (use 'mixminion clean-queue' to
+get rid of them).
+"""
+
+import sys
+import os
+import time
+import getopt
+import getpass
+import asyncore
+import threading
+import smtplib
+import tempfile
+
+import mmUtils
+from minionSMTP import minionSMTP
+
+class DummyBackend:
+    """A backend that does no mixminion work, but counts the calls it
+       gets. Reply blocks it makes are fake."""
+    def __init__(self):
+        self.counts = { 'surb' : 0, 'send' : 0, 'reply' : 0 }
+        self.__lock = threading.Lock()
+
+    def __count(self, what):
+        self.__lock.acquire()
+        self.counts[what] += 1
+        self.__lock.release()
+
+    def generateSURB(self, address, identity=''):
+        self.__count('surb')
+        return ('-----BEGIN TYPE III REPLY BLOCK-----\n'
+                'AAAA\n'
+                '-----END TYPE III REPLY BLOCK-----\n')
+
+    def decode(self, text):
+        return text
+
+    def send(self, message, address, subject='', nickname=''):
+        self.__count('send')
+        return 1
+
+    def reply(self, message, surb, subject='', nickname=''):
+        self.__count('reply')
+        return 1
+
+class NullFile:
+    def write(self, s):
+        pass
+    def flush(self):
+        pass
+
+def makeMessage(i):
+    """Return (from, to, text) for the i'th test message."""
+    kind = i % 4
+    frm = 'Load Tester <tester@example.com>'
+    if kind == 0:
+        to = 'bob%s@example.com' % i
+    elif kind == 1:
+        # A return address: the proxy attaches a reply block.
+        frm = 'Load Tester <mixminion:tester%s@example.com>' % i
+        to = 'carol%s@example.com' % i
+    elif kind == 2:
+        to = 'nym%s@nym.taz' % (i % 50)
+    else:
+        # Two recipients in one message.
+        to = 'dave%s@example.com, eve%s@example.com' % (i, i)
+    text = ('From: %s\r\nTo: %s\r\nSubject: load test %s\r\n\r\n'
+            'This is test message %s.\r\n' % (frm, to, i, i)) + \
+           ('Some filler text for the body.\r\n' * 20)
+    return frm, to.split(', '), text
+
+def runClient(port, indices, latencies, errors):
+    """Send the messages in 'indices' over a single SMTP connection."""
+    try:
+        s = smtplib.SMTP('127.0.0.1', port)
+    except Exception, e:
+        errors.append(str(e))
+        return
+    for i in indices:
+        frm, to, text = makeMessage(i)
+        start = time.time()
+        try:
+            s.sendmail(frm, to, text)
+        except smtplib.SMTPException, e:
+            errors.append(str(e))
+            continue
+        latencies.append(time.time() - start)
+    s.quit()
+
+def usage():
+    print __doc__
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:c:p:',
+                     ['help', 'messages=', 'clients=', 'port=', 'queue'])
+    except getopt.error, e:
+        print e
+        usage()
+        sys.exit(1)
+
+    nMessages = 200
+    nClients = 4
+    port = 20125
+    queue = 0
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif o in ('-n', '--messages'):
+            nMessages = int(a)
+        elif o in ('-c', '--clients'):
+            nClients = int(a)
+        elif o in ('-p', '--port'):
+            port = int(a)
+        elif o == '--queue':
+            queue = 1
+
+    if queue:
+        backend = mmUtils.InProcessBackend(
+            getpass.getpass('Mixminion password:'), queueOnly=1)
+    else:
+        backend = DummyBackend()
+
+    # Keep the store out of the current directory, and give it a few
+    # reply blocks for each nym.taz address we use.
+    storeDir = tempfile.mkdtemp()
+    store = mmUtils.GatewayStore(storeDir)
+    for n in range(50):
+        store.addSURBs('nym%s' % n, [ backend.generateSURB('nym%s' % n) ]
+                       * (nMessages // 50 + 1))
+
+    proxy = minionSMTP(('127.0.0.1', port), None, backend, store)
+    t = threading.Thread(target=asyncore.loop, args=(0.1,))
+    t.setDaemon(1)
+    t.start()
+
+    # The proxy reports on every message; keep it quiet while we time.
+    stdout = sys.stdout
+    sys.stdout = NullFile()
+    latencies = []
+    errors = []
+    threads = []
+    start = time.time()
+    try:
+        for c in range(nClients):
+            ct = threading.Thread(target=runClient,
+                     args=(port, range(c, nMessages, nClients),
+                           latencies, errors))
+            ct.start()
+            threads.append(ct)
+        for ct in threads:
+            ct.join()
+    finally:
+        sys.stdout = stdout
+    elapsed = time.time() - start
+
+    proxy.close()
+    store.close()
+    for fn in os.listdir(storeDir):
+        os.unlink(os.path.join(storeDir, fn))
+    os.rmdir(storeDir)
+
+    print "Sent %s messages over %s connections in %.2f sec" % (
+        len(latencies), nClients, elapsed)
+    if elapsed > 0:
+        print "  %.1f messages/sec" % (len(latencies) / elapsed)
+    if latencies:
+        latencies.sort()
+        print "  latency: median %.1f msec, max %.1f msec" % (
+            1000 * latencies[len(latencies)//2], 1000 * latencies[-1])
+    if errors:
+        print "  %s errors; first was: %s" % (len(errors), errors[0])
+    if hasattr(backend, 'counts'):
+        print "  backend calls: %s" % backend.counts
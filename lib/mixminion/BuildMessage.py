@@ -8,6 +8,7 @@
 
 import operator
 import sys
+import threading
 import types
 
 import mixminion.Crypto as Crypto
@@ -23,7 +24,8 @@ if sys.version_info[:3] < (2,2,0):
 
 __all__ = ['buildForwardPacket', 'buildEncryptedForwardPacket',
            'buildReplyPacket', 'buildReplyBlock', 'checkPathLength',
-           'encodeMessage', 'decodePayload', 'getNPacketsToEncode' ]
+           'encodeMessage', 'decodePayload', 'getNPacketsToEncode',
+           'PayloadDecoder' ]
 
 def getNPacketsToEncode(message, overhead, uncompressedFragmentPrefix=""):
     """Return the number of packets that would be needed to encode 'message'.
@@ -376,33 +378,110 @@ def decodePayload(payload, tag, key=None, userKeys=(), retNym=None):
        If we can successfully decrypt the payload, we return it.  If we
        might be able to decrypt the payload given more/different keys,
        we return None.  If the payload is corrupt, we raise MixError.
-    """
-    if userKeys is None:
-        userKeys = []
-    elif type(userKeys) is types.StringType:
-        userKeys = [ ("", userKeys) ]
-    elif type(userKeys) is types.DictType:
-        userKeys = userKeys.items()
-
-    if len(payload) != PAYLOAD_LEN:
-        raise MixError("Wrong payload length")
 
-    if len(tag) not in (0, TAG_LEN):
-        raise MixError("Wrong tag length: %s"%len(tag))
+       To decode many payloads with the same keys, use a PayloadDecoder.
+    """
+    return PayloadDecoder(key, userKeys).decode(payload, tag, retNym)
+
+class PayloadDecoder:
+    """A PayloadDecoder decodes payloads for a recipient with a given RSA
+       key and set of SURB identities.  It's meant for recipients (like
+       nym servers) that have many identities and receive many messages:
+       we do the per-identity work once, rather than once per message, and
+       decodeAll() can spread a batch of payloads over several threads.
+
+       Most of the work in decoding is in LIONESS and RSA, which don't
+       hold the interpreter lock, so threads really do run in parallel.
+       (We never let two threads use our RSA key at once, though: we don't
+       set OpenSSL up for threads, and its RSA blinding isn't safe to share
+       without that.)
+    """
+    ## Fields:
+    # key: an RSA key for encrypted forward messages, or None.
+    # userKeys: a list of (name, userKey, userKey+"Validate") tuples, in
+    #    the order they were given.  If two identities share a key, only
+    #    the first is listed: the second could never decode anything the
+    #    first couldn't.
+    # nThreads: how many threads decodeAll uses.
+    # _candidates: a map from tag to the list of entries in userKeys whose
+    #    validation hash matches it.  Cleared when it gets too big.
+    # _lock: a lock to protect _candidates.
+    # _rsaLock: a lock held while we use 'key'.
+    MAX_CACHED_TAGS = 4096
+    def __init__(self, key=None, userKeys=(), nThreads=1):
+        """Create a new PayloadDecoder.  'key' and 'userKeys' are as for
+           decodePayload; 'nThreads' is the number of threads decodeAll
+           uses."""
+        if userKeys is None:
+            userKeys = []
+        elif type(userKeys) is types.StringType:
+            userKeys = [ ("", userKeys) ]
+        elif type(userKeys) is types.DictType:
+            userKeys = userKeys.items()
+        self.key = key
+        self.userKeys = []
+        seen = {}
+        for name, userKey in userKeys:
+            if seen.has_key(userKey):
+                continue
+            seen[userKey] = 1
+            self.userKeys.append((name, userKey, userKey+"Validate"))
+        self.nThreads = max(1, nThreads)
+        self._candidates = {}
+        self._lock = threading.Lock()
+        self._rsaLock = threading.Lock()
+
+    def getCandidates(self, tag):
+        """Return a list of the (name, userKey, userKey+"Validate") entries
+           whose keys could have generated a reply block with tag 'tag'."""
+        self._lock.acquire()
+        try:
+            try:
+                return self._candidates[tag]
+            except KeyError:
+                pass
+        finally:
+            self._lock.release()
+
+        # If H(tag|userKey|"Validate") ends with 0, then the message _might_
+        # be a reply message using H(tag|userKey|"Generate") as the seed for
+        # its master secrets.  (There's a 1-in-256 chance that it isn't.)
+        # Reply tags always have their high bit clear (see _getRandomTag),
+        # so if it's set, no key can match.
+        if ord(tag[0]) & 0x80:
+            result = []
+        else:
+            sha1 = Crypto.sha1
+            result = [ ent for ent in self.userKeys
+                       if sha1(tag+ent[2])[-1] == '\x00' ]
 
-    # If the payload already contains a valid checksum, it's a forward
-    # message.
-    if _checkPayload(payload):
-        return parsePayload(payload)
+        self._lock.acquire()
+        try:
+            if len(self._candidates) >= self.MAX_CACHED_TAGS:
+                self._candidates.clear()
+            self._candidates[tag] = result
+        finally:
+            self._lock.release()
+        return result
+
+    def decode(self, payload, tag, retNym=None):
+        """Decode a single payload; arguments and return values are as for
+           decodePayload."""
+        if len(payload) != PAYLOAD_LEN:
+            raise MixError("Wrong payload length")
+
+        if len(tag) not in (0, TAG_LEN):
+            raise MixError("Wrong tag length: %s"%len(tag))
+
+        # If the payload already contains a valid checksum, it's a forward
+        # message.
+        if _checkPayload(payload):
+            return parsePayload(payload)
 
-    if not tag:
-        return None
+        if not tag:
+            return None
 
-    # If H(tag|userKey|"Validate") ends with 0, then the message _might_
-    # be a reply message using H(tag|userKey|"Generate") as the seed for
-    # its master secrets.  (There's a 1-in-256 chance that it isn't.)
-    for name,userKey in userKeys:
-        if Crypto.sha1(tag+userKey+"Validate")[-1] == '\x00':
+        for name, userKey, _ in self.getCandidates(tag):
             try:
                 p = _decodeStatelessReplyPayload(payload, tag, userKey)
                 if name:
@@ -413,15 +492,68 @@ def decodePayload(payload, tag, key=None, userKeys=(), retNym=None):
             except MixError:
                 pass
 
-    # If we have an RSA key, and none of the above steps get us a good
-    # payload, then we may as well try to decrypt the start of tag+key with
-    # our RSA key.
-    if key is not None:
-        p = _decodeEncryptedForwardPayload(payload, tag, key)
-        if p is not None:
-            return p
+        # If we have an RSA key, and none of the above steps get us a good
+        # payload, then we may as well try to decrypt the start of tag+key
+        # with our RSA key.
+        if self.key is not None:
+            p = _decodeEncryptedForwardPayload(payload, tag, self.key,
+                                               self._rsaLock)
+            if p is not None:
+                return p
+
+        return None
+
+    def decodeAll(self, packets):
+        """Given a list of (payload, tag) tuples, decode them all, using up
+           to self.nThreads threads.  Returns a list with one
+           (decoded, nym, error) tuple for each packet, in the same order:
+           'decoded' is the payload as returned by decodePayload; 'nym' is
+           a list holding the identity the payload was a reply to, if it
+           was one (as for decodePayload's 'retNym'); and 'error' is None,
+           or a string describing why the payload was corrupt.
+        """
+        results = [ None ] * len(packets)
+        nextIdx = [ 0 ]
+        failure = []
+        lock = threading.Lock()
+
+        def worker(self=self, packets=packets, results=results,
+                   nextIdx=nextIdx, failure=failure, lock=lock):
+            while 1:
+                lock.acquire()
+                try:
+                    idx = nextIdx[0]
+                    if idx >= len(packets) or failure:
+                        return
+                    nextIdx[0] = idx + 1
+                finally:
+                    lock.release()
+                payload, tag = packets[idx]
+                nym = []
+                try:
+                    p = self.decode(payload, tag, nym)
+                except MixError, e:
+                    results[idx] = (None, [], str(e))
+                except:
+                    failure.append(sys.exc_info())
+                    return
+                else:
+                    results[idx] = (p, nym, None)
+
+        nThreads = min(self.nThreads, len(packets))
+        if nThreads <= 1:
+            worker()
+        else:
+            threads = [ threading.Thread(target=worker)
+                        for _ in xrange(nThreads) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
 
-    return None
+        if failure:
+            raise failure[0][0], failure[0][1], failure[0][2]
+        return results
 
 def _decodeForwardPayload(payload):
     """Helper function: decode a non-encrypted forward payload. Return values
@@ -431,12 +563,13 @@ def _decodeForwardPayload(payload):
 
     return parsePayload(payload)
 
-def _decodeEncryptedForwardPayload(payload, tag, key):
+def _decodeEncryptedForwardPayload(payload, tag, key, rsaLock=None):
     """Helper function: decode an encrypted forward payload.  Return values
        are the same as decodePayload.
              payload: the payload to decode
              tag: the decoding tag
-             key: the RSA key of the payload's recipient."""
+             key: the RSA key of the payload's recipient.
+             rsaLock: if provided, a lock to hold while using 'key'."""
     assert len(tag) == TAG_LEN
     assert len(payload) == PAYLOAD_LEN
 
@@ -444,10 +577,16 @@ def _decodeEncryptedForwardPayload(payload, tag, key):
     # encrypted with RSA, and the rest with a lioness key given in the
     # first N.  Try decrypting...
     msg = tag+payload
+    if rsaLock is not None:
+        rsaLock.acquire()
     try:
-        rsaPart = Crypto.pk_decrypt(msg[:key.get_modulus_bytes()], key)
-    except Crypto.CryptoError:
-        return None
+        try:
+            rsaPart = Crypto.pk_decrypt(msg[:key.get_modulus_bytes()], key)
+        except Crypto.CryptoError:
+            return None
+    finally:
+        if rsaLock is not None:
+            rsaLock.release()
     rest = msg[key.get_modulus_bytes():]
 
     k = Crypto.Keyset(rsaPart[:SECRET_LEN]).getLionessKeys(
@@ -0,0 +1,554 @@
+# Copyright 2002-2004 Nick Mathewson.  See LICENSE for licensing information.
+# $Id$
+"""mixminion.ClientAgent
+
+   A long-running client process ('mixminion agent') that keeps a warm
+   client environment -- configuration, server directory, keyring,
+   queue, and PRNG -- and runs client commands on behalf of thin clients
+   that connect to it over a Unix socket.
+
+   When the MIXMINION_AGENT environment variable names the agent's
+   socket, 'mixminion send', 'queue', 'flush', 'decode', and
+   'generate-surb' forward themselves to the agent instead of starting
+   from scratch.
+
+   NOTE: This module is imported by the thin client before any other
+   mixminion modules, so it must not import them at module level.
+   """
+
+__all__ = [ 'AGENT_COMMANDS', 'ClientAgent', 'forwardCommand', 'runAgent' ]
+
+import errno
+import getopt
+import os
+import socket
+import struct
+import sys
+from StringIO import StringIO
+
+# Commands that the agent will run on behalf of a thin client.
+AGENT_COMMANDS = { 'send' : 1, 'queue' : 1, 'flush' : 1, 'decode' : 1,
+                   'generate-surb' : 1, 'generate-surbs' : 1 }
+
+# Version string sent at the start of each request.
+PROTOCOL_VERSION = "MIXAGENT-0.1"
+
+# Largest request or response we will accept.
+MAX_MESSAGE_LEN = 64*1024*1024
+
+# How long do we wait on a slow thin client before giving up on it?
+CLIENT_TIMEOUT = 60
+
+#----------------------------------------------------------------------
+# Wire format: each message is a 4-byte count of fields, followed by each
+# field as a 4-byte length and the field's bytes.
+#
+# The thin client sends a request: PROTOCOL_VERSION, then "stop", or
+# "run" followed by its working directory, its MIXMINIONRC (or ""), the
+# command string for usage messages, and the command's argv[1:].  While
+# running a command, the agent may send "stdin"; the thin client answers
+# with the whole of its standard input.  Finally, the agent answers with
+# "done", the exit status, the standard output, and the standard error.
+
+def _sendMessage(sock, fields):
+    """Write the list of strings 'fields' to 'sock'."""
+    out = [ struct.pack("!L", len(fields)) ]
+    for f in fields:
+        out.append(struct.pack("!L", len(f)))
+        out.append(f)
+    sock.sendall("".join(out))
+
+def _recvExactly(sock, n):
+    """Read exactly 'n' bytes from 'sock', or raise socket.error."""
+    chunks = []
+    while n:
+        s = sock.recv(min(n, 65536))
+        if not s:
+            raise socket.error(errno.EPIPE, "Connection closed")
+        chunks.append(s)
+        n -= len(s)
+    return "".join(chunks)
+
+def _recvMessage(sock):
+    """Read a list of strings, as written by _sendMessage, from 'sock'."""
+    nFields, = struct.unpack("!L", _recvExactly(sock, 4))
+    fields = []
+    total = 0
+    for _ in xrange(nFields):
+        n, = struct.unpack("!L", _recvExactly(sock, 4))
+        total += n
+        if total > MAX_MESSAGE_LEN:
+            raise socket.error(errno.EMSGSIZE, "Message too long")
+        fields.append(_recvExactly(sock, n))
+    return fields
+
+def _connect(sockName):
+    """Return a socket connected to the agent at 'sockName', or None if no
+       agent is listening there."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(sockName)
+    except socket.error, e:
+        s.close()
+        if e[0] in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+    return s
+
+#----------------------------------------------------------------------
+# Thin client
+
+def forwardCommand(sockName, args, stdin=None):
+    """Ask the agent listening on 'sockName' to run the command given in
+       'args' (as for Main.main), passing our standard input along if the
+       command wants it, and copying the command's output to our standard
+       output and error.  Return the command's exit status, or None if
+       there is no agent to talk to.
+
+       If 'stdin' is provided, it is used instead of our standard input.
+    """
+    s = _connect(sockName)
+    if s is None:
+        sys.stderr.write("No mixminion agent is listening on %s; "
+                         "running command directly.\n" % sockName)
+        return None
+    try:
+        commandStr = "%s %s" % (os.path.split(args[0])[1], args[1])
+        _sendMessage(s, [PROTOCOL_VERSION, "run", os.getcwd(),
+                         os.environ.get("MIXMINIONRC", ""), commandStr,
+                         args[1]] + list(args[2:]))
+        while 1:
+            msg = _recvMessage(s)
+            if msg and msg[0] == "stdin":
+                if stdin is None:
+                    stdin = sys.stdin.read()
+                _sendMessage(s, [stdin])
+            elif len(msg) == 4 and msg[0] == "done":
+                status, out, err = msg[1:]
+                break
+            else:
+                raise socket.error(errno.EPROTO, "Bad message from agent")
+    finally:
+        s.close()
+    sys.stdout.write(out)
+    sys.stdout.flush()
+    sys.stderr.write(err)
+    return int(status)
+
+def stopAgent(sockName):
+    """Tell the agent listening on 'sockName' to shut down.  Return true
+       if there was an agent to stop."""
+    s = _connect(sockName)
+    if s is None:
+        return 0
+    try:
+        _sendMessage(s, [PROTOCOL_VERSION, "stop"])
+        _recvMessage(s)
+    finally:
+        s.close()
+    return 1
+
+#----------------------------------------------------------------------
+# Agent
+
+class _AgentFile(StringIO):
+    """A StringIO that stands in for stdin, stdout, or stderr while the
+       agent runs a command.  Commands call os.isatty(f.fileno()), so we
+       give them an fd that is certainly not a terminal.  Commands may
+       also close their output when they're done, so we ignore close()."""
+    def __init__(self, fd, contents=""):
+        StringIO.__init__(self, contents)
+        self.fd = fd
+    def close(self):
+        pass
+    def fileno(self):
+        return self.fd
+    def isatty(self):
+        return 0
+
+class _AgentInput(_AgentFile):
+    """Stands in for stdin while the agent runs a command: fetches the
+       thin client's standard input the first time the command reads it."""
+    ## Fields:
+    # sock: the socket connected to the thin client, or None once we have
+    #    fetched its input.
+    def __init__(self, fd, sock):
+        _AgentFile.__init__(self, fd)
+        self.sock = sock
+    def read(self, n=-1):
+        if self.sock is not None:
+            # The user may take a while to type a message.
+            self.sock.settimeout(None)
+            _sendMessage(self.sock, ["stdin"])
+            data = _recvMessage(self.sock)
+            self.sock.settimeout(CLIENT_TIMEOUT)
+            self.sock = None
+            self.write("".join(data))
+            self.seek(0)
+        return _AgentFile.read(self, n)
+
+def _getMtime(fname):
+    """Return the modification time of 'fname', or None if it is absent."""
+    try:
+        return os.stat(fname).st_mtime
+    except OSError:
+        return None
+
+class AgentEnv:
+    """The warm client state for a single configuration file."""
+    ## Fields:
+    # config: the ClientConfig for this environment.
+    # configMtime: the modification time of config.fname when we read it.
+    # pwdManager: the AgentPasswordManager used by our keyring.  It is
+    #    shared among all environments, so that the passphrase entered
+    #    when the agent started outlives reloading the configuration.
+    # client: a MixminionClient, or None if we haven't needed one yet.
+    # directory: a ClientDirectory, or None if we haven't needed one yet.
+    # cacheMtime: the modification time of the directory cache when we
+    #    last loaded it or finished a command that might have changed it.
+    def __init__(self, configFile, pwdManager):
+        """Load the configuration in 'configFile' (as given with -f on the
+           command line)."""
+        import mixminion.ClientMain
+        self.config = mixminion.ClientMain.readConfigFile(configFile)
+        self.configMtime = _getMtime(self.config.fname)
+        self.pwdManager = pwdManager
+        self.client = None
+        self.directory = None
+        self.cacheMtime = None
+
+    def isStale(self):
+        """Return true iff our configuration file has changed."""
+        return _getMtime(self.config.fname) != self.configMtime
+
+    def getClient(self):
+        """Return this environment's MixminionClient."""
+        if self.client is None:
+            import mixminion.ClientMain
+            client = mixminion.ClientMain.MixminionClient(self.config)
+            client.pwdManager = self.pwdManager
+            client.keys.keyring.pwdManager = self.pwdManager
+            self.client = client
+        return self.client
+
+    def getDirectory(self):
+        """Return this environment's ClientDirectory, reloading it if some
+           other process has changed the cache on disk."""
+        import mixminion.ClientDirectory
+        import mixminion.ClientMain
+        if (self.directory is not None and
+            _getMtime(self.directory.store.cacheFile) != self.cacheMtime):
+            self.directory = None
+        if self.directory is None:
+            self.directory = mixminion.ClientDirectory.ClientDirectory(
+                config=self.config,
+                diskLock=mixminion.ClientMain.ClientDiskLock())
+            self.cacheMtime = _getMtime(self.directory.store.cacheFile)
+        return self.directory
+
+    def unlockKeyring(self, password=None):
+        """If we have a keyring, load it now, asking for its passphrase as
+           needed."""
+        client = self.getClient()
+        if os.path.exists(client.keys.keyring.fname):
+            client.keys.getSURBKeys(password=password)
+
+    def commandDone(self):
+        """Called after each command: remember the state of the directory
+           cache, so that changes we made ourselves don't look foreign."""
+        if self.directory is not None:
+            self.cacheMtime = _getMtime(self.directory.store.cacheFile)
+
+class ClientAgent:
+    """A ClientAgent listens on a Unix socket, and runs client commands
+       there for thin clients, one at a time, reusing the same AgentEnv
+       for all commands that use the same configuration file."""
+    ## Fields:
+    # sockName: the filename of our socket.
+    # listener: a listening socket, or None.
+    # envs: map from absolute configuration filename (or None for the
+    #    agent's default configuration) to AgentEnv.
+    # requestConfigFile: the thin client's MIXMINIONRC for the command
+    #    we're running, or None.
+    # commands: map from command name to the function that implements it.
+    # pwdManager: an AgentPasswordManager shared by all our AgentEnvs.
+    # nullFD: an open fd for /dev/null, used by _AgentFile.
+    # running: false once we've been told to stop.
+    def __init__(self, sockName):
+        import mixminion.ClientUtils
+        import mixminion.Main
+        self.sockName = sockName
+        self.listener = None
+        self.envs = {}
+        self.requestConfigFile = None
+        self.commands = {}
+        for name in AGENT_COMMANDS.keys():
+            modName, fnName = mixminion.Main._COMMANDS[name]
+            mod = __import__(modName, {}, {}, [fnName])
+            self.commands[name] = getattr(mod, fnName)
+        self.pwdManager = mixminion.ClientUtils.AgentPasswordManager(
+            mixminion.ClientUtils.CLIPasswordManager())
+        self.nullFD = os.open("/dev/null", os.O_RDWR)
+        self.running = 1
+
+    def listen(self):
+        """Start listening on our socket, replacing any stale socket left
+           behind by a dead agent."""
+        from mixminion.Common import UIError, createPrivateDir
+        createPrivateDir(os.path.split(self.sockName)[0])
+        if os.path.exists(self.sockName):
+            s = _connect(self.sockName)
+            if s is not None:
+                s.close()
+                raise UIError("An agent is already listening on %s" %
+                              self.sockName)
+            os.unlink(self.sockName)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        oldMask = os.umask(077)
+        try:
+            self.listener.bind(self.sockName)
+        finally:
+            os.umask(oldMask)
+        os.chmod(self.sockName, 0600)
+        self.listener.listen(16)
+
+    def getEnv(self, configFile):
+        """Return the AgentEnv for 'configFile' (as given with -f on the
+           command line), creating it as needed."""
+        if configFile is None:
+            configFile = self.requestConfigFile
+        if configFile is not None:
+            configFile = os.path.abspath(os.path.expanduser(configFile))
+        env = self.envs.get(configFile)
+        if env is None or env.isStale():
+            env = self.envs[configFile] = AgentEnv(configFile,
+                                                   self.pwdManager)
+        return env
+
+    def run(self):
+        """Answer requests until we are told to stop."""
+        from mixminion.Common import LOG
+        while self.running:
+            try:
+                s, _ = self.listener.accept()
+            except socket.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            try:
+                try:
+                    s.settimeout(CLIENT_TIMEOUT)
+                    self.handle(s)
+                except socket.error, e:
+                    LOG.warn("Error talking to agent client: %s", e)
+            finally:
+                s.close()
+
+    def handle(self, s):
+        """Read a single request from the socket 's', and answer it."""
+        req = _recvMessage(s)
+        if len(req) < 2 or req[0] != PROTOCOL_VERSION:
+            _sendMessage(s, ["done", "1", "", "Unsupported agent protocol\n"])
+        elif req[1] == "stop":
+            self.running = 0
+            _sendMessage(s, ["done", "0", "", ""])
+        elif req[1] == "run" and len(req) >= 6:
+            cwd, rcFile, commandStr, cmdName = req[2:6]
+            status, out, err = self.runCommand(cwd, commandStr, cmdName,
+                                               req[6:],
+                                               _AgentInput(self.nullFD, s),
+                                               rcFile or None)
+            _sendMessage(s, ["done", str(status), out, err])
+        else:
+            _sendMessage(s, ["done", "1", "", "Unrecognized agent request\n"])
+
+    def runCommand(self, cwd, commandStr, cmdName, args, stdin="",
+                   rcFile=None):
+        """Run the command 'cmdName' with arguments 'args' in directory
+           'cwd', as though it had been invoked from the command line as
+           'commandStr' with MIXMINIONRC set to 'rcFile'.  'stdin' is a
+           string or an _AgentInput to use as standard input.  Return a
+           tuple of exit status, standard output, and standard error.
+        """
+        import mixminion.ClientMain
+        from mixminion.Common import LOG, UIError
+
+        func = self.commands.get(cmdName)
+        if func is None:
+            return 1, "", "The agent can't run %r\n" % cmdName
+
+        out = _AgentFile(self.nullFD)
+        err = _AgentFile(self.nullFD)
+        saved = sys.stdin, sys.stdout, sys.stderr
+        savedLog = LOG.handlers, LOG.severity
+        oldCwd = os.getcwd()
+        status = 0
+        if type(stdin) == type(""):
+            stdin = _AgentFile(self.nullFD, stdin)
+        sys.stdin = stdin
+        sys.stdout, sys.stderr = out, err
+        LOG.configure(None)
+        mixminion.ClientMain._AGENT = self
+        self.requestConfigFile = rcFile
+        try:
+            try:
+                os.chdir(cwd)
+                func(commandStr, args)
+            except SystemExit, e:
+                if e.code is None:
+                    status = 0
+                elif type(e.code) == type(0):
+                    status = e.code
+                else:
+                    print >>err, e.code
+                    status = 1
+            except getopt.GetoptError, e:
+                print >>err, str(e)
+                status = 1
+            except UIError, e:
+                e.dump()
+                status = 1
+            except (OSError, IOError), e:
+                print >>err, str(e)
+                status = 1
+            except:
+                LOG.error_exc(sys.exc_info(), "Error while running %s",
+                              commandStr)
+                status = 1
+        finally:
+            mixminion.ClientMain._AGENT = None
+            self.requestConfigFile = None
+            sys.stdin, sys.stdout, sys.stderr = saved
+            LOG.handlers, LOG.severity = savedLog
+            os.chdir(oldCwd)
+            for env in self.envs.values():
+                env.commandDone()
+
+        return status, out.getvalue(), err.getvalue()
+
+    def close(self):
+        """Stop listening, and save any pending directory changes."""
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            try:
+                os.unlink(self.sockName)
+            except OSError:
+                pass
+        for env in self.envs.values():
+            if env.directory is not None:
+                env.directory.flush()
+        os.close(self.nullFD)
+
+def _daemonize():
+    """Detach from the terminal and run in the background."""
+    if os.fork() != 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() != 0:
+        os._exit(0)
+    os.chdir("/")
+    nullfd = os.open("/dev/null", os.O_RDWR|os.O_APPEND)
+    for f in sys.stdin, sys.stdout, sys.stderr:
+        os.dup2(nullfd, f.fileno())
+    os.close(nullfd)
+
+_AGENT_USAGE = """\
+Usage: %(cmd)s [options]
+Options:
+  -h, --help                 Print this usage message and exit.
+  -v, --verbose              Display extra debugging messages.
+  -f <file>, --config=<file> Use a configuration file other than ~/.mixminionrc
+                               (You can also use MIXMINIONRC=FILE)
+  --socket=<file>            Listen on <file>.  (Defaults to $MIXMINION_AGENT,
+                               or to 'agent' in your user directory.)
+  --passphrase-fd=<N>        Read the keyring passphrase from file descriptor N.
+  --no-daemon                Stay in the foreground.
+  --stop                     Stop a running agent.
+
+Once the agent is running, set MIXMINION_AGENT to the name of its socket,
+and the send, queue, flush, decode, and generate-surb commands will run
+inside the agent.
+
+EXAMPLES:
+  Start an agent.
+      %(cmd)s
+  Stop it again.
+      %(cmd)s --stop
+""".strip()
+
+def runAgent(cmd, args):
+    """[Entry point] Start or stop a client agent."""
+    import signal
+    import mixminion.ClientMain
+    import mixminion.ClientUtils
+    from mixminion.Common import LOG, UIError, UsageError
+
+    options, args = mixminion.ClientMain.getOptions(
+        args, "", ["socket=", "no-daemon", "stop"], passphrase=1)
+    sockName = os.environ.get("MIXMINION_AGENT")
+    daemon = 1
+    stop = 0
+    for o,v in options:
+        if o == '--socket':
+            sockName = v
+        elif o == '--no-daemon':
+            daemon = 0
+        elif o == '--stop':
+            stop = 1
+    try:
+        parser = mixminion.ClientMain.CLIArgumentParser(
+            options, wantConfig=1, wantLog=1,
+            ignoreOptions=['--socket', '--no-daemon', '--stop'])
+    except UsageError, e:
+        e.dump()
+        print _AGENT_USAGE % { 'cmd' : cmd }
+        sys.exit(1)
+
+    if sockName is None:
+        config = mixminion.ClientMain.readConfigFile(parser.configFile)
+        sockName = os.path.join(config['User']['UserDir'], "agent")
+    sockName = os.path.abspath(os.path.expanduser(sockName))
+
+    if stop:
+        if not stopAgent(sockName):
+            raise UIError("No agent is listening on %s" % sockName)
+        print "Agent stopped."
+        return
+
+    if daemon and not hasattr(os, 'fork'):
+        raise UIError("Daemon mode is not supported on this platform.")
+
+    agent = ClientAgent(sockName)
+    # Warm up the client and directory for our default configuration, the
+    # same way a command running inside the agent would.
+    password = None
+    if parser.password_fileno is not None:
+        password = mixminion.ClientUtils.getPassword_fd(parser.password_fileno)
+        parser.password_fileno = None
+    parser.wantClient = parser.wantClientDirectory = 1
+    mixminion.ClientMain._AGENT = agent
+    try:
+        parser.init()
+    finally:
+        mixminion.ClientMain._AGENT = None
+    agent.getEnv(parser.configFile).unlockKeyring(password)
+    agent.pwdManager.detach()
+    agent.listen()
+
+    print "Agent listening on %s" % sockName
+    print "Set MIXMINION_AGENT=%s to use it." % sockName
+    sys.stdout.flush()
+    if daemon:
+        _daemonize()
+
+    def stopHandler(signum, frame, agent=agent):
+        agent.running = 0
+    signal.signal(signal.SIGTERM, stopHandler)
+    signal.signal(signal.SIGINT, stopHandler)
+
+    try:
+        agent.run()
+    finally:
+        agent.close()
+        LOG.info("Agent exiting")
@@ -90,7 +90,7 @@ class _DescriptorSourceSharedState:
         """
         d = s.getDigest()
         if not self.digestMap.has_key(d):
-            self.digestMap[d] = s['Server']['Valid-Until']
+            self.digestMap[d] = s.getValidUntil()
             self._changed = 1
     def __getstate__(self):
         return self.MAGIC, self.digestMap
@@ -164,7 +164,7 @@ class FSBackedDescriptorSource(DescriptorSource):
     ## Fields:
     # directory: the location for this store on the filesystem
     # servers: A map from filename within the directory to tuples of
-    #     (file mtime, ServerInfo).
+    #     (file mtime, CompactServerInfo).
     MAGIC = "FBBDS-0.1"
     EXPIRY_SLOPPINESS = 7200
     def __init__(self, state):
@@ -220,11 +220,12 @@ class FSBackedDescriptorSource(DescriptorSource):
             try:
                 s = mixminion.ServerInfo.ServerInfo(
                     fname=fullname, assumeValid=0,
-                    validatedDigests=self._s.digestMap)
+                    validatedDigests=self._s.digestMap, _keepContents=1)
             except mixminion.Config.ConfigError, e:
                 LOG.warn("Invalid entry %s in %s: %s",
                          fname, self.directory, e)
                 continue
+            s = mixminion.ServerInfo.CompactServerInfo(s)
             self.servers[fname] = (mtime, s)
             self._s._addDigest(s)
             self._changed = 1
@@ -239,19 +240,20 @@ class FSBackedDescriptorSource(DescriptorSource):
         if now is None:
             now = time.time()
         cutoff = now + self.EXPIRY_SLOPPINESS
-        removed = []
-        byNickname = {}
-        for _,s in self.servers.values():
-            byNickname.setdefault(s.getNickname().lower(),[]).append(s)
+        removed = {}
+        entries = []
         for fname, (_, s) in self.servers.items():
-            expires = s['Server']['Valid-Until']
+            expires = s.getValidUntil()
             if expires > cutoff:
                 LOG.debug("Removing expired server %s",fname)
-                removed.append(fname)
-            elif s.isSupersededBy(byNickname[s.getNickname().lower()]):
+                removed[fname] = 1
+            entries.append((s.getNickname().lower(), s.getPublished(),
+                            s.getValidAfter(), expires, fname))
+        for fname in mixminion.ServerInfo.findSuperseded(entries):
+            if not removed.has_key(fname):
                 LOG.debug("Removing superseded server %s",fname)
-                removed.append(fname)
-        for fname in removed:
+                removed[fname] = 1
+        for fname in removed.keys():
             del self.servers[fname]
             self._changed = 1
             self._removeOne(fname)
@@ -273,7 +275,7 @@ class FSBackedDescriptorSource(DescriptorSource):
             raise UIError("Invalid server descriptor: %s"%e)
 
         nameBase = "%s-%s" %(s.getNickname(),
-                             formatFnameTime(s['Server']['Published']))
+                             formatFnameTime(s.getPublished()))
 
         if s.isExpiredAt(time.time()):
             raise UIError("Server descriptor is already expired")
@@ -290,6 +292,7 @@ class FSBackedDescriptorSource(DescriptorSource):
         f.write(contents)
         f.close()
         shortname = os.path.split(fname)[1]
+        s = mixminion.ServerInfo.CompactServerInfo(s, contents)
         self.servers[shortname] = (os.stat(fname)[stat.ST_MTIME], s)
         self._s._addDigest(s)
         self._changed = 1
@@ -522,7 +525,7 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
         try:
             directory = mixminion.ServerInfo.parseDirectory(
                 fname=tmpname,
-                validatedDigests=digestMap)
+                validatedDigests=digestMap, compact=1)
         except mixminion.Config.ConfigError, e:
             raise GotInvalidDirectoryError(
                 "Received an invalid directory: %s"%e)
@@ -1038,9 +1041,17 @@ class ClientDirectory:
                 blocked = self.blockedNicknames.get(nickname.lower(), [])
                 if goodOnly and not isGood:
                     continue
-                va = sd['Server']['Valid-After']
-                vu = sd['Server']['Valid-Until']
+                va = sd.getValidAfter()
+                vu = sd.getValidUntil()
                 d = result.setdefault(nickname, {}).setdefault((va,vu), {})
+                info = sd
+                if isinstance(sd, mixminion.ServerInfo.CompactServerInfo):
+                    # Parse the descriptor at most once, not once per
+                    # feature.
+                    for _, (sec,ent) in resFeatures:
+                        if sec not in ('+','-') and not sd.holdsSection(sec):
+                            info = sd.getServerInfo()
+                            break
                 for feature,(sec,ent) in resFeatures:
                     if sec == '+':
                         if ent == 'status':
@@ -1061,7 +1072,7 @@ class ClientDirectory:
                         else:
                             raise AssertionError # Unreached.
                     else:
-                        d[feature] = str(sd.getFeature(sec,ent))
+                        d[feature] = str(info.getFeature(sec,ent))
 
             return result
         finally:
@@ -1152,14 +1163,16 @@ class ClientDirectory:
            'name' valid over a given time range.  If not strict, and no
            such server is found, return None.
 
-           name -- A ServerInfo object, a nickname, or a filename.
+           name -- A ServerInfo or CompactServerInfo object, a nickname, or
+              a filename.
         """
         if startAt is None:
             startAt = time.time()
         if endAt is None:
             endAt = startAt + DEFAULT_REQUIRED_LIFETIME
 
-        if isinstance(name, mixminion.ServerInfo.ServerInfo):
+        if (isinstance(name, mixminion.ServerInfo.ServerInfo) or
+            isinstance(name, mixminion.ServerInfo.CompactServerInfo)):
             # If it's a valid ServerInfo, we're done.
             if name.isValidFrom(startAt, endAt):
                 return name
@@ -1765,7 +1778,7 @@ class ExitAddress:
         if self.headers:
             #XXXX007 remove this eventually, once all servers have upgraded
             #XXXX007 to 0.0.6 or later.
-            sware = desc['Server'].get("Software","")
+            sware = desc.getSoftware()
             if (sware.startswith("Mixminion 0.0.4") or
                 sware.startswith("Mixminion 0.0.5alpha1")):
                 raise UIError("Server %s is running old software that doesn't support exit headers."% nickname)
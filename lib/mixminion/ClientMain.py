@@ -14,13 +14,13 @@ import sys
 import time
 from types import IntType, StringType
 
-import mixminion.BuildMessage
+# NOTE: Most commands don't need to build packets, talk to servers, or
+# download directories, and BuildMessage, ClientDirectory, and MMTPClient
+# are slow to load.  We import them only in the functions that use them.
 import mixminion.ClientUtils
-import mixminion.ClientDirectory
 import mixminion.Config
 import mixminion.Crypto
 import mixminion.Filestore
-import mixminion.MMTPClient
 
 from mixminion.Common import LOG, Lockfile, LockfileLocked, MixError, \
      MixFatalError, MixProtocolBadAuth, MixProtocolError, STATUS, UIError, \
@@ -33,7 +33,11 @@ from mixminion.Packet import encodeMailHeaders, ParseError, parseMBOXInfo, \
      parseTextReplyBlocks, ReplyBlock, parseMessageAndHeaders, \
      CompressedDataTooLong
 
-from mixminion.ServerInfo import displayServerByRouting, ServerInfo
+from mixminion.ServerInfo import displayServerByRouting, ServerInfo, \
+     CompactServerInfo
+
+# How many threads do we use to decode encrypted messages?
+DECODING_THREADS = 4
 
 #----------------------------------------------------------------------
 # Global variable; holds an instance of Common.Lockfile used to prevent
@@ -65,6 +69,18 @@ def configureClientLock(filename):
     createPrivateDir(parent)
     _CLIENT_LOCKFILE = Lockfile(filename)
 
+#----------------------------------------------------------------------
+# Global variable; while 'mixminion agent' is running a command, holds the
+# ClientAgent whose warm configuration, client, and directory the command
+# should use instead of loading its own.
+_AGENT = None
+
+def _checkNotAgent(opt):
+    """Raise UIError if we're running in the agent: 'opt' names a file
+       descriptor in the thin client's process, not in ours."""
+    if _AGENT is not None:
+        raise UIError("The %s option can't be used through the agent" % opt)
+
 class ClientDiskLock:
     """A wrapper around clientLock and clientUnlock to present a lock-like
        interface, and default to blocking locks."""
@@ -252,7 +268,8 @@ class MixminionClient:
         """
         d = {}
         for packet, firstHop in packets:
-            if isinstance(firstHop, ServerInfo):
+            if (isinstance(firstHop, ServerInfo) or
+                isinstance(firstHop, CompactServerInfo)):
                 ri = firstHop.getRoutingInfo()
             else:
                 assert (isinstance(firstHop, mixminion.Packet.MMTPHostInfo) or
@@ -338,6 +355,7 @@ class MixminionClient:
             expiryTime -- if provided, a time at which the replyBlock must
                still be valid, and after which it should not be used.
         """
+        import mixminion.BuildMessage
         #XXXX write unit tests
         key = self.keys.getSURBKey(name=name, create=1)
         if not key:
@@ -367,6 +385,7 @@ class MixminionClient:
             startAt, endAt -- an interval over which all servers in the path
                must be valid.
             """
+        import mixminion.BuildMessage
         #XXXX we need to factor more of this long-message logic out to the
         #XXXX common code.  For now, this is a temporary measure.
 
@@ -418,6 +437,7 @@ class MixminionClient:
             startAt, endAt -- an interval over which all servers in the path
                must be valid.
             """
+        import mixminion.BuildMessage
         #XXXX write unit tests
         assert address.isReply
 
@@ -457,6 +477,7 @@ class MixminionClient:
     def pingServer(self, routingInfo):
         """Given an IPV4Info, try to connect to a server and find out if
            it's up.  Returns a boolean and a status message."""
+        import mixminion.MMTPClient
         timeout = self.config.getTimeout()
         try:
             mixminion.MMTPClient.pingServer(routingInfo, timeout)
@@ -482,6 +503,7 @@ class MixminionClient:
 
            XXXX return 1 if all delivered
            """
+        import mixminion.MMTPClient
         #XXXX write unit tests
         timeout = self.config.getTimeout()
 
@@ -665,10 +687,26 @@ class MixminionClient:
            Raise ParseError on malformatted messages.  Unless 'force' is
            true, do not uncompress possible zlib bombs.
         """
+        import mixminion.BuildMessage
         #XXXX write unit tests
         results = []
         foundAFragment = 0
-        for msg in parseTextEncodedMessages(s, force=force):
+        msgs = parseTextEncodedMessages(s, force=force)
+
+        # Decode all the encrypted messages at once: with many SURB
+        # identities and many messages, that's much faster than going one
+        # at a time.
+        encrypted = [ (msg.getContents(), msg.getTag()) for msg in msgs
+                      if msg.isEncrypted() ]
+        decoded = []
+        if encrypted:
+            decoder = mixminion.BuildMessage.PayloadDecoder(
+                userKeys=self.keys.getSURBKeys(),
+                nThreads=DECODING_THREADS)
+            decoded = decoder.decodeAll(encrypted)
+            decoded.reverse()
+
+        for msg in msgs:
             if msg.isOvercompressed() and not force:
                 LOG.warn("Message is a possible zlib bomb; not uncompressing")
 
@@ -680,12 +718,9 @@ class MixminionClient:
                     results.append(msg.getContents())
             else:
                 assert msg.isEncrypted()
-                surbKeys = self.keys.getSURBKeys()
-                nym = []
-                p = mixminion.BuildMessage.decodePayload(msg.getContents(),
-                                                         tag=msg.getTag(),
-                                                         userKeys=surbKeys,
-                                                         retNym=nym)
+                p, nym, err = decoded.pop()
+                if err is not None:
+                    raise MixError(err)
                 if p:
                     if nym == []:
                         nym = "---"
@@ -884,14 +919,16 @@ class CLIArgumentParser:
                 #XXXX008 reenable, sanely.
                 if self.exitAddress is not None:
                     raise UIError("Multiple addresses specified.")
+                from mixminion.ClientDirectory import parseAddress
                 try:
-                    self.exitAddress = mixminion.ClientDirectory.parseAddress(v)
+                    self.exitAddress = parseAddress(v)
                 except ParseError, e:
                     raise UsageError(str(e))
             elif o in ('-R', '--reply-block'):
                 #assert wantForwardPath #XXXX008 re-enable, sanely
                 self.replyBlockSources.append(v)
             elif o == '--reply-block-fd':
+                _checkNotAgent(o)
                 try:
                     self.replyBlockSources.append(int(v))
                 except ValueError:
@@ -913,6 +950,7 @@ class CLIArgumentParser:
                 except ValueError:
                     raise UsageError("%s expects an integer"%o)
             elif o in ('--passphrase-fd',):
+                _checkNotAgent(o)
                 try:
                     self.password_fileno = int(v)
                 except ValueError:
@@ -922,6 +960,7 @@ class CLIArgumentParser:
             elif o in ('--no-queue',):
                 self.forceNoQueue = 1
             elif o in ('--status-fd',):
+                _checkNotAgent(o)
                 try:
                     STATUS.setFD(int(v))
                 except ValueError:
@@ -940,8 +979,13 @@ class CLIArgumentParser:
         else:
             severity = "INFO"
 
+        env = None
         if self.wantConfig:
-            self.config = readConfigFile(self.configFile)
+            if _AGENT is not None:
+                env = _AGENT.getEnv(self.configFile)
+                self.config = env.config
+            else:
+                self.config = readConfigFile(self.configFile)
             if self.wantLog:
                 LOG.configure(self.config)
                 LOG.setMinSeverity(severity)
@@ -966,14 +1010,22 @@ class CLIArgumentParser:
         if self.wantClient:
             assert self.wantConfig
             LOG.debug("Configuring client")
-            self.client = MixminionClient(self.config, self.password_fileno)
+            if env is not None:
+                self.client = env.getClient()
+            else:
+                self.client = MixminionClient(self.config,
+                                              self.password_fileno)
 
         if self.wantClientDirectory:
             assert self.wantConfig
             assert _CLIENT_LOCKFILE
             LOG.debug("Configuring server list")
-            self.directory = mixminion.ClientDirectory.ClientDirectory(
-                config=self.config, diskLock=ClientDiskLock())
+            if env is not None:
+                self.directory = env.getDirectory()
+            else:
+                from mixminion.ClientDirectory import ClientDirectory
+                self.directory = ClientDirectory(
+                    config=self.config, diskLock=ClientDiskLock())
             self.directory._installAsKeyIDResolver()
 
         if self.wantDownload:
@@ -990,6 +1042,7 @@ class CLIArgumentParser:
 
     def parsePath(self):
         # Sets: exitAddress, pathSpec.
+        import mixminion.ClientDirectory
         if self.wantReplyPath and self.exitAddress is None:
             address = self.config['Security'].get('SURBAddress')
             if address is None:
@@ -1319,6 +1372,8 @@ Options:
   DOCDOC not right anymore
 """
 def countPackets(cmd,args):
+    import mixminion.BuildMessage
+    import mixminion.ClientDirectory
     options, args = getOptions(args, "R", ["reply"], dir=1, dest=1, path=1,
                                input=1, headers=1)
 
@@ -1377,7 +1432,7 @@ def countPackets(cmd,args):
         raise UsageError("Must specify a recipient, or --reply for a reply")
     else:
         assert reply and not address
-        address = mixminion.ClientDirectory.exitAddress(isReply=1)
+        address = mixminion.ClientDirectory.ExitAddress(isReply=1)
 
     if address and inFile == '-' and not address.hasPayload():
         print "1 packet needed"
@@ -1545,6 +1600,7 @@ EXAMPLES:
 def listServers(cmd, args):
     """[Entry point] Print info about servers in the directory, or on
        the command line."""
+    import mixminion.ClientDirectory
     options, args = getOptions(args, "F:JTrRs:cC",
                                ['feature=', 'justify',
                                 'with-time', "no-collapse", "recommended",
@@ -2080,7 +2136,7 @@ def listFragments(cmd, args):
     options, args = getOptions(args, dir=1)
     try:
         parser = CLIArgumentParser(options, wantConfig=1, wantLog=1,
-                                   wantClient=1, wantClientDirectory=1)
+                                   wantClient=1)
     except UsageError, e:
         e.dump()
         print _LIST_FRAGMENTS_USAGE % { 'cmd' : cmd }
@@ -2119,7 +2175,7 @@ def reassemble(cmd, args):
         reassemble = 0
     try:
         parser = CLIArgumentParser(options, wantConfig=1, wantLog=1,
-                                   wantClient=1, wantClientDirectory=1)
+                                   wantClient=1)
     except UsageError, e:
         e.dump()
         print _REASSEMBLE_USAGE % { 'cmd' : cmd }
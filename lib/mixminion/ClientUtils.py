@@ -7,7 +7,8 @@
    API, but useful for more than one user interface.
    """
 
-__all__ = [ 'NoPassword', 'PasswordManager', 'getPassword_term',
+__all__ = [ 'NoPassword', 'PasswordManager', 'AgentPasswordManager',
+            'getPassword_term',
             'getNewPassword_term', 'SURBLog', 'ClientQueue',
             'ClientFragmentPool' ]
 
@@ -121,6 +122,30 @@ class FDPasswordManager(PasswordManager):
     def _getNewPassword(self, name, prompt):
         return getPassword_fd(self.password_fileno)
 
+class AgentPasswordManager(PasswordManager):
+    """Implementation of PasswordManager for a long-running process with
+       no terminal: asks another PasswordManager for passwords until
+       'detach' is called, and refuses to ask for any new ones after that.
+    """
+    do_retry = 0
+    def __init__(self, base):
+        PasswordManager.__init__(self)
+        self.base = base
+        self.detached = 0
+    def detach(self):
+        """Stop asking for passwords."""
+        self.detached = 1
+    def _getPassword(self, name, prompt):
+        if self.detached:
+            raise UIError("No passphrase available for %s; restart the "
+                          "agent to enter it." % name)
+        return self.base._getPassword(name, prompt)
+    def _getNewPassword(self, name, prompt):
+        if self.detached:
+            raise UIError("Can't ask for a new passphrase for %s from the "
+                          "agent; run the command directly once." % name)
+        return self.base._getNewPassword(name, prompt)
+
 def getPassword_fd(fileno):
     """Read a password from a specified fileno."""
     pw = ""
@@ -1325,132 +1325,232 @@ class Duration:
 
 class IntervalSet:
     """An IntervalSet is a mutable set of numeric intervals, closed below and
-       open above.  Not very optimized for now.  Supports "+" for union, "-"
-       for disjunction, and "*" for intersection."""
+       open above.  Supports "+" for union, "-" for disjunction, and "*" for
+       intersection.  All of these operations walk both sets in order, and so
+       take time linear in the number of intervals involved."""
     ## Fields:
-    # edges: an ordered list of boundary points between interior and
-    #     exterior points, of the form (x, '+') for an 'entry' and
-    #     (x, '-') for an 'exit' boundary.
-    #
-    # FFFF There must be a more efficient algorithm for this, but we're so
-    # FFFF far from the critical path here that I'm not going to look for it
-    # FFFF for quite a while.
+    # starts, ends: two parallel lists holding the starting and ending
+    #     points of the intervals in this set, in order.  For all i,
+    #     starts[i] < ends[i] < starts[i+1]: intervals never overlap or
+    #     touch.
     def __init__(self, intervals=None):
         """Given a list of (start,end) tuples, construct a new IntervalSet.
            Tuples are ignored if start>=end."""
-        self.edges = []
+        self.starts = []
+        self.ends = []
         if intervals:
-            for start, end in intervals:
-                if start < end:
-                    self.edges.append((start, '+'))
-                    self.edges.append((end, '-'))
+            intervals = [ (s,e) for s,e in intervals if s < e ]
+            intervals.sort()
+            self._addSorted(intervals)
+
+    def _addSorted(self, intervals):
+        """Helper: append the intervals in 'intervals', a list of (start,end)
+           tuples sorted by start, merging any that overlap or touch.  All
+           the intervals must begin no earlier than the last interval
+           currently in this set."""
+        starts, ends = self.starts, self.ends
+        for s, e in intervals:
+            if ends and s <= ends[-1]:
+                if e > ends[-1]:
+                    ends[-1] = e
+            else:
+                starts.append(s)
+                ends.append(e)
+
     def copy(self):
         """Create a new IntervalSet with the same intervals as this one."""
         r = IntervalSet()
-        r.edges = self.edges[:]
+        r.starts = self.starts[:]
+        r.ends = self.ends[:]
         return r
+
+    def _union(self, other):
+        """Helper: return a list of the intervals in this set or in
+           'other', sorted by start, with overlaps."""
+        aS, aE, bS, bE = self.starts, self.ends, other.starts, other.ends
+        i = j = 0
+        nA, nB = len(aS), len(bS)
+        merged = []
+        while i < nA and j < nB:
+            if aS[i] <= bS[j]:
+                merged.append((aS[i], aE[i]))
+                i += 1
+            else:
+                merged.append((bS[j], bE[j]))
+                j += 1
+        while i < nA:
+            merged.append((aS[i], aE[i]))
+            i += 1
+        while j < nB:
+            merged.append((bS[j], bE[j]))
+            j += 1
+        return merged
+
+    def _intersection(self, other):
+        """Helper: return the starts and ends of the intervals that are in
+           both this set and 'other'."""
+        aS, aE, bS, bE = self.starts, self.ends, other.starts, other.ends
+        i = j = 0
+        nA, nB = len(aS), len(bS)
+        starts = []
+        ends = []
+        while i < nA and j < nB:
+            s = max(aS[i], bS[j])
+            e = min(aE[i], bE[j])
+            if s < e:
+                starts.append(s)
+                ends.append(e)
+            # Advance whichever interval ends first.
+            if aE[i] < bE[j]:
+                i += 1
+            else:
+                j += 1
+        return starts, ends
+
+    def _difference(self, other):
+        """Helper: return the starts and ends of the intervals that are in
+           this set but not in 'other'."""
+        aS, aE, bS, bE = self.starts, self.ends, other.starts, other.ends
+        j = 0
+        nB = len(bS)
+        starts = []
+        ends = []
+        for i in xrange(len(aS)):
+            s, e = aS[i], aE[i]
+            # Skip the intervals in other that end before this one starts.
+            while j < nB and bE[j] <= s:
+                j += 1
+            k = j
+            while k < nB and bS[k] < e:
+                if bS[k] > s:
+                    starts.append(s)
+                    ends.append(bS[k])
+                s = bE[k]
+                if s >= e:
+                    break
+                k += 1
+            if s < e:
+                starts.append(s)
+                ends.append(e)
+        return starts, ends
+
     def __iadd__(self, other):
         """self += b : Causes this set to contain all points in itself or
            in b."""
-        self.edges += other.edges
-        self._cleanEdges()
+        merged = self._union(other)
+        self.starts = []
+        self.ends = []
+        self._addSorted(merged)
         return self
     def __isub__(self, other):
         """self -= b : Causes this set to contain all points in itself but not
            in b"""
-        for t, e in other.edges:
-            if e == '+':
-                self.edges.append((t, '-'))
-            else:
-                self.edges.append((t, '+'))
-        self._cleanEdges()
+        self.starts, self.ends = self._difference(other)
         return self
     def __imul__(self, other):
         """self *= b : Causes this set to contain all points in both itself and
            b."""
-        self.edges += other.edges
-        self._cleanEdges(2)
+        self.starts, self.ends = self._intersection(other)
         return self
 
-    def _cleanEdges(self, nMin=1):
-        """Internal helper method: to be called when 'edges' is in a dirty
-           state, containing entry and exit points that don't create a
-           well-defined set of intervals.  Only those points that are 'entered'
-           nMin times or more are retained.
-           """
-        edges = self.edges
-        edges.sort()
-        depth = 0
-        newEdges = [ ('X', 'X') ] #marker value; will be removed.
-        for t, e in edges:
-            # Traverse the edges in order; keep track of how many more
-            # +'s we have seen than -'s.  Whenever that number increases
-            # above nMin, add a +.  Whenever that number drops below nMin,
-            # add a - ... but if the new edge would cancel out the most
-            # recently added one, then delete the most recently added one.
-            if e == '+':
-                depth += 1
-                if depth == nMin:
-                    if newEdges[-1] == (t, '-'):
-                        del newEdges[-1]
-                    else:
-                        newEdges.append((t, '+'))
-            if e == '-':
-                if depth == nMin:
-                    if newEdges[-1] == (t, '+'):
-                        del newEdges[-1]
-                    else:
-                        newEdges.append((t, '-'))
-                depth -= 1
-        assert depth == 0
-        del newEdges[0]
-        self.edges = newEdges
-
     def __add__(self, other):
         "Return the union of this IntervalSet and other"
-        r = self.copy()
-        r += other
+        r = IntervalSet()
+        r._addSorted(self._union(other))
         return r
 
     def __sub__(self, other):
         "Return the disjunction of this IntervalSet and other"
-        r = self.copy()
-        r -= other
+        r = IntervalSet()
+        r.starts, r.ends = self._difference(other)
         return r
 
     def __mul__(self, other):
         "Return the intersection of this IntervalSet and other"
-        r = self.copy()
-        r *= other
+        r = IntervalSet()
+        r.starts, r.ends = self._intersection(other)
         return r
 
+    def intersectionLengths(self, intervals):
+        """Given a list of (start,end) tuples sorted by start, return a list
+           of the total length of the parts of this set that fall within
+           each of those intervals.  This is equivalent to computing
+           (self*IntervalSet([(s,e)])).spanLength() for each one, but when
+           the intervals don't overlap, it takes only one pass over this
+           set."""
+        starts, ends = self.starts, self.ends
+        n = len(starts)
+        j = 0
+        result = []
+        for s, e in intervals:
+            # Skip the intervals in this set that end before this one
+            # starts.  Since the intervals are sorted by start, we never
+            # need them again.
+            while j < n and ends[j] <= s:
+                j += 1
+            total = 0
+            k = j
+            while k < n and starts[k] < e:
+                total += min(ends[k], e) - max(starts[k], s)
+                k += 1
+            result.append(total)
+        return result
+
     def getIntervalContaining(self, point):
         """If this set has any interval containing 'point', return
            a 2-tuple containing the start and end of that interval.
            Otherwise return (None,None).
         """
-        idx = bisect.bisect(self.edges, (point, '-'))
-        if idx < len(self.edges) and self.edges[idx][1] == '-':
-            return (self.edges[idx-1][0], self.edges[idx][0])
+        idx = bisect.bisect_right(self.starts, point) - 1
+        if idx >= 0 and point < self.ends[idx]:
+            return (self.starts[idx], self.ends[idx])
         else:
             return None, None
 
+    def addInterval(self, start, end):
+        """Add the interval [start,end) to this set.  Unlike '+=', this
+           doesn't rebuild the whole set: finding where the interval goes
+           takes logarithmic time, and inserting it takes time linear in
+           the number of intervals (but only a list splice).  It's the
+           right choice for building a set one interval at a time."""
+        if start >= end:
+            return
+        starts, ends = self.starts, self.ends
+        # Every interval from i up to (but not including) j overlaps or
+        # touches [start,end), so we replace them all with their union.
+        i = bisect.bisect_left(ends, start)
+        j = bisect.bisect_right(starts, end)
+        if i < j:
+            start = min(start, starts[i])
+            end = max(end, ends[j-1])
+        starts[i:j] = [start]
+        ends[i:j] = [end]
+
+    def containsInterval(self, start, end):
+        """Return true iff every point in [start,end) is in this set.  This
+           is equivalent to 'IntervalSet([(start,end)]) in self', but takes
+           only logarithmic time."""
+        if start >= end:
+            return 1
+        idx = bisect.bisect_right(self.starts, start) - 1
+        return idx >= 0 and end <= self.ends[idx]
+
     def __contains__(self, other):
         """'a in self' is true when 'a' is a number contained in some interval
             in this set, or when 'a' is an IntervalSet that is a subset of
             this set."""
         if isinstance(other, IntervalSet):
             return self*other == other
-        idx = bisect.bisect(self.edges, (other, '-'))
-        return idx < len(self.edges) and self.edges[idx][1] == '-'
+        idx = bisect.bisect_right(self.starts, other) - 1
+        return idx >= 0 and other < self.ends[idx]
 
     def isEmpty(self):
         """Return true iff this set contains no points"""
-        return len(self.edges) == 0
+        return len(self.starts) == 0
 
     def __nonzero__(self):
         """Return true iff this set contains some points"""
-        return len(self.edges) != 0
+        return len(self.starts) != 0
 
     def __repr__(self):
         s = [ "(%s,%s)"%(start,end) for start, end in self.getIntervals() ]
@@ -1459,39 +1559,35 @@ class IntervalSet:
     def getIntervals(self):
         """Returns a list of (start,end) tuples for a the intervals in this
            set."""
-        s = []
-        for i in xrange(0, len(self.edges), 2):
-            s.append((self.edges[i][0], self.edges[i+1][0]))
-        return s
+        return zip(self.starts, self.ends)
 
     def spanLength(self):
         """Return the sum of the lengths of the intervals in this set."""
         r = 0
-        for i in xrange(0, len(self.edges), 2):
-            r += self.edges[i+1][0] - self.edges[i][0]
+        ends = self.ends
+        for i in xrange(len(ends)):
+            r += ends[i] - self.starts[i]
         return r
 
     def _checkRep(self):
         """Helper function: raises AssertionError if this set's data is
            corrupted."""
-        assert (len(self.edges) % 2) == 0
-        for i in xrange(0, len(self.edges), 2):
-            assert self.edges[i][0] < self.edges[i+1][0]
-            assert self.edges[i][1] == '+'
-            assert self.edges[i+1][1] == '-'
-            assert i == 0 or self.edges[i-1][0] < self.edges[i][0]
+        assert len(self.starts) == len(self.ends)
+        for i in xrange(len(self.starts)):
+            assert self.starts[i] < self.ends[i]
+            assert i == 0 or self.ends[i-1] < self.starts[i]
 
     def __cmp__(self, other):
         """A == B iff A and B contain exactly the same intervals."""
-        return cmp(self.edges, other.edges)
+        return cmp((self.starts, self.ends), (other.starts, other.ends))
 
     def start(self):
         """Return the first point contained in this interval."""
-        return self.edges[0][0]
+        return self.starts[0]
 
     def end(self):
         """Return the last point contained in this interval."""
-        return self.edges[-1][0]
+        return self.ends[-1]
 
 #----------------------------------------------------------------------
 # SMTP address functionality
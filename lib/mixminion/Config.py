@@ -351,11 +351,26 @@ def _parseHex(s):
        its original. Raises ConfigError on failure."""
     return _parseBase64(s,1)
 
+# Map from ASN.1 encoding to RSA object for public keys we've decoded.  A
+# directory mentions each server's identity key once per descriptor, and
+# we see the same descriptors again with every directory we download, so
+# we only decode each key once.
+_PUBLIC_KEY_CACHE = {}
+# Largest number of keys to hold in _PUBLIC_KEY_CACHE.
+MAX_CACHED_PUBLIC_KEYS = 8192
+
 def _parsePublicKey(s):
     """Validate function.  Converts a Base-64 encoding of an ASN.1
        represented RSA public key with modulus 65537 into an RSA
        object."""
-    asn1 = _parseBase64(s)
+    return _decodePublicKey(_parseBase64(s))
+
+def _decodePublicKey(asn1):
+    """As _parsePublicKey, but takes the ASN.1 encoding of the key."""
+    try:
+        return _PUBLIC_KEY_CACHE[asn1]
+    except KeyError:
+        pass
     if len(asn1) > 550:
         raise ConfigError("Overlong public key")
     try:
@@ -364,6 +379,9 @@ def _parsePublicKey(s):
         raise ConfigError("Invalid public key")
     if key.get_exponent() != 65537:
         raise ConfigError("Invalid exponent on public key")
+    if len(_PUBLIC_KEY_CACHE) >= MAX_CACHED_PUBLIC_KEYS:
+        _PUBLIC_KEY_CACHE.clear()
+    _PUBLIC_KEY_CACHE[asn1] = key
     return key
 
 # FFFF008 stop accepting YYYY/MM/DD.  We've generated the right thing
@@ -526,6 +544,45 @@ def _readConfigFile(contents):
 def _readRestrictedConfigFile(contents):
     """Same interface as _readConfigFile, but only supports the restrictd
        file format as used by directories and descriptors."""
+    # Every descriptor in every directory comes through here, so we make a
+    # single quick pass over the file, using only string methods on each
+    # line.  If anything is amiss, we let _readRestrictedConfigFileByLine
+    # find the problem and report it.
+    if not isPrintingAscii(contents):
+        return _readRestrictedConfigFileByLine(contents)
+
+    fileLines = contents.split("\n")
+    if fileLines[-1] == '':
+        del fileLines[-1]
+
+    # List of (heading, [(key, val, lineno), ...])
+    sections = []
+    # [(key, val, lineno)] for the current section.
+    curSection = None
+    # Current line number
+    lineno = 0
+    _section_match = _section_re.match
+    try:
+        for line in fileLines:
+            lineno += 1
+            line = line.strip()
+            colonIdx = line.find(':')
+            if colonIdx >= 1 and line[0] not in '[#':
+                curSection.append( (line[:colonIdx].rstrip(),
+                                    line[colonIdx+1:].lstrip(), lineno) )
+            else:
+                m = _section_match(line)
+                curSection = [ ]
+                sections.append( (m.group(1), curSection) )
+    except AttributeError:
+        # Either a bad line, or an entry before the first section.
+        return _readRestrictedConfigFileByLine(contents)
+
+    return sections
+
+def _readRestrictedConfigFileByLine(contents):
+    """Helper function: same as _readRestrictedConfigFile, but examines the
+       file one line at a time."""
     # List of (heading, [(key, val, lineno), ...])
     sections = []
     # [(key, val, lineno)] for the current section.
@@ -666,6 +723,36 @@ def getFeatureList(klass):
     features.sort()
     return features
 
+# Map from (id(secConfig), id(codingFns)) to (secConfig, codingFns, rules)
+# for every section syntax that _compileSectionSyntax has seen.  We keep
+# references to the keys' objects so that their ids can't be reused.
+_COMPILED_SYNTAX = {}
+
+def _compileSectionSyntax(secConfig, codingFns):
+    """Helper: given the syntax for a section (as in _ConfigFile._syntax)
+       and a map from type names to parse functions (as in
+       _ConfigFile.CODING_FNS), return a 2-tuple of: a map from key to
+       (rule, parseFn, default); and a list of (key, rule, parseFn,
+       default) for the keys we need to check once the section has been
+       read.  Results are cached, so that we only look up each key's type
+       once for all the files we parse."""
+    cacheKey = (id(secConfig), id(codingFns))
+    ent = _COMPILED_SYNTAX.get(cacheKey)
+    if ent is not None and ent[0] is secConfig and ent[1] is codingFns:
+        return ent[2]
+
+    entryRules = {}
+    finalRules = []
+    for k, (rule, parseType, default) in secConfig.items():
+        parseFn, _ = codingFns.get(parseType,(None,None))
+        entryRules[k] = (rule, parseFn, default)
+        if k != '__SECTION__' and rule != 'IGNORE':
+            finalRules.append((k, rule, parseFn, default))
+
+    rules = (entryRules, finalRules)
+    _COMPILED_SYNTAX[cacheKey] = (secConfig, codingFns, rules)
+    return rules
+
 class _ConfigFile:
     """Base class to parse, validate, and represent configuration files.
     """
@@ -804,11 +891,14 @@ class _ConfigFile:
                     LOG.warn("Skipping unrecognized section %s", secName)
                     continue
 
+            entryRules, finalRules = _compileSectionSyntax(secConfig,
+                                                           self.CODING_FNS)
+
             # Set entries from the section, searching for bad entries
             # as we go.
             for k,v,line in secEntries:
                 try:
-                    rule, parseType, default = secConfig[k]
+                    rule, parseFn, default = entryRules[k]
                 except KeyError:
                     msg = "Unrecognized key %s on line %s"%(k,line)
                     acceptedIn = [ sn for sn,sc in self._syntax.items()
@@ -824,8 +914,6 @@ class _ConfigFile:
                         LOG.warn(msg)
                         continue
 
-                parseFn, _ = self.CODING_FNS.get(parseType,(None,None))
-
                 # Parse and validate the value of this entry.
                 if parseFn is not None:
                     try:
@@ -855,15 +943,12 @@ class _ConfigFile:
 
             # Check for missing entries, setting defaults and detecting
             # missing requirements as we go.
-            for k, (rule, parseType, default) in secConfig.items():
-                if k == '__SECTION__' or rule == 'IGNORE':
-                    continue
-                elif not section.has_key(k):
+            for k, rule, parseFn, default in finalRules:
+                if not section.has_key(k):
                     if rule in ('REQUIRE', 'REQUIRE*'):
                         raise ConfigError("Missing entry %s from section %s"
                                           % (k, secName))
                     else:
-                        parseFn, _ = self.CODING_FNS.get(parseType,(None,None))
                         if parseFn is None or default is None:
                             if rule == 'ALLOW*':
                                 section[k] = []
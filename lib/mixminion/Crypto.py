@@ -14,6 +14,7 @@ import errno
 import math
 import os
 import stat
+import struct
 import sys
 import threading
 from types import StringType
@@ -501,28 +502,33 @@ class RNG:
     '''Base implementation class for random number generators.  Works
        by requesting a bunch of bytes via self._prng, and doling them
        out piecemeal via self.getBytes.'''
+    ## Fields:
+    # bytes: A string of random bytes fetched from _prng.
+    # pos: The index of the first byte in 'bytes' that we haven't yet
+    #    handed out.  (We keep an offset, rather than slicing off the bytes
+    #    we use, so that each call only copies the bytes it returns.)
+    # chunksize: How many bytes to fetch from _prng at a time.
     def __init__(self, chunksize):
         """Initializes a RNG.  Bytes will be fetched from _prng by 'chunkSize'
            bytes at a time."""
         self.bytes = ""
+        self.pos = 0
         self.chunksize = chunksize
 
     def getBytes(self, n):
         """Returns a string of 'n' random bytes."""
         assert n >= 0
-
-        if n > len(self.bytes):
+        pos = self.pos
+        end = pos + n
+        if end > len(self.bytes):
             # If we don't have enough bytes, fetch enough so that we'll have
             # a full chunk left over.
-            nMore = n+self.chunksize-len(self.bytes)
-            morebytes = self._prng(nMore)
-            res = self.bytes+morebytes[:n-len(self.bytes)]
-            self.bytes = morebytes[n-len(self.bytes):]
-            return res
-        else:
-            res = self.bytes[:n]
-            self.bytes = self.bytes[n:]
-            return res
+            left = self.bytes[pos:]
+            self.bytes = left + self._prng(n+self.chunksize-len(left))
+            pos = 0
+            end = n
+        self.pos = end
+        return self.bytes[pos:end]
 
     def pick(self, lst):
         """Return a member of 'lst', chosen randomly according to a uniform
@@ -549,9 +555,28 @@ class RNG:
 
         # This permutation algorithm yields all permutation with equal
         # probability (assuming a good rng); others do not.
-        getInt = self.getInt
+        #
+        # We do the same thing as calling getInt(size-i) for each i, but we
+        # fetch our random values in bulk: we ask for one value per swap
+        # we have left to do, and only ask for more if some get rejected.
+        # This way, we use exactly the same random bytes as getInt would.
+        nSwaps = len(series)
+        _unpack = struct.unpack
+        vals = ()
+        j = 0
         for i in series:
-            swap = i+getInt(size-i)
+            m = size-i
+            cutoff = 0x7fffffff - (0x7fffffff % m)
+            while 1:
+                if j == len(vals):
+                    k = nSwaps-i
+                    vals = _unpack(">%dl"%k, self.getBytes(4*k))
+                    j = 0
+                o = vals[j] & 0x7fffffff
+                j += 1
+                if o < cutoff:
+                    break
+            swap = i + o % m
             lst[swap],lst[i] = lst[i],lst[swap]
 
         return lst[:n]
@@ -568,15 +593,11 @@ class RNG:
         # FFFF  we could do better.)
 
         assert 0 < max < 0x3fffffff
-        _ord = ord
+        _unpack = struct.unpack
         cutoff = 0x7fffffff - (0x7fffffff % max)
         while 1:
             # Get a random positive int between 0 and 0x7fffffff.
-            b = self.getBytes(4)
-            o = (((((((_ord(b[0])&0x7f)<<8) +
-                       _ord(b[1]))<<8) +
-                       _ord(b[2]))<<8) +
-                       _ord(b[3]))
+            o = _unpack(">l", self.getBytes(4))[0] & 0x7fffffff
             # Retry if we got a value that would fall in an incomplete
             # run of 'max' elements.
             if o < cutoff:
@@ -584,6 +605,20 @@ class RNG:
 
         raise AssertionError # unreached; appease pychecker
 
+    def getInts(self, max, n):
+        """Returns a list of 'n' random integers i s.t. 0 <= i < max.  This
+           gives the same result as calling getInt(max) 'n' times, but is
+           much faster for large n."""
+        assert 0 < max < 0x3fffffff
+        cutoff = 0x7fffffff - (0x7fffffff % max)
+        result = []
+        while len(result) < n:
+            k = n - len(result)
+            vals = struct.unpack(">%dl"%k, self.getBytes(4*k))
+            result.extend([ (o & 0x7fffffff) % max for o in vals
+                            if (o & 0x7fffffff) < cutoff ])
+        return result
+
     def getNormal(self, m, s):
         """Return a random value with mean m and standard deviation s.
         """
@@ -599,13 +634,18 @@ class RNG:
 
     def getFloat(self):
         """Return a floating-point number between 0 and 1."""
-        b = self.getBytes(4)
-        _ord = ord
-        o = ((((((_ord(b[0])&0x7f)<<8) + _ord(b[1]))<<8) +
-              _ord(b[2]))<<8) + _ord(b[3])
+        o = struct.unpack(">l", self.getBytes(4))[0] & 0x7fffffff
         #return o / float(0x7fffffff)
         return o / 2147483647.0
 
+    def getFloats(self, n):
+        """Return a list of 'n' floating-point numbers between 0 and 1.  This
+           gives the same result as calling getFloat() 'n' times."""
+        if n == 0:
+            return []
+        vals = struct.unpack(">%dl"%n, self.getBytes(4*n))
+        return [ (o & 0x7fffffff) / 2147483647.0 for o in vals ]
+
     def openNewFile(self, dir, prefix="", binary=1, conflictPrefix=None):
         """Generate a new random filename within a directory with a given
            prefix within a directory, and open a new file within the directory
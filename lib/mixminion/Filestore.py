@@ -15,9 +15,11 @@
 
 import anydbm
 import binascii
+import bisect
 import cPickle
 import dumbdbm
 import errno
+import math
 import os
 import stat
 import threading
@@ -33,7 +35,7 @@ __all__ = [ "StringStore", "StringMetadataStore",
             "ObjectStore", "ObjectMetadataStore",
             "MixedStore", "MixedMetadataStore",
             "DBBase", "JournaledDBBase", "BooleanJournaledDBBase",
-            "CorruptedFile",
+            "CorruptedFile", "PoolIndex",
             ]
 
 class CorruptedFile(MixError):
@@ -47,6 +49,25 @@ class CorruptedFile(MixError):
 # trash.
 INPUT_TIMEOUT = 6000
 
+def _syncDirectory(d):
+    """Helper: make sure that all the renames and creates in the directory
+       'd' are on disk.  (Not all platforms let us do this.)"""
+    if not hasattr(os, 'fsync'):
+        return
+    try:
+        fd = os.open(d, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        try:
+            os.fsync(fd)
+        except OSError, e:
+            # Some filesystems won't sync a directory.
+            if e.errno not in (errno.EINVAL, errno.EBADF, errno.EACCES):
+                raise
+    finally:
+        os.close(fd)
+
 class BaseStore:
     """A BaseStore is an unordered collection of files with secure insert,
        move, and delete operations.
@@ -92,6 +113,8 @@ class BaseStore:
     #                 the queue object.  Filesystem operations are allowed
     #                 without holding the lock, but they must not be visible
     #                 to users of the queue.
+    #           index: None, or a PoolIndex of the complete messages in the
+    #                 queue.
     def __init__(self, location, create=0, scrub=0):
         """Creates a file store object for a given directory, 'location'.  If
            'create' is true, creates the directory if necessary.  If 'scrub'
@@ -101,6 +124,7 @@ class BaseStore:
 
         self._lock = threading.RLock()
         self.dir = location
+        self.index = None
 
         if not os.path.isabs(location):
             LOG.warn("Directory path %s isn't absolute.", location)
@@ -124,10 +148,40 @@ class BaseStore:
         """Release the lock on this filestore."""
         self._lock.release()
 
+    def useIndex(self):
+        """Keep an in-memory index of the messages in this filestore, so
+           that we can count them and choose among them without listing
+           the directory.  Only do this if no other object will change the
+           same directory."""
+        try:
+            self._lock.acquire()
+            self._rebuildIndex()
+        finally:
+            self._lock.release()
+
+    def _rebuildIndex(self):
+        """Helper: rebuild self.index from the contents of the directory.
+           Messages are assumed to have arrived when they were last
+           modified."""
+        messages = []
+        for fn in os.listdir(self.dir):
+            if fn.startswith("msg_"):
+                try:
+                    mtime = os.stat(os.path.join(self.dir, fn))[stat.ST_MTIME]
+                except OSError:
+                    continue
+                messages.append((mtime, fn[4:]))
+        self.index = PoolIndex(messages)
+        self.n_entries = self.index.count()
+
     def count(self, recount=0):
         """Returns the number of complete messages in the filestore."""
         try:
             self._lock.acquire()
+            if self.index is not None:
+                if recount:
+                    self._rebuildIndex()
+                return self.index.count()
             if self.n_entries >= 0 and not recount:
                 return self.n_entries
             else:
@@ -140,22 +194,91 @@ class BaseStore:
         finally:
             self._lock.release()
 
-    def pickRandom(self, count=None):
+    def countBefore(self, when):
+        """Returns the number of complete messages in the filestore that
+           arrived before the time 'when'."""
+        try:
+            self._lock.acquire()
+            if self.index is not None:
+                return self.index.countBefore(when)
+            return len(self._getMessagesBefore(when))
+        finally:
+            self._lock.release()
+
+    def pickRandom(self, count=None, before=None):
         """Returns a list of 'count' handles to messages in this filestore.
            The messages are chosen randomly, and returned in a random order.
 
            If there are fewer than 'count' messages in the filestore,
-           all the messages will be included."""
-        handles = self.getAllMessages() # handles locking
+           all the messages will be included.  If 'before' is provided,
+           only consider messages that arrived before that time."""
+        try:
+            self._lock.acquire()
+            if self.index is not None:
+                return self.index.pickRandom(getCommonPRNG(), count, before)
+            if before is None:
+                handles = self.getAllMessages()
+            else:
+                handles = self._getMessagesBefore(before)
+        finally:
+            self._lock.release()
 
         return getCommonPRNG().shuffle(handles, count)
 
+    def pickWithProbability(self, probability):
+        """Returns a list of handles to messages in this filestore, in a
+           random order.  Each message is included independently, with
+           probability 'probability'."""
+        try:
+            self._lock.acquire()
+            if self.index is not None:
+                return self.index.pickWithProbability(getCommonPRNG(),
+                                                      probability)
+            handles = self.getAllMessages()
+        finally:
+            self._lock.release()
+        rng = getCommonPRNG()
+        return rng.shuffle([ h for h, f in zip(handles,
+                                               rng.getFloats(len(handles)))
+                             if f < probability ])
+
     def getAllMessages(self):
         """Returns handles for all messages currently in the filestore.
            Note: this ordering is not guaranteed to be random."""
         self._lock.acquire()
-        hs = [fn[4:] for fn in os.listdir(self.dir) if fn.startswith("msg_")]
-        self._lock.release()
+        try:
+            if self.index is not None:
+                return self.index.getHandles()
+            return [fn[4:] for fn in os.listdir(self.dir)
+                    if fn.startswith("msg_")]
+        finally:
+            self._lock.release()
+
+    def getArrivalTime(self, handle):
+        """Return the time at which the message 'handle' arrived in this
+           filestore, or None if there is no such message."""
+        try:
+            self._lock.acquire()
+            if self.index is not None:
+                return self.index.getArrivalTime(handle)
+        finally:
+            self._lock.release()
+        try:
+            return os.stat(self.getMessagePath(handle))[stat.ST_MTIME]
+        except OSError:
+            return None
+
+    def _getMessagesBefore(self, when):
+        """Helper: return handles for all messages in the filestore whose
+           files were last modified before 'when'."""
+        hs = []
+        for h in self.getAllMessages():
+            try:
+                mtime = os.stat(self.getMessagePath(h))[stat.ST_MTIME]
+            except OSError:
+                continue
+            if mtime < when:
+                hs.append(h)
         return hs
 
     def messageExists(self, handle):
@@ -280,6 +403,11 @@ class BaseStore:
                 self.count(1)
                 return
 
+            if self.index is not None:
+                if s1 == 'msg' and s2 != 'msg':
+                    self.index.remove(handle)
+                elif s1 != 'msg' and s2 == 'msg':
+                    self.index.add(handle, time.time())
             if self.n_entries < 0:
                 return
             if s1 == 'msg' and s2 != 'msg':
@@ -289,6 +417,196 @@ class BaseStore:
         finally:
             self._lock.release()
 
+class PoolIndex:
+    """A PoolIndex remembers the handles of the messages in a filestore in
+       the order they arrived, so that we can count them, choose among
+       them at random, and find the ones that arrived before a given time
+       without listing the filestore's directory.
+
+       Each new message takes the next slot in a pair of arrays ('handles'
+       and 'times'), and a Fenwick tree over the slots counts how many of
+       them still hold messages.  Removing a message just empties its
+       slot; when we run out of slots, we compact the arrays.  Counting the
+       messages in any prefix of the slots, or finding the Nth message,
+       takes O(log n) time."""
+    ## Fields:
+    # handles: A list holding the handle in each slot, or None for an
+    #    empty slot.
+    # times: A list holding the arrival time for each slot.  Never
+    #    decreases.
+    # slots: A map from handle to slot number.
+    # tree: A Fenwick tree: for 1 <= i <= capacity, tree[i] is the number
+    #    of full slots among slots i-(i&-i) through i-1.
+    # capacity: The number of slots we have room for.  Always a power of 2.
+    def __init__(self, messages=()):
+        """Create a new PoolIndex, given a list of (arrival time, handle)
+           for the messages already in the filestore."""
+        messages = list(messages)
+        messages.sort()
+        self._rebuild(messages)
+
+    def _rebuild(self, messages):
+        """Helper: make this index hold exactly the messages in 'messages',
+           a list of (arrival time, handle) sorted by time."""
+        capacity = 16
+        while capacity < 2*len(messages):
+            capacity *= 2
+        self.capacity = capacity
+        self.times = [ t for t, _ in messages ]
+        self.handles = [ h for _, h in messages ]
+        self.slots = {}
+        for i in xrange(len(self.handles)):
+            self.slots[self.handles[i]] = i
+        tree = self.tree = [0]*(capacity+1)
+        for i in xrange(1, len(self.handles)+1):
+            tree[i] = 1
+        for i in xrange(1, capacity+1):
+            j = i + (i & -i)
+            if j <= capacity:
+                tree[j] += tree[i]
+
+    def add(self, handle, when):
+        """Add the message 'handle', which arrived at 'when'."""
+        if self.slots.has_key(handle):
+            return
+        if len(self.handles) == self.capacity:
+            self._rebuild([ (t, h) for t, h in zip(self.times, self.handles)
+                            if h is not None ])
+        # If the clock went backwards, pretend this message arrived at the
+        # same time as the last one.
+        if self.times and when < self.times[-1]:
+            when = self.times[-1]
+        i = len(self.handles)
+        self.handles.append(handle)
+        self.times.append(when)
+        self.slots[handle] = i
+        self._update(i, 1)
+
+    def remove(self, handle):
+        """Remove the message 'handle', if we have it."""
+        try:
+            i = self.slots[handle]
+        except KeyError:
+            return
+        del self.slots[handle]
+        self.handles[i] = None
+        self._update(i, -1)
+        if not self.slots:
+            self._rebuild([])
+
+    def count(self):
+        """Return the number of messages in this index."""
+        return len(self.slots)
+
+    def countBefore(self, when):
+        """Return the number of messages that arrived before 'when'."""
+        return self._prefix(bisect.bisect_left(self.times, when))
+
+    def getArrivalTime(self, handle):
+        """Return the time at which the message 'handle' arrived, or None
+           if we don't have it."""
+        try:
+            return self.times[self.slots[handle]]
+        except KeyError:
+            return None
+
+    def getHandles(self):
+        """Return a list of all the handles in this index, oldest first."""
+        return [ h for h in self.handles if h is not None ]
+
+    def pickRandom(self, rng, n=None, before=None):
+        """Use 'rng' to choose 'n' messages at random, and return their
+           handles in a random order.  If 'n' is None or we have fewer
+           than 'n' messages, return them all.  If 'before' is provided,
+           only consider messages that arrived before that time."""
+        if before is None:
+            end = len(self.handles)
+            avail = len(self.slots)
+        else:
+            end = bisect.bisect_left(self.times, before)
+            avail = self._prefix(end)
+        if n is None or n*8 >= avail:
+            # When we want a good fraction of the messages, it's cheaper
+            # to shuffle them all than to look for each one in the tree.
+            return rng.shuffle([ h for h in self.handles[:end]
+                                 if h is not None ], n)
+        # Take out each message as we pick it, so that we don't pick it
+        # twice; then put them all back.
+        picked = []
+        for _ in xrange(n):
+            i = self._find(rng.getInt(avail))
+            picked.append(i)
+            self._update(i, -1)
+            avail -= 1
+        for i in picked:
+            self._update(i, 1)
+        return [ self.handles[i] for i in picked ]
+
+    def pickWithProbability(self, rng, p):
+        """Use 'rng' to choose each message independently with probability
+           'p', and return the handles of the chosen messages in a random
+           order.  When 'p' is small, this takes time proportional to the
+           number of messages chosen, not the number in the index."""
+        n = len(self.slots)
+        if p <= 0 or n == 0:
+            return []
+        if p >= 1:
+            return self.pickRandom(rng)
+        if p*8 >= 1:
+            handles = self.getHandles()
+            return rng.shuffle([ h for h, f in zip(handles,
+                                                   rng.getFloats(n))
+                                 if f < p ])
+        # The gap between one chosen message and the next is geometrically
+        # distributed, so we draw the gaps instead of one value for each
+        # message.
+        logq = math.log(1.0 - p)
+        picked = []
+        k = -1
+        while 1:
+            # getFloat() can return 1.0, and log(0) is an error.
+            u = rng.getFloat()
+            while u >= 1.0:
+                u = rng.getFloat()
+            k += 1 + int(math.log(1.0 - u) / logq)
+            if k >= n:
+                break
+            picked.append(self.handles[self._find(k)])
+        return rng.shuffle(picked)
+
+    def _update(self, i, delta):
+        """Helper: add 'delta' to the count for slot 'i'."""
+        tree = self.tree
+        capacity = self.capacity
+        i += 1
+        while i <= capacity:
+            tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, i):
+        """Helper: return the number of messages in slots 0 through i-1."""
+        tree = self.tree
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def _find(self, k):
+        """Helper: return the slot holding the k'th message (counting from
+           0)."""
+        tree = self.tree
+        capacity = self.capacity
+        pos = 0
+        step = capacity
+        while step:
+            nxt = pos + step
+            if nxt <= capacity and tree[nxt] <= k:
+                pos = nxt
+                k -= tree[nxt]
+            step >>= 1
+        return pos
+
 class StringStoreMixin:
     """Combine the 'StringStoreMixin' class with a BaseStore in order
        to implement a BaseStore that stores strings.
@@ -312,6 +630,35 @@ class StringStoreMixin:
         self.finishMessage(f, handle) # handles locking
         return handle
 
+    def queueMessages(self, contentsList):
+        """Durably create a new message in the filestore for each string
+           in 'contentsList', and return a list of handles for the new
+           messages.  When this method returns, all of the messages have
+           been synced to disk.
+
+           We write and sync all of the files before we commit any of them,
+           and sync the directory only once, so this is a good deal cheaper
+           than calling queueMessage once for each message and syncing each
+           time.  If we can't write every message, we commit none of them,
+           and raise the error."""
+        files = []
+        try:
+            for contents in contentsList:
+                f, handle = self.openNewMessage()
+                files.append((f, handle))
+                f.write(contents)
+                f.flush()
+                if hasattr(os, 'fsync'):
+                    os.fsync(f.fileno())
+        except:
+            for f, handle in files:
+                self.abortMessage(f, handle)
+            raise
+        for f, handle in files:
+            self.finishMessage(f, handle)
+        _syncDirectory(self.dir)
+        return [ handle for _, handle in files ]
+
 class ObjectStoreMixin:
     """Combine the 'ObjectStoreMixin' class with a BaseStore in order
        to implement a BaseStore that stores strings.
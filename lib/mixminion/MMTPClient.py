@@ -13,7 +13,8 @@
    easy-to-verify reference implementation of the protocol.)
    """
 
-__all__ = [ "MMTPClientConnection", "sendPackets", "DeliverableMessage" ]
+__all__ = [ "MMTPClientConnection", "sendPackets", "DeliverableMessage",
+            "TLSSessionCache" ]
 
 import socket
 import sys
@@ -34,6 +35,7 @@ class EventStatsDummy:
         return _noop
 EventStats = EventStatsDummy()
 EventStats.log = EventStats
+EventStats.metrics = EventStats
 
 def useEventStats():
     import mixminion.server.EventStats
@@ -69,6 +71,8 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     #   server we're trying to connect to.
     # certCache: an instance of PeerCertificateCache to use to check the
     #   peer server's certificate
+    # sessionCache: an instance of TLSSessionCache to hold the TLS sessions
+    #   we can resume, or None if we don't resume sessions.
     # packets: a list of DeliverableMessage objects that have not yet been
     #   sent to the TLS connection, in the order they should be sent.
     # pendingPackets: a list of DeliverableMessage objects that have been
@@ -88,8 +92,11 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     # External interface
     ####
     def __init__(self, targetFamily, targetAddr, targetPort, targetKeyID,
-                 serverName=None, context=None, certCache=None):
-        """Initialize a new MMTPClientConnection."""
+                 serverName=None, context=None, certCache=None,
+                 sessionCache=None):
+        """Initialize a new MMTPClientConnection.  If 'sessionCache' is
+           provided, try to resume a TLS session from an earlier connection
+           to the same server, and remember the session from this one."""
         assert targetFamily in (mixminion.NetUtils.AF_INET,
                                 mixminion.NetUtils.AF_INET6)
         if context is None:
@@ -122,6 +129,14 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         else:
             self.targetKeyID = None
         self.certCache = certCache
+        self.sessionCache = sessionCache
+        if sessionCache is not None:
+            session = sessionCache.get(self.getAddr())
+            if session is not None:
+                try:
+                    tls.set_session(session)
+                except _ml.TLSError:
+                    sessionCache.remove(self.getAddr())
 
         self.packets = []
         self.pendingPackets = []
@@ -223,6 +238,8 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
             self.certCache.check(self.tls, self.targetKeyID, self.address)
         except MixProtocolBadAuth, e:
             LOG.warn("Certificate error: %s. Shutting down connection.", e)
+            if self.sessionCache is not None:
+                self.sessionCache.remove(self.getAddr())
             self._failPendingPackets()
             self.startShutdown()
             return
@@ -230,6 +247,11 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
             LOG.debug("KeyID is valid from %s", self.address)
 
         EventStats.log.successfulConnect()
+        noteHandshake("client", self.tls, self.handshakeTime)
+        if self.sessionCache is not None:
+            session = self.tls.get_session()
+            if session is not None:
+                self.sessionCache.put(self.getAddr(), session)
 
         # The certificate is fine; start protocol negotiation.
         self.beginWriting("MMTP %s\r\n" % ",".join(self.PROTOCOL_VERSIONS))
@@ -329,6 +351,9 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         # If we got an error, fail all our packets and don't accept any more.
         if not self._isConnected:
             EventStats.log.failedConnect()
+            # Maybe the server didn't like the session we tried to resume.
+            if self.sessionCache is not None:
+                self.sessionCache.remove(self.getAddr())
         self._isConnected = 0
         self._failPendingPackets()
     def onTimeout(self):
@@ -473,6 +498,95 @@ def pingServer(routing, timeout=60):
        isn't up."""
     sendPackets(routing, ["JUNK"], timeout=timeout)
 
+# How long do we try to resume a TLS session, in seconds?  Keep this short:
+# a resumed session reuses its key material instead of doing a fresh DH
+# exchange.
+SESSION_LIFETIME = 10*60
+
+class TLSSessionCache:
+    """A TLSSessionCache remembers the TLS sessions from our recent
+       connections to MMTP servers, so that we can resume them instead of
+       doing a full handshake the next time we connect."""
+    ## Fields
+    # sessions: A map from (address, port, keyID) to a (session, expiry
+    #    time) tuple.
+    # maxSessions: The largest number of sessions we'll remember.
+    # lifetime: How long after a connection will we try to resume its
+    #    session?
+    def __init__(self, maxSessions=1024, lifetime=SESSION_LIFETIME):
+        self.sessions = {}
+        self.maxSessions = maxSessions
+        self.lifetime = lifetime
+
+    def get(self, peer, now=None):
+        """Return the session to resume for the 3-tuple 'peer', or None if
+           we have none."""
+        try:
+            session, expiry = self.sessions[peer]
+        except KeyError:
+            return None
+        if now is None:
+            now = time.time()
+        if expiry < now:
+            del self.sessions[peer]
+            return None
+        return session
+
+    def put(self, peer, session, now=None):
+        """Remember that we can resume 'session' with the 3-tuple 'peer'."""
+        if now is None:
+            now = time.time()
+        if not self.sessions.has_key(peer) and \
+               len(self.sessions) >= self.maxSessions:
+            self.clean(now)
+            if len(self.sessions) >= self.maxSessions:
+                # Forget the session that would expire soonest.
+                oldest = min([ (e,p) for p,(s,e) in self.sessions.items() ])
+                del self.sessions[oldest[1]]
+        self.sessions[peer] = (session, now+self.lifetime)
+
+    def remove(self, peer):
+        """Forget any session for the 3-tuple 'peer'."""
+        try:
+            del self.sessions[peer]
+        except KeyError:
+            pass
+
+    def clean(self, now=None):
+        """Forget all expired sessions."""
+        if now is None:
+            now = time.time()
+        for peer, (session, expiry) in self.sessions.items():
+            if expiry < now:
+                del self.sessions[peer]
+
+    def clear(self):
+        """Forget all sessions."""
+        self.sessions.clear()
+
+# Map from "client" or "server" to a running average of the time we spend
+# on full (not resumed) TLS handshakes, in seconds.
+_fullHandshakeTime = {}
+
+def noteHandshake(side, tls, elapsed):
+    """Tell EventStats that we've finished a TLS handshake on 'tls' as a
+       'side' ("client" or "server"), after spending 'elapsed' seconds on
+       it.  If the handshake resumed a session, estimate the time we saved."""
+    metrics = EventStats.metrics
+    label = '{side="%s"}' % side
+    avg = _fullHandshakeTime.get(side)
+    if tls.session_reused():
+        metrics.incr("TLSSessionsResumed"+label)
+        if avg is not None and avg > elapsed:
+            metrics.incr("TLSHandshakeMsecSaved"+label,
+                         int((avg-elapsed)*1000))
+    else:
+        if avg is None:
+            _fullHandshakeTime[side] = elapsed
+        else:
+            _fullHandshakeTime[side] = avg*0.9 + elapsed*0.1
+    metrics.observe("TLSHandshakeTime"+label, elapsed)
+
 class PeerCertificateCache:
     """A PeerCertificateCache validates certificate chains from MMTP servers,
        and remembers which chains we've already seen and validated."""
@@ -135,6 +135,7 @@ _COMMANDS = {
     "list-fragments" : ( 'mixminion.ClientMain', 'listFragments' ),
     "reassemble" :     ( 'mixminion.ClientMain', 'reassemble' ),
     "purge-fragments" :( 'mixminion.ClientMain', 'reassemble' ),
+    "agent" :          ( 'mixminion.ClientAgent', 'runAgent' ),
     "server-start" :   ( 'mixminion.server.ServerMain', 'runServer' ),
     "server-stop" :    ( 'mixminion.server.ServerMain', 'signalServer' ),
     "server-reload" :  ( 'mixminion.server.ServerMain', 'signalServer' ),
@@ -167,6 +168,7 @@ _USAGE = (
   "       inspect-surbs  [Describe a single-use reply block]\n"+
   "       count-packets  [DOCDOC]\n"
   "       ping           [Quick and dirty check whether a server is running]\n"
+  "       agent          [Keep a client running in the background]\n"
   "                               (For Servers)\n"+
   "       server-start   [Begin running a Mixminion server]\n"+
   "       server-stop    [Halt a running Mixminion server]\n"+
@@ -288,8 +290,12 @@ def commandShell(cmd,args):
 
 def getUIError():
     """Return the UIError class from mixminion.Common"""
-    commonModule = __import__('mixminion.Common', {}, {}, ['UIError'])
-    return commonModule.UIError
+    return getCommonClass('UIError')
+
+def getCommonClass(name):
+    """Return the class called 'name' from mixminion.Common"""
+    commonModule = __import__('mixminion.Common', {}, {}, [name])
+    return getattr(commonModule, name)
 
 def main(args,daemon=0):
     "Use <args> to fix path, pick a command and pass it arguments."
@@ -316,18 +322,26 @@ def main(args,daemon=0):
         print >>sys.stderr, "This software is for testing purposes only."\
               "  Anonymity is not guaranteed."
 
-    # Read the 'common' module to get the UIError class.  To simplify
-    # command implementation code, we catch all UIError exceptions here.
-    uiErrorClass = getUIError()
-    commonModule = __import__('mixminion.Common', {}, {}, ['UIError'])
-    filePermissionErrorClass = commonModule.MixFilePermissionError
+    # If there's a client agent running, let it run the command for us, so
+    # we don't have to load everything from scratch.
+    agentSocket = os.environ.get("MIXMINION_AGENT")
+    if agentSocket and not daemon:
+        agentModule = __import__('mixminion.ClientAgent', {}, {},
+                                 ['forwardCommand'])
+        if agentModule.AGENT_COMMANDS.has_key(args[1]):
+            status = agentModule.forwardCommand(agentSocket, args)
+            if status is not None:
+                sys.exit(status)
 
     # Read the module and function.
     command_module, command_fn = _COMMANDS[prefix+args[1]]
     mod = __import__(command_module, {}, {}, [command_fn])
     func = getattr(mod, command_fn)
 
-    # Invoke the command.
+    # Invoke the command.  To simplify command implementation code, we
+    # catch all UIError exceptions here.  (We don't look up the exception
+    # classes until something is raised, so that commands which never load
+    # mixminion.Common don't have to.)
     try:
         cmdFile = os.path.split(args[0])[1]
         cmdName = args[1]
@@ -336,9 +350,9 @@ def main(args,daemon=0):
     except getopt.GetoptError, e:
         sys.stderr.write(str(e)+"\n")
         func(commandStr, ["--help"])
-    except uiErrorClass, e:
+    except getUIError(), e:
         e.dumpAndExit()
-    except filePermissionErrorClass, e:
+    except getCommonClass('MixFilePermissionError'), e:
         print str(e)
         print "(You can disable file permission checking by setting",
         print "the MM_NO_FILE_PARANOIA"
@@ -8,6 +8,7 @@
 
 import time
 import threading
+from heapq import heappush, heappop
 
 __all__ = [ 'ScheduledEvent', 'OneTimeEvent', 'RecurringEvent',
             'RecurringComplexEvent', 'RecurringBackgroundEvent',
@@ -78,6 +79,9 @@ class RecurringBackgroundEvent:
         self.repeat = repeat
         self.running = 0
         self.lock = threading.Lock()
+        # Function to invoke (from the background thread) when we're done
+        # running, so that our scheduler can notice our new time.
+        self.onFinished = None
     def getNextTime(self):
         self.lock.acquire()
         try:
@@ -109,6 +113,8 @@ class RecurringBackgroundEvent:
             self.running = 0
         finally:
             self.lock.release()
+        if self.onFinished is not None:
+            self.onFinished()
 
 class RecurringComplexBackgroundEvent(RecurringBackgroundEvent):
     """An event to run a job at irregular intervals in the background."""
@@ -130,45 +136,90 @@ class RecurringComplexBackgroundEvent(RecurringBackgroundEvent):
             self.running = 0
         finally:
             self.lock.release()
+        if self.onFinished is not None:
+            self.onFinished()
 
 class Scheduler:
-    """Base class: used to run a bunch of events periodically."""
+    """Base class: used to run a bunch of events periodically.
+
+       Events are kept in a heap ordered by the time at which they next
+       want to run, so that finding the next event (to decide how long we
+       can sleep) and finding the events that are due are both cheap, no
+       matter how many events we have.
+
+       An event's next time only changes when it is invoked, so the heap
+       stays correct as long as nobody changes an event's time from
+       outside.  (Background events are the exception: while they run, they
+       don't know their next time, so we keep them aside until they are
+       done.)
+    """
     ##Fields:
-    # scheduledEvents: a list of ScheduledEvent objects.
-    # schedLock: a threading.RLock object to protect the list scheduledEvents
-    #   (but not the events themselves).
-    #XXXX008 needs more tests
+    # eventHeap: a heap of (time, seq, ScheduledEvent) tuples, one for each
+    #   event with a known next time.  'seq' is a counter, to break ties in
+    #   the order events were added.
+    # waitingEvents: a list of ScheduledEvent objects whose next time is
+    #   currently unknown.
+    # nextSeq: the next value of 'seq' to use.
+    # schedLock: a threading.RLock object to protect eventHeap and
+    #   waitingEvents (but not the events themselves).
     def __init__(self):
         """Create a new scheduler."""
-        self.scheduledEvents = []
+        self.eventHeap = []
+        self.waitingEvents = []
+        self.nextSeq = 0
         self.schedLock = threading.RLock()
 
+    def _addEvent(self, event):
+        """Helper: insert 'event' into the heap or the waiting list,
+           depending on its next time.  Caller must hold schedLock."""
+        when = event.getNextTime()
+        if when == -1:
+            return
+        elif when is None:
+            self.waitingEvents.append(event)
+        else:
+            heappush(self.eventHeap, (when, self.nextSeq, event))
+            self.nextSeq += 1
+
+    def _checkWaitingEvents(self):
+        """Helper: move every waiting event that now knows its next time
+           onto the heap.  Caller must hold schedLock."""
+        if not self.waitingEvents:
+            return
+        waiting = self.waitingEvents
+        self.waitingEvents = []
+        for event in waiting:
+            self._addEvent(event)
+
     def firstEventTime(self):
-        """Return the time at which an event will first occur."""
+        """Return the time at which an event will first occur, or -1 if no
+           scheduled event knows when it will next occur."""
         self.schedLock.acquire()
         try:
-            if not self.scheduledEvents:
+            self._checkWaitingEvents()
+            if self.eventHeap:
+                return self.eventHeap[0][0]
+            else:
                 return -1
-            first = 0
-            for e in self.scheduledEvents:
-                t = e.getNextTime()
-                if t in (-1,None): continue
-                if not first or t < first:
-                    first = t
-            return first
         finally:
             self.schedLock.release()
 
     def scheduleEvent(self, event):
         """Add a ScheduledEvent to this scheduler"""
-        when = event.getNextTime()
-        if when == -1:
-            return
+        if hasattr(event, 'onFinished'):
+            event.onFinished = self.eventFinished
         self.schedLock.acquire()
         try:
-            self.scheduledEvents.append(event)
+            self._addEvent(event)
         finally:
-            self.schedLock.acquire()
+            self.schedLock.release()
+
+    def eventFinished(self):
+        """Called (possibly from another thread) when a background event
+           is done running, and so knows when it next wants to run.
+           Subclasses that sleep until the next event should override this
+           to wake up and recompute their timeout."""
+        pass
 
     #XXXX008 -- these are only used for testing.
     def scheduleOnce(self, when, name, cb):
@@ -181,17 +232,38 @@ class Scheduler:
         self.scheduleEvent(RecurringComplexEvent(first, cb))
 
     def processEvents(self, now=None):
-        """Run all events that need to get called at the time 'now'."""
+        """Run all events that need to get called at the time 'now'.  Each
+           event runs at most once, even if it would want to run again
+           before 'now'."""
         if now is None:
             now = time.time()
+        runnable = []
         self.schedLock.acquire()
         try:
-            events = [(e.getNextTime(),e) for e in self.scheduledEvents]
-            self.scheduledEvents = [e for t,e in events if t != -1]
-            runnable = [(t,e) for t,e in events
-                        if t not in (-1,None) and t <= now]
+            self._checkWaitingEvents()
+            heap = self.eventHeap
+            while heap and heap[0][0] <= now:
+                when, seq, event = heappop(heap)
+                t = event.getNextTime()
+                if t == when:
+                    runnable.append(event)
+                elif t is None:
+                    self.waitingEvents.append(event)
+                elif t != -1:
+                    # The event changed its mind; put it back.
+                    heappush(heap, (t, seq, event))
         finally:
             self.schedLock.release()
-        runnable.sort()
-        for _,e in runnable:
-            e()
+
+        try:
+            for i in xrange(len(runnable)):
+                runnable[i]()
+        finally:
+            # Put back all the events we took, even if one of them raised
+            # an exception.
+            self.schedLock.acquire()
+            try:
+                for event in runnable:
+                    self._addEvent(event)
+            finally:
+                self.schedLock.release()
@@ -8,14 +8,17 @@
    descriptors.
    """
 
-__all__ = [ 'ServerInfo', 'ServerDirectory', 'displayServerByRouting',
-            'getNicknameByKeyID', 'SignedDirectory', 'parseDirectory' ]
+__all__ = [ 'ServerInfo', 'CompactServerInfo', 'ServerDirectory',
+            'displayServerByRouting', 'getNicknameByKeyID', 'SignedDirectory',
+            'parseDirectory', 'getSupersededServers' ]
 
+import binascii
 import re
+import sys
 import time
+import types
 
 import mixminion.Config
-import mixminion.MMTPClient
 import mixminion.Packet
 
 from mixminion.Common import IntervalSet, LOG, MixError, createPrivateDir, \
@@ -353,7 +356,7 @@ class ServerInfo(mixminion.Config._ConfigFile):
         """Return the digest of this server's public identity key, encoded in
            hexadecimal, with every 4 characters separated by spaces.
         """
-        d = getIdentityDigest(self)
+        d = self.getIdentityDigest()
         assert (len(d) % 2) == 0
         b = binascii.b2a_hex(d)
         if not space:
@@ -379,12 +382,16 @@ class ServerInfo(mixminion.Config._ConfigFile):
             return []
         return out["Protocols"]
 
+    def getPacketVersions(self):
+        """Return a list of the packet versions this server recognizes."""
+        formats = self['Server'].get("Packet-Versions")
+        if formats == None: formats = [ "0.3" ]
+        return formats
+
     def supportsPacketVersion(self):
         """Return true iff we can build packets in a format this server
            recognizes."""
-        formats = self['Server'].get("Packet-Versions")
-        if formats == None: formats = [ "0.3" ]
-        return mixminion.Packet.PACKET_VERSION in formats
+        return mixminion.Packet.PACKET_VERSION in self.getPacketVersions()
 
     def canRelayTo(self, otherDesc):
         """Return true iff this server can relay packets to the server
@@ -405,6 +412,9 @@ class ServerInfo(mixminion.Config._ConfigFile):
     def canStartAt(self):
         """Return true iff this server is one we (that is, this
            version of Mixminion) can send packets to directly."""
+        # (MMTPClient imports us, and is slow to load; don't import it
+        # until we need it.)
+        import mixminion.MMTPClient
         myInProtocols = self.getIncomingMMTPProtocols()
         for out in mixminion.MMTPClient.MMTPClientConnection.PROTOCOL_VERSIONS:
             if out in myInProtocols:
@@ -441,6 +451,11 @@ class ServerInfo(mixminion.Config._ConfigFile):
             caps.append('frag')
         return caps
 
+    def getSoftware(self):
+        """Return the software that this server says it runs, or "" if it
+           doesn't say."""
+        return self['Server'].get("Software", "")
+
     def isSameDescriptorAs(self, other):
         """Return true iff this is the same server descriptor as other."""
         return self.getDigest() == other.getDigest()
@@ -454,44 +469,56 @@ class ServerInfo(mixminion.Config._ConfigFile):
         """Return true iff this ServerInfo has been validated"""
         return self._isValidated
 
+    def getPublished(self):
+        """Return the time at which this ServerInfo was published."""
+        return self['Server']['Published']
+
+    def getValidAfter(self):
+        """Return the time at which this ServerInfo becomes valid."""
+        return self['Server']['Valid-After']
+
+    def getValidUntil(self):
+        """Return the time at which this ServerInfo stops being valid."""
+        return self['Server']['Valid-Until']
+
     def getIntervalSet(self):
         """Return an IntervalSet covering all the time at which this
            ServerInfo is valid."""
-        return IntervalSet([(self['Server']['Valid-After'],
-                             self['Server']['Valid-Until'])])
+        return IntervalSet([(self.getValidAfter(), self.getValidUntil())])
 
     def isExpiredAt(self, when):
         """Return true iff this ServerInfo expires before time 'when'."""
-        return self['Server']['Valid-Until'] < when
+        return self.getValidUntil() < when
 
     def isValidAt(self, when):
         """Return true iff this ServerInfo is valid at time 'when'."""
-        return (self['Server']['Valid-After'] <= when <=
-                self['Server']['Valid-Until'])
+        return self.getValidAfter() <= when <= self.getValidUntil()
 
     def isValidFrom(self, startAt, endAt):
         """Return true iff this ServerInfo is valid at all time from 'startAt'
            to 'endAt'."""
         assert startAt <= endAt
-        return (self['Server']['Valid-After'] <= startAt and
-                endAt <= self['Server']['Valid-Until'])
+        return (self.getValidAfter() <= startAt and
+                endAt <= self.getValidUntil())
 
     def isValidAtPartOf(self, startAt, endAt):
         """Return true iff this ServerInfo is valid at some time between
            'startAt' and 'endAt'."""
         assert startAt <= endAt
-        va = self['Server']['Valid-After']
-        vu = self['Server']['Valid-Until']
+        va = self.getValidAfter()
+        vu = self.getValidUntil()
         return ((startAt <= va and va <= endAt) or
                 (startAt <= vu and vu <= endAt) or
                 (va <= startAt and endAt <= vu))
 
     def isNewerThan(self, other):
         """Return true iff this ServerInfo was published after 'other',
-           where 'other' is either a time or a ServerInfo."""
-        if isinstance(other, ServerInfo):
-            other = other['Server']['Published']
-        return self['Server']['Published'] > other
+           where 'other' is either a time, a ServerInfo, or a
+           CompactServerInfo."""
+        if (isinstance(other, ServerInfo) or
+            isinstance(other, CompactServerInfo)):
+            other = other.getPublished()
+        return self.getPublished() > other
 
     def isSupersededBy(self, others):
         """Return true iff this ServerInfo is superseded by the other
@@ -504,13 +531,14 @@ class ServerInfo(mixminion.Config._ConfigFile):
            This function is only accurate when called with two valid
            server descriptors.
         """
-        valid = self.getIntervalSet()
+        newer = IntervalSet()
         for o in others:
             if (o.getDigest() != self.getDigest() and
                 o.isNewerThan(self) and
                 o.getNickname().lower() == self.getNickname().lower()):
-                valid -= o.getIntervalSet()
-        return valid.isEmpty()
+                newer.addInterval(o.getValidAfter(), o.getValidUntil())
+        return newer.containsInterval(self.getValidAfter(),
+                                      self.getValidUntil())
 
     def getFeature(self,sec,name):
         """Overrides getFeature from _ConfigFile."""
@@ -523,6 +551,275 @@ class ServerInfo(mixminion.Config._ConfigFile):
         else:
             return mixminion.Config._ConfigFile.getFeature(self,sec,name)
 
+# Base class for CompactServerInfo.  __slots__ only saves memory in
+# new-style classes, which we don't have before Python 2.2.
+if sys.version_info[:3] >= (2,2,0):
+    _SlottedBase = object
+else:
+    class _SlottedBase:
+        pass
+
+# Map from value to itself, for strings and tuples of strings that many
+# descriptors have in common: nicknames, hostnames, identity keys,
+# protocol lists, and so on.  CompactServerInfo keeps one copy of each.
+_SHARED_VALUES = {}
+# Largest number of values to hold in _SHARED_VALUES.
+MAX_SHARED_VALUES = 65536
+
+def _share(v):
+    """Return a value equal to 'v', using the copy in _SHARED_VALUES if
+       there is one."""
+    try:
+        return _SHARED_VALUES[v]
+    except KeyError:
+        if len(_SHARED_VALUES) >= MAX_SHARED_VALUES:
+            _SHARED_VALUES.clear()
+        _SHARED_VALUES[v] = v
+        return v
+
+class CompactServerInfo(_SlottedBase):
+    """A CompactServerInfo holds the parts of a server descriptor that
+       clients and directory servers look at most often, in much less
+       memory than a ServerInfo.  Use it for descriptors that you keep
+       around in bulk.
+
+       It answers the same queries as ServerInfo.  Keys are kept in their
+       ASN.1 encoding, and decoded when they are asked for.  We keep the
+       (small) Delivery sections that path selection checks; any other
+       section (for example, self['Testing']) is found by parsing the
+       descriptor's text again, so callers that do that often should use a
+       ServerInfo instead.
+    """
+    ## Fields:
+    # _nickname, _digest, _keyDigest, _published, _validAfter, _validUntil,
+    #    _hostname, _port: As returned by the corresponding accessors.
+    # _identity, _packetKey: The ASN.1 encodings of the identity and packet
+    #    keys.
+    # _inProtocols, _outProtocols, _packetVersions, _caps: Tuples holding
+    #    the values returned by the corresponding accessors.
+    # _software: As returned by getSoftware.
+    # _sections: A tuple of (section name, tuple of (key, value) items) for
+    #    each section in HELD_SECTIONS.
+    # _originalContents: The text of the descriptor.
+    # _isValidated, assumeValid: As for ServerInfo.
+    __slots__ = ( '_nickname', '_digest', '_keyDigest', '_published',
+                  '_validAfter', '_validUntil', '_hostname', '_port',
+                  '_identity', '_packetKey', '_inProtocols', '_outProtocols',
+                  '_packetVersions', '_caps', '_software', '_sections',
+                  '_originalContents', '_isValidated', 'assumeValid' )
+    # Used to identify version when pickling
+    MAGIC = "CSI-0.2"
+    # Sections of the descriptor that we keep, rather than parsing again.
+    HELD_SECTIONS = ( "Delivery/MBOX", "Delivery/SMTP",
+                      "Delivery/Fragmented" )
+    def __init__(self, server, contents=None):
+        """Create a new CompactServerInfo for the ServerInfo 'server', whose
+           text is 'contents'.  If 'contents' is not provided, 'server'
+           must have been created with _keepContents set."""
+        if contents is None:
+            contents = server._originalContents
+        assert contents
+        self._nickname = _share(server.getNickname())
+        self._digest = server.getDigest()
+        self._identity = _share(pk_encode_public_key(server.getIdentity()))
+        self._keyDigest = _share(sha1(self._identity))
+        self._packetKey = pk_encode_public_key(server.getPacketKey())
+        self._published = server.getPublished()
+        self._validAfter = server.getValidAfter()
+        self._validUntil = server.getValidUntil()
+        self._hostname = _share(server.getHostname())
+        self._port = server['Incoming/MMTP'].get("Port")
+        self._inProtocols = _share(tuple(server.getIncomingMMTPProtocols()))
+        self._outProtocols = _share(tuple(server.getOutgoingMMTPProtocols()))
+        self._packetVersions = _share(tuple(server.getPacketVersions()))
+        self._caps = _share(tuple(server.getCaps()))
+        self._software = _share(server.getSoftware())
+        sections = []
+        for sec in self.HELD_SECTIONS:
+            items = server[sec].items()
+            items.sort()
+            sections.append((sec, tuple(items)))
+        self._sections = _share(tuple(sections))
+        self._originalContents = contents
+        self._isValidated = server._isValidated
+        self.assumeValid = server.assumeValid
+
+    def __getstate__(self):
+        return (self.MAGIC,) + tuple([ getattr(self, name)
+                                       for name in self.__slots__ ])
+
+    def __setstate__(self, state):
+        if (type(state) != types.TupleType or
+            len(state) != len(self.__slots__)+1 or state[0] != self.MAGIC):
+            raise ValueError("Unrecognized state on pickled CompactServerInfo")
+        for name, value in zip(self.__slots__, state[1:]):
+            if name in ('_nickname', '_identity', '_keyDigest', '_hostname',
+                        '_inProtocols', '_outProtocols', '_packetVersions',
+                        '_caps', '_software', '_sections'):
+                value = _share(value)
+            setattr(self, name, value)
+
+    def getServerInfo(self):
+        """Parse this descriptor again, and return a ServerInfo for it."""
+        server = ServerInfo(string=self._originalContents, assumeValid=1,
+                            _keepContents=1)
+        server._isValidated = self._isValidated
+        return server
+
+    def holdsSection(self, sec):
+        """Return true iff we can look up the section 'sec' without parsing
+           the descriptor again."""
+        return sec in self.HELD_SECTIONS
+
+    def __getitem__(self, sec):
+        """As ServerInfo.__getitem__.  Parses the descriptor again unless
+           holdsSection(sec)."""
+        for name, items in self._sections:
+            if name == sec:
+                return dict(items)
+        return self.getServerInfo()[sec]
+
+    def get(self, sec, val="---"):
+        """As ServerInfo.get.  Parses the descriptor again unless
+           holdsSection(sec)."""
+        for name, items in self._sections:
+            if name == sec:
+                return dict(items)
+        return self.getServerInfo().get(sec, val)
+
+    def getFeature(self, sec, name):
+        """As ServerInfo.getFeature.  Parses the descriptor again unless
+           sec is '-' or holdsSection(sec)."""
+        if sec == '-':
+            if name in ("caps", "capabilities"):
+                return " ".join(self.getCaps())
+            elif name == 'fingerprint':
+                return self.getIdentityFingerprint()
+            assert 0
+        parseType = ServerInfo._syntax[sec].get(name)[1]
+        _, unparseFn = ServerInfo.CODING_FNS.get(parseType, (None,str))
+        try:
+            v = self[sec][name]
+        except KeyError:
+            return "<none>"
+        return unparseFn(v)
+
+    # Accessors: see the corresponding ServerInfo methods.
+    def getNickname(self):
+        return self._nickname
+
+    def getDigest(self):
+        return self._digest
+
+    def getHostname(self):
+        return self._hostname
+
+    def getPort(self):
+        return self._port
+
+    def getPacketKey(self):
+        return mixminion.Config._decodePublicKey(self._packetKey)
+
+    def getKeyDigest(self):
+        return self._keyDigest
+
+    def getIdentity(self):
+        return mixminion.Config._decodePublicKey(self._identity)
+
+    def getIdentityDigest(self):
+        return self._keyDigest
+
+    def getIncomingMMTPProtocols(self):
+        return list(self._inProtocols)
+
+    def getOutgoingMMTPProtocols(self):
+        return list(self._outProtocols)
+
+    def getPacketVersions(self):
+        return list(self._packetVersions)
+
+    def getCaps(self):
+        return list(self._caps)
+
+    def getSoftware(self):
+        return self._software
+
+    def getPublished(self):
+        return self._published
+
+    def getValidAfter(self):
+        return self._validAfter
+
+    def getValidUntil(self):
+        return self._validUntil
+
+# The rest of ServerInfo's queries only use the accessors above, so
+# CompactServerInfo shares their code.
+for _name in ("getMMTPHostInfo", "getRoutingInfo", "getIdentityFingerprint",
+              "supportsPacketVersion", "canRelayTo", "canRelay",
+              "canStartAt", "getRoutingFor", "isSameDescriptorAs",
+              "hasSameNicknameAs", "isValidated", "getIntervalSet",
+              "isExpiredAt", "isValidAt", "isValidFrom", "isValidAtPartOf",
+              "isNewerThan", "isSupersededBy"):
+    setattr(CompactServerInfo, _name, ServerInfo.__dict__[_name])
+del _name
+
+def getSupersededServers(servers):
+    """Given a list of ServerInfo objects, return a list of the ones that
+       are superseded by others in the list, in their original order.
+
+       This gives the same answer as calling s.isSupersededBy(servers) for
+       every s in 'servers', but takes O(N log N) time rather than
+       O(N^2)."""
+    entries = []
+    for s in servers:
+        entries.append((s.getNickname().lower(), s.getPublished(),
+                        s.getValidAfter(), s.getValidUntil(), s))
+    return findSuperseded(entries)
+
+def findSuperseded(entries):
+    """Given a list of (group, published, valid-after, valid-until, item)
+       tuples, return a list of the items that are superseded, in their
+       original order.  An entry is superseded when, for all the time it
+       is valid, some entry in the same group with a later published time
+       is also valid.  (Callers group descriptors by lowercase nickname,
+       or by identity.)
+
+       We sort the entries by group, and within each group from newest to
+       oldest.  Sweeping along that order, we keep the union of the
+       validity intervals of all the entries we've passed in the current
+       group: an entry is superseded iff that union covers its own
+       interval.  Entries published at the same time can't supersede one
+       another, so we add all of them to the union at once."""
+    order = [ (entries[i][0], -entries[i][1], i)
+              for i in xrange(len(entries)) ]
+    order.sort()
+    superseded = []
+    n = len(order)
+    i = 0
+    lastGroup = None
+    newer = None
+    while i < n:
+        group, negPublished, _ = order[i]
+        if newer is None or group != lastGroup:
+            newer = IntervalSet()
+            lastGroup = group
+        j = i
+        while (j < n and order[j][1] == negPublished and
+               order[j][0] == group):
+            j += 1
+        for _, _, idx in order[i:j]:
+            _, _, va, vu, _ = entries[idx]
+            if newer.containsInterval(va, vu):
+                superseded.append(idx)
+        for _, _, idx in order[i:j]:
+            _, _, va, vu, _ = entries[idx]
+            newer.addInterval(va, vu)
+        i = j
+
+    superseded.sort()
+    return [ entries[idx][4] for idx in superseded ]
+
 #----------------------------------------------------------------------
 # Server Directories
 
@@ -540,7 +837,8 @@ class ServerDirectory:
     #    servers in this directory.
     # header: a _DirectoryHeader object for the non-serverinfo part of this
     #    directory.
-    def __init__(self, string=None, fname=None, validatedDigests=None):
+    def __init__(self, string=None, fname=None, validatedDigests=None,
+                 compact=0):
         """Create a new ServerDirectory object, either from a literal <string>
            (if specified) or a filename [possibly gzipped].
 
@@ -548,6 +846,9 @@ class ServerDirectory:
            are the digests of already-validated descriptors.  Any descriptor
            whose (calculated) digest matches doesn't need to be validated
            again.
+
+           If compact is true, hold the servers as CompactServerInfo
+           objects.
         """
         if string:
             contents = string
@@ -571,9 +872,12 @@ class ServerDirectory:
         self.header = _DirectoryHeader(headercontents, digest)
         self.goodServerNames = [name.lower() for name in
                    self.header['Directory']['Recommended-Servers'] ]
-        servers = [ ServerInfo(string=s,
-                               validatedDigests=validatedDigests)
-                    for s in servercontents ]
+        servers = []
+        for s in servercontents:
+            si = ServerInfo(string=s, validatedDigests=validatedDigests)
+            if compact:
+                si = CompactServerInfo(si, s)
+            servers.append(si)
         self.allServers = servers[:]
         goodServers = [ s for s in servers
                         if s.getNickname().lower() in self.goodServerNames ]
@@ -607,8 +911,9 @@ class SignedDirectory:
     # signers
     # goodServerNames
     def __init__(self, string=None, fname=None, validatedDigests=None,
-                 _keepServerContents=0):
+                 _keepServerContents=0, compact=0):
         """DOCDOC
+           If compact is true, hold the servers as CompactServerInfo objects.
            raises ConfigError.
         """
         if string:
@@ -644,6 +949,8 @@ class SignedDirectory:
         for s in servers:
             si = ServerInfo(string=s, validatedDigests=validatedDigests,
                             _keepContents=_keepServerContents)
+            if compact:
+                si = CompactServerInfo(si, s)
             self.servers.append(si)
         self.goodServerNames = [ name.lower()
              for name in self.dirInfo['Directory-Info']['Recommended-Servers'] ]
@@ -696,7 +1003,7 @@ class SignedDirectory:
     def get(self, item, default=None):
         return self.header.get(item, default)
 
-def parseDirectory(fname, validatedDigests=None):
+def parseDirectory(fname, validatedDigests=None, compact=0):
     """DOCDOC"""
     try:
         s = readPossiblyGzippedFile(fname)
@@ -707,7 +1014,8 @@ def parseDirectory(fname, validatedDigests=None):
         tp = ServerDirectory
     else:
         tp = SignedDirectory
-    return tp(fname=fname, string=s, validatedDigests=validatedDigests)
+    return tp(fname=fname, string=s, validatedDigests=validatedDigests,
+              compact=compact)
 
 class _DirectoryHeader(mixminion.Config._ConfigFile):
     """Internal object: used to parse, validate, and store fields in a
@@ -43,6 +43,9 @@ class TLSConnection:
     #   events on self.sock?  (As a special case, if wantWrite is 2, we're
     #   currently waiting for socket.connect.)
     # lastActivity -- When did this connection last get any activity?
+    # handshakeTime -- How many seconds have we spent inside the TLS
+    #   library performing the handshake?  (Doesn't count time spent
+    #   waiting for the network.)
     #
     # inbuf -- a list of strings received from self.tls
     # inbuflen -- the total length of the strings in self.inbuf
@@ -71,6 +74,7 @@ class TLSConnection:
         self.address = address
         self.wantRead = self.wantWrite = 0
         self.lastActivity = time.time()
+        self.handshakeTime = 0.0
 
         self.__stateFn = None
         self.__setup = 0
@@ -265,14 +269,22 @@ class TLSConnection:
 
     def __connectFn(self, r, w, cap):
         """state function: client-side TLS handshaking"""
-        self.tls.connect() # might raise TLS*
+        start = time.time()
+        try:
+            self.tls.connect() # might raise TLS*
+        finally:
+            self.handshakeTime += time.time() - start
         self.__setup = 1
         self.onConnected()
         return 1 # We may be ready for the next state.
 
     def __acceptFn(self, r, w, cap):
         """state function: server-side TLS handshaking"""
-        self.tls.accept() # might raise TLS*
+        start = time.time()
+        try:
+            self.tls.accept() # might raise TLS*
+        finally:
+            self.handshakeTime += time.time() - start
         self.__setup = 1
         self.onConnected()
         return 1 # We may be ready for the next state.
@@ -15,24 +15,30 @@ __all__ = [ 'timeAll', 'testLeaks1', 'testLeaks2' ]
 
 import gc
 import os
+import re
 import stat
+import sys
 import cPickle
 import threading
 from time import time
 
 import mixminion._minionlib as _ml
+import mixminion.Config
+import mixminion.server.EventStats
+import mixminion.server.HashLog
 import mixminion.server.ServerQueue
 
 from mixminion.BuildMessage import _buildHeader, buildForwardPacket, \
      compressData, uncompressData, encodeMessage, decodePayload
 from mixminion.Common import secureDelete, installSIGCHLDHandler, \
-     waitForChildren, formatBase64, Lockfile
+     waitForChildren, formatBase64, formatDate, formatTime, IntervalSet, \
+     Lockfile, previousMidnight, writeFile
 from mixminion.Crypto import *
 from mixminion.Crypto import OAEP_PARAMETER
 from mixminion.Crypto import _add_oaep_padding, _check_oaep_padding
 from mixminion.Packet import SMTP_TYPE, CompressedDataTooLong, IPV4Info
 from mixminion.ServerInfo import ServerInfo
-from mixminion.server.HashLog import HashLog
+from mixminion.server.HashLog import HashLog, MappedHashLog
 from mixminion.server.PacketHandler import PacketHandler
 from mixminion.server.ServerConfig import ServerConfig
 from mixminion.test import FakeServerInfo
@@ -222,6 +228,72 @@ def cryptoTiming():
     print "bear D (32K)", timeit((
         lambda bkey=bkey: bear_decrypt(s32K, bkey)), 100)
 
+class _SlicingPRNG(AESCounterPRNG):
+    """An AESCounterPRNG that works the way RNG used to: it slices the bytes
+       it hands out off the front of its buffer, and getInt and shuffle
+       ask for 4 bytes at a time."""
+    def getBytes(self, n):
+        if n > len(self.bytes):
+            nMore = n+self.chunksize-len(self.bytes)
+            morebytes = self._prng(nMore)
+            res = self.bytes+morebytes[:n-len(self.bytes)]
+            self.bytes = morebytes[n-len(self.bytes):]
+            return res
+        else:
+            res = self.bytes[:n]
+            self.bytes = self.bytes[n:]
+            return res
+
+    def getInt(self, max):
+        _ord = ord
+        cutoff = 0x7fffffff - (0x7fffffff % max)
+        while 1:
+            b = self.getBytes(4)
+            o = (((((((_ord(b[0])&0x7f)<<8) +
+                       _ord(b[1]))<<8) +
+                       _ord(b[2]))<<8) +
+                       _ord(b[3]))
+            if o < cutoff:
+                return o % max
+
+    def shuffle(self, lst, n=None):
+        size = len(lst)
+        if n is None:
+            n = size
+        else:
+            n = min(n, size)
+        if n == size:
+            series = xrange(n-1)
+        else:
+            series = xrange(n)
+        getInt = self.getInt
+        for i in series:
+            swap = i+getInt(size-i)
+            lst[swap],lst[i] = lst[i],lst[swap]
+        return lst[:n]
+
+def rngTiming():
+    print "#==================== RNG ======================="
+    L10K = range(10000)
+    for name, c in (("slicing", _SlicingPRNG("a"*16)),
+                    ("buffered", AESCounterPRNG("a"*16))):
+        for max in (10, 1000):
+            t = timeit_((lambda c=c,max=max: c.getInt(max)), 20000)
+            print "%s getInt (%s): %s (%d calls/sec)" % (
+                name, max, timestr(t), 1/t)
+        t = timeit_((lambda c=c,L=L10K: c.shuffle(L)), 10)
+        print "%s shuffle (10000/10000): %s (%.1f calls/sec)" % (
+            name, timestr(t), 1/t)
+        t = timeit_((lambda c=c,L=L10K: c.shuffle(L,100)), 1000)
+        print "%s shuffle (100/10000): %s (%d calls/sec)" % (
+            name, timestr(t), 1/t)
+
+    c = AESCounterPRNG("a"*16)
+    print "getInts (1000, 10000 at once)", timeit(
+        (lambda c=c: c.getInts(1000, 10000)), 10)
+    print "getFloats (10000 at once)", timeit(
+        (lambda c=c: c.getFloats(10000)), 10)
+
 def rsaTiming():
     c = AESCounterPRNG()
     if hasattr(_ml, 'add_oaep_padding'):
@@ -309,28 +381,44 @@ def rsaTiming():
 
 #----------------------------------------------------------------------
 
+_HASHLOG_SUFFIXES = ("", ".dat", ".bak", ".dir", ".map", ".log", ".lock")
+
 def hashlogTiming():
     print "#==================== HASH LOGS ======================="
-    for load in (100, 1000, 10000, 100000):
-        fname = mix_mktemp(".db")
+    kinds = [ ("dbm", HashLog) ]
+    if mixminion.server.HashLog.fcntl is not None:
+        kinds.append(("mapped", MappedHashLog))
+    for kind, cls in kinds:
+        for load in (100, 1000, 10000, 100000):
+            fname = mix_mktemp(".db")
+            try:
+                _hashlogTiming(fname,load,kind,cls)
+            finally:
+                _removeHashlog(fname)
+    if len(kinds) > 1 and hasattr(os, 'fork'):
+        for nProcs in (1, 2, 4):
+            fname = mix_mktemp(".db")
+            try:
+                _sharedHashlogTiming(fname, nProcs)
+            finally:
+                _removeHashlog(fname)
+
+def _removeHashlog(fname):
+    for suffix in _HASHLOG_SUFFIXES:
         try:
-            _hashlogTiming(fname,load)
-        finally:
-            for suffix in ("", ".dat", ".bak", ".dir"):
-                try:
-                    os.unlink(fname+suffix)
-                except OSError:
-                    pass
+            os.unlink(fname+suffix)
+        except OSError:
+            pass
 
-def _hashlogTiming(fname, load):
+def _hashlogTiming(fname, load, kind="dbm", cls=HashLog):
 
     # Try more realistic access patterns.
     prng = AESCounterPRNG("a"*16)
 
-    print "Testing hash log (%s entries)"%load
+    print "Testing %s hash log (%s entries)"%(kind,load)
     if load > 20000:
         print "This may take a few minutes..."
-    h = HashLog(fname, "A")
+    h = cls(fname, "A")
     hashes = [ prng.getBytes(20) for _ in xrange(load) ]
 
     # XXXX Check under different circumstances -- different sync patterns.
@@ -364,13 +452,337 @@ def _hashlogTiming(fname, load):
 
     h.close()
     size = 0
-    for suffix in ("", ".dat", ".bak", ".dir"):
+    for suffix in _HASHLOG_SUFFIXES:
         if not os.path.exists(fname+suffix):
             continue
         size += os.stat(fname+suffix)[stat.ST_SIZE]
 
     print "File size (%s entries)"%load, spacestr(size)
 
+def _sharedHashlogTiming(fname, nProcs, load=20000):
+    # Several processes check and log digests in the same MappedHashLog,
+    # as decryption workers would.  Half of each process's digests are
+    # also logged by another process.
+    prng = AESCounterPRNG("b"*16)
+    hashes = [ prng.getBytes(20) for _ in xrange(load) ]
+    MappedHashLog(fname, "A").close()
+    per = load // (nProcs+1)
+    t = time()
+    pids = []
+    for i in xrange(nProcs):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                h = MappedHashLog(fname, "A")
+                for hash_ in hashes[i*per:(i+2)*per]:
+                    h.checkAndLogHash(hash_)
+                h.close()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    t = time()-t
+    print "Check+add from %s processes (%s each)" %(nProcs, 2*per), \
+          timestr(t/float(2*per*nProcs))
+
+#----------------------------------------------------------------------
+def pingLogTiming():
+    import mixminion.server.Pinger
+    if not mixminion.server.Pinger.canRunPinger():
+        print "Skipping ping log timing: no sqlite3 module."
+        return
+    print "#==================== PING LOG ======================="
+    prng = AESCounterPRNG("a"*16)
+    ids = [ prng.getBytes(20) for _ in xrange(100) ]
+    hashes = [ prng.getBytes(20) for _ in xrange(10000) ]
+    now = time()
+
+    def logEvents(log, n, ids=ids, hashes=hashes, now=now):
+        # One ping sent, one received, one connection: what a busy
+        # server sees for each of its pings.
+        for i in xrange(n):
+            log.queuedPing(hashes[i], [ids[i%100]], now=now+i)
+            log.gotPing(hashes[i], now=now+i+60)
+            log.connected(ids[i%100], now=now+i)
+
+    for n in 1000, 10000:
+        loc = os.path.join(mix_mktemp(), "pingdb")
+        log = mixminion.server.Pinger.openPingLog(None, location=loc)
+        log.startup(now)
+        t = time()
+        logEvents(log, n)
+        log.flush()
+        t = time()-t
+        print "Ping log events, same thread (%s events)"%(3*n), \
+              timestr(t/(3*n)), "(%d events/sec)"%(3*n/t)
+        log.close()
+
+        loc = os.path.join(mix_mktemp(), "pingdb")
+        thread = mixminion.server.Pinger.PingLogWriterThread()
+        log = mixminion.server.Pinger.openPingLog(None, location=loc,
+                                                  databaseThread=thread)
+        thread.start()
+        log.startup(now)
+        t = time()
+        logEvents(log, n)
+        thread.waitForFlush()
+        t = time()-t
+        print "Ping log events, writer thread (%s events)"%(3*n), \
+              timestr(t/(3*n)), "(%d events/sec)"%(3*n/t)
+        t = time()
+        log.calculateAll(now=now+n)
+        thread.waitForFlush()
+        t = time()-t
+        print "Recompute ping results (%s events)"%(3*n), timestr(t)
+        thread.shutdown(flush=0)
+        thread.join()
+        log._baseObject.close()
+
+#----------------------------------------------------------------------
+def schedulerTiming():
+    import select
+    from mixminion.ScheduleUtils import Scheduler, RecurringEvent, \
+         RecurringComplexEvent
+    print "#===================== SCHEDULER ====================="
+    now = time()
+    for n in 100, 10000:
+        s = Scheduler()
+        for i in xrange(n):
+            s.scheduleEvent(RecurringEvent(now+1000+i, lambda: None, n))
+        print "Find next event (%s events)"%n, timeit(s.firstEventTime, 1000)
+        print "Process events, none due (%s events)"%n, \
+              timeit(lambda s=s, now=now: s.processEvents(now), 1000)
+        s = Scheduler()
+        for i in xrange(n):
+            s.scheduleEvent(RecurringEvent(now+i*.001, lambda: None, n))
+        t = time()
+        s.processEvents(now+n)
+        t = time()-t
+        print "Process events, all due (%s events)"%n, timestr(t/n)
+
+    # Now see how close to its due time a mix-like event fires, when we
+    # sleep until the next event in the same way the server's main loop
+    # does.
+    INTERVAL = .05
+    N = 40
+    lateness = []
+    due = [ time()+INTERVAL ]
+    def mix(lateness=lateness, due=due, interval=INTERVAL):
+        t = time()
+        lateness.append(t-due[0])
+        due[0] = t+interval
+        return due[0]
+    s = Scheduler()
+    s.scheduleEvent(RecurringComplexEvent(due[0], mix))
+    while len(lateness) < N:
+        s.processEvents(time())
+        timeout = s.firstEventTime()-time()
+        if timeout > 0:
+            select.select([], [], [], timeout)
+    lateness.sort()
+    print "Mix timer lateness (%s firings): median %s, max %s" % (
+        N, timestr(lateness[N//2]), timestr(lateness[-1]))
+
+def tlsSessionTiming():
+    import socket
+    import mixminion.MMTPClient
+    from mixminion.server.MMTPServer import AsyncServer
+    from mixminion.test import _getMMTPServer, _getTLSContext, \
+         FakeDeliverable, TEST_PORT
+    print "#===================== TLS SESSIONS ==================="
+    N = 20
+    if PRECISION_FACTOR == 0:
+        N = 2
+    port = TEST_PORT+2
+    context = _getTLSContext(0)
+    for sessions, label in (0, "Full handshakes"), (64, "Resumed sessions"):
+        # One server listens; the other opens a connection for every
+        # packet, as a relay does when it delivers a batch.
+        server, listener, packetsIn, keyid = _getMMTPServer(
+            minimal=1, port=port, sessions=sessions)
+        client = AsyncServer()
+        certCache = mixminion.MMTPClient.PeerCertificateCache()
+        sessionCache = mixminion.MMTPClient.TLSSessionCache()
+        handshakeTime = [0.0]
+        total = 0.0
+        for i in xrange(N+1):
+            con = mixminion.MMTPClient.MMTPClientConnection(
+                socket.AF_INET, "127.0.0.1", port, keyid, context=context,
+                certCache=certCache, sessionCache=sessionCache)
+            con.addPacket(FakeDeliverable("X"*(32*1024)))
+            client.register(con)
+            t = time()
+            while con.sock is not None:
+                client.process(0.1)
+                server.process(0.1)
+            if i:
+                # Don't count the first connection: it can never resume.
+                total += time()-t
+                handshakeTime[0] += con.handshakeTime
+        server.remove(listener)
+        listener.shutdown()
+        print "%s: %s per connection, %s client handshake CPU" % (
+            label, timestr(total/N), timestr(handshakeTime[0]/N))
+
+def bandwidthSchedulerTiming():
+    from mixminion.server.MMTPServer import SelectAsyncServer
+    print "#================= BANDWIDTH SCHEDULER ================"
+    # Simulate one peer with a large outgoing batch, and many peers that
+    # each send a packet and wait for an acknowledgment, on a server
+    # limited to 200KB/sec.  Nothing touches the network: the clock and
+    # the connections are fake.
+    PACKET = 32*1024 + 26
+    ACK = 30
+    STEP = 0.01
+    class SimServer(SelectAsyncServer):
+        clock = 0.0
+        def _isMetered(self, c):
+            return 1
+        def _refill(self, timeout=None, now=None):
+            return SelectAsyncServer._refill(self, timeout, self.clock)
+    class SimCon:
+        def __init__(self, fd, outbuflen, inbuflen):
+            self.fd = fd
+            self.outbuflen = outbuflen
+            self.toRead = inbuflen
+            self.done = None
+        def fileno(self):
+            return self.fd
+        def getStatus(self):
+            return self.toRead > 0, self.outbuflen > 0, 1
+        def process(self, r, w, x, cap):
+            if cap is None:
+                cap = 1L<<40
+            n = 0
+            if r and self.toRead:
+                n = min(cap, self.toRead)
+                self.toRead -= n
+                if not self.toRead:
+                    # We got a whole packet; acknowledge it.
+                    self.outbuflen += ACK
+            if w and self.outbuflen:
+                m = min(cap-n, self.outbuflen)
+                self.outbuflen -= m
+                n += m
+            if not (self.toRead or self.outbuflen) and self.done is None:
+                self.done = SimServer.clock
+            return self.toRead > 0, self.outbuflen > 0, 1, n
+
+    for nPeers in 10, 100:
+        SimServer.clock = 0.0
+        server = SimServer()
+        server.setBandwidth(200*1024)
+        server.lastRefill = 0.0
+        bulk = SimCon(0, 10*1024*1024, 0)
+        peers = [ SimCon(i, 0, PACKET) for i in xrange(1, nPeers+1) ]
+        for c in [bulk]+peers:
+            server.register(c)
+        while [ c for c in peers if c.done is None ]:
+            SimServer.clock += STEP
+            server._refill()
+            active = []
+            for fd, (wr, ww) in server.state.items():
+                c = server.connections[fd]
+                wr, ww = server._getInterest(c, wr, ww)
+                if wr or ww:
+                    active.append((fd, c, wr, ww, 0))
+            server._processActive(active)
+        finished = [ c.done for c in peers ]
+        finished.sort()
+        sent = 10*1024*1024 - bulk.outbuflen
+        print ("%s peers + 1 bulk sender: median peer done at %.2fs, "
+               "last at %.2fs; bulk sent %sKB") % (
+            nPeers, finished[len(finished)//2], finished[-1], sent//1024)
+
+    # How long does a pass over many connections take?
+    server = SelectAsyncServer()
+    server._isMetered = lambda c: 1
+    server.setBandwidth(1L<<30)
+    cons = [ SimCon(i, 1L<<40, 0) for i in xrange(1000) ]
+    for c in cons:
+        server.register(c)
+    active = [ (c.fd, c, 0, 1, 0) for c in cons ]
+    print "Fair-share pass (1000 connections)", \
+          timeit(lambda s=server, a=active: s._processActive(a), 100)
+
+#----------------------------------------------------------------------
+# We'd like every client command to start up in less than this long on a
+# warm disk cache.
+STARTUP_BUDGET = 0.25
+
+def _timeCommand(argv, env, n):
+    """Run the program 'argv' with environment 'env' 'n' times, with all
+       output discarded, and return the fastest time."""
+    best = None
+    for _ in xrange(n):
+        t = time()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                fd = os.open("/dev/null", os.O_RDWR)
+                os.dup2(fd, 0)
+                os.dup2(fd, 1)
+                os.dup2(fd, 2)
+                os.execve(argv[0], argv, env)
+            finally:
+                os._exit(127)
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            # Our SIGCHLD handler got to it first.
+            pass
+        t = time()-t
+        if best is None or t < best:
+            best = t
+    return best
+
+def startupTiming():
+    import mixminion.Main
+    print "#================= COMMAND STARTUP ==================="
+    userdir = mix_mktemp()
+    rcFile = mix_mktemp()
+    writeFile(rcFile, "[Host]\n[User]\nUserDir: %s\n[DirectoryServers]\n"
+              % userdir)
+    emptyFile = mix_mktemp()
+    writeFile(emptyFile, "")
+    mainPy = os.path.join(os.path.split(mixminion.Main.__file__)[0],
+                          "Main.py")
+    env = os.environ.copy()
+    env['MM_NO_FILE_PARANOIA'] = '1'
+    if env.has_key('MIXMINION_AGENT'):
+        del env['MIXMINION_AGENT']
+
+    n = max(5*PRECISION_FACTOR, 1)
+    base = _timeCommand([sys.executable, "-c", "pass"], env, n)
+    print "Python interpreter startup", timestr(base)
+    # Run each command once first, so that the directory cache and friends
+    # exist before we start timing.
+    commands = [ ("version", []),
+                 ("send", ["--help"]),
+                 ("generate-surb", ["--help"]),
+                 ("flush", ["-f", rcFile]),
+                 ("inspect-queue", ["-f", rcFile]),
+                 ("clean-queue", ["-f", rcFile]),
+                 ("list-fragments", ["-f", rcFile]),
+                 ("decode", ["-f", rcFile, "-i", emptyFile]),
+                 ("inspect-surbs", ["-f", rcFile, emptyFile]),
+                 ("list-servers", ["-f", rcFile]) ]
+    for cmd, args in commands:
+        if cmd == 'version' or args == ["--help"]:
+            name = " ".join([cmd]+args)
+        else:
+            name = cmd
+            args = ["-Q"] + args
+        argv = [sys.executable, mainPy, cmd] + args
+        _timeCommand(argv, env, 1)
+        t = _timeCommand(argv, env, n)
+        if t > STARTUP_BUDGET:
+            note = " (over %s budget)" % timestr(STARTUP_BUDGET)
+        else:
+            note = ""
+        print "Startup: %-30s %s%s" % (name, timestr(t), note)
+
 #----------------------------------------------------------------------
 def directoryTiming():
     print "#========== DESCRIPTORS AND DIRECTORIES =============="
@@ -405,6 +817,17 @@ IP: 1.1.1.1
     print "Parse server descriptor (full validation)", \
           timeit(lambda desc=desc: ServerInfo(string=desc,assumeValid=0),
                  400)
+    def parseUncached(desc=desc):
+        mixminion.Config._PUBLIC_KEY_CACHE.clear()
+        ServerInfo(string=desc,assumeValid=1)
+    print "Parse server descriptor (no validation, no key cache)", \
+          timeit(parseUncached, 400)
+    print "Tokenize server descriptor (single pass)", \
+          timeit(lambda desc=desc:
+                 mixminion.Config._readRestrictedConfigFile(desc), 2000)
+    print "Tokenize server descriptor (line by line)", \
+          timeit(lambda desc=desc:
+                 mixminion.Config._readRestrictedConfigFileByLine(desc), 2000)
     info = ServerInfo(string=desc)
     dbin = cPickle.dumps(info, 1)
     print "Unpickle binary-pickled descriptor (%s/%s)"%(len(dbin),len(desc)), \
@@ -413,6 +836,195 @@ IP: 1.1.1.1
     print "Unpickle text-pickled descriptor (%s/%s)"%(len(dtxt),len(desc)), \
           timeit(lambda dtxt=dtxt: cPickle.loads(dtxt), 400)
 
+def compactDescriptorTiming(nServers=2000, nIdentities=40):
+    print "#=========== COMPACT SERVER DESCRIPTORS =============="
+    from mixminion.ServerInfo import CompactServerInfo, signServerInfo
+    from mixminion.server.ServerKeys import ServerKeyring
+    confStr = """
+[Server]
+EncryptIdentityKey: no
+PublicKeyLifetime: 1 day
+EncryptPrivateKey: no
+Homedir: %s
+Mode: relay
+Nickname: The-Server
+Contact-Email: a@b.c
+[Incoming/MMTP]
+Enabled: yes
+IP: 1.1.1.1
+""" % mix_mktemp()
+    keyring = ServerKeyring(ServerConfig(string=confStr))
+    keyring.getIdentityKey()
+    keyring.createKeys(1)
+    template = open(keyring.getServerKeysets()[0].getDescriptorFileName()
+                    ).read()
+
+    # A week of descriptors for nIdentities servers, as a client or a
+    # directory server would hold them.  (Real packet keys would all be
+    # different, but generating that many takes too long.)
+    now = time()
+    day = 24*60*60
+    midnight = previousMidnight(now)
+    idKeys = [ pk_generate(2048) for _ in xrange(nIdentities) ]
+    packetKeys = [ pk_generate(2048) for _ in xrange(nIdentities) ]
+    def setField(desc, field, value):
+        return re.sub(r"(?m)^%s:.*$"%field, "%s: %s"%(field,value), desc)
+    texts = []
+    for i in xrange(nServers):
+        key = idKeys[i % nIdentities]
+        va = midnight + ((i % 7) - 3)*day
+        d = setField(template, "Nickname", "Server%03d"%(i % nIdentities))
+        d = setField(d, "Identity", formatBase64(pk_encode_public_key(key)))
+        pkey = packetKeys[(i // nIdentities) % nIdentities]
+        d = setField(d, "Packet-Key", formatBase64(pk_encode_public_key(pkey)))
+        d = setField(d, "Published", formatTime(now - 3600 - i))
+        d = setField(d, "Valid-After", formatDate(va))
+        d = setField(d, "Valid-Until", formatDate(va+4*day))
+        texts.append(signServerInfo(d, key))
+
+    def load(texts=texts):
+        return [ ServerInfo(string=t, assumeValid=1) for t in texts ]
+    def loadCompact(texts=texts):
+        return [ CompactServerInfo(ServerInfo(string=t, assumeValid=1), t)
+                 for t in texts ]
+    print "Load %s descriptors as ServerInfo"%nServers, timeit(load, 1)
+    print "Load %s descriptors as CompactServerInfo"%nServers, \
+          timeit(loadCompact, 1)
+
+    for name, fn in ("ServerInfo", load), ("CompactServerInfo", loadCompact):
+        gc.collect()
+        nObjects = len(gc.get_objects())
+        servers = fn()
+        gc.collect()
+        print "Objects tracked by gc for %s %s" % (nServers, name), \
+              len(gc.get_objects()) - nObjects
+        print "Full garbage collection with %s %s" % (nServers, name), \
+              timeit(gc.collect, 5)
+        pickled = cPickle.dumps(servers, 1)
+        print "Unpickle %s %s (%s)" % (nServers, name, spacestr(len(pickled))),\
+              timeit(lambda pickled=pickled: cPickle.loads(pickled), 1)
+        del servers, pickled
+
+def consensusTiming(nVoters=9, nServers=2000, nIdentities=40):
+    print "#============ CONSENSUS DIRECTORIES =================="
+    import mixminion.directory.DirFormats as DF
+    from mixminion.ServerInfo import SignedDirectory, signServerInfo
+    from mixminion.server.ServerKeys import ServerKeyring
+    confStr = """
+[Server]
+EncryptIdentityKey: no
+PublicKeyLifetime: 1 day
+EncryptPrivateKey: no
+Homedir: %s
+Mode: relay
+Nickname: The-Server
+Contact-Email: a@b.c
+[Incoming/MMTP]
+Enabled: yes
+IP: 1.1.1.1
+""" % mix_mktemp()
+    keyring = ServerKeyring(ServerConfig(string=confStr))
+    keyring.getIdentityKey()
+    keyring.createKeys(1)
+    template = open(keyring.getServerKeysets()[0].getDescriptorFileName()
+                    ).read()
+
+    # Make nServers descriptors for nIdentities servers, each with several
+    # overlapping descriptors, by rewriting and re-signing our template.
+    now = time()
+    day = 24*60*60
+    midnight = previousMidnight(now)
+    idKeys = [ pk_generate(2048) for _ in xrange(nIdentities) ]
+    def setField(desc, field, value):
+        return re.sub(r"(?m)^%s:.*$"%field, "%s: %s"%(field,value), desc)
+    servers = []
+    for i in xrange(nServers):
+        key = idKeys[i % nIdentities]
+        va = midnight + ((i % 7) - 3)*day
+        d = setField(template, "Nickname", "Server%03d"%(i % nIdentities))
+        d = setField(d, "Identity", formatBase64(pk_encode_public_key(key)))
+        d = setField(d, "Published", formatTime(now - 3600 - i))
+        d = setField(d, "Valid-After", formatDate(va))
+        d = setField(d, "Valid-Until", formatDate(va+4*day))
+        d = signServerInfo(d, key)
+        servers.append(ServerInfo(string=d, assumeValid=1, _keepContents=1))
+
+    # Each voter lists a different 95% of the servers.
+    voterKeys = [ pk_generate(2048) for _ in xrange(nVoters) ]
+    voters = [ (pk_fingerprint(k), "http://dir%d/"%i)
+               for i,k in zip(range(nVoters), voterKeys) ]
+    voters.sort()
+    rng = getCommonPRNG()
+    names = [ "Server%03d"%i for i in xrange(nIdentities) ]
+    votes = []
+    for i in xrange(nVoters):
+        mine = [ s for s in servers if rng.getInt(20) != 0 ]
+        v = DF._generateDirectory(voterKeys[i], "vote", mine, names, voters,
+                                  midnight, ["0.0.8"], ["0.0.8"])
+        votes.append(("voter%d"%i, v))
+    print "Votes: %s voters x %s descriptors (%s each)" % (
+        nVoters, nServers, spacestr(len(votes[0][1])))
+
+    print "Parse and check votes as SignedDirectory, serially", \
+          timeit(lambda votes=votes, voters=voters, va=midnight, DF=DF:
+                 [ DF.checkVoteDirectory(voters, va,
+                              SignedDirectory(string=v,_keepServerContents=1))
+                   for _,v in votes ], 1)
+
+    for n in 1, 2, 4, DF.getCPUCount():
+        vd = {}
+        print "Consensus (%s workers, cold)"%n, \
+              timeit(lambda votes=votes, voters=voters, va=midnight, DF=DF,
+                            n=n, vd=vd, k=voterKeys[0]:
+                     DF.generateConsensusDirectory(k, voters, va, votes,
+                                                   vd, nWorkers=n), 1)
+        print "Consensus (%s workers, digests cached)"%n, \
+              timeit(lambda votes=votes, voters=voters, va=midnight, DF=DF,
+                            n=n, vd=vd, k=voterKeys[0]:
+                     DF.generateConsensusDirectory(k, voters, va, votes,
+                                                   vd, nWorkers=n), 1)
+
+#----------------------------------------------------------------------
+
+def supersessionTiming(nDescriptors=50000, nNicknames=500):
+    print "#============ SUPERSEDED DESCRIPTORS ================="
+    from mixminion.ServerInfo import findSuperseded
+    # A synthetic archive: each server publishes a descriptor about once a
+    # day, valid for one to four days.  Entries are (nickname, published,
+    # valid-after, valid-until, item), as findSuperseded takes them.
+    day = 24*60*60
+    rng = getCommonPRNG()
+    entries = []
+    for i in xrange(nDescriptors):
+        n, k = i % nNicknames, i // nNicknames
+        published = k*day + rng.getInt(day)
+        va = previousMidnight(published)
+        entries.append(("server%04d"%n, published, va,
+                        va+(1+rng.getInt(4))*day, i))
+
+    def pairwise(entries):
+        # The old way: subtract every newer descriptor with the same
+        # nickname from each descriptor's validity.
+        byNickname = {}
+        for e in entries:
+            byNickname.setdefault(e[0],[]).append(e)
+        result = []
+        for nickname, p, va, vu, item in entries:
+            valid = IntervalSet([(va,vu)])
+            for _, p2, va2, vu2, _ in byNickname[nickname]:
+                if p2 > p:
+                    valid -= IntervalSet([(va2,vu2)])
+            if valid.isEmpty():
+                result.append(item)
+        return result
+
+    assert findSuperseded(entries) == pairwise(entries)
+    print "Find superseded, pairwise (%s descriptors)"%len(entries), \
+          timeit(lambda entries=entries,pairwise=pairwise: pairwise(entries),
+                 1)
+    print "Find superseded, sweep (%s descriptors)"%len(entries), \
+          timeit(lambda entries=entries: findSuperseded(entries), 5)
+
 #----------------------------------------------------------------------
 
 def buildMessageTiming():
@@ -540,10 +1152,49 @@ def serverQueueTiming():
             os.unlink(os.path.join(d1,p))
 
 
+def mixPoolTiming():
+    print "#==================== MIX POOLS ======================="
+    ServerQueue = mixminion.server.ServerQueue
+    for size in (1000, 10000, 100000):
+        d = mix_mktemp()
+        pool = ServerQueue.BinomialCottrellMixPool(d, 600, 6, sendRate=.3)
+        if size > 20000:
+            print "This may take a few minutes..."
+        for i in xrange(size):
+            pool.queueObject(i)
+        # Pretend the first half of the packets arrived a while ago.
+        pool.index.times[:size//2] = [ time()-3600 ] * (size//2)
+        it = max(2, 100000//size)
+        for kind in ("indexed", "listdir"):
+            if kind == "listdir":
+                t = time()
+                pool.index = None
+                pool.count(1)
+                print "Recount pool (%s packets)"%size, timestr(time()-t)
+            print "Cottrell batch (%s packets, %s)"%(size, kind), timeit(
+                lambda pool=pool: ServerQueue.CottrellMixPool.getBatch(pool),
+                it)
+            print "Binomial batch, 30%% (%s packets, %s)"%(size, kind), \
+                  timeit(lambda pool=pool: pool.getBatch(), it)
+            print "Binomial batch, 1%% (%s packets, %s)"%(size, kind), \
+                  timeit(lambda pool=pool: pool.pickWithProbability(.01), it)
+            print "Pick 100 (%s packets, %s)"%(size, kind), timeit(
+                lambda pool=pool: pool.pickRandom(100), it)
+            if kind == "indexed":
+                print "Pick 100 older than 10 min (%s packets, %s)"%(
+                    size, kind), timeit(
+                    lambda pool=pool: pool.pickRandom(100, time()-600), it)
+                t = time()
+                pool.useIndex()
+                print "Build index (%s packets)"%size, timestr(time()-t)
+        for fn in os.listdir(d):
+            os.unlink(os.path.join(d, fn))
+
 #----------------------------------------------------------------------
 class DummyLog:
     def seenHash(self,h): return 0
     def logHash(self,h): pass
+    def checkAndLogHash(self,h): return 0
 
 def serverProcessTiming():
     print "#================= SERVER PROCESS ====================="
@@ -565,6 +1216,27 @@ def serverProcessTiming():
     print "Server process (swap, no log)", timeit(
         lambda sp=sp, m_swap=m_swap: sp.processPacket(m_swap), 100)
 
+    # Packet tracing should cost nothing when it's off.  (The stage times
+    # would go to the metrics, which are off here.)
+    ES = mixminion.server.EventStats
+    for name, tracer in (("off", ES.NilPacketTracer()),
+                         ("every packet", ES.PacketTracer(1.0))):
+        def traced(sp=sp, m_noswap=m_noswap, tracer=tracer):
+            traceID = tracer.start()
+            sp.processPacket(m_noswap)
+            if traceID is not None:
+                tracer.stamp(traceID, "Crypto")
+                tracer.finish(traceID)
+        def traceOnly(tracer=tracer):
+            traceID = tracer.start()
+            if traceID is not None:
+                tracer.stamp(traceID, "Crypto")
+                tracer.finish(traceID)
+        print "Server process (no swap, no log, tracing %s)" % name, \
+              timeit(traced, 100)
+        print "Tracer calls for one stage (tracing %s)" % name, \
+              timeit(traceOnly, 10000)
+
 def encodingTiming():
     print "#=============== END-TO-END ENCODING =================="
     shortP = "hello world"
@@ -594,6 +1266,65 @@ def encodingTiming():
             pass
     print "Decode overcompressed payload", timeit(decode, 1000)
 
+#----------------------------------------------------------------------
+def bulkDecodingTiming(nIdentities=200, nPackets=400):
+    print "#============ BULK PAYLOAD DECODING =================="
+    from mixminion.BuildMessage import PayloadDecoder, _getRandomTag
+    from mixminion.Packet import ENC_FWD_OVERHEAD, OAEP_OVERHEAD, \
+         SECRET_LEN, TAG_LEN
+    # A nym server's mailbox: three quarters of the packets are replies
+    # to one of nIdentities SURB identities, and the rest are encrypted
+    # forward messages to our RSA key.
+    prng = AESCounterPRNG()
+    rsa = pk_generate(2048)
+    userKeys = [ ("nym%d"%i, prng.getBytes(20)) for i in xrange(nIdentities) ]
+    replyPayload = encodeMessage("Hello!!!"*512, 0)[0]
+    efwdPayload = encodeMessage("Hello!!!"*512, ENC_FWD_OVERHEAD)[0]
+
+    def makeReply(userKey, payload=replyPayload, prng=prng):
+        # As it arrives after 4 hops.
+        while 1:
+            tag = _getRandomTag(prng)
+            if sha1(tag+userKey+"Validate")[-1] == '\x00':
+                break
+        secretPRNG = AESCounterPRNG(sha1(tag+userKey+"Generate")[:16])
+        secrets = [ secretPRNG.getBytes(SECRET_LEN) for _ in xrange(4) ]
+        secrets.reverse()
+        for s in secrets:
+            payload = lioness_decrypt(payload,
+                           Keyset(s).getLionessKeys(PAYLOAD_ENCRYPT_MODE))
+        return payload, tag
+
+    def makeEfwd(rsa=rsa, payload=efwdPayload, prng=prng):
+        n = rsa.get_modulus_bytes() - OAEP_OVERHEAD - SECRET_LEN
+        sessionKey = prng.getBytes(SECRET_LEN)
+        k = Keyset(sessionKey).getLionessKeys(END_TO_END_ENCRYPT_MODE)
+        enc = (pk_encrypt(sessionKey+payload[:n], rsa) +
+               lioness_encrypt(payload[n:], k))
+        return enc[TAG_LEN:], enc[:TAG_LEN]
+
+    packets = []
+    for i in xrange(nPackets):
+        if i % 4 == 3:
+            packets.append(makeEfwd())
+        else:
+            packets.append(makeReply(userKeys[prng.getInt(nIdentities)][1]))
+
+    def oneAtATime(packets=packets, rsa=rsa, userKeys=userKeys):
+        for p, t in packets:
+            assert decodePayload(p, t, rsa, userKeys) is not None
+    def bulk(nThreads, packets=packets, rsa=rsa, userKeys=userKeys):
+        for p, _, _ in PayloadDecoder(rsa, userKeys, nThreads).decodeAll(
+            packets):
+            assert p is not None
+
+    print "Decode %s packets for %s identities, one at a time" % (
+        nPackets, nIdentities), timeit(oneAtATime, 1)
+    for nThreads in 1, 2, 4:
+        print "Decode %s packets for %s identities, %s threads" % (
+            nPackets, nIdentities, nThreads), \
+            timeit(lambda n=nThreads,bulk=bulk: bulk(n), 1)
+
 #----------------------------------------------------------------------
 def timeEfficiency():
     print "#================= ACTUAL v. IDEAL ====================="
@@ -1015,14 +1746,25 @@ def timeAll(name, args):
 
     fecTiming()
     cryptoTiming()
+    rngTiming()
     rsaTiming()
     buildMessageTiming()
     directoryTiming()
+    compactDescriptorTiming()
+    consensusTiming()
+    supersessionTiming()
     fileOpsTiming()
     encodingTiming()
+    bulkDecodingTiming()
     serverQueueTiming()
+    mixPoolTiming()
     serverProcessTiming()
     hashlogTiming()
+    pingLogTiming()
+    schedulerTiming()
+    tlsSessionTiming()
+    bandwidthSchedulerTiming()
+    startupTiming()
     timeEfficiency()
     #import profile
     #profile.run("import mixminion.benchmark; mixminion.benchmark.directoryTiming()")
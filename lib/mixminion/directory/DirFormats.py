@@ -6,6 +6,8 @@
    General purpose code for directory servers.
    """
 
+import cPickle
+import os
 import sys
 
 import mixminion
@@ -17,11 +19,16 @@ from mixminion.Common import formatBase64, formatDate, floorDiv, LOG, \
 from mixminion.Config import ConfigError
 from mixminion.Crypto import pk_sign, sha1, pk_encode_public_key, \
      pk_fingerprint
+from mixminion.ServerInfo import findSuperseded, _cleanForDigest, \
+     _getMultisignedDirectoryDigest, _splitMultisignedDirectory
 
 def _generateDirectory(identity, status,
                       servers, goodServerNames,
                       voters, validAfter,
-                      clientVersions, serverVersions):
+                      clientVersions, serverVersions, serverText=None):
+    """Return a signed directory containing 'servers'.  If 'serverText' is
+       provided, it must be the concatenated text of the servers, already
+       in sorted order; it is used instead of 'servers'."""
 
     assert status in ("vote", "consensus")
     va = formatDate(previousMidnight(validAfter))
@@ -34,7 +41,6 @@ def _generateDirectory(identity, status,
     for keyid, urlbase in voters:
         v.append("Voting-Server: %s %s\n"
                  % (keyid, urlbase))
-    servers = sortServerList(servers)
 
     cvers = ", ".join(sortVersionList(clientVersions))
     svers = ", ".join(sortVersionList(serverVersions))
@@ -49,17 +55,23 @@ def _generateDirectory(identity, status,
                "MixminionServer: %s\n")%(status, va, vu, rec, "".join(v),
                                          cvers, svers)
 
-    unsigned = "".join([dirInfo]+[s._originalContents for s in servers])
+    if serverText is None:
+        servers = sortServerList(servers)
+        serverText = "".join([s._originalContents for s in servers])
+    unsigned = dirInfo+serverText
     signature = getDirectorySignature(unsigned, identity)
     return signature+unsigned
 
 def generateVoteDirectory(identity, servers, goodServerNames,
                           voters, validAfter, clientVersions, serverVersions,
-                          validatedDigests=None):
+                          validatedDigests=None, serverText=None):
+    # If serverText is provided, it holds the (already sorted and
+    # validated) descriptors, and servers is ignored.
     valid = []
     for server in servers:
         try:
-            if isinstance(server, mixminion.ServerInfo.ServerInfo):
+            if (isinstance(server, mixminion.ServerInfo.ServerInfo) or
+                isinstance(server, mixminion.ServerInfo.CompactServerInfo)):
                 assert server._originalContents
                 s = server
             else:
@@ -73,7 +85,8 @@ def generateVoteDirectory(identity, servers, goodServerNames,
 
     val = _generateDirectory(identity, 'vote', valid, goodServerNames,
                              voters, validAfter,
-                             clientVersions, serverVersions)
+                             clientVersions, serverVersions,
+                             serverText=serverText)
 
     try:
         directory = mixminion.ServerInfo.SignedDirectory(
@@ -89,59 +102,107 @@ def generateVoteDirectory(identity, servers, goodServerNames,
     return val
 
 def generateConsensusDirectory(identity, voters, validAfter, directories,
-                               validatedDigests=None):
-    # directories is (source, stringable) list
-
-    # First -- whom shall we vote with?
-    goodDirectories = {} # {fingerprint: (src,SignedDirectory)}
-    serverMap = {} # digest->server info
-    serversByDir = {} # keyid->list of digest
+                               validatedDigests=None, nWorkers=None):
+    """Generate and return a consensus directory signed with 'identity',
+       from the vote directories in 'directories', a list of (source,
+       stringable) tuples.
+
+       Votes and server descriptors are checked in up to 'nWorkers'
+       forked processes (by default, one per CPU).  A descriptor that
+       appears in several votes is only parsed once, and the consensus is
+       assembled from the descriptors' text without keeping any ServerInfo
+       objects around.
+    """
+    if nWorkers is None:
+        nWorkers = getCPUCount()
+
+    # First, split every vote into its parts and find the distinct
+    # descriptors.  This is just string slicing, so we do it here.
+    votes = [] # list of (src, digest, sigs, info, list of descriptor hash)
+    descText = {} # sha1 of descriptor text -> descriptor text
     for src, val in directories:
         LOG.debug("Checking vote directory from %s",src)
-        val = str(val)
+        val = _cleanForDigest(str(val))
         try:
-            directory = mixminion.ServerInfo.SignedDirectory(string=val,
-                                  validatedDigests=validatedDigests,
-                                  _keepServerContents=1)
-        except ConfigError,e:
+            digest = _getMultisignedDirectoryDigest(val)
+            sigs, info, servers = _splitMultisignedDirectory(val)
+        except ConfigError, e:
             LOG.warn("Rejecting malformed vote directory from %s: %s",src,e)
             continue
-        try:
-            checkVoteDirectory(voters, validAfter, directory)
-        except BadVote, e:
-            LOG.warn("Rejecting vote directory from %s: %s", src, e)
+        hashes = []
+        for s in servers:
+            h = sha1(s)
+            if not descText.has_key(h):
+                descText[h] = s
+            hashes.append(h)
+        votes.append((src, digest, sigs, info, hashes))
+
+    # Next, parse and check the vote headers and the descriptors.  This is
+    # where the time goes: every signature needs an RSA operation.
+    uniqueHashes = descText.keys()
+    tasks = [ ("vote", v) for v in votes ] + \
+            [ ("desc", descText[h]) for h in uniqueHashes ]
+    def checkOne(task, voters=voters, validAfter=validAfter,
+                 validatedDigests=validatedDigests):
+        if task[0] == "vote":
+            _, digest, sigs, info, _ = task[1]
+            return _checkVoteHeaderText(voters, validAfter, digest, sigs, info)
+        else:
+            return _summarizeDescriptor(task[1], validatedDigests)
+    results = _forkMap(checkOne, tasks, nWorkers)
+    del tasks
+
+    descs = {} # sha1 of descriptor text -> _summarizeDescriptor result
+    descErrors = {} # sha1 of descriptor text -> error
+    for h, r in zip(uniqueHashes, results[len(votes):]):
+        if r[0] == "ok":
+            descs[h] = r
+            if validatedDigests is not None:
+                validatedDigests[r[1]] = 1
+        else:
+            descErrors[h] = r[1]
+
+    # Now -- whom shall we vote with?
+    goodVotes = {} # {fingerprint: (src, _checkVoteHeaderText result)}
+    serversByDir = {} # keyid->list of descriptor hash
+    for (src, _, _, _, hashes), r in zip(votes, results):
+        if r[0] == "malformed":
+            LOG.warn("Rejecting malformed vote directory from %s: %s",
+                     src, r[1])
             continue
-        LOG.info("Accepting vote directory from %s",src)
-
-        # Remember server descs minimally to save room.
-        sig = directory.getSignatures()[0]
-        fp = pk_fingerprint(sig['Signed-Directory']['Directory-Identity'])
-        serversByDir[fp] = []
-        for s in directory.getAllServers():
-            d = s.getDigest()
-            serversByDir[fp].append(d)
-            if not serverMap.has_key(d):
-                serverMap[d] = s
-
-        del directory.servers[:] # Save RAM
-        if goodDirectories.has_key(fp):
-            LOG.warn("Multiple directories with fingerprint %s; ignoring one from %s",
-                     fp, goodDirectories[fp][0])
-        goodDirectories[fp] = (src, directory)
-
-    goodVotes = [ v for _,v in goodDirectories.values() ]
+        for h in hashes:
+            if descErrors.has_key(h):
+                LOG.warn("Rejecting malformed vote directory from %s: %s",
+                         src, descErrors[h])
+                break
+        else:
+            if r[0] == "bad":
+                LOG.warn("Rejecting vote directory from %s: %s", src, r[1])
+                continue
+            order = [ _descriptorOrdering(descs[h]) for h in hashes ]
+            if not _listIsSorted(order):
+                LOG.warn("Rejecting vote directory from %s: %s", src,
+                   "Server descriptors are not in correct sorted order")
+                continue
+            LOG.info("Accepting vote directory from %s",src)
+            fp = r[1]
+            if goodVotes.has_key(fp):
+                LOG.warn("Multiple directories with fingerprint %s; ignoring one from %s",
+                         fp, goodVotes[fp][0])
+            goodVotes[fp] = (src, r)
+            serversByDir[fp] = hashes
+    del results
+
+    goodVotes = [ r for _,r in goodVotes.values() ]
 
     # Next -- what is the result of the vote? (easy cases)
     threshold = floorDiv(len(voters)+1, 2)
     includedClientVersions = commonElements(
-        [ d['Recommended-Software']['MixminionClient'] for d in goodVotes ],
-        threshold)
+        [ r[2] for r in goodVotes ], threshold)
     includedServerVersions = commonElements(
-        [ d['Recommended-Software']['MixminionServer'] for d in goodVotes ],
-        threshold)
+        [ r[3] for r in goodVotes ], threshold)
     includedRecommended = commonElements(
-        [ d['Directory-Info']['Recommended-Servers'] for d in goodVotes ],
-        threshold)
+        [ r[4] for r in goodVotes ], threshold)
 
     # Hard part -- what servers go in?
 
@@ -150,13 +211,11 @@ def generateConsensusDirectory(identity, voters, validAfter, directories,
     identNickname = {}
     badIdents = {}
     identsByVoter = []
-    digestsByIdent = {}
-    for digestList in serversByDir.values():
+    digestsByIdent = {} # identity -> {digest: descriptor hash}
+    for hashList in serversByDir.values():
         idents = {}
-        for digest in digestList:
-            s = serverMap[digest]
-            n = s.getNickname()
-            ident = s.getIdentityDigest()
+        for h in hashList:
+            _, digest, n, ident = descs[h][:4]
             try:
                 if n != identNickname[ident]:
                     LOG.warn("Multiple nicknames for %s",formatBase64(ident))
@@ -165,38 +224,161 @@ def generateConsensusDirectory(identity, voters, validAfter, directories,
                 identNickname[ident]=n
 
             idents[ident] = 1
-            digestsByIdent.setdefault(ident,{})[digest]=1
+            digestsByIdent.setdefault(ident,{}).setdefault(digest,h)
         identsByVoter.append(idents.keys())
 
     includedIdentities = [ i for i in commonElements(identsByVoter, threshold)
                            if not badIdents.has_key(i) ]
 
     # okay -- for each identity, what servers do we include?
-    includedServers = []
+    candidates = []
     for ident in includedIdentities:
-        servers = [ serverMap[digest] for digest in digestsByIdent[ident].keys()]
-        for s in servers:
-            if s['Server']['Valid-Until'] < validAfter:
-                continue
-            elif s['Server']['Valid-After'] - MAX_WINDOW > validAfter:
-                continue
-            elif s.isSupersededBy(servers):
-                continue
-            includedServers.append(s)
+        for h in digestsByIdent[ident].values():
+            s = descs[h]
+            candidates.append((ident, s[4], s[5], s[6], h))
+    superseded = {}
+    for h in findSuperseded(candidates):
+        superseded[h] = 1
+    included = []
+    for _, _, _, _, h in candidates:
+        s = descs[h]
+        if s[6] < validAfter:
+            continue
+        elif s[5] - MAX_WINDOW > validAfter:
+            continue
+        elif superseded.has_key(h):
+            continue
+        included.append((_descriptorOrdering(s), h))
 
-    # Generate and sign the result.
+    # Generate and sign the result, copying the descriptors' text straight
+    # from the votes.
+    included.sort()
+    serverText = "".join([ descText[h] for _, h in included ])
     val = _generateDirectory(identity, "consensus",
-                             includedServers, includedRecommended,
+                             [], includedRecommended,
                              voters, validAfter,
-                             includedClientVersions, includedServerVersions)
+                             includedClientVersions, includedServerVersions,
+                             serverText=serverText)
     try:
-        directory = mixminion.ServerInfo.SignedDirectory(
-            string=val, validatedDigests=validatedDigests)
-    except ConfigError,e:
-        raise MixError("Generated a consensus directory we cannot parse: %s"%e)
+        sigs, info, _ = _splitMultisignedDirectory(val)
+        for sig in sigs:
+            mixminion.ServerInfo._DirectorySignature(sig)
+        mixminion.ServerInfo._DirectoryInfo(info)
+    except ConfigError, e:
+        raise MixError("Generated a consensus directory we cannot parse: %s"
+                       % e)
 
     return val
 
+def _checkVoteHeaderText(voters, validAfter, digest, sigs, info):
+    """Helper for generateConsensusDirectory: parse and check the signature
+       sections 'sigs' and the header 'info' of a vote directory whose
+       digest is 'digest'.  Returns ("malformed", error) if we can't parse
+       them; ("bad", error) if they aren't an acceptable vote; and
+       otherwise ("ok", keyid, client versions, server versions,
+       recommended servers).  Doesn't check the descriptors."""
+    try:
+        signatures = []
+        for idx in range(len(sigs)):
+            sig = mixminion.ServerInfo._DirectorySignature(sigs[idx])
+            if sig.getDigest() != digest:
+                LOG.warn("Signature #%s does not match directory; skipping",
+                         idx+1)
+            else:
+                signatures.append(sig)
+        dirInfo = mixminion.ServerInfo._DirectoryInfo(info)
+    except ConfigError, e:
+        return ("malformed", str(e))
+    try:
+        keyid = _checkVoteHeader(voters, validAfter, signatures, dirInfo)
+    except BadVote, e:
+        return ("bad", str(e))
+    return ("ok", keyid,
+            dirInfo['Recommended-Software']['MixminionClient'],
+            dirInfo['Recommended-Software']['MixminionServer'],
+            dirInfo['Directory-Info']['Recommended-Servers'])
+
+def _summarizeDescriptor(text, validatedDigests=None):
+    """Helper for generateConsensusDirectory: parse and validate the
+       server descriptor in 'text'.  Returns ("bad", error) if it isn't
+       valid; otherwise returns ("ok", digest, nickname, identity digest,
+       published, valid-after, valid-until)."""
+    try:
+        s = mixminion.ServerInfo.ServerInfo(string=text,
+                                            validatedDigests=validatedDigests)
+    except ConfigError, e:
+        return ("bad", str(e))
+    return ("ok", s.getDigest(), s.getNickname(), s.getIdentityDigest(),
+            s.getPublished(), s.getValidAfter(), s.getValidUntil())
+
+def _descriptorOrdering(d):
+    """Return the same key as _serverOrdering, for a descriptor summary as
+       returned by _summarizeDescriptor."""
+    return (d[2].lower(), d[5], d[1])
+
+def getCPUCount():
+    """Return the number of CPUs online on this host, or 1 if we can't
+       tell."""
+    try:
+        n = os.sysconf('SC_NPROCESSORS_ONLN')
+    except (AttributeError, ValueError, OSError):
+        return 1
+    if n < 1:
+        return 1
+    return n
+
+def _forkMap(fn, items, nWorkers):
+    """Return [ fn(item) for item in items ], computing the results in up
+       to 'nWorkers' forked processes.  Each result must be picklable.  If
+       we can't fork, or there's only one worker, just compute the results
+       here.  Raises MixError if a worker fails."""
+    if nWorkers > len(items):
+        nWorkers = len(items)
+    if nWorkers <= 1 or not hasattr(os, 'fork'):
+        return map(fn, items)
+
+    # Worker i handles items i, i+nWorkers, i+2*nWorkers, ...
+    workers = []
+    for i in xrange(nWorkers):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # We're the child.  Never return from here.
+            try:
+                os.close(rfd)
+                try:
+                    r = (1, map(fn, items[i::nWorkers]))
+                except:
+                    r = (0, str(sys.exc_info()[1]))
+                out = os.fdopen(wfd, 'wb')
+                cPickle.dump(r, out, 1)
+                out.close()
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        workers.append((pid, os.fdopen(rfd, 'rb')))
+
+    chunks = []
+    for pid, f in workers:
+        try:
+            chunks.append(cPickle.load(f))
+        except (EOFError, cPickle.UnpicklingError):
+            chunks.append((0, "Worker %s exited unexpectedly"%pid))
+        f.close()
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            # A SIGCHLD handler may have reaped it already.
+            pass
+    for ok, r in chunks:
+        if not ok:
+            raise MixError("Error in worker process: %s"%r)
+
+    results = [None]*len(items)
+    for i in xrange(nWorkers):
+        results[i::nWorkers] = chunks[i][1]
+    return results
+
 MAX_WINDOW = 30*24*60*60
 
 class BadVote(Exception):
@@ -205,9 +387,16 @@ class BadVote(Exception):
 
 def checkVoteDirectory(voters, validAfter, directory):
     # my (sorted, uniqd) list of voters, SignedDirectory instance, URL
+    _checkVoteHeader(voters, validAfter, directory.getSignatures(),
+                     directory.dirInfo)
+    if not serverListIsSorted(directory.getAllServers()):
+        raise BadVote("Server descriptors are not in correct sorted order")
 
+def _checkVoteHeader(voters, validAfter, sigs, dirInfo):
+    """Helper: raise BadVote unless the signatures 'sigs' and the parsed
+       header 'dirInfo' make an acceptable vote.  Returns the fingerprint
+       of the voter."""
     # Is there a single signature?
-    sigs = directory.getSignatures()
     if len(sigs) == 0:
         raise BadVote("No signatures")
     elif len(sigs) > 1:
@@ -229,25 +418,25 @@ def checkVoteDirectory(voters, validAfter, directory):
         raise BadVote("Invalid signature")
 
     # Is the version valid?
-    if (directory['Directory-Info']['Version'] !=
+    if (dirInfo['Directory-Info']['Version'] !=
         mixminion.ServerInfo._DirectoryInfo.VERSION):
         raise BadVote("Unrecognized version (%s)")
 
     # Is the directory marked as a vote?
-    if directory['Directory-Info']['Status'] != 'vote':
+    if dirInfo['Directory-Info']['Status'] != 'vote':
         raise BadVote("Not marked as vote")
 
     # Do we agree about the voters?
-    if not _listIsSorted(directory.dirInfo.voters):
+    if not _listIsSorted(dirInfo.voters):
         raise BadVote("Voters not sorted")
 
     vkeys = {}
-    for k,u in directory.dirInfo.voters:
+    for k,u in dirInfo.voters:
         vkeys[k]=u
     mykeys = {}
     for k,u in voters: mykeys[k]=u
 
-    for k,u in directory.dirInfo.voters:
+    for k,u in dirInfo.voters:
         try:
             if mykeys[k] != u:
                 raise BadVote("Mismatched URL for voter %s (%s vs %s)"%(
@@ -258,11 +447,11 @@ def checkVoteDirectory(voters, validAfter, directory):
         if not vkeys.has_key(k):
             raise BadVote("Missing voter %s at %s"%(k,u))
 
-    assert directory.dirInfo.voters == voters
+    assert dirInfo.voters == voters
 
     # Are the dates right?
-    va = directory['Directory-Info']['Valid-After']
-    vu = directory['Directory-Info']['Valid-Until']
+    va = dirInfo['Directory-Info']['Valid-After']
+    vu = dirInfo['Directory-Info']['Valid-Until']
     if va != validAfter:
         raise BadVote("Validity date is wrong (%s)"%formatDate(va))
     elif vu != previousMidnight(va+24*60*60+60):
@@ -271,11 +460,10 @@ def checkVoteDirectory(voters, validAfter, directory):
 
     # Is everything sorted right?
     for vs in ['MixminionClient', 'MixminionServer']:
-        versions = directory['Recommended-Software'][vs]
+        versions = dirInfo['Recommended-Software'][vs]
         if not versionListIsSorted(versions):
             raise BadVote("%s:%s is not in correct sorted order"%(vs,versions))
-    if not serverListIsSorted(directory.getAllServers()):
-        raise BadVote("Server descriptors are not in correct sorted order")
+    return keyid
 
 def getDirectorySignature(directory, pkey):
     digest = mixminion.ServerInfo._getMultisignedDirectoryDigest(directory)
@@ -294,8 +482,7 @@ def _versionOrdering(v):
         return (sys.maxint, sys.maxint)
 
 def _serverOrdering(s):
-    return ( s.getNickname().lower(), s['Server']['Valid-After'],
-             s.getDigest() )
+    return ( s.getNickname().lower(), s.getValidAfter(), s.getDigest() )
 
 def sortServerList(servers):
     return _sortedBy(servers, _serverOrdering)
@@ -8,13 +8,14 @@
 
 __all__ = [ ]
 
+import getopt
 import gzip
 import os
 import shutil
 import sys
 import time
 from mixminion.Common import createPrivateDir, formatTime, iterFileLines, LOG, \
-     UIError
+     replaceFile, UIError
 from mixminion.Config import ConfigError
 from mixminion.Crypto import init_crypto, pk_fingerprint, pk_generate, \
      pk_PEM_load, pk_PEM_save
@@ -30,6 +31,9 @@ Usage: mixminion dir <command>
       generate                 [Generate and sign a new directory]
       fingerprint              [Return the fingerprint of this directory's pk]
       rebuildcache             [Rebuild a corrupted or removed identity cache]
+      serve [-a addr] [-p port] [-t threads]
+                               [Accept descriptors over HTTP (default
+                                127.0.0.1, port 8080)]
 """.strip()
 
 def getDirectory():
@@ -170,17 +174,31 @@ def cmd_generate(args):
 
     fname = serverList.getDirectoryFilename()
 
-    if location.endswith(".gz"):
-        fIn = open(fname)
-        fOut = gzip.GzipFile(location, 'wb')
-        fOut.write(fIn.read())
-        fIn.close()
-        fOut.close()
-    else:
-        shutil.copy(fname, location)
+    publishFile(fname, location)
 
     print "Published."
 
+def publishFile(fname, location):
+    """Copy the directory in the file 'fname' to 'location', compressing
+       it if 'location' ends with '.gz'.  The directory is copied a block
+       at a time, and replaces any existing file at 'location' atomically.
+    """
+    if not location.endswith(".gz"):
+        shutil.copy(fname, location)
+        return
+
+    tmpname = location+".tmp"
+    fIn = open(fname, 'rb')
+    try:
+        fOut = gzip.GzipFile(tmpname, 'wb')
+        try:
+            shutil.copyfileobj(fIn, fOut, 64*1024)
+        finally:
+            fOut.close()
+    finally:
+        fIn.close()
+    replaceFile(tmpname, location)
+
 def cmd_fingerprint(args):
     """[Entry point] Print the fingerprint for this directory's key."""
 
@@ -190,13 +208,43 @@ def cmd_fingerprint(args):
     key = d.getIdentity()
     print pk_fingerprint(key)
 
+def cmd_serve(args):
+    """[Entry point] Run a long-lived HTTP service to accept (possibly
+       batched) descriptor submissions, in place of the CGI."""
+    from mixminion.directory.DirSubmit import runSubmissionServer
+    try:
+        options, args = getopt.getopt(args, "a:p:t:",
+                                      ["address=", "port=", "threads="])
+    except getopt.GetoptError, e:
+        raise UIError(str(e))
+    if args:
+        raise UIError("mixminion dir serve takes no arguments")
+    # Listen on localhost unless told otherwise: the service is meant to
+    # sit behind the web server that publishes the directory.
+    address, port, threads = "127.0.0.1", 8080, 2
+    for o, v in options:
+        try:
+            if o in ('-a', '--address'):
+                address = v
+            elif o in ('-p', '--port'):
+                port = int(v)
+            elif o in ('-t', '--threads'):
+                threads = int(v)
+        except ValueError:
+            raise UIError("%s expects an integer"%o)
+
+    d = getDirectory()
+    runSubmissionServer(d.getInbox(), d.submitBase, (address, port),
+                        threads)
+
 SUBCOMMANDS = { 'initialize' : cmd_init,
                 'update' : cmd_update,
                 'list' : cmd_list,
                 'import-new' : cmd_import,
                 'generate' : cmd_generate,
                 'fingerprint' : cmd_fingerprint,
-                'rebuildcache' : cmd_rebuildcache
+                'rebuildcache' : cmd_rebuildcache,
+                'serve' : cmd_serve
                 }
 
 def main(cmd, args):
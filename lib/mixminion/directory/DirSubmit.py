@@ -0,0 +1,409 @@
+# Copyright 2002-2004 Nick Mathewson.  See LICENSE for licensing information.
+# $Id$
+
+"""mixminion.directory.DirSubmit
+
+   A long-running service that accepts server descriptors over HTTP.
+
+   Unlike the CGI in DirCGI, the service takes any number of descriptors
+   in a single request, and doesn't make the publisher wait while they
+   are checked.  Descriptors are written to a queue on disk as they
+   arrive, checked by a pool of worker threads, and their results are
+   remembered so that publishers can poll for them.  A descriptor we
+   have already seen recently is answered from our records without being
+   queued again.
+
+   Protocol:
+      POST /publish with one or more 'desc' fields: submit descriptors.
+         If there is a single descriptor and no 'batch' field, we wait a
+         little while for it to be checked, and answer in the same format
+         as DirCGI, so that existing servers can publish here unchanged.
+         Otherwise we answer at once.
+      GET /status?id=ID&id=ID...: report on earlier submissions.
+
+   Either way, the reply is text/plain, with one block per descriptor:
+         Submission: ID
+         State: queued|accepted|pending|rejected|busy|unknown
+         Message: ...
+   A 'busy' descriptor was not queued because too many others were
+   waiting to be checked; the publisher should try again later.
+"""
+
+__all__ = [ 'SubmissionQueue', 'SubmissionHandler', 'runSubmissionServer' ]
+
+import BaseHTTPServer
+import binascii
+import cgi
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+import mixminion.Filestore
+
+from mixminion.Common import LOG, MixError, UIError, tryUnlink
+from mixminion.Crypto import sha1
+from mixminion.ServerInfo import ServerInfo, _cleanForDigest
+from mixminion.ThreadUtils import MessageQueue
+from mixminion.directory.ServerInbox import ServerQueuedException
+
+# How long do we remember the result of a submission?
+STATUS_LIFETIME = 6*60*60
+# How long do we wait for a single, unbatched descriptor to be checked?
+SYNC_TIMEOUT = 20
+# Largest request body we'll accept.
+MAX_REQUEST_LEN = 4<<20
+# Largest number of descriptors we'll hold waiting to be checked.
+MAX_QUEUED = 1000
+# Largest number of finished submissions we'll remember results for.
+MAX_STATUS_ENTRIES = 10000
+# Largest number of HTTP requests we'll handle at once.
+MAX_HANDLERS = 16
+# How long do we wait for a client to send its request?
+REQUEST_TIMEOUT = 60
+
+class SubmissionQueue:
+    """A SubmissionQueue holds descriptors that have been submitted but not
+       yet checked, and the results for descriptors we've checked
+       recently.  Descriptors are identified by the hex-encoded SHA-1
+       digest of their (cleaned) text.
+    """
+    ## Fields:
+    # inbox: The ServerInbox that receives descriptors once we've parsed
+    #    them.
+    # store: A StringStore holding the text of unchecked descriptors.
+    # status: A map from submission ID to (state, message, time); 'state'
+    #    is one of "queued", "accepted", "pending", "rejected", or "busy",
+    #    and 'time' is when we last changed it.
+    # validatedDigests: A map from descriptor digest to the time we last
+    #    checked its signature.
+    # jobs: A MessageQueue of (id, handle, source) for descriptors waiting
+    #    to be checked; None tells a worker to exit.
+    # nQueued: The number of submissions in the "queued" state.
+    # threads: A list of our worker threads.
+    # _lock: A Condition to protect 'status' and the inbox, and notified
+    #    whenever a submission is finished.
+    def __init__(self, inbox, location, nThreads=2):
+        """Create a new SubmissionQueue to feed descriptors into 'inbox',
+           keeping unchecked descriptors in the directory 'location'.
+           We check descriptors in 'nThreads' threads, once start() is
+           called."""
+        self.inbox = inbox
+        self.store = mixminion.Filestore.StringStore(location, create=1,
+                                                     scrub=1)
+        self.status = {}
+        self.validatedDigests = {}
+        self.nQueued = 0
+        self.jobs = MessageQueue()
+        self.threads = []
+        self.nThreads = nThreads
+        self._lock = threading.Condition()
+
+    def start(self):
+        """Launch our worker threads, and queue any descriptors that were
+           waiting when we last shut down."""
+        now = time.time()
+        for h in self.store.getAllMessages():
+            id = getSubmissionID(self.store.messageContents(h))
+            self.status[id] = ("queued", "Waiting to be checked", now)
+            self.nQueued += 1
+            self.jobs.put((id, h, "(queued before restart)"))
+        for i in xrange(self.nThreads):
+            t = threading.Thread(target=self._run)
+            t.setDaemon(1)
+            t.start()
+            self.threads.append(t)
+
+    def shutdown(self):
+        """Tell our worker threads to stop once they have finished their
+           current descriptors, and wait for them.  Descriptors still in
+           the queue will be checked after our next start()."""
+        for _ in self.threads:
+            self.jobs.put(None)
+        for t in self.threads:
+            t.join()
+        del self.threads[:]
+
+    def submit(self, texts, source):
+        """Queue every descriptor in the list 'texts', received from
+           'source', and return a list of their submission IDs.  Texts that
+           we are already checking, or have checked recently, are not
+           queued again.  If more than MAX_QUEUED descriptors would be
+           waiting, the extra ones are marked 'busy' instead."""
+        ids = [ getSubmissionID(t) for t in texts ]
+        new = []
+        newIDs = {}
+        nBusy = 0
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._expire(now)
+            for id, text in zip(ids, texts):
+                if newIDs.has_key(id):
+                    continue
+                state = self.status.get(id, ("busy",))[0]
+                if state != "busy":
+                    continue
+                newIDs[id] = 1
+                if self.nQueued + len(new) >= MAX_QUEUED:
+                    self.status[id] = ("busy", "Too many descriptors "
+                                       "waiting; try again later", now)
+                    nBusy += 1
+                    continue
+                new.append((id, text))
+            if new:
+                # Write all the new descriptors with a single sync.
+                handles = self.store.queueMessages([ t for _,t in new ])
+                for (id, _), h in zip(new, handles):
+                    self.status[id] = ("queued", "Waiting to be checked", now)
+                    self.jobs.put((id, h, source))
+                self.nQueued += len(new)
+        finally:
+            self._lock.release()
+        if new:
+            LOG.info("Queued %s new descriptors (of %s) from %s",
+                     len(new), len(texts), source)
+        if nBusy:
+            LOG.warn("Too many descriptors waiting; turned away %s from %s",
+                     nBusy, source)
+        return ids
+
+    def getStatus(self, id):
+        """Return a (state, message) tuple for the submission 'id'; the
+           state is 'unknown' if we don't know about it."""
+        self._lock.acquire()
+        try:
+            state, msg, _ = self.status.get(id, ("unknown",
+                                                 "No such submission", 0))
+            return state, msg
+        finally:
+            self._lock.release()
+
+    def waitFor(self, id, timeout):
+        """Wait up to 'timeout' seconds for the submission 'id' to leave the
+           'queued' state.  Return its (state, message)."""
+        end = time.time() + timeout
+        self._lock.acquire()
+        try:
+            while 1:
+                state, msg, _ = self.status.get(id, ("unknown",
+                                                     "No such submission", 0))
+                left = end - time.time()
+                if state != "queued" or left <= 0:
+                    return state, msg
+                self._lock.wait(left)
+        finally:
+            self._lock.release()
+
+    def _expire(self, now):
+        """Helper: forget all finished submissions and validated digests
+           that are older than STATUS_LIFETIME.  If we still remember more
+           than MAX_STATUS_ENTRIES finished submissions, forget the oldest
+           ones.  Caller must hold _lock."""
+        cutoff = now - STATUS_LIFETIME
+        finished = []
+        for id, (state, _, when) in self.status.items():
+            if state == "queued":
+                continue
+            if when < cutoff:
+                del self.status[id]
+            else:
+                finished.append((when, id))
+        if len(finished) > MAX_STATUS_ENTRIES:
+            finished.sort()
+            for _, id in finished[:len(finished)-MAX_STATUS_ENTRIES]:
+                del self.status[id]
+        for digest, when in self.validatedDigests.items():
+            if when < cutoff:
+                del self.validatedDigests[digest]
+
+    def _run(self):
+        """Main loop for a worker thread."""
+        while 1:
+            job = self.jobs.get()
+            if job is None:
+                return
+            id, handle, source = job
+            try:
+                self._check(id, handle, source)
+            except:
+                LOG.error_exc(sys.exc_info(),
+                              "Error while checking descriptor from %s",
+                              source)
+                self._finish(id, handle, "rejected",
+                             "Internal error while checking descriptor")
+
+    def _check(self, id, handle, source):
+        """Helper: parse and validate the descriptor in 'handle', then give
+           it to the inbox and record the result."""
+        text = self.store.messageContents(handle)
+        try:
+            server = ServerInfo(string=text, assumeValid=0,
+                                validatedDigests=self.validatedDigests,
+                                _keepContents=1)
+        except MixError, e:
+            LOG.warn("Rejected invalid server from %s: %s", source, e)
+            self._finish(id, handle, "rejected",
+                         "Server descriptor was not valid: %s"%e)
+            return
+
+        self._lock.acquire()
+        try:
+            self.validatedDigests[server.getDigest()] = time.time()
+            try:
+                self.inbox.acceptServer(server, source)
+            except UIError, e:
+                result = ("rejected", str(e))
+            except ServerQueuedException, e:
+                result = ("pending", str(e))
+            else:
+                result = ("accepted", "Accepted.")
+        finally:
+            self._lock.release()
+        self._finish(id, handle, result[0], result[1])
+
+    def _finish(self, id, handle, state, message):
+        """Helper: record the result for submission 'id', and remove its
+           descriptor from the queue."""
+        self.store.removeMessage(handle)
+        self._lock.acquire()
+        try:
+            self.status[id] = (state, message, time.time())
+            self.nQueued -= 1
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+        if self.jobs.empty():
+            self.store.cleanQueue(_unlinkAll)
+
+def getSubmissionID(text):
+    """Return the submission ID for the descriptor in 'text'."""
+    return binascii.b2a_hex(sha1(_cleanForDigest(text)))
+
+def _unlinkAll(fnames):
+    """Helper: remove every file in 'fnames'.  Descriptors are public, so
+       there's no need to shred them."""
+    for fn in fnames:
+        tryUnlink(fn)
+
+def formatStatus(id, state, message):
+    """Return the reply block describing submission 'id'."""
+    return "Submission: %s\nState: %s\nMessage: %s\n" % (id, state, message)
+
+class SubmissionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles HTTP requests for a SubmissionQueue; the server must have
+       a 'submissions' attribute holding the queue."""
+    # Don't let a client that never finishes its request hold a handler.
+    timeout = REQUEST_TIMEOUT
+    def do_POST(self):
+        path = urlparse.urlparse(self.path)[2]
+        if path != "/publish":
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.getheader('content-length'))
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+        if length > MAX_REQUEST_LEN:
+            self.send_error(413)
+            return
+        form = cgi.parse_qs(self.rfile.read(length))
+        texts = form.get('desc', [])
+        if not texts:
+            self._reply("Status: 0\nMessage: no desc field found\n")
+            return
+
+        queue = self.server.submissions
+        source = "<%s:%s>" % self.client_address
+        ids = queue.submit(texts, source)
+
+        if len(ids) == 1 and not form.has_key('batch'):
+            # Answer like the CGI does.
+            state, msg = queue.waitFor(ids[0], SYNC_TIMEOUT)
+            if state == 'queued':
+                msg = "Queued for checking as %s" % ids[0]
+            ok = state not in ('rejected', 'busy')
+            self._reply("Status: %d\nMessage: %s\n%s" % (
+                ok, msg, formatStatus(ids[0], state, msg)))
+            return
+
+        reply = []
+        for id in ids:
+            state, msg = queue.getStatus(id)
+            reply.append(formatStatus(id, state, msg))
+        self._reply("".join(reply))
+
+    def do_GET(self):
+        _, _, path, _, query, _ = urlparse.urlparse(self.path)
+        if path != "/status":
+            self.send_error(404)
+            return
+        queue = self.server.submissions
+        reply = []
+        for id in cgi.parse_qs(query).get('id', []):
+            state, msg = queue.getStatus(id.lower())
+            reply.append(formatStatus(id, state, msg))
+        self._reply("".join(reply))
+
+    def _reply(self, body):
+        """Helper: send 'body' as a text/plain response."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug("%s: %s", self.address_string(), format%args)
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    """An HTTP server that handles each request in its own thread, but
+       stops accepting connections while MAX_HANDLERS requests are
+       being handled."""
+    ## Fields:
+    # handlerSlots: A semaphore with one slot for each request we're
+    #    willing to handle at once.
+    daemon_threads = 1
+    allow_reuse_address = 1
+    def __init__(self, address, handlerClass, maxHandlers=MAX_HANDLERS):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handlerClass)
+        self.handlerSlots = threading.Semaphore(maxHandlers)
+
+    def process_request(self, request, client_address):
+        self.handlerSlots.acquire()
+        try:
+            SocketServer.ThreadingMixIn.process_request(
+                self, request, client_address)
+        except:
+            self.handlerSlots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            self.handlerSlots.release()
+
+def runSubmissionServer(inbox, location, address, nThreads=2):
+    """Accept descriptors on the (host, port) pair 'address', and feed
+       them to 'inbox' using a SubmissionQueue in 'location'.  Runs
+       until interrupted.  Only listen on a public address if the
+       directory is meant to take descriptors from other hosts."""
+    queue = SubmissionQueue(inbox, location, nThreads)
+    queue.start()
+    server = _ThreadingHTTPServer(address, SubmissionHandler)
+    server.submissions = queue
+    LOG.info("Accepting descriptors on %s:%s", address[0], address[1])
+    try:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        LOG.info("Shutting down descriptor service")
+        server.server_close()
+        queue.shutdown()
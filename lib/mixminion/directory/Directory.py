@@ -39,6 +39,7 @@ class Directory:
        Layout:
           BASEDIR/dir            [Base for ServerList.]
           BASEDIR/inbox          [Base for ServerInbox.]
+          BASEDIR/inbox/submit   [Queue for the submission service.]
 
        DOCDOC
     """
@@ -47,6 +48,8 @@ class Directory:
     # location: the base of the directory server's files.
     # inboxBase, directoryBase, cacheFile: filenames for the components
     #     of this directory.
+    # submitBase: directory for descriptors waiting in the submission
+    #     service.
     # cache, inbox, serverList: the actual components of this directory.
     #     None until first initialized.
     def __init__(self, config=None, location=None):
@@ -58,6 +61,7 @@ class Directory:
             self.location = location
         assert location
         self.inboxBase = os.path.join(self.location, "inbox")
+        self.submitBase = os.path.join(self.inboxBase, "submit")
         self.directoryBase = os.path.join(self.location, "dir")
         self.cacheFile = os.path.join(self.location, "identity_cache")
         self.cache = None
@@ -90,7 +94,8 @@ class Directory:
             (ib,                  dir_uid, cgi_gid, 0750, 0),
             (join(ib, "new"),     dir_uid, cgi_gid, 0770, 0),
             (join(ib, "reject"),  dir_uid, cgi_gid, 0770, 0),
-            (join(ib, "updates"), dir_uid, cgi_gid, 0770, 0), ]:
+            (join(ib, "updates"), dir_uid, cgi_gid, 0770, 0),
+            (self.submitBase,     dir_uid, dir_gid, 0700, 0), ]:
 
             if not os.path.exists(fn):
                 if recurse:
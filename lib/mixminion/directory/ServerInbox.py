@@ -11,6 +11,7 @@
 __all__ = [ 'ServerInbox' ]
 
 import os
+import time
 
 from mixminion.Common import LOG, MixError, MixFatalError, UIError, \
      formatBase64, readPickled, tryUnlink, writePickled
@@ -29,7 +30,7 @@ class ServerInbox:
         self.store = store
         self.voteFile = voteFile
 
-    def receiveServer(self, text, source, now=None):
+    def receiveServer(self, text, source, now=None, validatedDigests=None):
         """Process a new server descriptor and store it for later action.
            (To be run by the CGI user.)
 
@@ -41,38 +42,46 @@ class ServerInbox:
            text -- a string containing a new server descriptor.
            source -- a (human readable) string describing the source
                of the descriptor, used in error messages.
+           validatedDigests -- as for ServerInfo.
 
         """
-        if now is None:
-            now = time.time()
-
         try:
-            #XXXX digest cache??
-            server = ServerInfo(string=text,assumeValid=0,_keepContents=1)
+            server = ServerInfo(string=text,assumeValid=0,
+                                validatedDigests=validatedDigests,
+                                _keepContents=1)
         except MixError, e:
             LOG.warn("Rejected invalid server from %s: %s", source,e)
             raise UIError("Server descriptor was not valid: %s"%e)
 
+        return self.acceptServer(server, source, now)
+
+    def acceptServer(self, server, source, now=None):
+        """As receiveServer, but takes a ServerInfo (with its contents) that
+           has already been parsed and validated."""
+        if now is None:
+            now = time.time()
+
+        nickname = server.getNickname()
         status = self.voteFile.getServerStatus(server)
         if status == "mismatch":
             LOG.warn("Rejected server with mismatched identity for %r from %s",
                      nickname, source)
             self.store.addServer(server)
             raise UIError(("I already know a server named "
-                           "%s with a different key.")%server.getNickname())
+                           "%s with a different key.")%nickname)
         elif status == "ignore":
             LOG.warn("Rejected descriptor for ignored server %r from %s",
                      nickname, source)
             return
 
-        if server.isExpiredAt(time.time()):
+        if server.isExpiredAt(now):
             LOG.warn("Rejecting expired descriptor from %s", source)
             raise UIError("That descriptor is already expired; your clock"
                           " is probably skewed.")
 
         if status in ("yes", "no", "abstain"):
             LOG.info("Received update for server %r from %s (vote=%s)",
-                     server.getNickname(), source, status)
+                     nickname, source, status)
             self.store.addServer(server)
             return 1
         else:
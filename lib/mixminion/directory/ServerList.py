@@ -6,35 +6,37 @@
    Implements a store of serverinfos for a directory, as well as functions
    to generate and sign directories.
 
-   FFFF Right now, this is about maximally slow.  There are a lot of tricks
-   FFFF we could do to speed it up: not revalidating servers in our cache;
-   FFFF pickling serverinfo objects for easy access, and so on.  But
-   FFFF really, we'd need to get 1000 servers before any of these tricks made
-   FFFF more than a 10-second difference in directory generation time, so
-   FFFF let's leave it simple for now.
+   The store keeps indices by nickname, identity, and validity interval,
+   remembers which descriptors it has already validated, and reuses
+   descriptor text between directories, so that a directory with
+   thousands of servers doesn't need to reparse them all on every run.
    """
 
 __all__ = [ 'ServerList' ]
 
+import cPickle
 import os
+import shutil
 import time
 import threading
+import types
 
 import mixminion
 import mixminion.Config
 import mixminion.Filestore
+import mixminion.directory.DirFormats
 import mixminion.directory.Directory
 
 from mixminion.Crypto import pk_decode_public_key, pk_encode_public_key, \
      pk_same_public_key
-from mixminion.Common import IntervalSet, LOG, MixError, MixFatalError, \
-     UIError, createPrivateDir, formatBase64, formatDate, formatFnameTime, \
+from mixminion.Common import AtomicFile, IntervalSet, LOG, MixError, \
+     MixFatalError, UIError, createPrivateDir, formatBase64, formatDate, formatFnameTime, \
      formatTime, iterFileLines, Lockfile, openUnique, previousMidnight, readFile,\
      readPickled, readPossiblyGzippedFile, stringContains, writeFile, \
      writePickled
 from mixminion.Config import ConfigError
-from mixminion.ServerInfo import ServerDirectory, ServerInfo, \
-     _getDirectoryDigestImpl
+from mixminion.ServerInfo import CompactServerInfo, ServerDirectory, \
+     ServerInfo, findSuperseded, _getDirectoryDigestImpl
 
 """
 Redesign notes:
@@ -83,30 +85,163 @@ class DescriptorStatus:
         self._identityDigest = identityDigest
 
     def isSupersededBy(self, others):
-        valid = IntervalSet([(self._validAfter, self._validUntil)])
+        newer = IntervalSet()
         for o in others:
             if (o._published > self._published and
                 o._identityDigest == self._identityDigest):
-                valid -= o.getIntervalSet()
-        return valid.isEmpty()
+                newer.addInterval(o._validAfter, o._validUntil)
+        return newer.containsInterval(self._validAfter, self._validUntil)
+
+    def getSupersessionEntry(self):
+        """Return a tuple describing this descriptor, as used by
+           ServerInfo.findSuperseded."""
+        return (self._identityDigest, self._published, self._validAfter,
+                self._validUntil, self)
+
+    def getSortKey(self):
+        """Return the value that DirFormats.sortServerList uses to order
+           this descriptor within a directory."""
+        return (self._nickname.lower(), self._validAfter, self._digest)
+
+class _IntervalIndex:
+    """An index over a set of half-open time intervals [start,end), each
+       associated with a key, that can find every interval overlapping a
+       given range without looking at all of them.
+
+       We keep the intervals sorted by start time, and treat the sorted
+       list as an implicit balanced binary tree: the root of the range
+       [lo,hi) is at (lo+hi)//2.  Each node remembers the latest end time
+       within its subtree, so that a query can skip any subtree whose
+       intervals have all ended.  The tree is rebuilt lazily after
+       changes."""
+    ## Fields:
+    # _intervals: map from key to (start,end).
+    # _sorted: list of (start,end,key) tuples, sorted; or None if we have
+    #    changed since we last built the tree.
+    # _maxEnd: list parallel to _sorted; _maxEnd[i] is the latest end time
+    #    of any interval in the subtree rooted at i.
+    def __init__(self, intervals=None):
+        if intervals is None:
+            intervals = {}
+        self._intervals = intervals
+        self._sorted = None
+        self._maxEnd = None
+
+    def add(self, key, start, end):
+        """Add (or replace) the interval [start,end) for 'key'."""
+        self._intervals[key] = (start, end)
+        self._sorted = None
+
+    def remove(self, key):
+        """Remove the interval for 'key', if any."""
+        if self._intervals.has_key(key):
+            del self._intervals[key]
+            self._sorted = None
+
+    def getIntervals(self):
+        """Return a map from key to (start,end) for every interval in this
+           index."""
+        return self._intervals
+
+    def getOverlapping(self, startAt, endAt):
+        """Return a list of all keys whose intervals overlap
+           [startAt,endAt)."""
+        if self._sorted is None:
+            self._rebuild()
+        result = []
+        self._search(0, len(self._sorted), startAt, endAt, result)
+        return result
+
+    def _rebuild(self):
+        """Helper: regenerate _sorted and _maxEnd from _intervals."""
+        s = [ (start, end, key)
+              for key, (start, end) in self._intervals.items() ]
+        s.sort()
+        self._sorted = s
+        self._maxEnd = [None]*len(s)
+        self._build(0, len(s))
+
+    def _build(self, lo, hi):
+        """Helper: fill in _maxEnd for the subtree over [lo,hi), and return
+           its latest end time."""
+        if lo >= hi:
+            return None
+        mid = (lo+hi)//2
+        m = self._sorted[mid][1]
+        for sub in self._build(lo, mid), self._build(mid+1, hi):
+            if sub is not None and sub > m:
+                m = sub
+        self._maxEnd[mid] = m
+        return m
+
+    def _search(self, lo, hi, startAt, endAt, result):
+        """Helper: append to 'result' every key in the subtree over [lo,hi)
+           whose interval overlaps [startAt,endAt)."""
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self._maxEnd[mid] <= startAt:
+                # Everything in this subtree ended before the range began.
+                return
+            self._search(lo, mid, startAt, endAt, result)
+            start, end, key = self._sorted[mid]
+            if start >= endAt:
+                # This node, and everything to its right, starts too late.
+                return
+            if end > startAt:
+                result.append(key)
+            lo = mid+1
 
 class ServerStore:
-    KEY_LENGTH=29
+    """A set of server descriptors, each stored in a file named by its
+       digest.  Unless we are opened insert-only, we keep a cache of the
+       status of each descriptor, and indices to look them up by nickname,
+       by identity, and by validity interval.  The indices are saved next
+       to the status cache, so that we don't need to rebuild them on
+       every run."""
+    ## Fields:
+    # _loc: The directory holding our descriptors.
+    # _dbLoc: The filename for _statusDB.
+    # _idxLoc: The filename for our pickled indices.
+    # _statusDB: A WritethroughDict mapping key to DescriptorStatus, or None
+    #     if we are insert-only.
+    # _byNickname: A map from nickname to a {key:1} dict.
+    # _byIdentity: A map from identity digest to a {key:1} dict.
+    # _liveness: An _IntervalIndex over the validity intervals of our keys.
+    # _validatedDigests: A map from descriptor digest to 1 for every
+    #     descriptor whose signature we've already checked.  Persisted along
+    #     with the indices.
+    # _parsed: A map from key to CompactServerInfo for every descriptor
+    #     we've parsed since we were opened.
+    # _texts: A map from key to descriptor text for the keys we used in the
+    #     last call to getServerText.
+    # _lastText: A tuple of (ordered keys, concatenated text) from the last
+    #     call to getServerText, or None.
+    # _indexDirty: True iff our indices have changed since we last saved
+    #     them.
+    KEY_LENGTH=27
+    INDEX_VERSION="ServerStore-Index-0.1"
     def __init__(self, location, dbLocation, insertOnly=0):
         self._loc = location
         self._dbLoc = dbLocation
+        self._idxLoc = dbLocation+".idx"
+        self._statusDB = None
+        self._validatedDigests = {}
+        self._parsed = {}
+        self._texts = {}
+        self._lastText = None
+        createPrivateDir(location)
         if not insertOnly:
             self.clean()
             self._statusDB = mixminion.Filestore.WritethroughDict(
                 self._dbLoc, "server cache")
-        else:
-            self._statusDB = None
-        createPrivateDir(location)
+            self._loadIndices()
 
     def close(self):
+        self._saveIndices()
         self._statusDB.close()
 
     def sync(self):
+        self._saveIndices()
         self._statusDB.sync()
 
     def hasServer(self, server):
@@ -135,27 +270,29 @@ class ServerStore:
         return key
 
     def delServer(self, key):
-        if self._statusDB is not None:
-            try:
-                del self._statusDB[key]
-            except KeyError:
-                pass
+        self._forget(key)
         try:
             os.unlink(os.path.join(self._loc, key))
         except OSError:
             pass
 
     def rescan(self):
+        """Rebuild the status cache and indices from the descriptors on
+           disk.  Descriptors whose digests we have already validated
+           are parsed, but their signatures are not checked again."""
         self._statusDB.close()
-        os.path.unlink(self._dbLoc)
+        os.unlink(self._dbLoc)
         self.clean()
         self._statusDB = mixminion.Filestore.WritethroughDict(
             self._dbLoc, "server cache")
+        self._clearIndices()
+        self._parsed = {}
         for key in os.listdir(self._loc):
             fn = os.path.join(self._loc, key)
             try:
-                #XXXX digest-cache
-                server = ServerInfo(fname=fn)
+                server = ServerInfo(fname=fn,
+                                    validatedDigests=self._validatedDigests,
+                                    _keepContents=1)
             except (OSError, MixError, ConfigError), e:
                 LOG.warn("Deleting invalid server %s: %s", key, e)
                 os.unlink(fn)
@@ -168,25 +305,26 @@ class ServerStore:
                 os.rename(fn, os.path.join(self._loc, k2))
                 key = k2
             self._updateCache(key, server)
+            self._parsed[key] = CompactServerInfo(server)
 
-        self.flush()
+        self.sync()
 
     def archiveServers(self, archiveLocation, now=None):
-        if now is not None:
+        """Move every expired or superseded descriptor to
+           'archiveLocation', and drop it from our caches."""
+        if now is None:
             now = time.time()
 
         archive = {}
-        byIdentity = {}
         for key, status in self._statusDB.items():
             if status._validUntil < now:
                 archive[key] = 1
-                continue
-            byIdentity.setdefault(status._identityDigest, []).append(status)
 
-        for ident, servers in byIdentity.items():
-            for s in servers:
-                if s.isSupersededBy(servers):
-                    archive[self._getKey(s._digest)] = 1
+        entries = [ status.getSupersessionEntry()
+                    for key, status in self._statusDB.items()
+                    if not archive.has_key(key) ]
+        for s in findSuperseded(entries):
+            archive[self._getKey(s._digest)] = 1
 
         for key in archive.keys():
             self.moveServer(key,archiveLocation)
@@ -194,16 +332,54 @@ class ServerStore:
     def moveServer(self, key, location):
         os.rename(os.path.join(self._loc, key),
                   os.path.join(location, key))
-        try:
-            del self._statusDB[key]
-        except KeyError:
-            pass
+        self._forget(key)
 
     def loadServer(self, key, keepContents=0, assumeValid=1):
-        #XXXX008 digest-cache
-        return ServerInfo(fname=os.path.join(self._loc,key),
-                          assumeValid=assumeValid,
-                          _keepContents=keepContents)
+        """Return a CompactServerInfo for the descriptor stored under
+           'key'.  We remember every descriptor we parse, so asking for the
+           same one twice is cheap; the contents are always kept.  If
+           'assumeValid' is false, we check the signature unless we have
+           already checked it once."""
+        server = self._parsed.get(key)
+        if server is not None and (assumeValid or not server.assumeValid):
+            return server
+        server = ServerInfo(fname=os.path.join(self._loc,key),
+                            assumeValid=assumeValid,
+                            validatedDigests=self._validatedDigests,
+                            _keepContents=1)
+        if not assumeValid:
+            self._validatedDigests[server.getDigest()] = 1
+            self._indexDirty = 1
+        server = CompactServerInfo(server)
+        self._parsed[key] = server
+        return server
+
+    def getServerText(self, keys):
+        """Return the text of every descriptor in 'keys', concatenated in
+           the order that DirFormats.sortServerList would use.  Descriptor
+           text that we used last time is reused rather than re-read;
+           if the set of keys hasn't changed at all, we return the same
+           string as last time."""
+        ordered = [ (self._statusDB[k].getSortKey(), k) for k in keys ]
+        ordered.sort()
+        ordered = tuple([ k for _, k in ordered ])
+        if self._lastText is not None and self._lastText[0] == ordered:
+            return self._lastText[1]
+
+        texts = {}
+        for k in ordered:
+            t = self._texts.get(k)
+            if t is None:
+                server = self._parsed.get(k)
+                if server is not None:
+                    t = server._originalContents
+                else:
+                    t = readFile(os.path.join(self._loc, k))
+            texts[k] = t
+        self._texts = texts
+        text = "".join([ texts[k] for k in ordered ])
+        self._lastText = (ordered, text)
+        return text
 
     def listKeys(self):
         if self._statusDB is not None:
@@ -213,30 +389,112 @@ class ServerStore:
                      if not f.endswith(".tmp") ]
 
     def getByNickname(self, nickname):
-        return [ key for key,status in self._statusDB.items()
-                 if status._nickname == nickname ]
+        """Return the keys of every descriptor whose nickname is exactly
+           'nickname'.  The match is case-sensitive."""
+        return self._byNickname.get(nickname, {}).keys()
 
-    def getByIdentityDigest(self, digest):
-        return [ key for key,status in self._statusDB.items()
-                 if status._identityDigest == identityDigest ]
+    def getByIdentityDigest(self, identityDigest):
+        return self._byIdentity.get(identityDigest, {}).keys()
 
     def getByLiveness(self, startAt, endAt):
-        return [ key for key,status in self._statusDB.items()
-                 if (endAt > status._validAfter and
-                     startAt < status._validUntil) ]
+        return self._liveness.getOverlapping(startAt, endAt)
 
     def _updateCache(self, key, server):
         assert key == self._getKey(server.getDigest())
 
-        sec = server['Server']
-
-        status = DescriptorStatus(sec['Digest'],
-                                  sec['Published'],
-                                  sec['Valid-After'],
-                                  sec['Valid-Until'],
-                                  sec['Nickname'],
+        status = DescriptorStatus(server.getDigest(),
+                                  server.getPublished(),
+                                  server.getValidAfter(),
+                                  server.getValidUntil(),
+                                  server.getNickname(),
                                   server.getKeyDigest())
+        old = self._statusDB.get(key)
+        if old is not None:
+            self._unindex(key, old)
         self._statusDB[key] = status
+        self._index(key, status)
+        if not server.assumeValid:
+            self._validatedDigests[server.getDigest()] = 1
+
+    def _forget(self, key):
+        """Helper: remove 'key' from our status cache, indices, and parse
+           cache."""
+        for d in self._parsed, self._texts:
+            if d.has_key(key):
+                del d[key]
+        if self._statusDB is None:
+            return
+        status = self._statusDB.get(key)
+        if status is None:
+            return
+        del self._statusDB[key]
+        self._unindex(key, status)
+
+    def _index(self, key, status):
+        """Helper: add 'key', with the DescriptorStatus 'status', to our
+           indices."""
+        self._byNickname.setdefault(status._nickname, {})[key] = 1
+        self._byIdentity.setdefault(status._identityDigest, {})[key] = 1
+        self._liveness.add(key, status._validAfter, status._validUntil)
+        self._indexDirty = 1
+
+    def _unindex(self, key, status):
+        """Helper: remove 'key', with the DescriptorStatus 'status', from
+           our indices."""
+        for idx, k in ((self._byNickname, status._nickname),
+                       (self._byIdentity, status._identityDigest)):
+            keys = idx.get(k)
+            if keys is None or not keys.has_key(key):
+                continue
+            del keys[key]
+            if not keys:
+                del idx[k]
+        self._liveness.remove(key)
+        self._indexDirty = 1
+
+    def _clearIndices(self):
+        """Helper: make all of our indices empty."""
+        self._byNickname = {}
+        self._byIdentity = {}
+        self._liveness = _IntervalIndex()
+        self._indexDirty = 1
+
+    def _loadIndices(self):
+        """Helper: load our indices from disk if they are present and match
+           the status cache; otherwise, rebuild them from the status
+           cache."""
+        keys = self._statusDB.keys()
+        keys.sort()
+        try:
+            obj = readPickled(self._idxLoc)
+        except (OSError, IOError, EOFError, cPickle.UnpicklingError), e:
+            obj = None
+        if type(obj) == types.TupleType and len(obj) == 6 and \
+               obj[0] == self.INDEX_VERSION:
+            _, idxKeys, byNickname, byIdentity, intervals, digests = obj
+            self._validatedDigests = digests
+            if idxKeys == keys:
+                self._byNickname = byNickname
+                self._byIdentity = byIdentity
+                self._liveness = _IntervalIndex(intervals)
+                self._indexDirty = 0
+                return
+            LOG.info("Server index is out of date; rebuilding.")
+        self._clearIndices()
+        for key, status in self._statusDB.items():
+            self._index(key, status)
+
+    def _saveIndices(self):
+        """Helper: if our indices have changed, write them to disk."""
+        if self._statusDB is None or not self._indexDirty:
+            return
+        keys = self._statusDB.keys()
+        keys.sort()
+        writePickled(self._idxLoc, (self.INDEX_VERSION, keys,
+                                    self._byNickname, self._byIdentity,
+                                    self._liveness.getIntervals(),
+                                    self._validatedDigests))
+        self._indexDirty = 0
 
     def _getKey(self, digest):
         k = formatBase64(digest).replace("/","-").replace("=","")
@@ -244,9 +502,17 @@ class ServerStore:
         return k
 
     def clean(self):
+        """Remove stray temporary files, and drop any parsed descriptor or
+           text we're caching for a key we no longer hold."""
         for fn in os.listdir(self._loc):
             if len(fn) > self.KEY_LENGTH and stringContains(fn, ".tmp"):
                 os.unlink(os.path.join(self._loc,fn))
+        if self._statusDB is None:
+            return
+        for d in self._parsed, self._texts:
+            for key in d.keys():
+                if not self._statusDB.has_key(key):
+                    del d[key]
 
     def _repOK(self):
         self.clean()
@@ -259,8 +525,8 @@ class ServerStore:
         for f in fnames:
             status = self._statusDB[f]
             try:
-                #XXXX digest-cache
-                server = ServerInfo(fname=os.path.join(self._loc, f))
+                server = ServerInfo(fname=os.path.join(self._loc, f),
+                                    validatedDigests=self._validatedDigests)
             except:
                 return 0
             if status._digest != server.getDigest(): return 0
@@ -277,7 +543,7 @@ class LiveServerList:
         self.store = store
 
     def clean(self, voteList, archiveLocation, now=None):
-        self.store.flush()
+        self.store.sync()
         self.store.clean()
         self.store.archiveServers(archiveLocation, now=now)
         rejectKeys = [ k for k,status in self.store._statusDB.items()
@@ -289,20 +555,39 @@ class LiveServerList:
                               now=None):
         if now is None:
             now = time.time()
-        self.store.clean(voteList, archiveLocation, now=now)
+        self.clean(voteList, archiveLocation, now=now)
         # add 2 extra days for margin-of-error.
         for k in self.store.getByLiveness(now, now+24*60*60*32):
             f = open(os.path.join(self.store._loc, k), 'r')
-            outFile.write(f.read())
-            f.close()
+            try:
+                shutil.copyfileobj(f, outFile)
+            finally:
+                f.close()
+
+    def generateVoteDirectory(self, identity, goodServerNames, voters,
+                              validAfter, clientVersions, serverVersions):
+        """Generate and return a signed vote directory, valid starting at
+           the midnight before 'validAfter', containing every descriptor in
+           our store that is live at any time in the directory's lifetime.
+           Descriptor text is reused from the last directory we generated
+           where possible, so only the header and signature are new."""
+        startAt = previousMidnight(validAfter)
+        keys = self.store.getByLiveness(startAt, startAt+24*60*60)
+        text = self.store.getServerText(keys)
+        return mixminion.directory.DirFormats.generateVoteDirectory(
+            identity, [], goodServerNames, voters, validAfter,
+            clientVersions, serverVersions,
+            validatedDigests=self.store._validatedDigests,
+            serverText=text)
 
     def addServersFromInbox(self, inbox):
         self.inbox.moveEntriesToStore(self)
 
     def _addOneFromRawDirLines(self, lines):
         s = "".join(lines)
-        #XXXX digest-cache
-        si = ServerInfo(s,assumeValid=0,keepContents=1)
+        si = ServerInfo(string=s,
+                        validatedDigests=self.store._validatedDigests,
+                        _keepContents=1)
         if not self.store.hasServer(si):
             self.store.addServer(si)
 
@@ -310,8 +595,8 @@ class LiveServerList:
         curLines = []
         for line in iterFileLines(file):
             if line == '[Server]\n' and curLines:
-                self._addOneFromRawLines(curLines)
+                self._addOneFromRawDirLines(curLines)
                 del curLines[:]
         if curLines:
-            self._addOneFromRawLines(curLines)
+            self._addOneFromRawDirLines(curLines)
 
@@ -3,16 +3,23 @@
 
 """mixminion.server.DNSFarm: code to implement asynchronous DNS resolves with
    background threads and cachhe the results.
+
+   Alternatively, AsyncDNSCache can do its own resolves by sending DNS
+   queries over UDP from the server's main loop.
    """
 
+import errno
+import socket
+import struct
 import threading
 import time
 import sys
+import mixminion.Crypto
 import mixminion.NetUtils
 from mixminion.Common import LOG
 from mixminion.ThreadUtils import TimeoutQueue, QueueEmpty
 
-__all__ = [ 'DNSCache' ]
+__all__ = [ 'DNSCache', 'AsyncDNSCache' ]
 
 class _Pending:
     """Class to represent resolves that we're waiting for an answer on."""
@@ -36,33 +43,21 @@ MAX_ENTRY_TTL = 30*60
 # ...and entries from the reverse cache after MAX_RENTRY_TTL seconds.
 MAX_RENTRY_TTL = 24*60*60
 
-class DNSCache:
-    """Class to cache answers to DNS requests and manager DNS threads."""
+class _BaseDNSCache:
+    """Abstract class: caches answers to DNS requests, and passes them to
+       callbacks.  Subclasses decide how to actually resolve names."""
     ## Fields:
-    # _isShutdown: boolean: are the threads shutting down?  (While the
-    #     threads are shutting down, we don't answer any requests.)
     # cache: map from name to PENDING or getIP result.
     # rCache: map from (family,lowercase IP) to (hostname, time).
     # callbacks: map from name to list of callback functions. (See lookup
     #     for definition of callback.)
     # lock: Lock to control access to this class's shared state.
-    # nBusyThreads: Number of threads that are currently handling requests.
-    # nLiveThreads: Number of threads that are currently running.
-    # queue: Instance of TimeoutQueue that holds either names to resolve,
-    #     or instances of None to shutdown threads.
-    # threads: List of DNSThreads, some of which may be dead.
     def __init__(self):
-        """Create a new DNSCache"""
         self.cache = {}
         self.rCache = {}
         self.callbacks = {}
         self.lock = threading.RLock()
-        self.queue = TimeoutQueue()
-        self.threads = []
-        self.nLiveThreads = 0
-        self.nBusyThreads = 0
-        self._isShutdown = 0
-        self.cleanCache()
+
     def getNonblocking(self, name):
         """Return the cached result for the lookup of name.  If we're
            waiting for an answer, return PENDING.  If there is no cached
@@ -112,7 +107,7 @@ class DNSCache:
 
         try:
             self.lock.acquire()
-            v = self.cache.get(name)
+            v = self._getCached(name)
             # If we don't have a cached answer, add cb to self.callbacks
             if v is None or v is PENDING:
                 self.callbacks.setdefault(name, []).append(cb)
@@ -128,6 +123,67 @@ class DNSCache:
                       v,name)
             cb(name,v)
 
+    def prefetch(self, names):
+        """Start looking up every name in 'names' that we don't already have
+           an answer for, so that the answer will be cached when we need
+           it."""
+        pass
+
+    def _getCached(self, name):
+        """Helper: return the cached value for 'name', or None if we have
+           none.  Caller must hold self.lock."""
+        return self.cache.get(name)
+
+    def _beginLookup(self,name):
+        """Helper function: Begin looking up 'name'.
+
+           Caller must hold self.lock
+        """
+        raise NotImplementedError()
+
+    def _lookupDone(self,name,val):
+        """Helper function: invoked when we get the answer 'val' for
+           a lookup of 'name'.
+           """
+        try:
+            self.lock.acquire()
+            # Insert the value in the cache.
+            self.cache[name]=val
+            # Insert the value in the reverse cache.
+            if val[0] != 'NOENT':
+                self.rCache[(val[0], val[1].lower())] = (name.lower(),val[2])
+            # Get the callbacks for the name, if any.
+            cbs = self.callbacks.get(name,[])
+            try:
+                del self.callbacks[name]
+            except KeyError:
+                pass
+        finally:
+            self.lock.release()
+        # Now that we've released the lock, invoke the callbacks.
+        for cb in cbs:
+            cb(name,val)
+
+class DNSCache(_BaseDNSCache):
+    """Class to cache answers to DNS requests and manager DNS threads."""
+    ## Fields:
+    # _isShutdown: boolean: are the threads shutting down?  (While the
+    #     threads are shutting down, we don't answer any requests.)
+    # nBusyThreads: Number of threads that are currently handling requests.
+    # nLiveThreads: Number of threads that are currently running.
+    # queue: Instance of TimeoutQueue that holds either names to resolve,
+    #     or instances of None to shutdown threads.
+    # threads: List of DNSThreads, some of which may be dead.
+    def __init__(self):
+        """Create a new DNSCache"""
+        _BaseDNSCache.__init__(self)
+        self.queue = TimeoutQueue()
+        self.threads = []
+        self.nLiveThreads = 0
+        self.nBusyThreads = 0
+        self._isShutdown = 0
+        self.cleanCache()
+
     def shutdown(self, wait=0):
         """Tell all the DNS threads to shut down.  If 'wait' is true,
            don't wait until all the theads have completed."""
@@ -195,28 +251,17 @@ class DNSCache:
             thread = DNSThread(self)
             thread.start()
             self.threads.append(thread)
-    def _lookupDone(self,name,val):
-        """Helper function: invoked when we get the answer 'val' for
-           a lookup of 'name'.
-           """
-        try:
-            self.lock.acquire()
-            # Insert the value in the cache.
-            self.cache[name]=val
-            # Insert the value in the reverse cache.
-            if val[0] != 'NOENT':
-                self.rCache[(val[0], val[1].lower())] = (name.lower(),val[2])
-            # Get the callbacks for the name, if any.
-            cbs = self.callbacks.get(name,[])
-            try:
-                del self.callbacks[name]
-            except KeyError:
-                pass
-        finally:
-            self.lock.release()
-        # Now that we've released the lock, invoke the callbacks.
-        for cb in cbs:
-            cb(name,val)
+
+    def checkTimeouts(self, now=None):
+        """Give up on or retry any lookups that have taken too long.  (Our
+           threads never give up, so this does nothing.)"""
+        pass
+
+    def getNextTimeoutCheck(self):
+        """Return the time by which checkTimeouts should next be called,
+           or None if it doesn't need to be called."""
+        return None
+
     def _adjLiveThreads(self,n):
         """Helper: adjust the number of live threads by n"""
         self.lock.acquire()
@@ -268,3 +313,563 @@ class DNSThread(threading.Thread):
         finally:
             _adjLiveThreads(-1)
 
+
+#----------------------------------------------------------------------
+# Non-blocking DNS.
+
+# Port on which DNS servers listen.
+DNS_PORT = 53
+# Resource record types and classes we use.
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_AAAA = 28
+CLASS_IN = 1
+# Response codes we care about.
+RCODE_OK = 0
+RCODE_NXDOMAIN = 3
+# How long do we wait for an answer to a query before retrying it, in
+# seconds?
+DNS_RETRY_INTERVAL = 2
+# How many times do we send a query before giving up?
+DNS_MAX_TRIES = 4
+# We never cache an answer for less than MIN_ANSWER_TTL seconds, no matter
+# what its TTL says.  (We never cache it for more than MAX_ENTRY_TTL.)
+MIN_ANSWER_TTL = 60
+# How long do we remember that a name doesn't exist, if the DNS server
+# doesn't tell us?
+NEGATIVE_TTL = 5*60
+# When prefetching, we refresh answers that will expire within
+# PREFETCH_MARGIN seconds.
+PREFETCH_MARGIN = 5*60
+# How many random source ports do we try to bind before letting the
+# kernel pick one?
+MAX_BIND_TRIES = 10
+
+class DNSFormatError(Exception):
+    """Exception: raised when we receive a malformed DNS message."""
+    pass
+
+def getNameservers(fname="/etc/resolv.conf"):
+    """Return a list of (IP, port) tuples for the IPv4 nameservers listed
+       in the resolv.conf file 'fname'.  If there are none, return the
+       local host."""
+    servers = []
+    try:
+        f = open(fname, 'r')
+        try:
+            for line in f.readlines():
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    v = mixminion.NetUtils.nameIsStaticIP(fields[1])
+                    if v is not None and v[0] == mixminion.NetUtils.AF_INET:
+                        servers.append((v[1], DNS_PORT))
+        finally:
+            f.close()
+    except (IOError, OSError), e:
+        LOG.warn("Couldn't read nameservers from %s: %s", fname, e)
+    if not servers:
+        servers.append(("127.0.0.1", DNS_PORT))
+    return servers
+
+def _encodeQuery(qid, name, qtype):
+    """Return a DNS query message with ID 'qid', asking for records of type
+       'qtype' for the hostname 'name'."""
+    # Header: ID, flags (just 'recursion desired'), 1 question, no answers.
+    parts = [ struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0) ]
+    for label in name.rstrip(".").split("."):
+        if not (0 < len(label) < 64):
+            raise DNSFormatError("Bad hostname %r" % name)
+        parts.append(chr(len(label)))
+        parts.append(label)
+    parts.append("\x00")
+    parts.append(struct.pack("!HH", qtype, CLASS_IN))
+    return "".join(parts)
+
+def _skipName(msg, pos):
+    """Return the position just after the (possibly compressed) domain name
+       that starts at 'pos' in the DNS message 'msg'."""
+    while 1:
+        if pos >= len(msg):
+            raise DNSFormatError("Truncated name")
+        n = ord(msg[pos])
+        if n == 0:
+            return pos+1
+        elif n & 0xC0 == 0xC0:
+            # A compression pointer always ends the name.
+            return pos+2
+        pos += n+1
+
+def _readName(msg, pos):
+    """Return the uncompressed domain name that starts at 'pos' in the DNS
+       message 'msg'."""
+    labels = []
+    for _ in xrange(128):
+        if pos >= len(msg):
+            raise DNSFormatError("Truncated name")
+        n = ord(msg[pos])
+        if n == 0:
+            return ".".join(labels)
+        elif n & 0xC0 == 0xC0:
+            if pos+2 > len(msg):
+                raise DNSFormatError("Truncated name")
+            pos = struct.unpack("!H", msg[pos:pos+2])[0] & 0x3FFF
+        else:
+            labels.append(msg[pos+1:pos+1+n])
+            pos += n+1
+    raise DNSFormatError("Compression loop in name")
+
+def _decodeResponse(msg):
+    """Parse the DNS response 'msg'.  Return a tuple of (ID, response code,
+       truncated, question name, question type, answers, negative TTL),
+       where truncated is true iff the server set the TC bit, answers is
+       a list of (type, TTL, data) tuples for the records in the answer
+       section, and negative TTL is the TTL for caching a negative answer
+       given in the authority section, or None.  Raise DNSFormatError if
+       the message is malformed."""
+    if len(msg) < 12:
+        raise DNSFormatError("Truncated header")
+    qid, flags, qdcount, ancount, nscount, _ = struct.unpack("!HHHHHH",
+                                                             msg[:12])
+    if not flags & 0x8000:
+        raise DNSFormatError("Message is not a response")
+    if qdcount != 1:
+        raise DNSFormatError("Wrong number of questions")
+    rcode = flags & 0x000F
+    truncated = flags & 0x0200
+    pos = 12
+    qname = _readName(msg, pos)
+    pos = _skipName(msg, pos)
+    if pos+4 > len(msg):
+        raise DNSFormatError("Truncated question")
+    qtype, _ = struct.unpack("!HH", msg[pos:pos+4])
+    pos += 4
+    answers = []
+    negTTL = None
+    for i in xrange(ancount+nscount):
+        pos = _skipName(msg, pos)
+        if pos+10 > len(msg):
+            raise DNSFormatError("Truncated record")
+        rtype, rclass, ttl, rdlen = struct.unpack("!HHLH", msg[pos:pos+10])
+        pos += 10
+        rdata = msg[pos:pos+rdlen]
+        if len(rdata) != rdlen:
+            raise DNSFormatError("Truncated record")
+        if i < ancount:
+            if rclass == CLASS_IN:
+                answers.append((rtype, ttl, rdata))
+        elif rtype == TYPE_SOA:
+            # The negative TTL is the lesser of the SOA record's TTL and the
+            # 'minimum' field at the end of its data.
+            if rdlen >= 4:
+                minimum, = struct.unpack("!L", rdata[-4:])
+                negTTL = min(ttl, minimum)
+        pos += rdlen
+    return qid, rcode, truncated, qname, qtype, answers, negTTL
+
+def _formatAddress(rtype, rdata):
+    """Return the printable address in the data of an A or AAAA record."""
+    if rtype == TYPE_A:
+        return socket.inet_ntoa(rdata)
+    else:
+        return ":".join([ "%X"%w for w in struct.unpack("!8H", rdata) ])
+
+def _openQuerySocket():
+    """Return a new nonblocking UDP socket, bound to a randomly chosen
+       port so that nobody can guess where to send forged answers."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    prng = mixminion.Crypto.getCommonPRNG()
+    for _ in xrange(MAX_BIND_TRIES):
+        try:
+            sock.bind(("0.0.0.0", 1024 + prng.getInt(0x10000-1024)))
+            break
+        except socket.error:
+            # Somebody has that port; try another.
+            pass
+    sock.setblocking(0)
+    return sock
+
+class _DNSQuery:
+    """Helper class: a DNS query that we're waiting for an answer to.  Each
+       query has its own socket, and obeys the interface of
+       MMTPServer.Connection so that the socket can be registered with an
+       AsyncServer."""
+    ## Fields:
+    # cache: the AsyncDNSCache that sent this query.
+    # name: the hostname we're resolving.
+    # qtypes: list of the record types we still want to ask for, starting
+    #    with the one we're asking for now.
+    # qid: the ID of the current query.
+    # msg: the encoded current query.
+    # nTries: the number of times we have sent the current query.
+    # nextRetry: the time at which we give up on our last attempt.
+    # sock: a nonblocking UDP socket, or None if we're done.
+    # fd: the file descriptor under which we're registered with the
+    #    cache's server, or None if we aren't registered.
+    def __init__(self, cache, name, qtypes):
+        self.cache = cache
+        self.name = name
+        self.qtypes = qtypes
+        self.qid = None
+        self.msg = None
+        self.nTries = 0
+        self.nextRetry = None
+        self.sock = None
+        self.fd = None
+
+    def close(self):
+        """Close this query's socket, if it is open."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    # Implementation of MMTPServer.Connection.
+    def fileno(self):
+        return self.sock.fileno()
+    def getStatus(self):
+        isOpen = self.sock is not None
+        return isOpen, 0, isOpen
+    def tryTimeout(self, cutoff):
+        return 0
+    def process(self, r, w, x, cap):
+        now = time.time()
+        while self.sock is not None:
+            try:
+                msg, addr = self.sock.recvfrom(4096)
+            except socket.error, e:
+                if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                errno.ECONNREFUSED, errno.EINTR):
+                    LOG.warn("Error reading DNS response: %s", e)
+                break
+            self.cache._handleResponse(self, msg, addr, now)
+        if self.sock is None:
+            # The server will forget about us once we return.
+            self.fd = None
+        isOpen = self.sock is not None
+        return isOpen, 0, isOpen, 0
+
+class _FallbackLookupThread(threading.Thread):
+    """Helper class: used by AsyncDNSCache to resolve a name with the
+       system's blocking resolver, when the answer was too big for a UDP
+       DNS message."""
+    ## Fields:
+    # dnscache: the AsyncDNSCache that should receive our answer.
+    # name: the hostname to resolve.
+    def __init__(self, dnscache, name):
+        threading.Thread.__init__(self)
+        self.dnscache = dnscache
+        self.name = name
+        self.setDaemon(1)
+    def run(self):
+        try:
+            result = mixminion.NetUtils.getIP(self.name)
+            self.dnscache._fallbackDone(self.name, result)
+        except:
+            LOG.error_exc(sys.exc_info(),
+                          "Exception while resolving %r", self.name)
+            self.dnscache._fallbackDone(self.name,
+                               ("NOENT", "Internal error", time.time()))
+
+class AsyncDNSCache(_BaseDNSCache):
+    """A DNS cache that resolves names itself, by sending queries over UDP
+       to the system's recursive nameservers, rather than by calling the
+       blocking resolver from background threads.
+
+       Each query goes out from a fresh socket on a random port, which we
+       register with an AsyncServer: answers are read and callbacks are
+       invoked from the server's main loop.  The main loop must also call
+       checkTimeouts whenever it wakes up, to retry lost queries and to
+       start watching the sockets of new ones.  If an answer is too big
+       for UDP, we fall back to the system resolver for that name.
+
+       We cache each answer for as long as its TTL allows (within
+       MIN_ANSWER_TTL and MAX_ENTRY_TTL), and remember names that don't
+       resolve for NEGATIVE_TTL seconds, or as long as the name's zone asks.
+    """
+    ## Fields:
+    # server: the AsyncServer that watches our queries' sockets.
+    # expires: map from name to the time at which its cached answer expires.
+    # nameservers: list of (IP, port) for the nameservers we query.
+    # queries: map from query ID to _DNSQuery.
+    # newQueries: list of _DNSQuery whose sockets we haven't yet registered
+    #     with the server.
+    # _isShutdown: boolean: have we stopped resolving names?
+    # preferIP4: boolean: do we look for IPv4 addresses before IPv6?
+    def __init__(self, server, nameservers=None, preferIP4=None):
+        """Create a new AsyncDNSCache to send queries to 'nameservers', a
+           list of (IP, port) tuples, and read answers from the main loop
+           of the AsyncServer 'server'.  If no nameservers are given, use
+           the ones listed in /etc/resolv.conf."""
+        _BaseDNSCache.__init__(self)
+        if nameservers is None:
+            nameservers = getNameservers()
+        if preferIP4 is None:
+            preferIP4 = mixminion.NetUtils.PREFER_INET4
+        self.server = server
+        self.nameservers = nameservers
+        self.preferIP4 = preferIP4
+        self.expires = {}
+        self.queries = {}
+        self.newQueries = []
+        self._isShutdown = 0
+
+    def shutdown(self, wait=0):
+        """Stop resolving names.  Pending lookups will never complete."""
+        try:
+            self.lock.acquire()
+            self._isShutdown = 1
+            for query in self.queries.values():
+                query.close()
+            self.queries = {}
+            self.newQueries = []
+        finally:
+            self.lock.release()
+
+    def cleanCache(self, now=None):
+        """Remove all expired entries from the cache."""
+        if now is None:
+            now = time.time()
+        try:
+            self.lock.acquire()
+            for name, t in self.expires.items():
+                if t < now and self.cache.get(name) is not PENDING:
+                    del self.expires[name]
+                    try:
+                        del self.cache[name]
+                    except KeyError:
+                        pass
+            rCache = self.rCache
+            for name in rCache.keys():
+                if now-rCache[name][1] > MAX_RENTRY_TTL:
+                    del rCache[name]
+        finally:
+            self.lock.release()
+
+    def prefetch(self, names, now=None):
+        if now is None:
+            now = time.time()
+        n = 0
+        try:
+            self.lock.acquire()
+            for name in names:
+                if not name or mixminion.NetUtils.nameIsStaticIP(name):
+                    continue
+                v = self.cache.get(name)
+                if v is PENDING:
+                    continue
+                if v is None or self.expires.get(name,0) < now+PREFETCH_MARGIN:
+                    self._beginLookup(name, now)
+                    n += 1
+        finally:
+            self.lock.release()
+        LOG.debug("Prefetching addresses for %s hostnames", n)
+
+    def _getCached(self, name):
+        v = self.cache.get(name)
+        if v is not None and v is not PENDING and \
+               self.expires.get(name,0) < time.time():
+            return None
+        return v
+
+    def _beginLookup(self, name, now=None):
+        if now is None:
+            now = time.time()
+        self.cache[name] = PENDING
+        _, haveIP6 = mixminion.NetUtils.getProtocolSupport()
+        qtypes = [ TYPE_A ]
+        if haveIP6:
+            if self.preferIP4:
+                qtypes.append(TYPE_AAAA)
+            else:
+                qtypes.insert(0, TYPE_AAAA)
+        self._sendQuery(_DNSQuery(self, name, qtypes), now)
+
+    def _sendQuery(self, query, now):
+        """Helper: send a new query for the first type in query.qtypes.
+           Caller must hold self.lock."""
+        if self._isShutdown:
+            # We've shut down; the lookup stays pending indefinitely.
+            return
+        prng = mixminion.Crypto.getCommonPRNG()
+        while 1:
+            qid = prng.getInt(0x10000)
+            if not self.queries.has_key(qid):
+                break
+        try:
+            query.msg = _encodeQuery(qid, query.name, query.qtypes[0])
+        except DNSFormatError, e:
+            self._lookupFailed(query, str(e), now, NEGATIVE_TTL)
+            return
+        if query.sock is None:
+            try:
+                query.sock = _openQuerySocket()
+            except socket.error, e:
+                self._lookupFailed(query, "Couldn't open socket: %s"%e,
+                                   now, MIN_ANSWER_TTL)
+                return
+            # Only the main loop may register the socket with the server.
+            self.newQueries.append(query)
+            wakeup = getattr(self.server, 'wakeup', None)
+            if wakeup is not None:
+                wakeup.wakeup()
+        query.qid = qid
+        query.nTries = 0
+        self.queries[qid] = query
+        self._transmit(query, now)
+
+    def _transmit(self, query, now):
+        """Helper: send (or resend) the current message for 'query', to the
+           next nameserver in turn.  Caller must hold self.lock."""
+        server = self.nameservers[query.nTries % len(self.nameservers)]
+        query.nTries += 1
+        query.nextRetry = now + DNS_RETRY_INTERVAL
+        try:
+            query.sock.sendto(query.msg, server)
+        except socket.error, e:
+            # We'll try again when the query times out.
+            LOG.debug("Error sending DNS query to %s: %s", server[0], e)
+
+    def checkTimeouts(self, now=None):
+        """Resend every query that has gone unanswered for too long, give
+           up on queries we've sent too many times, and register the
+           sockets of new queries with our server.
+
+           This function should only be called from the main thread."""
+        if now is None:
+            now = time.time()
+        failed = []
+        try:
+            self.lock.acquire()
+            for qid, query in self.queries.items():
+                if query.nextRetry > now:
+                    continue
+                if query.nTries < DNS_MAX_TRIES:
+                    self._transmit(query, now)
+                else:
+                    del self.queries[qid]
+                    failed.append(query)
+            for query in failed:
+                if query.fd is not None:
+                    self.server.remove(query, query.fd)
+                    query.fd = None
+                query.close()
+            # Register new sockets only after removing old ones, in case
+            # a new socket has reused an old one's descriptor.
+            for query in self.newQueries:
+                if query.sock is not None:
+                    query.fd = query.fileno()
+                    self.server.register(query)
+            self.newQueries = []
+        finally:
+            self.lock.release()
+        for query in failed:
+            # Don't remember timeouts for long; the network may come back.
+            self._lookupFailed(query, "DNS query timed out", now,
+                               MIN_ANSWER_TTL)
+
+    def getNextTimeoutCheck(self):
+        """Return the time by which checkTimeouts should next be called,
+           or None if no queries are pending."""
+        try:
+            self.lock.acquire()
+            if self.newQueries:
+                return time.time()
+            if not self.queries:
+                return None
+            return min([ q.nextRetry for q in self.queries.values() ])
+        finally:
+            self.lock.release()
+
+    def _lookupFailed(self, query, reason, now, ttl):
+        """Helper: note that we couldn't resolve the name in 'query', for
+           'reason', and remember that for 'ttl' seconds."""
+        LOG.trace("Couldn't resolve %r: %s", query.name, reason)
+        self.lock.acquire()
+        self.expires[query.name] = now + ttl
+        self.lock.release()
+        self._lookupDone(query.name, ("NOENT", reason, now))
+
+    def _fallbackDone(self, name, result):
+        """Helper: invoked by a _FallbackLookupThread when the system
+           resolver has answered for 'name'."""
+        if result[0] == 'NOENT':
+            ttl = MIN_ANSWER_TTL
+        else:
+            ttl = MAX_ENTRY_TTL
+        self.lock.acquire()
+        self.expires[name] = result[2] + ttl
+        self.lock.release()
+        self._lookupDone(name, result)
+
+    def _handleResponse(self, query, msg, addr, now):
+        """Helper: process the DNS message 'msg' received from 'addr' on
+           the socket for 'query'."""
+        if addr not in self.nameservers:
+            LOG.debug("Ignoring DNS message from unexpected address %s",
+                      addr[0])
+            return
+        try:
+            qid, rcode, truncated, qname, qtype, answers, negTTL = \
+                 _decodeResponse(msg)
+        except DNSFormatError, e:
+            LOG.debug("Ignoring malformed DNS message: %s", e)
+            return
+        self.lock.acquire()
+        try:
+            if (self.queries.get(qid) is not query or
+                qtype != query.qtypes[0] or
+                qname.lower() != query.name.rstrip(".").lower()):
+                # Probably an answer to a query we gave up on.
+                return
+            if truncated:
+                # The answer didn't fit in a UDP message.  Rather than
+                # speak DNS over TCP, let the system resolver have a go.
+                LOG.debug("DNS answer for %r was truncated; using the "
+                          "system resolver", query.name)
+                del self.queries[qid]
+                query.close()
+                _FallbackLookupThread(self, query.name).start()
+                return
+            if rcode not in (RCODE_OK, RCODE_NXDOMAIN):
+                # The server failed; give the next one a chance.
+                if query.nTries < DNS_MAX_TRIES:
+                    self._transmit(query, now)
+                    return
+            del self.queries[qid]
+            addrs = [ (ttl, rdata) for rtype, ttl, rdata in answers
+                      if rtype == qtype ]
+            if rcode == RCODE_OK and not addrs and len(query.qtypes) > 1:
+                # No records of this type; try the next type.
+                del query.qtypes[0]
+                self._sendQuery(query, now)
+                return
+            query.close()
+        finally:
+            self.lock.release()
+
+        if negTTL is None:
+            negTTL = NEGATIVE_TTL
+        if rcode == RCODE_NXDOMAIN:
+            self._lookupFailed(query, "No such host", now, negTTL)
+        elif rcode != RCODE_OK:
+            self._lookupFailed(query, "DNS server failure", now,
+                               MIN_ANSWER_TTL)
+        elif not addrs:
+            self._lookupFailed(query, "No inet addresses returned", now,
+                               negTTL)
+        else:
+            ttl, rdata = addrs[0]
+            try:
+                address = _formatAddress(qtype, rdata)
+            except (struct.error, socket.error):
+                self._lookupFailed(query, "Malformed address", now,
+                                   MIN_ANSWER_TTL)
+                return
+            if qtype == TYPE_A:
+                family = mixminion.NetUtils.AF_INET
+            else:
+                family = mixminion.NetUtils.AF_INET6
+            ttl = max(MIN_ANSWER_TTL, min(ttl, MAX_ENTRY_TTL))
+            self.lock.acquire()
+            self.expires[query.name] = now + ttl
+            self.lock.release()
+            self._lookupDone(query.name, (family, address, now))
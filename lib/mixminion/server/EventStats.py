@@ -5,14 +5,24 @@
 
    Classes to gather time-based server statistics"""
 
-__all__ = [ 'EventLog', 'NilEventLog' ]
+__all__ = [ 'EventLog', 'NilEventLog', 'Metrics', 'NilMetrics',
+            'PacketTracer', 'NilPacketTracer' ]
 
+import cStringIO
+import operator
 import os
-from threading import RLock
+import sys
+from bisect import bisect_left
+from threading import Lock, RLock
 from time import time
 
 from mixminion.Common import formatTime, LOG, previousMidnight, floorDiv, \
-     createPrivateDir, MixError, readPickled, tryUnlink, writePickled
+     createPrivateDir, MixError, readPickled, tryUnlink, writeFile, \
+     writePickled
+
+import thread
+_get_ident = thread.get_ident
+del thread
 
 # _EVENTS: a list of all recognized event types.
 _EVENTS = [ 'ReceivedPacket',
@@ -51,7 +61,7 @@ class NilEventLog:
            event -- the type of event to note
            arg -- an optional topic of the event.
         """
-        pass
+        metrics.incr(event)
     def receivedPacket(self, arg=None):
         """Called whenever a packet is received via MMTP."""
         self._log("ReceivedPacket", arg)
@@ -202,6 +212,7 @@ class EventLog(NilEventLog):
                                       })
 
     def _log(self, event, arg=None):
+        metrics.incr(event)
         try:
             self._lock.acquire()
             try:
@@ -309,6 +320,437 @@ class EventLog(NilEventLog):
             rest = self.nextRotation - mid
             self.nextRotation = mid + 3600 * floorDiv(rest+55*60, 3600)
 
+#----------------------------------------------------------------------
+# Metrics
+
+# Upper bounds, in seconds, for the buckets of every metrics histogram.  Any
+# larger value goes into a final, unbounded bucket.
+HISTOGRAM_BUCKETS = [ .001, .005, .01, .05, .1, .5, 1, 5, 30, 60,
+                      300, 1800, 3600, 6*3600, 24*3600 ]
+
+class _Histogram:
+    """Helper class: counts the values observed for a single histogram
+       metric."""
+    ## Fields:
+    # buckets: a list of len(HISTOGRAM_BUCKETS)+1 counts.  buckets[i] holds
+    #     the number of values no greater than HISTOGRAM_BUCKETS[i] (and
+    #     greater than HISTOGRAM_BUCKETS[i-1]).  The last element holds the
+    #     number of values too large for any bucket.
+    # count: the total number of values observed.
+    # total: the sum of all values observed.
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS)+1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        """Record a single value."""
+        self.buckets[bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        """Add all the values observed by another _Histogram to this one."""
+        buckets = self.buckets
+        for i in xrange(len(buckets)):
+            buckets[i] += other.buckets[i]
+        self.count += other.count
+        self.total += other.total
+
+class NilMetrics:
+    """Null implementation of the Metrics interface: ignores all
+       measurements and exports nothing."""
+    # Are we actually recording anything?  Callers may check this to avoid
+    # expensive computations whose only purpose is to feed a metric.
+    enabled = 0
+    def incr(self, name, n=1):
+        """Add 'n' to the counter called 'name'."""
+        pass
+    def observe(self, name, value):
+        """Record 'value' (usually a number of seconds) in the histogram
+           called 'name'."""
+        pass
+    def addGauge(self, name, fn):
+        """Report the value returned by the no-argument function 'fn' as
+           the gauge called 'name'.  We only invoke 'fn' when somebody reads
+           the metrics."""
+        pass
+    def getNextExport(self):
+        """Return the time at which we next want to export our metrics, or
+           0 if we never export."""
+        return 0
+    def export(self, now=None):
+        """Write the current value of every metric to disk.  Return the time
+           of the next export."""
+        return 0
+
+class Metrics(NilMetrics):
+    """A Metrics object records counters, histograms, and gauges that
+       describe the running server, and periodically writes their current
+       values to a text file that a local monitoring tool can read.
+
+       Recording a measurement needs to be cheap, since we do it on the
+       packet path.  Therefore, each thread updates its own private counters
+       and histograms without taking any lock; we only add them together
+       when somebody reads the metrics.  Gauges cost nothing until they are
+       read: they are functions that we only invoke at export time.
+
+       The exported file uses one 'name value' pair per line.  Histograms
+       are exported as cumulative buckets, along with the number and sum
+       of the observed values, in the style expected by most text-file
+       metric collectors.
+    """
+    ## Fields:
+    # filename: the file to which we export the metrics.
+    # interval: number of seconds between exports.
+    # startTime: the time at which we started recording.
+    # nextExport: the time at which we next export the metrics.
+    # _perThread: a map from thread ID to a (counters, histograms) tuple of
+    #     the measurements made by that thread.  'counters' maps names to
+    #     numbers; 'histograms' maps names to _Histogram objects.  Only the
+    #     thread that owns a tuple may modify its contents.
+    # _gauges: a map from gauge name to a no-argument function.
+    # _lock: a threading.Lock that must be held when adding entries to
+    #     _perThread or _gauges.
+    enabled = 1
+    def __init__(self, filename, interval, now=None):
+        """Create a Metrics object that exports its values to 'filename'
+           every 'interval' seconds."""
+        if now is None: now = time()
+        parent = os.path.split(filename)[0]
+        if not os.path.exists(parent):
+            # Not createPrivateDir: the file is meant to be read by
+            # monitoring tools that may not run as the server's user.
+            os.makedirs(parent, 0755)
+        self.filename = filename
+        self.interval = interval
+        self.startTime = now
+        self.nextExport = now + interval
+        self._perThread = {}
+        self._gauges = {}
+        self._lock = Lock()
+
+    def _getThreadData(self):
+        """Helper: return the (counters, histograms) tuple for the current
+           thread, creating it if necessary."""
+        ident = _get_ident()
+        try:
+            return self._perThread[ident]
+        except KeyError:
+            self._lock.acquire()
+            try:
+                data = self._perThread[ident] = ({}, {})
+            finally:
+                self._lock.release()
+            return data
+
+    def incr(self, name, n=1):
+        counters = self._getThreadData()[0]
+        counters[name] = counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        histograms = self._getThreadData()[1]
+        try:
+            h = histograms[name]
+        except KeyError:
+            h = histograms[name] = _Histogram()
+        h.add(value)
+
+    def addGauge(self, name, fn):
+        self._lock.acquire()
+        try:
+            self._gauges[name] = fn
+        finally:
+            self._lock.release()
+
+    def getCounters(self):
+        """Return a map from counter name to its total across all threads."""
+        totals = {}
+        for counters, _ in self._perThread.values():
+            for name, n in counters.items():
+                totals[name] = totals.get(name, 0) + n
+        return totals
+
+    def getHistograms(self):
+        """Return a map from histogram name to a _Histogram holding the
+           values observed by all threads."""
+        totals = {}
+        for _, histograms in self._perThread.values():
+            for name, h in histograms.items():
+                try:
+                    total = totals[name]
+                except KeyError:
+                    total = totals[name] = _Histogram()
+                total.merge(h)
+        return totals
+
+    def getGauges(self):
+        """Return a map from gauge name to its current value.  Gauges whose
+           functions fail are omitted."""
+        values = {}
+        for name, fn in self._gauges.items():
+            try:
+                values[name] = fn()
+            except:
+                LOG.error_exc(sys.exc_info(), "Error reading gauge %s", name)
+        return values
+
+    def dump(self, f, now=None):
+        """Write the current value of every metric to a file handle 'f'."""
+        if now is None: now = time()
+        print >>f, "# Mixminion server metrics at %s" % formatTime(now, 1)
+        print >>f, "Uptime %d" % (now - self.startTime)
+        for d in self.getCounters(), self.getGauges():
+            names = d.keys()
+            names.sort()
+            for name in names:
+                print >>f, "%s %s" % (name, d[name])
+        histograms = self.getHistograms()
+        names = histograms.keys()
+        names.sort()
+        for name in names:
+            h = histograms[name]
+            cumulative = 0
+            for i in xrange(len(HISTOGRAM_BUCKETS)):
+                cumulative += h.buckets[i]
+                print >>f, '%s_bucket{le="%s"} %s' % (
+                    name, HISTOGRAM_BUCKETS[i], cumulative)
+            print >>f, '%s_bucket{le="+Inf"} %s' % (name, h.count)
+            print >>f, "%s_sum %f" % (name, h.total)
+            print >>f, "%s_count %s" % (name, h.count)
+
+    def getNextExport(self):
+        return self.nextExport
+
+    def export(self, now=None):
+        if now is None: now = time()
+        f = cStringIO.StringIO()
+        self.dump(f, now)
+        # The metrics file is meant for monitoring tools that probably
+        # don't run as the server's user, so we make it world-readable.
+        writeFile(self.filename, f.getvalue(), mode=0644)
+        self.nextExport = now + self.interval
+        return self.nextExport
+
+#----------------------------------------------------------------------
+# Packet tracing
+
+# The stages that a traced packet can finish, in the order that a packet
+# relayed through this server finishes them.  Each stage is named for the
+# interval that ends when we stamp it:
+#    Store -- from receipt on an MMTP connection until the packet is on disk
+#          in the incoming queue.
+#    Wait -- until the processing thread picks the packet up.
+#    Crypto -- decrypting and checking the packet.
+#    Pool -- writing the processed packet into the mix pool.
+#    Mix -- waiting in the mix pool until the pool sends it.
+#    Queue -- writing the packet into the outgoing or delivery queue.
+#    Deliver -- until the next hop acknowledges the packet.  (We don't
+#          follow packets through the exit modules.)
+TRACE_STAGES = [ 'Store', 'Wait', 'Crypto', 'Pool', 'Mix', 'Queue',
+                 'Deliver' ]
+
+class NilPacketTracer:
+    """Null implementation of the PacketTracer interface: traces no
+       packets.
+
+       Since start() never returns a trace ID here, callers that only
+       stamp packets whose trace ID is not None never call the tracer
+       again, and so tracing costs almost nothing when it is off."""
+    # Are we tracing anything?  Callers check this before looking up a
+    # packet's trace ID by handle.
+    enabled = 0
+    def start(self):
+        """Called when a packet arrives.  Return a trace ID if we are going
+           to trace the packet, or None if we aren't."""
+        return None
+    def stamp(self, traceID, stage):
+        """Note that the packet with the trace ID 'traceID' has just
+           finished the stage 'stage'."""
+        pass
+    def follow(self, traceID, key):
+        """Remember that the packet with the trace ID 'traceID' is now
+           stored under 'key' (such as 'MIX:'+handle), so that whoever
+           takes it out can look up its trace ID with take()."""
+        pass
+    def take(self, key):
+        """Return and forget the trace ID stored under 'key' with follow(),
+           or None if there is none."""
+        return None
+    def finish(self, traceID):
+        """Stop tracing the packet with the trace ID 'traceID'."""
+        pass
+    def getNextExport(self):
+        """Return the time at which we next want to dump our traces, or 0
+           if we never dump them."""
+        return 0
+    def export(self, now=None):
+        """Write our recent traces to disk.  Return the time of the next
+           export."""
+        return 0
+
+class PacketTracer(NilPacketTracer):
+    """A PacketTracer follows a sample of the packets that pass through the
+       server, and notes how long each one spends in each stage of
+       processing.
+
+       Every stage time goes into the histogram 'Stage<stage>Time' of the
+       current metrics.  We also keep the most recent stamps in a ring
+       buffer, which we can periodically write to a file along with a
+       summary of each stage.
+
+       A packet changes threads as it moves from stage to stage, so every
+       method here may be called from any thread.  We don't take a lock:
+       each traced packet is in only one stage at a time, and the worst that
+       two threads stamping at the same moment can do to the ring is to
+       make one stamp overwrite the other.
+    """
+    ## Fields:
+    # period: we trace one packet out of every 'period' that arrive.
+    # maxActive: the largest number of packets we trace at once.
+    # ring: a list of (traceID, stage, time, duration) records, or None for
+    #     unused slots.
+    # nextSlot: the number of records we have ever written to 'ring'.  The
+    #     next record goes in ring[nextSlot % len(ring)].
+    # filename: the file to which we dump our traces, or None.
+    # interval: number of seconds between dumps.
+    # nextExport: the time at which we next dump our traces, or 0.
+    # _count: the number of packets passed to start() so far.
+    # _lastID: the most recently assigned trace ID.
+    # _last: a map from the ID of every packet we're tracing to the time of
+    #     its last stamp.
+    # _byKey: a map from key to trace ID for packets waiting in a queue.
+    #     See follow().
+    enabled = 1
+    def __init__(self, rate, ringSize=4096, maxActive=10000, filename=None,
+                 interval=60, now=None):
+        """Create a PacketTracer that follows a fraction 'rate' of all
+           packets, and remembers the last 'ringSize' stamps.  If 'filename'
+           is provided, dump the remembered stamps there every 'interval'
+           seconds."""
+        if now is None: now = time()
+        self.period = max(1, int(round(1.0/rate)))
+        self.maxActive = maxActive
+        self.ring = [None] * ringSize
+        self.nextSlot = 0
+        self.filename = filename
+        self.interval = interval
+        if filename:
+            parent = os.path.split(filename)[0]
+            if not os.path.exists(parent):
+                # As with Metrics, other users may want to read our traces.
+                os.makedirs(parent, 0755)
+            self.nextExport = now + interval
+        else:
+            self.nextExport = 0
+        self._count = 0
+        self._lastID = 0
+        self._last = {}
+        self._byKey = {}
+
+    def start(self):
+        # This is only called from the main thread, so we can count without
+        # a lock.
+        n = self._count = self._count + 1
+        if n % self.period:
+            return None
+        if len(self._last) >= self.maxActive:
+            # Some packets must have gone away without being finished.
+            # Rather than stop tracing, we give up on all of them.
+            LOG.debug("Too many packets traced at once; dropping traces.")
+            self._last.clear()
+            self._byKey.clear()
+        traceID = self._lastID = self._lastID + 1
+        now = time()
+        self._last[traceID] = now
+        self._record((traceID, 'Received', now, 0.0))
+        return traceID
+
+    def stamp(self, traceID, stage):
+        now = time()
+        last = self._last.get(traceID)
+        if last is None:
+            # We gave up on this packet.
+            return
+        self._last[traceID] = now
+        self._record((traceID, stage, now, now-last))
+        metrics.observe("Stage%sTime" % stage, now-last)
+
+    def follow(self, traceID, key):
+        if self._last.has_key(traceID):
+            self._byKey[key] = traceID
+
+    def take(self, key):
+        try:
+            traceID = self._byKey[key]
+            del self._byKey[key]
+        except KeyError:
+            return None
+        return traceID
+
+    def finish(self, traceID):
+        try:
+            del self._last[traceID]
+        except KeyError:
+            pass
+
+    def _record(self, rec):
+        """Helper: add a record to the ring buffer."""
+        i = self.nextSlot
+        self.nextSlot = i + 1
+        ring = self.ring
+        ring[i % len(ring)] = rec
+
+    def getRecords(self):
+        """Return a list of the (traceID, stage, time, duration) records in
+           the ring buffer, oldest first."""
+        n = len(self.ring)
+        i = self.nextSlot
+        if i <= n:
+            recs = self.ring[:i]
+        else:
+            i = i % n
+            recs = self.ring[i:] + self.ring[:i]
+        return [ r for r in recs if r is not None ]
+
+    def dump(self, f, now=None):
+        """Write the records in the ring buffer, and a summary of the time
+           spent in each stage, to a file handle 'f'."""
+        if now is None: now = time()
+        records = self.getRecords()
+        print >>f, "# Mixminion packet traces at %s" % formatTime(now, 1)
+        print >>f, "# Tracing 1 packet in %s; %s stamps remembered" % (
+            self.period, len(records))
+        byStage = {}
+        for _, stage, _, duration in records:
+            if stage != 'Received':
+                byStage.setdefault(stage, []).append(duration)
+        print >>f, "# Stage Count Mean Median 90th Max"
+        for stage in TRACE_STAGES:
+            ds = byStage.get(stage)
+            if not ds:
+                continue
+            ds.sort()
+            n = len(ds)
+            print >>f, "# %s %s %f %f %f %f" % (
+                stage, n, reduce(operator.add, ds)/n, ds[n//2],
+                ds[(n*9)//10], ds[-1])
+        for traceID, stage, when, duration in records:
+            print >>f, "%s %s %f %f" % (traceID, stage, when, duration)
+
+    def getNextExport(self):
+        return self.nextExport
+
+    def export(self, now=None):
+        if now is None: now = time()
+        if not self.filename:
+            return 0
+        f = cStringIO.StringIO()
+        self.dump(f, now)
+        writeFile(self.filename, f.getvalue(), mode=0644)
+        self.nextExport = now + self.interval
+        return self.nextExport
+
 def configureLog(config):
     """Given a configuration file, set up the log.  May replace the log global
        variable.
@@ -331,5 +773,52 @@ def configureLog(config):
         log = NilEventLog()
         LOG.info("Statistics logging disabled")
 
+    configureMetrics(config)
+
+def configureMetrics(config):
+    """Given a configuration file, set up the metrics.  May replace the
+       metrics global variable.
+    """
+    global metrics
+    server = config['Server']
+    if server.get('Metrics'):
+        metricsFile = config.getMetricsFile()
+        interval = server['MetricsInterval'].getSeconds()
+        metrics = Metrics(metricsFile, interval)
+        # MMTP connections report their TLS handshakes.
+        import mixminion.MMTPClient
+        mixminion.MMTPClient.useEventStats()
+        LOG.info("Exporting metrics to %s every %s seconds",
+                 metricsFile, interval)
+    else:
+        metrics = NilMetrics()
+
+    configureTracing(config)
+
+def configureTracing(config):
+    """Given a configuration file, set up packet tracing.  May replace the
+       tracer global variable.
+    """
+    global tracer
+    server = config['Server']
+    rate = server.get('PacketTraceRate', 0)
+    if server.get('PacketTracing') and rate > 0:
+        traceFile = server.get('PacketTraceFile')
+        interval = server['MetricsInterval'].getSeconds()
+        tracer = PacketTracer(rate, filename=traceFile, interval=interval)
+        if traceFile:
+            LOG.info("Tracing 1 packet in %s; dumping traces to %s",
+                     tracer.period, traceFile)
+        else:
+            LOG.info("Tracing 1 packet in %s", tracer.period)
+    else:
+        tracer = NilPacketTracer()
+
 # Global variable: The currently configured event log.
 log = NilEventLog()
+
+# Global variable: The currently configured metrics.
+metrics = NilMetrics()
+
+# Global variable: The currently configured packet tracer.
+tracer = NilPacketTracer()
@@ -6,13 +6,25 @@
    Persistent memory for the hashed secrets we've seen.  Used by
    PacketHandler to prevent replay attacks."""
 
+import mmap
 import os
+import stat
+import struct
 import threading
 import mixminion.Filestore
-from mixminion.Common import MixFatalError, LOG, secureDelete
+from mixminion.Common import MixFatalError, LOG, O_BINARY, secureDelete
+from mixminion.Crypto import sha1
 from mixminion.Packet import DIGEST_LEN
 
-__all__ = [ 'HashLog', 'getHashLog', 'deleteHashLog' ]
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl, we can't lock parts of a file, so we can't share a
+    # MappedHashLog between processes.
+    fcntl = None
+
+__all__ = [ 'HashLog', 'MappedHashLog', 'getHashLog', 'deleteHashLog',
+            'configureHashLogs' ]
 
 # FFFF Mechanism to force a different default db module.
 
@@ -23,6 +35,30 @@ __all__ = [ 'HashLog', 'getHashLog', 'deleteHashLog' ]
 _HASHLOG_DICT_LOCK = threading.RLock()
 # Map from (filename) to (keyid,open HashLog). Needed to implement getHashLog.
 _OPEN_HASHLOGS = {}
+# If true, getHashLog creates MappedHashLogs for new keys; otherwise it
+# creates HashLogs.
+_USE_MAPPED_HASHLOGS = 0
+
+def configureHashLogs(config):
+    """Given a configuration object, decide which kind of hashlog to
+       create for new keys."""
+    global _USE_MAPPED_HASHLOGS
+    _USE_MAPPED_HASHLOGS = config['Server'].get('SharedHashLogs', 0)
+
+def _isMappedHashLog(filename):
+    """Return true iff the hashlog at 'filename' is a MappedHashLog, or
+       doesn't exist yet and should be one.  A hashlog keeps the kind it
+       was created with, so changing SharedHashLogs never makes us forget
+       the packets we've seen under a live key."""
+    if os.path.exists(filename+".log") or os.path.exists(filename+".map"):
+        return 1
+    parent, name = os.path.split(filename)
+    if os.path.exists(parent):
+        for fn in os.listdir(parent):
+            if fn == name or fn.startswith(name+".") or \
+                   fn.startswith(name+"_"):
+                return 0
+    return _USE_MAPPED_HASHLOGS
 
 def getHashLog(filename, keyid):
     """Given a filename and keyid, return a HashLog object with that fname
@@ -38,7 +74,10 @@ def getHashLog(filename, keyid):
             LOG.trace("getHashLog() returning open hashlog at %s",filename)
         except KeyError:
             LOG.trace("getHashLog() opening hashlog at %s",filename)
-            hl = HashLog(filename, keyid)
+            if _isMappedHashLog(filename):
+                hl = MappedHashLog(filename, keyid)
+            else:
+                hl = HashLog(filename, keyid)
             _OPEN_HASHLOGS[filename] = (keyid, hl)
         return hl
     finally:
@@ -106,6 +145,19 @@ class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
         assert len(hash) == DIGEST_LEN
         self[hash] = 1
 
+    def checkAndLogHash(self, hash):
+        """Return true if we've seen 'hash' before.  Otherwise, log it and
+           return false."""
+        assert len(hash) == DIGEST_LEN
+        self._lock.acquire()
+        try:
+            if self.has_key(hash):
+                return 1
+            self[hash] = 1
+            return 0
+        finally:
+            self._lock.release()
+
     def close(self):
         try:
             _HASHLOG_DICT_LOCK.acquire()
@@ -117,3 +169,356 @@ class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
         finally:
             _HASHLOG_DICT_LOCK.release()
 
+
+# A MappedHashLog's table file begins with a header: a magic string, the
+# SHA-1 hash of the keyid, the number of buckets, how many bytes of the log
+# file the table is known to hold on disk, and a flag set once another
+# table has replaced this one.
+_MAP_MAGIC = "MIXHMAP1"
+_MAP_HEADER_FORMAT = "!8s20sLLB"
+_MAP_HEADER_LEN = 64
+_MAP_CHECKPOINT_POS = 32
+_MAP_RETIRED_POS = 36
+# The log file begins with a magic string and the hash of the keyid; the
+# rest is a list of digests.
+_LOG_MAGIC = "MIXHLOG1"
+_LOG_HEADER_LEN = 8+DIGEST_LEN
+# A slot in the table is a byte that is nonzero when the slot is full,
+# followed by a digest.
+SLOT_LEN = 1+DIGEST_LEN
+# Number of slots in each bucket.  A bucket is the unit of locking.
+BUCKET_SLOTS = 16
+BUCKET_LEN = SLOT_LEN*BUCKET_SLOTS
+# We grow the table when more than this fraction of its slots are full.
+MAX_LOAD = 0.75
+
+class MappedHashLog:
+    """A MappedHashLog does the same job as a HashLog, but several
+       processes can use the same one at once.
+
+       The digests live in an open-addressing hash table, in a file
+       ("FILENAME.map") that every process maps into memory.  The table is
+       divided into buckets of BUCKET_SLOTS slots.  A digest goes into the
+       first bucket with room, starting with the one its first bytes
+       select.  Since we never remove a digest, a bucket that was full
+       without a given digest stays that way; so two processes that take
+       turns locking each bucket in the same order will always agree on
+       whether a digest is new.  Processes lock buckets with fcntl locks
+       on "FILENAME.lock", and never hold more than one bucket at a time.
+
+       The table is only a cache.  Every new digest is also appended to
+       "FILENAME.log", and sync() records in the table how much of the log
+       it holds on disk.  When we open the table, we re-insert every
+       digest logged after that point, or rebuild the table from the whole
+       log if the table is missing or damaged.  When the table gets too
+       full, one process builds a bigger one and marks the old one as
+       retired; the others notice, and open the new one.
+
+       As with HashLog, you must sync() the log before relaying any
+       packet whose digest you've logged."""
+    ## Fields:
+    # filename: The name of the HashLog; all our files start with it.
+    # keyid: The keyid for this log.
+    # keyHash: SHA-1 hash of keyid, as stored in the files.
+    # tableFile, logFile, lockFile: Names of our files.
+    # tableFD, logFD, lockFD: Open file descriptors for our files.
+    # table: An mmap object for the table file.
+    # nBuckets: The number of buckets in 'table'.
+    # _lock: A lock to keep the threads of this process out of each
+    #    other's way: fcntl locks only exclude other processes.
+    def __init__(self, filename, keyid, nBuckets=1024):
+        """Open or create the MappedHashLog whose files begin with
+           'filename', for the key whose hash is 'keyid'.  If we need to
+           create the table, make it at least 'nBuckets' buckets long."""
+        if fcntl is None:
+            raise MixFatalError("Shared hashlogs aren't supported on this "
+                                "platform.")
+        self.filename = filename
+        self.keyid = keyid
+        self.keyHash = sha1(keyid)
+        self.tableFile = filename+".map"
+        self.logFile = filename+".log"
+        self.lockFile = filename+".lock"
+        self.table = None
+        self.tableFD = None
+        self._lock = threading.RLock()
+        self.lockFD = os.open(self.lockFile, os.O_RDWR|os.O_CREAT|O_BINARY,
+                              0600)
+        # Nobody else may touch the table while we check it.
+        self._lockRange(fcntl.LOCK_EX, 0)
+        try:
+            self._openLog()
+            self._openTable(nBuckets)
+        finally:
+            self._unlockRange(0)
+
+    def seenHash(self, hash):
+        return self._probe(hash, 0)
+
+    def logHash(self, hash):
+        self._probe(hash, 1)
+
+    def checkAndLogHash(self, hash):
+        """Return true if we've seen 'hash' before.  Otherwise, log it and
+           return false.  Unlike a call to seenHash followed by a call to
+           logHash, this is atomic even if other processes share the log."""
+        return self._probe(hash, 1)
+
+    def sync(self):
+        """Flush all logged digests to disk."""
+        self._lock.acquire()
+        try:
+            self._lockRange(fcntl.LOCK_SH, 0)
+            try:
+                self._checkRetired()
+                # Every digest in the first 'end' bytes of the log is
+                # already in the table, since we always add to the table
+                # before we add to the log.
+                end = os.fstat(self.logFD)[stat.ST_SIZE]
+                if hasattr(os, 'fsync'):
+                    os.fsync(self.logFD)
+                self.table.flush()
+                self.table[_MAP_CHECKPOINT_POS:_MAP_CHECKPOINT_POS+4] = \
+                                        struct.pack("!L", end)
+                self.table.flush()
+            finally:
+                self._unlockRange(0)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Sync this log to disk and release its files."""
+        try:
+            _HASHLOG_DICT_LOCK.acquire()
+            self._lock.acquire()
+            try:
+                if self.table is not None:
+                    self.sync()
+                    self._closeTable()
+                    os.close(self.logFD)
+                    os.close(self.lockFD)
+            finally:
+                self._lock.release()
+            try:
+                del _OPEN_HASHLOGS[self.filename]
+            except KeyError:
+                pass
+        finally:
+            _HASHLOG_DICT_LOCK.release()
+
+    def _lockRange(self, op, pos):
+        """Helper: lock byte 'pos' of the lock file.  Byte 0 guards the
+           table as a whole; byte 1+N guards bucket N."""
+        fcntl.lockf(self.lockFD, op, 1, pos)
+
+    def _unlockRange(self, pos):
+        """Helper: unlock byte 'pos' of the lock file."""
+        fcntl.lockf(self.lockFD, fcntl.LOCK_UN, 1, pos)
+
+    def _probe(self, hash, add):
+        """Helper: return true iff 'hash' is in the table.  If it isn't,
+           and 'add' is true, add it to the table and the log."""
+        assert len(hash) == DIGEST_LEN
+        self._lock.acquire()
+        try:
+            self._lockRange(fcntl.LOCK_SH, 0)
+            try:
+                self._checkRetired()
+                found = self._probeTable(hash, add, 1)
+                if found or not add:
+                    return found
+                n = os.write(self.logFD, hash)
+                if n != DIGEST_LEN:
+                    raise MixFatalError("Short write to hashlog %s"
+                                        % self.logFile)
+                nEntries = ((os.fstat(self.logFD)[stat.ST_SIZE]
+                             - _LOG_HEADER_LEN) // DIGEST_LEN)
+            finally:
+                self._unlockRange(0)
+            if nEntries > self.nBuckets*BUCKET_SLOTS*MAX_LOAD:
+                self._grow()
+            return 0
+        finally:
+            self._lock.release()
+
+    def _probeTable(self, hash, add, lock):
+        """Helper: return true iff 'hash' is in the table.  If it isn't,
+           and 'add' is true, add it to the table.  If 'lock' is true, lock
+           each bucket as we look at it."""
+        table = self.table
+        nBuckets = self.nBuckets
+        entry = "\001"+hash
+        b = struct.unpack("!L", hash[:4])[0] % nBuckets
+        for _ in xrange(nBuckets):
+            if lock:
+                self._lockRange(fcntl.LOCK_EX, b+1)
+            try:
+                start = _MAP_HEADER_LEN + b*BUCKET_LEN
+                bucket = table[start:start+BUCKET_LEN]
+                idx = bucket.find(entry)
+                while idx > 0 and idx % SLOT_LEN:
+                    idx = bucket.find(entry, idx+1)
+                if idx >= 0:
+                    return 1
+                # Slots fill from the front of each bucket, so an empty
+                # slot means the digest isn't in any later bucket either.
+                for pos in xrange(0, BUCKET_LEN, SLOT_LEN):
+                    if bucket[pos] == "\000":
+                        if add:
+                            table[start+pos:start+pos+SLOT_LEN] = entry
+                        return 0
+            finally:
+                if lock:
+                    self._unlockRange(b+1)
+            b = (b+1) % nBuckets
+        if add:
+            raise MixFatalError("Hashlog %s is full" % self.filename)
+        return 0
+
+    def _checkRetired(self):
+        """Helper: if another process has replaced our table, open the new
+           one.  Caller must hold the table lock."""
+        if self.table[_MAP_RETIRED_POS] != "\000":
+            self._closeTable()
+            self._mapTable()
+
+    def _grow(self):
+        """Helper: replace the table with one twice as large, if nobody
+           else has done so already."""
+        self._lockRange(fcntl.LOCK_EX, 0)
+        try:
+            self._checkRetired()
+            nEntries = ((os.fstat(self.logFD)[stat.ST_SIZE]
+                         - _LOG_HEADER_LEN) // DIGEST_LEN)
+            if nEntries <= self.nBuckets*BUCKET_SLOTS*MAX_LOAD:
+                return
+            LOG.debug("Growing hashlog %s to %s buckets", self.filename,
+                      self.nBuckets*2)
+            table = self.table
+            digests = []
+            for pos in xrange(_MAP_HEADER_LEN, len(table), SLOT_LEN):
+                if table[pos] != "\000":
+                    digests.append(table[pos+1:pos+SLOT_LEN])
+            end = struct.unpack("!L", table[_MAP_CHECKPOINT_POS:
+                                              _MAP_CHECKPOINT_POS+4])[0]
+            self._buildTable(self.nBuckets*2, digests, end)
+            table[_MAP_RETIRED_POS] = "\001"
+            self._closeTable()
+            self._mapTable()
+        finally:
+            self._unlockRange(0)
+
+    def _openLog(self):
+        """Helper: open the log file, creating it if it doesn't exist.
+           Caller must hold the table lock exclusively."""
+        self.logFD = os.open(self.logFile,
+                             os.O_RDWR|os.O_CREAT|os.O_APPEND|O_BINARY, 0600)
+        size = os.fstat(self.logFD)[stat.ST_SIZE]
+        if size == 0:
+            os.write(self.logFD, _LOG_MAGIC+self.keyHash)
+            if hasattr(os, 'fsync'):
+                os.fsync(self.logFD)
+            return
+        os.lseek(self.logFD, 0, 0)
+        header = os.read(self.logFD, _LOG_HEADER_LEN)
+        if header[:len(_LOG_MAGIC)] != _LOG_MAGIC or \
+               len(header) != _LOG_HEADER_LEN:
+            raise MixFatalError("Hashlog %s is corrupt" % self.logFile)
+        if header[len(_LOG_MAGIC):] != self.keyHash:
+            raise MixFatalError("Log KEYID does not match current KEYID")
+        extra = (size - _LOG_HEADER_LEN) % DIGEST_LEN
+        if extra:
+            # We crashed in the middle of a write.  Since every digest in
+            # the log is also in the table, losing part of one is harmless.
+            LOG.warn("Discarding partial entry at end of hashlog %s",
+                     self.logFile)
+            os.ftruncate(self.logFD, size - extra)
+
+    def _readLog(self, start):
+        """Helper: return a list of all the digests in the log from
+           offset 'start' onwards."""
+        os.lseek(self.logFD, start, 0)
+        chunks = []
+        while 1:
+            s = os.read(self.logFD, 65536)
+            if not s:
+                break
+            chunks.append(s)
+        s = "".join(chunks)
+        return [ s[i:i+DIGEST_LEN]
+                 for i in xrange(0, len(s)-DIGEST_LEN+1, DIGEST_LEN) ]
+
+    def _openTable(self, nBuckets):
+        """Helper: map the table into memory, bringing it up to date with
+           the log, or rebuilding it if it is unusable.  Caller must hold
+           the table lock exclusively."""
+        logSize = os.fstat(self.logFD)[stat.ST_SIZE]
+        if os.path.exists(self.tableFile):
+            try:
+                self._mapTable()
+            except MixFatalError:
+                pass
+            else:
+                magic, keyHash, _, end, retired = struct.unpack(
+                    _MAP_HEADER_FORMAT,
+                    self.table[:struct.calcsize(_MAP_HEADER_FORMAT)])
+                if (magic == _MAP_MAGIC and keyHash == self.keyHash
+                    and not retired and _LOG_HEADER_LEN <= end <= logSize):
+                    for hash in self._readLog(end):
+                        self._probeTable(hash, 1, 0)
+                    return
+                self._closeTable()
+            LOG.warn("Rebuilding damaged hashlog %s", self.tableFile)
+        digests = self._readLog(_LOG_HEADER_LEN)
+        while len(digests) > nBuckets*BUCKET_SLOTS*MAX_LOAD/2:
+            nBuckets *= 2
+        self._buildTable(nBuckets, digests, logSize)
+        self._mapTable()
+
+    def _buildTable(self, nBuckets, digests, end):
+        """Helper: write a new table with 'nBuckets' buckets, holding every
+           digest in 'digests', to the table file.  'end' is how much of
+           the log the new table is known to hold.  Caller must hold the
+           table lock exclusively."""
+        tmpName = self.tableFile+".tmp"
+        fd = os.open(tmpName, os.O_RDWR|os.O_CREAT|os.O_TRUNC|O_BINARY, 0600)
+        try:
+            header = struct.pack(_MAP_HEADER_FORMAT, _MAP_MAGIC,
+                                 self.keyHash, nBuckets, end, 0)
+            os.write(fd, header + "\000"*(_MAP_HEADER_LEN-len(header)))
+            zeros = "\000"*(BUCKET_LEN*64)
+            left = nBuckets
+            while left > 0:
+                n = min(left, 64)
+                os.write(fd, zeros[:n*BUCKET_LEN])
+                left -= n
+            table = mmap.mmap(fd, _MAP_HEADER_LEN + nBuckets*BUCKET_LEN)
+        finally:
+            os.close(fd)
+        oldTable, oldBuckets = self.table, getattr(self, 'nBuckets', None)
+        self.table, self.nBuckets = table, nBuckets
+        try:
+            for hash in digests:
+                self._probeTable(hash, 1, 0)
+            table.flush()
+        finally:
+            self.table, self.nBuckets = oldTable, oldBuckets
+            table.close()
+        os.rename(tmpName, self.tableFile)
+
+    def _mapTable(self):
+        """Helper: open and map the current table file."""
+        self.tableFD = os.open(self.tableFile, os.O_RDWR|O_BINARY)
+        size = os.fstat(self.tableFD)[stat.ST_SIZE]
+        if size < _MAP_HEADER_LEN or (size-_MAP_HEADER_LEN) % BUCKET_LEN:
+            os.close(self.tableFD)
+            self.tableFD = None
+            raise MixFatalError("Hashlog %s is corrupt" % self.tableFile)
+        self.table = mmap.mmap(self.tableFD, size)
+        self.nBuckets = (size-_MAP_HEADER_LEN) // BUCKET_LEN
+
+    def _closeTable(self):
+        """Helper: unmap the table."""
+        self.table.close()
+        os.close(self.tableFD)
+        self.table = self.tableFD = None
@@ -0,0 +1,477 @@
+# Copyright 2002-2004 Nick Mathewson.  See LICENSE for licensing information.
+# $Id$
+"""mixminion.server.MMTPFrontEnd
+
+   Code to run the TLS and MMTP work for a server in several front-end
+   processes, so that it isn't limited to a single CPU.
+
+   The core server process creates the listening sockets, and then forks
+   a number of front-end processes that share them.  Each front end
+   accepts incoming connections, does all the TLS and MMTP framing
+   (including checking each packet's digest), and passes every verified
+   packet to the core over a Unix socket.  The core stores the packet,
+   and tells the front end when it may acknowledge it.  In the other
+   direction, the core resolves the address for each batch of outgoing
+   packets and passes the batch to a front end, which makes the
+   connection and reports back which packets were delivered.
+
+   All traffic between the core and a front end is a sequence of
+   messages, each of the form:
+        Length  [4 bytes]  (Length of the type and body)
+        Type    [1 byte]
+        Body    [Length-1 bytes]
+   """
+
+__all__ = [ 'FrontEndPool', 'canRunFrontEnds' ]
+
+import cPickle
+import errno
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+import mixminion.Crypto
+import mixminion.server.DNSFarm
+import mixminion.server.MMTPServer
+import mixminion.server.ServerKeys
+import mixminion._minionlib as _ml
+from mixminion.Common import LOG, MixFatalError
+from mixminion.MMTPClient import DeliverableMessage
+
+# Message types from the core to a front end:
+#    Acknowledge a packet: 4-byte ID, 1-byte 'stored' flag.
+MSG_ACK = "A"
+#    Deliver packets: pickled (family, ip, port, keyID, serverName,
+#    knownServer, [(ID, contents, isJunk)...])
+MSG_DELIVER = "D"
+#    Use new TLS keys: pickled (certFile, encoded private key, dhFile)
+MSG_KEYS = "K"
+# Message types from a front end to the core:
+#    Received a packet: 4-byte ID, 32K packet.
+MSG_PACKET = "P"
+#    Delivery result: 4-byte ID, 1-byte 'succeeded' flag, 1-byte 'retriable'
+#    flag.
+MSG_RESULT = "R"
+#    Ping log event: pickled (methodName, identity)
+MSG_PINGLOG = "L"
+
+# How much do we try to read from a channel at once?
+_READLEN = 64*1024
+
+def canRunFrontEnds():
+    """Return true iff this platform can run front-end processes."""
+    return (hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX')
+            and mixminion.server.MMTPServer.fcntl is not None)
+
+class _Channel(mixminion.server.MMTPServer.Connection):
+    """A nonblocking connection over a Unix socket that carries messages
+       between the core and a front end.  Registered with an AsyncServer.
+    """
+    ## Fields:
+    # sock: the underlying socket, or None if we're closed.
+    # server: the AsyncServer we're registered with.
+    # handler: a function to call with (type, body) for each message we
+    #    receive.
+    # onClose: a function to call when the other side closes the socket.
+    # inbuf, outbuf: lists of strings read and waiting to be written.
+    # inbuflen: total length of the strings in inbuf.
+    def __init__(self, sock, server, handler, onClose):
+        self.sock = sock
+        self.sock.setblocking(0)
+        self.server = server
+        self.handler = handler
+        self.onClose = onClose
+        self.inbuf = []
+        self.inbuflen = 0
+        self.outbuf = []
+
+    def send(self, msgType, body):
+        """Queue a message of type 'msgType' with the body 'body' to be sent
+           to the other side.  Must be called from the main thread."""
+        if self.sock is None:
+            return
+        wasWriting = len(self.outbuf)
+        self.outbuf.append(struct.pack("!L", len(body)+1))
+        self.outbuf.append(msgType)
+        self.outbuf.append(body)
+        if not wasWriting:
+            # Tell the server that we want to write now.
+            self.server.register(self)
+
+    def close(self):
+        """Close this channel."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            self.onClose()
+
+    def isShutdown(self):
+        return self.sock is None
+    def fileno(self):
+        return self.sock.fileno()
+    def getStatus(self):
+        isOpen = self.sock is not None
+        return isOpen, isOpen and len(self.outbuf) > 0, isOpen
+    def tryTimeout(self, cutoff):
+        return 0
+
+    def process(self, r, w, x, cap):
+        try:
+            if x:
+                self.close()
+            if r and self.sock is not None:
+                self.__doRead()
+            if self.outbuf and self.sock is not None:
+                self.__doWrite()
+        except socket.error, e:
+            if e[0] not in (errno.ECONNRESET, errno.EPIPE):
+                LOG.warn("Error on front-end channel: %s", e)
+            self.close()
+        wr, ww, isOpen = self.getStatus()
+        return wr, ww, isOpen, 0
+
+    def __doRead(self):
+        """Helper: read as much as we can, and handle every complete
+           message."""
+        while 1:
+            try:
+                s = self.sock.recv(_READLEN)
+            except socket.error, e:
+                if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            if not s:
+                self.close()
+                return
+            self.inbuf.append(s)
+            self.inbuflen += len(s)
+
+        if self.inbuflen < 5:
+            return
+        data = "".join(self.inbuf)
+        pos = 0
+        while len(data)-pos >= 4:
+            length, = struct.unpack("!L", data[pos:pos+4])
+            if len(data)-pos-4 < length:
+                break
+            msgType = data[pos+4]
+            body = data[pos+5:pos+4+length]
+            pos += 4+length
+            self.handler(msgType, body)
+            if self.sock is None:
+                return
+        data = data[pos:]
+        self.inbuf = [ data ]
+        self.inbuflen = len(data)
+
+    def __doWrite(self):
+        """Helper: write as much of self.outbuf as we can."""
+        data = "".join(self.outbuf)
+        try:
+            n = self.sock.send(data)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                n = 0
+            else:
+                raise
+        if n < len(data):
+            self.outbuf = [ data[n:] ]
+        else:
+            self.outbuf = []
+
+#----------------------------------------------------------------------
+# Core side
+
+class _RemoteAck:
+    """Stands in for the _PendingAck of a packet received by a front end:
+       releasing it tells the front end to acknowledge the packet."""
+    def __init__(self, channel, msgID):
+        self.connection = channel
+        self.msgID = msgID
+    def release(self, ok):
+        self.connection.send(MSG_ACK, self.msgID+chr(ok and 1 or 0))
+
+class _FrontEnd:
+    """The core's record of a single front-end process."""
+    ## Fields:
+    # pid: the process ID of the front end.
+    # channel: a _Channel connected to the front end.
+    # deliverables: map from message ID to the DeliverableMessage objects
+    #     we've asked this front end to deliver.
+    def __init__(self, pid, channel):
+        self.pid = pid
+        self.channel = channel
+        self.deliverables = {}
+
+class FrontEndPool:
+    """Runs in the core process: manages a set of front-end processes for
+       an MMTPAsyncServer."""
+    ## Fields:
+    # server: the MMTPAsyncServer in the core process.
+    # frontEnds: a list of _FrontEnd objects.
+    # nextID: the ID to use for the next packet we send to a front end.
+    # _isShutdown: flag: have we shut down the front ends on purpose?
+    # _keyBody: the body of the last MSG_KEYS we sent, or None.
+    def __init__(self, server):
+        self.server = server
+        self.frontEnds = []
+        self.nextID = 0
+        self._isShutdown = 0
+        self._keyBody = None
+
+    def start(self, n, config):
+        """Fork 'n' front-end processes to handle connections on the
+           server's listeners.  Must be called before any threads start."""
+        listeners = self.server.listeners
+        for i in xrange(n):
+            core, child = socket.socketpair(socket.AF_UNIX,
+                                            socket.SOCK_STREAM)
+            pid = os.fork()
+            if pid == 0:
+                # We're the child.
+                core.close()
+                for fe in self.frontEnds:
+                    fe.channel.sock.close()
+                # Don't share our random state with the core or with the
+                # other front ends.
+                mixminion.Crypto.openssl_seed(40)
+                threading.currentThread().minion_shared_PRNG = \
+                    mixminion.Crypto.AESCounterPRNG()
+                _runFrontEnd(config, self.server.serverContext, listeners,
+                             child, n)
+                os._exit(0)
+            child.close()
+            fe = _FrontEnd(pid, None)
+            fe.channel = _Channel(core, self.server,
+                                  lambda t,b,self=self,fe=fe:
+                                        self._handleMessage(fe, t, b),
+                                  lambda self=self,fe=fe: self._closed(fe))
+            self.frontEnds.append(fe)
+            self.server.register(fe.channel)
+            LOG.info("Started MMTP front end %s (pid %s)", i+1, pid)
+
+    def isAlive(self):
+        """Return true iff all of our front ends are still running."""
+        for fe in self.frontEnds:
+            if fe.channel.isShutdown():
+                return 0
+        return 1
+
+    def shutdown(self):
+        """Tell all the front ends to exit, and wait for them."""
+        self._isShutdown = 1
+        for fe in self.frontEnds:
+            fe.channel.close()
+        for fe in self.frontEnds:
+            try:
+                os.kill(fe.pid, signal.SIGTERM)
+                os.waitpid(fe.pid, 0)
+            except OSError:
+                # It's already gone, or somebody else reaped it.
+                pass
+
+    def setKeys(self, keyInfo):
+        """Tell all the front ends to use the TLS keys in 'keyInfo', a
+           (certificate file, private key, DH parameter file) tuple.  Does
+           nothing if the keys are the same as last time."""
+        certFile, key, dhFile = keyInfo
+        body = cPickle.dumps((certFile,
+                              mixminion.Crypto.pk_encode_private_key(key),
+                              dhFile), 1)
+        if body == self._keyBody:
+            return
+        self._keyBody = body
+        for fe in self.frontEnds:
+            fe.channel.send(MSG_KEYS, body)
+
+    def sendPackets(self, family, ip, port, keyID, deliverable, serverName):
+        """Ask one of our front ends to deliver the packets in the list of
+           DeliverableMessage 'deliverable'.  All packets for a given
+           server go to the same front end, so that they can share a
+           connection."""
+        fe = self.frontEnds[hash((ip, port, keyID)) % len(self.frontEnds)]
+        knownServer = self.server._isKnownServer(keyID)
+        pkts = []
+        for d in deliverable:
+            msgID = self._newID()
+            fe.deliverables[msgID] = d
+            pkts.append((msgID, d.getContents(), d.isJunk()))
+        fe.channel.send(MSG_DELIVER, cPickle.dumps(
+            (family, ip, port, keyID, serverName, knownServer, pkts), 1))
+
+    def _newID(self):
+        """Helper: return a new 4-byte message ID."""
+        msgID = struct.pack("!L", self.nextID)
+        self.nextID = (self.nextID + 1) & 0xFFFFFFFFL
+        return msgID
+
+    def _handleMessage(self, fe, msgType, body):
+        """Helper: called when we receive a message from a front end."""
+        server = self.server
+        if msgType == MSG_PACKET:
+            msgID, pkt = body[:4], body[4:]
+            if server.deferAcks:
+                server.onPacketReceived(pkt, _RemoteAck(fe.channel, msgID))
+            else:
+                server.onPacketReceived(pkt)
+                fe.channel.send(MSG_ACK, msgID+chr(1))
+        elif msgType == MSG_RESULT:
+            msgID = body[:4]
+            succeeded, retriable = ord(body[4]), ord(body[5])
+            try:
+                d = fe.deliverables[msgID]
+                del fe.deliverables[msgID]
+            except KeyError:
+                LOG.warn("Front end %s reported on unknown packet", fe.pid)
+                return
+            if succeeded:
+                d.succeeded()
+            else:
+                d.failed(retriable)
+        elif msgType == MSG_PINGLOG:
+            method, identity = cPickle.loads(body)
+            if server.pingLog is not None and \
+                   method in ('connected', 'connectFailed'):
+                getattr(server.pingLog, method)(identity)
+        else:
+            LOG.warn("Unrecognized message %r from front end %s",
+                     msgType, fe.pid)
+
+    def _closed(self, fe):
+        """Helper: called when the channel to a front end closes."""
+        if not self._isShutdown:
+            LOG.error("MMTP front end %s has exited.", fe.pid)
+        # We'll never hear about these packets now; try them again later.
+        deliverables = fe.deliverables.values()
+        fe.deliverables = {}
+        for d in deliverables:
+            d.failed(1)
+
+#----------------------------------------------------------------------
+# Front-end side
+
+class _RemoteDeliverable(DeliverableMessage):
+    """A packet that the core has asked a front end to deliver: reports
+       the result back to the core."""
+    def __init__(self, channel, msgID, contents, isJunk):
+        self.channel = channel
+        self.msgID = msgID
+        self.contents = contents
+        self._isJunk = isJunk
+    def succeeded(self):
+        self.channel.send(MSG_RESULT, self.msgID+"\x01\x00")
+    def failed(self, retriable=0):
+        self.channel.send(MSG_RESULT,
+                          self.msgID+"\x00"+chr(retriable and 1 or 0))
+    def getContents(self):
+        return self.contents
+    def isJunk(self):
+        return self._isJunk
+
+class _RemotePingLog:
+    """Stands in for a PingLog in a front end: passes connection events
+       to the core."""
+    def __init__(self, channel):
+        self.channel = channel
+    def connected(self, identity, now=None):
+        self.channel.send(MSG_PINGLOG, cPickle.dumps(("connected",
+                                                      identity), 1))
+    def connectFailed(self, identity, now=None):
+        self.channel.send(MSG_PINGLOG, cPickle.dumps(("connectFailed",
+                                                      identity), 1))
+
+class _FrontEndServer(mixminion.server.MMTPServer.MMTPAsyncServer):
+    """The MMTPAsyncServer that runs in a front-end process."""
+    ## Fields:
+    # channel: the _Channel connected to the core.
+    # pendingAcks: map from message ID to _PendingAck for the packets we've
+    #    passed to the core, but not yet acknowledged.
+    # knownServers: set of the key IDs the core has told us are for
+    #    servers in the directory.
+    # nextID: the ID to use for the next packet we send to the core.
+    # sessionOptions: keyword arguments for TLSContext_new to configure
+    #    the session cache of our server contexts.
+    def __init__(self, config, servercontext, listeners, sock):
+        mixminion.server.MMTPServer.MMTPAsyncServer.__init__(
+            self, config, servercontext, listeners=listeners)
+        self.connectDNSCache(mixminion.server.DNSFarm.DNSCache())
+        self.channel = _Channel(sock, self, self._handleMessage,
+                                lambda: None)
+        self.register(self.channel)
+        self.connectPingLog(_RemotePingLog(self.channel))
+        self.deferAcks = 1
+        self.pendingAcks = {}
+        self.knownServers = {}
+        self.nextID = 0
+        self.sessionOptions = \
+                mixminion.server.ServerKeys.getTLSSessionOptions(config)
+
+    def onPacketReceived(self, pkt, ack=None):
+        msgID = struct.pack("!L", self.nextID)
+        self.nextID = (self.nextID + 1) & 0xFFFFFFFFL
+        self.pendingAcks[msgID] = ack
+        self.channel.send(MSG_PACKET, msgID+pkt)
+
+    def _isKnownServer(self, keyID):
+        return self.knownServers.has_key(keyID)
+
+    def _handleMessage(self, msgType, body):
+        """Helper: called when we receive a message from the core."""
+        if msgType == MSG_ACK:
+            msgID, ok = body[:4], ord(body[4])
+            try:
+                ack = self.pendingAcks[msgID]
+                del self.pendingAcks[msgID]
+            except KeyError:
+                return
+            ack.release(ok)
+            self._connectionChanged(ack.connection)
+        elif msgType == MSG_DELIVER:
+            family, ip, port, keyID, serverName, knownServer, pkts = \
+                    cPickle.loads(body)
+            if knownServer:
+                self.knownServers[keyID] = 1
+            deliverable = [ _RemoteDeliverable(self.channel, msgID,
+                                               contents, isJunk)
+                            for msgID, contents, isJunk in pkts ]
+            self._sendPackets(family, ip, port, keyID, deliverable,
+                              serverName)
+        elif msgType == MSG_KEYS:
+            certFile, key, dhFile = cPickle.loads(body)
+            key = mixminion.Crypto.pk_decode_private_key(key)
+            self.setServerContext(_ml.TLSContext_new(certFile, key, dhFile,
+                                                     **self.sessionOptions))
+        else:
+            LOG.warn("Unrecognized message %r from core", msgType)
+
+def _runFrontEnd(config, servercontext, listeners, sock, nFrontEnds):
+    """Main loop for a front-end process.  Handles MMTP connections on
+       'listeners' until the core closes 'sock'."""
+    try:
+        # The core handles signals; we just go away when it tells us to.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        server = _FrontEndServer(config, servercontext, listeners, sock)
+        # Divide our bandwidth allowance among the front ends.
+        maxbw = config['Server'].get('MaxBandwidth', None)
+        if maxbw is not None:
+            maxbwspike = config['Server'].get('MaxBandwidthSpike', None)
+            if maxbwspike is not None:
+                maxbwspike = maxbwspike // nFrontEnds
+            server.setBandwidth(maxbw // nFrontEnds, maxbwspike)
+
+        nextTimeout = time.time()
+        while not server.channel.isShutdown():
+            server.process(server.TICK_INTERVAL)
+            now = time.time()
+            if now >= nextTimeout:
+                server.tryTimeout(now)
+                nextTimeout = server.getNextTimeoutTime(now)
+    except:
+        LOG.error_exc(sys.exc_info(), "Exception in MMTP front end")
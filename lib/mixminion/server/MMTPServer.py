@@ -20,6 +20,7 @@
 #    easier to use with TLS.
 
 import errno
+import os
 import socket
 import select
 import re
@@ -27,21 +28,29 @@ import sys
 import threading
 import time
 from types import StringType
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl, we can't make pipes nonblocking, so we can't use
+    # WakeupConnection.
+    fcntl = None
 
 import mixminion.ServerInfo
 import mixminion.TLSConnection
 import mixminion._minionlib as _ml
 from mixminion.Common import MixError, MixFatalError, MixProtocolError, \
-     LOG, stringContains, floorDiv, UIError
+     LOG, stringContains, UIError
 from mixminion.Crypto import sha1, getCommonPRNG
 from mixminion.Packet import PACKET_LEN, DIGEST_LEN, IPV4Info, MMTPHostInfo
-from mixminion.MMTPClient import PeerCertificateCache, MMTPClientConnection
+from mixminion.MMTPClient import PeerCertificateCache, MMTPClientConnection, \
+     TLSSessionCache, noteHandshake
 from mixminion.NetUtils import getProtocolSupport, AF_INET, AF_INET6
 import mixminion.server.EventStats as EventStats
 from mixminion.Filestore import CorruptedFile
 from mixminion.ThreadUtils import MessageQueue, QueueEmpty
 
-__all__ = [ 'AsyncServer', 'ListenConnection', 'MMTPServerConnection' ]
+__all__ = [ 'AsyncServer', 'ListenConnection', 'MMTPServerConnection',
+            'WakeupConnection' ]
 
 class SelectAsyncServer:
     """AsyncServer is the core of a general-purpose asynchronous
@@ -49,6 +58,16 @@ class SelectAsyncServer:
        Connection objects that are waiting for reads and writes
        (respectively), and waits for their underlying sockets to be
        available for the desired operations.
+
+       If bandwidth is limited, the server shares it among its TLS
+       connections with deficit round-robin: every connection that's
+       ready gets up to QUANTUM more bytes in each direction on each
+       pass, starting from a different connection each time, so one busy
+       peer can't starve the others.  Reading and writing have separate
+       budgets, and small writes (acknowledgments and protocol lines) go
+       ahead of everything else.  When a budget runs out, we stop
+       listening for that direction on TLS connections until it has
+       refilled enough for another quantum, rather than sleeping.
        """
     ## Fields:
     # self.connections: a map from fd to Connection objects.
@@ -59,21 +78,44 @@ class SelectAsyncServer:
     #    on average?
     # self.maxBucket: How many bytes of bandwidth are we willing to use in
     #    a single 1-tick burst?
-    # self.bucket: How many bytes are we willing to use in the next tick?
+    # self.readBucket, self.writeBucket: How many bytes are we willing to
+    #    read and write (respectively) right now?  Each gets half of our
+    #    bandwidth.  These can go negative when we let acknowledgments
+    #    through.
     #
-    #   (NOTE: if no bandwidth limitation is used, the 3 fields above are
+    #   (NOTE: if no bandwidth limitation is used, the 4 fields above are
     #   set to None.)
+    # self.lastRefill: When did we last add bandwidth to the buckets?
+    # self.throttled: A (readThrottled, writeThrottled) tuple: are we
+    #    currently ignoring reads or writes on TLS connections because the
+    #    corresponding bucket is empty?
+    # self.deficits: A map from fd to a [readDeficit, writeDeficit] list:
+    #    how many more bytes the connection on fd may use in each direction
+    #    before it has had its fair share.
+    # self.rrOffset: A counter used to pick which connection goes first.
 
     # How many seconds pass between the 'ticks' at which we increment
     # our bandwidth bucket?
     TICK_INTERVAL = 1.0
+    # How many bytes does each connection get in each direction on each
+    # round-robin pass?
+    QUANTUM = 4096
+    # If a connection has no more than this many bytes waiting to be
+    # written, it's sending acknowledgments or protocol lines: let it
+    # write before the connections that are sending packets.
+    PRIORITY_WRITE_LEN = 512
 
     def __init__(self):
         """Create a new AsyncServer with no readers or writers."""
         self._timeout = None
         self.connections = {}
         self.state = {}
-        self.bandwidthPerTick = self.bucket = self.maxBucket = None
+        self.bandwidthPerTick = self.maxBucket = None
+        self.readBucket = self.writeBucket = None
+        self.lastRefill = time.time()
+        self.throttled = (0,0)
+        self.deficits = {}
+        self.rrOffset = 0
 
     def process(self,timeout):
         """If any relevant file descriptors become available within
@@ -83,8 +125,10 @@ class SelectAsyncServer:
 
            If we receive an unblocked signal, return immediately.
            """
+        timeout = self._refill(timeout)
         readfds = []; writefds = []; exfds = []
         for fd,(wr,ww) in self.state.items():
+            wr,ww = self._getInterest(self.connections[fd],wr,ww)
             if wr: readfds.append(fd)
             if ww==2: exfds.append(fd)
             if ww: writefds.append(fd)
@@ -96,10 +140,6 @@ class SelectAsyncServer:
             time.sleep(timeout)
             return
 
-        if self.bucket is not None and self.bucket <= 0:
-            time.sleep(timeout)
-            return
-
         try:
             readfds,writefds,exfds = select.select(readfds,writefds,exfds,
                                                    timeout)
@@ -118,22 +158,9 @@ class SelectAsyncServer:
             w = fd in writefds
             if not (r or w):
                 continue
-            active.append((c,r,w,fd))
+            active.append((fd,c,r,w,0))
 
-        if not active: return
-        if self.bucket is None:
-            cap = None
-        else:
-            cap = floorDiv(self.bucket, len(active))
-        for c,r,w,fd in active:
-            wr, ww, isopen, nbytes = c.process(r,w,0,cap)
-            if cap is not None:
-                self.bucket -= nbytes
-            if not isopen:
-                del self.connections[fd]
-                del self.state[fd]
-                continue
-            self.state[fd] = (wr,ww)
+        self._processActive(active)
 
     def register(self, c):
         """Add a connection to this server."""
@@ -149,6 +176,136 @@ class SelectAsyncServer:
             fd = c.fileno()
         del self.connections[fd]
         del self.state[fd]
+        self.deficits.pop(fd, None)
+
+    def _update(self, fd, c, wr, ww, isopen):
+        """Helper: record that the connection 'c' on 'fd' now has
+           status wr, ww, isopen."""
+        if not isopen:
+            del self.connections[fd]
+            del self.state[fd]
+            self.deficits.pop(fd, None)
+        else:
+            self.state[fd] = (wr,ww)
+
+    def _throttleChanged(self):
+        """Helper: called when self.throttled changes."""
+        pass
+
+    def _isMetered(self, c):
+        """Return true iff bandwidth limits apply to the connection 'c'."""
+        return isinstance(c, mixminion.TLSConnection.TLSConnection)
+
+    def _getInterest(self, c, wr, ww):
+        """Given that the connection 'c' wants to read and write as
+           indicated by 'wr' and 'ww', return the wr, ww we should actually
+           wait for, given our bandwidth limits."""
+        readThrottled, writeThrottled = self.throttled
+        if not (readThrottled or writeThrottled) or not self._isMetered(c):
+            return wr, ww
+        if readThrottled:
+            wr = 0
+        if writeThrottled and ww == 1 and \
+               c.outbuflen > self.PRIORITY_WRITE_LEN:
+            ww = 0
+        return wr, ww
+
+    def _processActive(self, active):
+        """Helper: given a list of (fd, connection, r, w, x) tuples for the
+           connections with pending events, let each connection handle its
+           events, sharing out our bandwidth fairly among them."""
+        if self.readBucket is None:
+            for fd,c,r,w,x in active:
+                wr, ww, isopen, n = c.process(r,w,x,None)
+                self._update(fd,c,wr,ww,isopen)
+            return
+
+        metered = []
+        for fd,c,r,w,x in active:
+            if x or not self._isMetered(c):
+                wr, ww, isopen, n = c.process(r,w,x,None)
+                self._update(fd,c,wr,ww,isopen)
+                continue
+            if w and c.outbuflen <= self.PRIORITY_WRITE_LEN:
+                # Acknowledgments (and handshakes) don't wait for their
+                # turn, or for the bucket to refill.
+                wr, ww, isopen, n = c.process(0,w,0,self.PRIORITY_WRITE_LEN)
+                self.writeBucket -= n
+                if not (isopen and r):
+                    self._update(fd,c,wr,ww,isopen)
+                    continue
+                w = 0
+            metered.append((fd,c,r,w))
+
+        if metered:
+            self.rrOffset = (self.rrOffset + 1) % len(metered)
+            metered = metered[self.rrOffset:] + metered[:self.rrOffset]
+        maxDeficit = self.QUANTUM*4
+        for fd,c,r,w in metered:
+            deficit = self.deficits.get(fd)
+            if deficit is None:
+                deficit = self.deficits[fd] = [0,0]
+            wr, ww, isopen = c.getStatus()
+            if r:
+                deficit[0] = min(deficit[0] + self.QUANTUM, maxDeficit)
+                cap = int(min(deficit[0], self.readBucket))
+                if cap > 0:
+                    wr, ww, isopen, n = c.process(1,0,0,cap)
+                    self.readBucket -= n
+                    deficit[0] -= n
+                if not wr:
+                    deficit[0] = 0
+            if w and isopen:
+                deficit[1] = min(deficit[1] + self.QUANTUM, maxDeficit)
+                cap = int(min(deficit[1], self.writeBucket))
+                if cap > 0:
+                    wr, ww, isopen, n = c.process(0,1,0,cap)
+                    self.writeBucket -= n
+                    deficit[1] -= n
+                if not ww:
+                    deficit[1] = 0
+            self._update(fd,c,wr,ww,isopen)
+        self._refill()
+
+    def _refill(self, timeout=None, now=None):
+        """Helper: add all the bandwidth we've earned since we last called
+           this function, and decide which directions to throttle.  If
+           'timeout' is provided, return the number of seconds we should
+           wait for events: no more than 'timeout', and no longer than it
+           will take for a throttled bucket to refill."""
+        if self.bandwidthPerTick is None:
+            return timeout
+        if now is None:
+            now = time.time()
+        elapsed = now - self.lastRefill
+        self.lastRefill = now
+        # Each direction gets half of our bandwidth.
+        rate = self.bandwidthPerTick / (2.0*self.TICK_INTERVAL)
+        limit = self.maxBucket / 2.0
+        if elapsed > 0:
+            self.readBucket = min(limit, self.readBucket + rate*elapsed)
+            self.writeBucket = min(limit, self.writeBucket + rate*elapsed)
+
+        # Stop listening when a bucket is (nearly) empty, so we don't
+        # waste time on tiny reads and writes; start again once it has a
+        # quantum's worth of bytes.
+        resume = min(self.QUANTUM, limit)
+        empty = min(self.PRIORITY_WRITE_LEN, resume)
+        throttled = []
+        for bucket, wasThrottled in zip((self.readBucket, self.writeBucket),
+                                        self.throttled):
+            if wasThrottled:
+                isThrottled = bucket < resume
+            else:
+                isThrottled = bucket < empty
+            throttled.append(isThrottled)
+            if isThrottled and timeout is not None:
+                timeout = min(timeout, max(0.01, (resume-bucket)/rate))
+        throttled = tuple(throttled)
+        if throttled != self.throttled:
+            self.throttled = throttled
+            self._throttleChanged()
+        return timeout
 
     def tryTimeout(self, now=None):
         """Timeout any connection that is too old."""
@@ -174,26 +331,26 @@ class SelectAsyncServer:
         if n is None:
             self.bandwidthPerTick = None
             self.maxBucket = None
+            self.readBucket = self.writeBucket = None
+            if self.throttled != (0,0):
+                self.throttled = (0,0)
+                self._throttleChanged()
         else:
             self.bandwidthPerTick = int(n * self.TICK_INTERVAL)
             if maxBucket is None:
                 self.maxBucket = self.bandwidthPerTick*5
             else:
                 self.maxBucket = maxBucket
+            # Start out with one tick's worth of bandwidth.
+            self.readBucket = self.writeBucket = self.bandwidthPerTick / 2.0
+            self.lastRefill = time.time()
 
     def tick(self):
-        """Tell the server that one unit of time has passed, and the bandwidth
-           limitations can be readjusted.  This method must be called once
-           every TICK_INTERVAL seconds."""
-        bwpt = self.bandwidthPerTick
-        if bwpt is None:
-            self.bucket = None
-        else:
-            bucket = (self.bucket or 0) + bwpt
-            if bucket > self.maxBucket:
-                self.bucket = self.maxBucket
-            else:
-                self.bucket = bucket
+        """Tell the server that time has passed, and the bandwidth
+           limitations can be readjusted.  (The server also does this
+           whenever it processes events, so there's no need to call this
+           method on any schedule.)"""
+        self._refill()
 
 class PollAsyncServer(SelectAsyncServer):
     """Subclass of SelectAsyncServer that uses 'poll' where available.  This
@@ -208,9 +365,7 @@ class PollAsyncServer(SelectAsyncServer):
                            (1,1): select.POLLIN+select.POLLOUT+select.POLLERR,
                            (1,2): select.POLLIN+select.POLLOUT+select.POLLERR }
     def process(self,timeout):
-        if self.bucket is not None and self.bucket <= 0:
-            time.sleep(timeout)
-            return
+        timeout = self._refill(timeout)
         try:
             # (watch out: poll takes a timeout in msec, but select takes a
             #  timeout in sec.)
@@ -222,32 +377,35 @@ class PollAsyncServer(SelectAsyncServer):
                 raise e
         if not events:
             return
-        if self.bucket is None:
-            cap = None
-        else:
-            cap = floorDiv(self.bucket,len(events))
         #print events, self.connections.keys()
+        active = []
         for fd, mask in events:
             c = self.connections[fd]
-            wr,ww,isopen,n = c.process(mask&select.POLLIN, mask&select.POLLOUT,
-                                       mask&(select.POLLERR|select.POLLHUP),
-                                       cap)
-            if cap is not None:
-                self.bucket -= n
-            if not isopen:
-                #print "unregister",fd
-                self.poll.unregister(fd)
-                del self.connections[fd]
-                continue
-            #print "register",fd
-            self.poll.register(fd,self.EVENT_MASK[wr,ww])
+            active.append((fd, c, mask&select.POLLIN, mask&select.POLLOUT,
+                           mask&(select.POLLERR|select.POLLHUP)))
+        self._processActive(active)
+
+    def _update(self, fd, c, wr, ww, isopen):
+        if not isopen:
+            #print "unregister",fd
+            self.poll.unregister(fd)
+            del self.connections[fd]
+            self.deficits.pop(fd, None)
+            return
+        #print "register",fd
+        self.poll.register(fd,self.EVENT_MASK[self._getInterest(c,wr,ww)])
+
+    def _throttleChanged(self):
+        # Re-register every connection, so that we wait for the right events.
+        for c in self.connections.values():
+            self.register(c)
 
     def register(self,c):
         fd = c.fileno()
         wr, ww, isopen = c.getStatus()
         if not isopen: return
         self.connections[fd] = c
-        mask = self.EVENT_MASK[(wr,ww)]
+        mask = self.EVENT_MASK[self._getInterest(c,wr,ww)]
         #print "register",fd
         self.poll.register(fd, mask)
     def remove(self,c,fd=None):
@@ -256,6 +414,7 @@ class PollAsyncServer(SelectAsyncServer):
         #print "unregister",fd
         self.poll.unregister(fd)
         del self.connections[fd]
+        self.deficits.pop(fd, None)
 
 if hasattr(select,'poll') and not _ml.POLL_IS_EMULATED and sys.platform != 'cygwin':
     # Prefer 'poll' to 'select', except on MacOS and other platforms where
@@ -325,7 +484,10 @@ class ListenConnection(Connection):
             LOG.debug("Accepted connection from %s", addr)
             self.connectionFactory(con)
         except socket.error, e:
-            LOG.warn("Socket error while accepting connection: %s", e)
+            # If several processes share this socket, another one may
+            # have accepted the connection first.
+            if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                LOG.warn("Socket error while accepting connection: %s", e)
         return self.isOpen,0,self.isOpen,0
 
     def getStatus(self):
@@ -340,6 +502,71 @@ class ListenConnection(Connection):
     def fileno(self):
         return self.sock.fileno()
 
+class WakeupConnection(Connection):
+    """A WakeupConnection lets other threads interrupt an AsyncServer that
+       is waiting for network events, so that the main loop can act on their
+       results right away rather than at the next tick.  It is implemented
+       with a pipe; calling 'wakeup' writes a byte to the pipe."""
+    ## Fields:
+    # rfd, wfd: the read and write ends of the pipe.
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        for fd in self.rfd, self.wfd:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def wakeup(self):
+        """Make the server's next (or current) wait for events return
+           immediately.  It is safe to call this method from any thread."""
+        try:
+            os.write(self.wfd, "x")
+        except OSError, e:
+            # If the pipe is full, the server is already going to wake up.
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def process(self, r, w, x, cap):
+        try:
+            while os.read(self.rfd, 1024):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return 1,0,1,0
+    def getStatus(self):
+        return 1,0,1
+    def fileno(self):
+        return self.rfd
+    def tryTimeout(self, cutoff):
+        return 0
+
+class _PendingAck:
+    """Helper class: an acknowledgment for a packet that we have received,
+       but that we may not acknowledge until it has been stored.  Passed
+       to the packet consumer of an MMTPServerConnection that defers its
+       acknowledgments."""
+    ## Fields:
+    # connection: the MMTPServerConnection that received the packet.
+    # accepted: the reply to send if we store the packet.
+    # rejected: the reply to send if we can't.
+    # reply: the reply we have decided to send, or None if we haven't
+    #    decided yet.
+    def __init__(self, connection, accepted, rejected):
+        self.connection = connection
+        self.accepted = accepted
+        self.rejected = rejected
+        self.reply = None
+
+    def release(self, ok):
+        """Send the acknowledgment for this packet: RECEIVED if 'ok' is
+           true, or REJECTED otherwise.  Must be called from the main
+           thread."""
+        if ok:
+            self.reply = self.accepted
+        else:
+            self.reply = self.rejected
+        self.connection._flushAcks()
+
 class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
     """A TLSConnection that implements the server side of MMTP."""
     ##
@@ -349,9 +576,26 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
     #   rejectCallback -- a callback to invoke whenever we've rejected a packet
     #   protocol -- the negotiated MMTP version
     #   rejectPackets -- flag: do we reject the packets we've received?
+    #   deferAcks -- flag: do we wait for the packet consumer to tell us
+    #      that it has stored each packet before we acknowledge it?
+    #   _acks -- a list of the replies we have yet to send, in order.  Each
+    #      is either a string, or a _PendingAck.
+    #   _throttled -- flag: have we stopped reading because too many
+    #      packets are waiting for acknowledgment?
+    #   _closing -- flag: have we started shutting down?
+    #   _startTime -- the time at which we accepted this connection.
     MESSAGE_LEN = 6 + (1<<15) + 20
     PROTOCOL_VERSIONS = ['0.3']
-    def __init__(self, sock, tls, consumer, rejectPackets=0, serverName=None):
+    # When deferring acknowledgments, we stop reading from the network while
+    # MAX_UNACKED_PACKETS packets are waiting to be stored.
+    MAX_UNACKED_PACKETS = 32
+    def __init__(self, sock, tls, consumer, rejectPackets=0, serverName=None,
+                 deferAcks=0):
+        """Create a new MMTPServerConnection to handle a newly accepted
+           socket.  'consumer' is invoked with each packet we receive.  If
+           'deferAcks' is true, 'consumer' is invoked with the packet and a
+           _PendingAck, and must eventually call the _PendingAck's release
+           method from the main thread."""
         if serverName is None:
             addr,port = sock.getpeername()
             serverName = mixminion.ServerInfo.displayServerByAddress(addr,port)
@@ -360,14 +604,20 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
         mixminion.TLSConnection.TLSConnection.__init__(
             self, tls, sock, serverName)
         EventStats.log.receivedConnection()
+        self._startTime = time.time()
         self.packetConsumer = consumer
         self.junkCallback = lambda : None
         self.rejectCallback = lambda : None
         self.protocol = None
         self.rejectPackets = rejectPackets
+        self.deferAcks = deferAcks
+        self._acks = []
+        self._throttled = 0
+        self._closing = 0
         self.beginAccepting()
 
     def onConnected(self):
+        noteHandshake("server", self.tls, self.handshakeTime)
         self.onRead = self.readProtocol
         self.beginReading()
 
@@ -406,7 +656,7 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
         self.beginReading()
 
     def onDataRead(self):
-        while self.inbuflen >= self.MESSAGE_LEN:
+        while self.inbuflen >= self.MESSAGE_LEN and not self._throttled:
             data = self.getInbuf(self.MESSAGE_LEN, clear=1)
             control = data[:SEND_CONTROL_LEN]
             pkt = data[SEND_CONTROL_LEN:-DIGEST_LEN]
@@ -451,16 +701,56 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
                 self.junkCallback()
             elif self.rejectPackets:
                 self.rejectCallback()
+            elif self.deferAcks:
+                ack = _PendingAck(self, replyControl+replyDigest,
+                        REJECTED_CONTROL+sha1(pkt+"REJECTED"))
+                self._acks.append(ack)
+                self.packetConsumer(pkt, ack)
+                if len(self._acks) >= self.MAX_UNACKED_PACKETS:
+                    LOG.trace("Too many unacknowledged packets from %s; "
+                              "pausing.", self.address)
+                    self._throttled = 1
+                    self.stopReading()
+                continue
             else:
                 self.packetConsumer(pkt)
 
             # Queue the ack.
-            self.beginWriting(replyControl+replyDigest)
+            if self._acks:
+                # Don't send it until we've sent the acks before it.
+                self._acks.append(replyControl+replyDigest)
+            else:
+                self.beginWriting(replyControl+replyDigest)
+
+    def _flushAcks(self):
+        """Helper: send every reply at the front of self._acks that is
+           ready to go, and start reading again if we had stopped."""
+        if self._closing or self.isShutdown():
+            return
+        acks = self._acks
+        while acks:
+            a = acks[0]
+            if isinstance(a, _PendingAck):
+                if a.reply is None:
+                    break
+                a = a.reply
+            self.beginWriting(a)
+            del acks[0]
+        if self._throttled and len(acks) < self.MAX_UNACKED_PACKETS:
+            self._throttled = 0
+            self.beginReading()
+            self.onDataRead()
+
+    def startShutdown(self):
+        self._closing = 1
+        mixminion.TLSConnection.TLSConnection.startShutdown(self)
 
     def onDataWritten(self, n): pass
     def onTLSError(self): pass
     def onTimeout(self): pass
-    def onClosed(self): pass
+    def onClosed(self):
+        EventStats.metrics.observe("IncomingConnectionTime",
+                                   time.time()-self._startTime)
     def doneWriting(self): pass
     def receivedShutdown(self): pass
     def shutdownFinished(self): pass
@@ -559,20 +849,38 @@ class MMTPAsyncServer(AsyncServer):
     # clientConByAddr: A map from 3-tuples returned by MMTPClientConnection.
     #     getAddr, to MMTPClientConnection objects.
     # certificateCache: A PeerCertificateCache object.
+    # sessionCache: A TLSSessionCache object to hold the sessions we can
+    #     resume on initiated connections, or None if we don't resume them.
+    # _clearSessions: flag: should we clear sessionCache the next time
+    #     we're in the main thread?
     # listeners: A list of ListenConnection objects.
     # _timeout: The number of seconds of inactivity to allow on a connection
     #     before formerly shutting it down.
     # dnsCache: An instance of mixminion.server.DNSFarm.DNSCache.
     # msgQueue: An instance of MessageQueue to receive notification from DNS
     #     DNS threads.  See _queueSendablePackets for more information.
-    # _lock: protects only serverContext.
+    # _lock: protects only serverContext, pendingKeyInfo, and
+    #     _clearSessions.
     # maxClientConnections: Number of client connections we're willing
     #     to have outgoing at any time.  If we try to deliver packets
     #     to a new server, but we already have this many open outgoing
     #     connections, we put the packets in pendingPackets.
     # pendingPackets: A list of tuples to serve as arguments for _sendPackets.
-
-    def __init__(self, config, servercontext):
+    # deferAcks: flag: do we acknowledge received packets only once
+    #     onPacketReceived tells us that they're stored?
+    # ackQueue: An instance of MessageQueue to hold (_PendingAck, ok) tuples
+    #     for acknowledgments that other threads have released.
+    # wakeup: A WakeupConnection to interrupt our main loop when an
+    #     acknowledgment is released, or None if we don't have one.
+    # frontEnds: A mixminion.server.MMTPFrontEnd.FrontEndPool to handle
+    #     our connections, or None if we handle them ourselves.
+    # pendingKeyInfo: TLS key information from the last call to
+    #     setServerContext, not yet passed to self.frontEnds; or None.
+
+    def __init__(self, config, servercontext, listeners=None):
+        """Create a new MMTPAsyncServer.  If 'listeners' is provided, it is
+           a list of ListenConnection objects to accept connections from;
+           otherwise, we create our own from the configuration."""
         AsyncServer.__init__(self)
 
         self.serverContext = servercontext
@@ -606,7 +914,14 @@ class MMTPAsyncServer(AsyncServer):
         if port is None:
             port = config['Incoming/MMTP']['Port']
 
-        self.listeners = []
+        if listeners is not None:
+            self.listeners = listeners
+            for listener in listeners:
+                listener.connectionFactory = self._newMMTPConnection
+                self.register(listener)
+            IP = IP6 = None
+        else:
+            self.listeners = []
         for (supported, addr, family) in [(ip4_supported,IP,AF_INET),
                                           (ip6_supported,IP6,AF_INET6)]:
             if not supported or not addr:
@@ -620,10 +935,24 @@ class MMTPAsyncServer(AsyncServer):
         self._timeout = config['Server']['Timeout'].getSeconds()
         self.clientConByAddr = {}
         self.certificateCache = PeerCertificateCache()
+        if config['Outgoing/MMTP'].get('ResumeSessions', 0):
+            self.sessionCache = TLSSessionCache()
+        else:
+            self.sessionCache = None
+        self._clearSessions = 0
         self.dnsCache = None
         self.msgQueue = MessageQueue()
         self.pendingPackets = []
         self.pingLog = None
+        self.deferAcks = 0
+        self.ackQueue = MessageQueue()
+        if fcntl is not None:
+            self.wakeup = WakeupConnection()
+            self.register(self.wakeup)
+        else:
+            self.wakeup = None
+        self.frontEnds = None
+        self.pendingKeyInfo = None
 
     def connectDNSCache(self, dnsCache):
         """Use the DNSCache object 'DNSCache' to resolve DNS queries for
@@ -635,12 +964,58 @@ class MMTPAsyncServer(AsyncServer):
         """Report successful or failed connection attempts to 'pingLog'."""
         self.pingLog = pingLog
 
-    def setServerContext(self, servercontext):
+    def setServerContext(self, servercontext, keyInfo=None):
         """Change the TLS context used for newly received connections.
-           Used to rotate keys."""
+           Used to rotate keys.  If we have front-end processes, 'keyInfo'
+           must be a (certificate file, private key, DH parameter file)
+           tuple for them to build the new context from.
+
+           Since our keys have changed, we also forget all the TLS sessions
+           we were keeping to resume.
+
+           It is safe to call this function from any thread."""
         self._lock.acquire()
         self.serverContext = servercontext
+        self._clearSessions = 1
+        if keyInfo is not None:
+            self.pendingKeyInfo = keyInfo
+        self._lock.release()
+        if keyInfo is not None and self.wakeup is not None:
+            self.wakeup.wakeup()
+
+    def startFrontEnds(self, n, config):
+        """Start 'n' front-end processes to handle TLS and MMTP for our
+           listeners and outgoing connections.  Must be called before any
+           other threads are started."""
+        # Import here to avoid a cyclic import.
+        import mixminion.server.MMTPFrontEnd
+        self._lock.acquire()
+        self.pendingKeyInfo = None
         self._lock.release()
+        self.frontEnds = mixminion.server.MMTPFrontEnd.FrontEndPool(self)
+        self.frontEnds.start(n, config)
+        # The front ends accept connections for us from now on; we keep
+        # the listening sockets open, but stop watching them.
+        for listener in self.listeners:
+            self.remove(listener)
+
+    def stopFrontEnds(self):
+        """Shut down all our front-end processes, if we have any."""
+        if self.frontEnds is not None:
+            self.frontEnds.shutdown()
+
+    def _sendPendingKeys(self):
+        """Helper function: if setServerContext has given us new keys,
+           pass them to our front ends.
+
+           This function should only be called from the main thread.
+        """
+        self._lock.acquire()
+        keyInfo = self.pendingKeyInfo
+        self.pendingKeyInfo = None
+        self._lock.release()
+        if keyInfo is not None:
+            self.frontEnds.setKeys(keyInfo)
 
     def getNextTimeoutTime(self, now=None):
         """Return the time at which we next purge connections, if we have
@@ -666,7 +1041,7 @@ class MMTPAsyncServer(AsyncServer):
             addr, port, hostname)
 
         con = MMTPServerConnection(sock, tls, self.onPacketReceived,
-                                   serverName=name)
+                                   serverName=name, deferAcks=self.deferAcks)
         self.register(con)
         return con
 
@@ -767,6 +1142,11 @@ class MMTPAsyncServer(AsyncServer):
                     con.addPacket(d)
                 return
 
+        if self.frontEnds is not None:
+            self.frontEnds.sendPackets(family, ip, port, keyID, deliverable,
+                                       serverName)
+            return
+
         if len(self.clientConByAddr) >= self.maxClientConnections:
             LOG.debug("We already have %s open client connections; delaying %s packets for %s",
                       len(self.clientConByAddr), len(deliverable), serverName)
@@ -776,12 +1156,13 @@ class MMTPAsyncServer(AsyncServer):
         try:
             # There isn't any connection to the right server. Open one...
             addr = (ip, port, keyID)
-            finished = lambda addr=addr, self=self: self.__clientFinished(addr)
+            finished = lambda addr=addr, self=self, start=time.time(): \
+                       self.__clientFinished(addr, start)
             con = _ClientCon(
                 family, ip, port, keyID, serverName=serverName,
-                context=self.clientContext, certCache=self.certificateCache)
-            nickname = mixminion.ServerInfo.getNicknameByKeyID(keyID)
-            if nickname is not None:
+                context=self.clientContext, certCache=self.certificateCache,
+                sessionCache=self.sessionCache)
+            if self._isKnownServer(keyID):
                 # If we recognize this server, then we'll want to tell
                 # the ping log what happens to our connection attempt.
                 con.configurePingLog(self.pingLog, keyID)
@@ -806,22 +1187,71 @@ class MMTPAsyncServer(AsyncServer):
             self.register(con)
             self.clientConByAddr[addr] = con
 
-    def __clientFinished(self, addr):
-        """Called when a client connection runs out of packets to send,
-           or halts."""
+    def _isKnownServer(self, keyID):
+        """Return true iff 'keyID' is the identity digest of a server we
+           recognize."""
+        return mixminion.ServerInfo.getNicknameByKeyID(keyID) is not None
+
+    def __clientFinished(self, addr, startTime):
+        """Called when a client connection, opened at 'startTime', runs out
+           of packets to send, or halts."""
+        EventStats.metrics.observe("OutgoingConnectionTime",
+                                   time.time()-startTime)
         try:
             del self.clientConByAddr[addr]
         except KeyError:
             LOG.warn("Didn't find client connection to %s in address map",
                      addr)
 
-    def onPacketReceived(self, pkt):
-        """Abstract function.  Called when we get a packet"""
+    def onPacketReceived(self, pkt, ack=None):
+        """Abstract function.  Called when we get a packet.  If
+           self.deferAcks is true, 'ack' is a _PendingAck; the packet will
+           not be acknowledged until somebody passes it to releaseAck."""
         pass
 
+    def releaseAck(self, ack, ok):
+        """Acknowledge the received packet corresponding to the _PendingAck
+           'ack': with RECEIVED if 'ok' is true, and REJECTED otherwise.
+
+           It is safe to call this function from any thread."""
+        self.ackQueue.put((ack, ok))
+        if self.wakeup is not None:
+            self.wakeup.wakeup()
+
+    def _releaseQueuedAcks(self):
+        """Helper function: Send all the acknowledgments in self.ackQueue.
+
+           This function should only be called from the main thread.
+        """
+        while 1:
+            try:
+                ack, ok = self.ackQueue.get(block=0)
+            except QueueEmpty:
+                return
+            ack.release(ok)
+            self._connectionChanged(ack.connection)
+
+    def _connectionChanged(self, con):
+        """Helper function: called when 'con' may want to write, because
+           of something that happened outside its process method.  Tells the
+           poll loop about it, if 'con' is still registered."""
+        if not con.isShutdown() and \
+               self.connections.get(con.fileno()) is con:
+            self.register(con)
+
     def process(self, timeout):
         """overrides asyncserver.process to call sendQueuedPackets before
-           checking fd status.
+           checking fd status, and to send released acknowledgments.
         """
+        if self.frontEnds is not None:
+            self._sendPendingKeys()
+        if self._clearSessions:
+            self._lock.acquire()
+            self._clearSessions = 0
+            self._lock.release()
+            if self.sessionCache is not None:
+                self.sessionCache.clear()
         self._sendQueuedPackets()
+        self._releaseQueuedAcks()
         AsyncServer.process(self, timeout)
+        self._releaseQueuedAcks()
@@ -152,10 +152,8 @@ class PacketHandler:
 
         # Replay prevention
         replayhash = keys.get(Crypto.REPLAY_PREVENTION_MODE, Crypto.DIGEST_LEN)
-        if hashlog.seenHash(replayhash):
+        if hashlog.checkAndLogHash(replayhash):
             raise ContentError("Duplicate packet detected.")
-        else:
-            hashlog.logHash(replayhash)
 
         # If we're meant to drop, drop now.
         rt = subh.routingtype
@@ -114,8 +114,16 @@ class SQLiteDatabase:
         """Create a SQLite database storing its data in the file 'location'."""
         parent = os.path.split(location)[0]
         createPrivateDir(parent)
-        self._theConnection = sqlite3.connect(location, isolation_level=None)
+        # We open the database in one thread and use it from another;
+        # that's safe so long as only one thread uses it at a time.
+        self._theConnection = sqlite3.connect(location, isolation_level=None,
+                                              check_same_thread=0)
         self._theCursor = self._theConnection.cursor()
+        # With a write-ahead log, a commit only needs to append to the log,
+        # and readers don't block the writer.  (Older versions of SQLite
+        # just ignore these pragmas.)
+        self._theCursor.execute("PRAGMA journal_mode=WAL")
+        self._theCursor.execute("PRAGMA synchronous=NORMAL")
 
     def close(self):
         """Release resources held by this database."""
@@ -282,10 +290,24 @@ class PingLog:
     # _startTime: The 'startup' time for the current myLifespan row.
     # _lastRecalculation: The last time this process recomputed all
     #   the stats, or 0 for 'never'.
+    # _batchStarted: The time at which we began the current batch
+    #   transaction, or None if we have no open transaction.
+    # _batchRows: The number of events we have logged in the current batch
+    #   transaction.
     # _set{Uptime|OneHop|CurOneHop|TwoHop}: Functions generated by
     #   getInsertOrUpdateFn.
+    # _set{UptimeProgress|UptimeAccumulated|Watermark}: Functions generated
+    #   by getInsertOrUpdateFn to hold the state of our incremental uptime
+    #   calculation.
 
     # FFFF Maybe refactor this into data storage and stats computation.
+
+    # We group the events we log into transactions, so that we don't need to
+    # wait for the disk on every single event.  We commit a batch once it
+    # holds BATCH_MAX_ROWS events, or once it is BATCH_MAX_DELAY seconds
+    # old, whichever comes first.
+    BATCH_MAX_ROWS = 256
+    BATCH_MAX_DELAY = 0.5
     def __init__(self, db):
         """Create a new PingLog, storing events into the databse 'db'."""
         self._db = db
@@ -298,6 +320,8 @@ class PingLog:
         self._interestingChains = {}
         self._startTime = None
         self._lastRecalculation = 0
+        self._batchStarted = None
+        self._batchRows = 0
         self._createAllTables()
         self._loadServers()
 
@@ -428,6 +452,40 @@ class PingLog:
                  ("interesting", "bool",      "not null")],
                 ["PRIMARY KEY (server1, server2)"])
 
+            #### Tables holding partial results.
+
+            # Holds the state of our incremental uptime calculation for each
+            # server.  A row in uptimeProgress means: the last connection
+            # attempt to 'server' that we have taken into account happened
+            # at 'at'.  If 'status' is not null, that attempt succeeded iff
+            # 'status' is 1, and we will attribute half of the time until
+            # the next attempt to that outcome.
+            self._db.createTable(
+                "uptimeProgress",
+                [("server", "integer",   "primary key REFERENCES server(id)"),
+                 ("at",     "timestamp", "not null"),
+                 ("status", "bool")])
+
+            # Holds the running totals from which we compute 'uptime'.  A row
+            # in uptimeAccumulated means: during 'interval', we have so far
+            # attributed 'up' seconds to 'server' being up, and 'down'
+            # seconds to its being down.
+            self._db.createTable(
+                "uptimeAccumulated",
+                [("interval", "integer", "not null REFERENCES statsinterval(id)"),
+                 ("server",   "integer", "not null REFERENCES server(id)"),
+                 ("up",       "float",   "not null"),
+                 ("down",     "float",   "not null")],
+                ["PRIMARY KEY (interval, server)"])
+
+            # Holds high-water marks for incremental calculations.  A row in
+            # watermark means: we have processed all the rows in the table
+            # 'name' whose rowid is no greater than 'value'.
+            self._db.createTable(
+                "watermark",
+                [("name",  "varchar(32)", "primary key"),
+                 ("value", "integer",     "not null")])
+
             #### Indices.
 
             self._db.createIndex("serverIdentity", "server",
@@ -449,6 +507,12 @@ class PingLog:
 
             self._setUptime = self._db.getInsertOrUpdateFn(
                 "uptime", ["interval", "server"], ["uptime"])
+            self._setUptimeProgress = self._db.getInsertOrUpdateFn(
+                "uptimeProgress", ["server"], ["at", "status"])
+            self._setUptimeAccumulated = self._db.getInsertOrUpdateFn(
+                "uptimeAccumulated", ["interval", "server"], ["up", "down"])
+            self._setWatermark = self._db.getInsertOrUpdateFn(
+                "watermark", ["name"], ["value"])
             self._setOneHop = self._db.getInsertOrUpdateFn(
                 "echolotOneHopResult",
                 ["server", "interval"],
@@ -509,9 +573,10 @@ class PingLog:
         """Add the names 'descriptorSource' to the database, if they
            aren't there already.
         """
+        self._beginWrite()
         for s in descriptorSource.getServerList():
             self._getServerID(s.getIdentityDigest())
-        self._db.getConnection().commit()
+        self.flush()
 
     def _getServerID(self, identity):
         """Helper: Return the database ID for the server whose
@@ -572,6 +637,7 @@ class PingLog:
         #dataCutoff = self._db.time(now - sec['RetainPingData'])
         #resultsCutoff = self._db.time(now - sec['RetainPingResults'])
 
+        self._beginWrite()
         cur = self._db.getCursor()
         cur.execute("DELETE FROM myLifespan WHERE stillup < ?", [dataCutoff])
         cur.execute("DELETE FROM ping WHERE sentat < ?", [dataCutoff])
@@ -580,20 +646,54 @@ class PingLog:
         cur.execute("DELETE FROM uptime WHERE interval IN "
                     "( SELECT id FROM statsInterval WHERE endAt < ? )",
                     [resultsCutoff])
+        cur.execute("DELETE FROM uptimeAccumulated WHERE interval IN "
+                    "( SELECT id FROM statsInterval WHERE endAt < ? )",
+                    [resultsCutoff])
         cur.execute("DELETE FROM echolotOneHopResult WHERE interval IN "
                     "( SELECT id FROM statsInterval WHERE endAt < ? )",
                     [resultsCutoff])
         cur.execute("DELETE FROM statsInterval WHERE endAt < ?", [resultsCutoff])
 
-        self._db.getConnection().commit()
+        self.flush()
+
+    def _beginWrite(self):
+        """Helper: make sure that we have an open batch transaction for the
+           writes we are about to make."""
+        if self._batchStarted is None:
+            self._db.getCursor().execute("BEGIN")
+            self._batchStarted = time.time()
+
+    def _endWrite(self):
+        """Helper: note that we have logged an event in the current batch
+           transaction, and commit the batch if it is big or old enough."""
+        self._batchRows += 1
+        if (self._batchRows >= self.BATCH_MAX_ROWS or
+            time.time() >= self._batchStarted + self.BATCH_MAX_DELAY):
+            self.flush()
+
+    def _abortWrite(self):
+        """Helper: roll back the current batch transaction."""
+        self._db.getConnection().rollback()
+        self._batchStarted = None
+        self._batchRows = 0
+
+    def getFlushDeadline(self):
+        """Return the time by which the current batch transaction should be
+           committed, or None if there is no open transaction."""
+        if self._batchStarted is None:
+            return None
+        return self._batchStarted + self.BATCH_MAX_DELAY
 
     def flush(self):
         """Write any pending information to disk."""
         self._db.getConnection().commit()
+        self._batchStarted = None
+        self._batchRows = 0
 
     def close(self):
         """Release all resources held by this PingLog and the underlying
            database."""
+        self.flush()
         self._db.close()
 
     _STARTUP = "INSERT INTO myLifespan (startup, stillup, shutdown) VALUES (?,?, 0)"
@@ -604,7 +704,7 @@ class PingLog:
         self._startTime = now = self._db.time(now)
         self._lock.release()
         self._db.getCursor().execute(self._STARTUP, (now,now))
-        self._db.getConnection().commit()
+        self.flush()
 
     _SHUTDOWN = "UPDATE myLifespan SET stillup = ?, shutdown = ? WHERE startup = ?"
     def shutdown(self, now=None):
@@ -613,7 +713,7 @@ class PingLog:
         if self._startTime is None: self.startup()
         now = self._db.time(now)
         self._db.getCursor().execute(self._SHUTDOWN, (now, now, self._startTime))
-        self._db.getConnection().commit()
+        self.flush()
 
     _HEARTBEAT = "UPDATE myLifespan SET stillup = ? WHERE startup = ? AND stillup < ?"
     def heartbeat(self, now=None):
@@ -621,8 +721,9 @@ class PingLog:
            the time 'now'."""
         if self._startTime is None: self.startup()
         now = self._db.time(now)
+        self._beginWrite()
         self._db.getCursor().execute(self._HEARTBEAT, (now, self._startTime, now))
-        self._db.getConnection().commit()
+        self._endWrite()
 
     _CONNECTED = ("INSERT INTO connectionAttempt (at, server, success) "
                   "VALUES (?,?,?)")
@@ -630,10 +731,11 @@ class PingLog:
         """Note that we attempted to connect to the server with 'identity'.
            We successfully negotiated a protocol iff success is true.
         """
+        self._beginWrite()
         serverID = self._getServerID(identity)
         self._db.getCursor().execute(self._CONNECTED,
                         (self._db.time(now), serverID, self._db.bool(success)))
-        self._db.getConnection().commit()
+        self._endWrite()
 
     def connectFailed(self, identity, now=None):
         """Note that we attempted to connect to the server named 'nickname',
@@ -650,10 +752,11 @@ class PingLog:
            'hash' as its digest.
         """
         assert len(hash) == mixminion.Crypto.DIGEST_LEN
+        self._beginWrite()
         ids = ",".join([ str(self._getServerID(s)) for s in path ])
         self._db.getCursor().execute(self._QUEUED_PING,
                              (formatBase64(hash), ids, self._db.time(now), 0))
-        self._db.getConnection().commit()
+        self._endWrite()
 
     _GOT_PING = "UPDATE ping SET received = ? WHERE hash = ?"
     def gotPing(self, hash, now=None):
@@ -661,80 +764,160 @@ class PingLog:
            as its digest.
         """
         assert len(hash) == mixminion.Crypto.DIGEST_LEN
+        self._beginWrite()
         self._db.getCursor().execute(self._GOT_PING, (self._db.time(now), formatBase64(hash)))
         n = self._db.getCursor().rowcount
+        self._endWrite()
         if n == 0:
             LOG.warn("Received ping with no record of its hash")
         elif n > 1:
             LOG.warn("Received ping with multiple hash entries!")
 
+    def _getWatermark(self, name):
+        """Helper: return the high-water mark called 'name', or 0 if we
+           have none."""
+        cur = self._db.getCursor()
+        cur.execute("SELECT value FROM watermark WHERE name = ?", (name,))
+        r = cur.fetchall()
+        if r:
+            return r[0][0]
+        else:
+            return 0
+
     def _calculateUptimes(self, serverIdentities, startTime, endTime, now=None):
         """Helper: calculate the uptime results for a set of servers, named in
            serverIdentities, for all intervals between startTime and endTime
-           inclusive.  Does not commit the current transaction.
+           inclusive.  Does not commit the current transaction.  The caller
+           should record a heartbeat first, so that our own lifespan covers
+           all the connection attempts we've logged.
+
+           We only look at the connection attempts that have been logged
+           since the last time we were called: the contribution of older
+           attempts is already stored in uptimeAccumulated, and the outcome
+           of the last attempt to each server is stored in uptimeProgress.
+           Attempts before startTime are ignored for servers we have never
+           calculated before.
         """
         cur = self._db.getCursor()
         serverIdentities.sort()
-
-        # First, calculate my own uptime.
         if now is None: now = time.time()
-        self.heartbeat(now)
 
-        timespan = IntervalSet( [(startTime, endTime)] )
-        calcIntervals = [ (s,e,self._getIntervalID(s,e)) for s,e in
-                          self._intervals.getIntervals(startTime,endTime)]
+        # Load the state of the last calculation.
+        progress = {}
+        cur.execute("SELECT server, at, status FROM uptimeProgress")
+        for serverID, at, status in cur:
+            progress[serverID] = (at, status)
+        lastRowID = self._getWatermark("connectionAttempt")
+        cur.execute("SELECT max(rowid) FROM connectionAttempt")
+        maxRowID, = cur.fetchone()
+        if maxRowID is None or maxRowID < lastRowID:
+            # Everything we processed has been rotated away, and the database
+            # may be reusing row IDs.  Rows older than the state we stored
+            # in uptimeProgress will be skipped below.
+            lastRowID = 0
+
+        earliest = startTime
+        for at, _ in progress.values():
+            earliest = min(earliest, at)
 
         cur.execute("SELECT startup, stillup, shutdown FROM myLifespan WHERE "
                     "startup <= ? AND stillup >= ?",
-                    (self._db.time(endTime), self._db.time(startTime)))
+                    (self._db.time(max(endTime,now)), self._db.time(earliest)))
         myIntervals = IntervalSet([ (start, max(end,shutdown))
                                     for start,end,shutdown in cur ])
-        myIntervals *= timespan
-        for s, e, i in calcIntervals:
-            uptime = (myIntervals * IntervalSet([(s,e)])).spanLength()
+        myIntervalList = myIntervals.getIntervals()
+
+        timespan = IntervalSet( [(startTime, endTime)] )
+        calcIntervals = [ (s,e,self._getIntervalID(s,e)) for s,e in
+                          self._intervals.getIntervals(startTime,endTime)]
+        # First, calculate my own uptime.
+        myTimespan = myIntervals * timespan
+        uptimes = myTimespan.intersectionLengths(
+            [ (s,e) for s,e,_ in calcIntervals ])
+        for (s, e, i), uptime in zip(calcIntervals, uptimes):
             fracUptime = float(uptime)/(e-s)
             self._setUptime((i, self._getServerID("<self>")), (fracUptime,))
 
-        # Okay, now everybody else.
-        for (identity, serverID) in self._serverIDs.items():
-            if s in ('<self>','<unknown>'): continue
-            cur.execute("SELECT at, success FROM connectionAttempt"
-                        " WHERE server = ? AND at >= ? AND at <= ?"
-                        " ORDER BY at",
-                        (serverID, startTime, endTime))
-
-            intervals = [[], []] #uptimes, downtimes
-            lastStatus = None
-            lastTime = None
-            for at, success in cur:
-                assert success in (0,1)
-                upAt, downAt = myIntervals.getIntervalContaining(at)
-                #if upAt == None:
-                #    # Event outside edge of interval.  This means that
-                #    # it happened after a heartbeat, but we never actually
-                #    # shut down.  That's fine.
-                #    pass
-                if lastTime is None or (upAt and upAt > lastTime):
-                    lastTime = upAt
-                    lastStatus = None
-                if lastStatus is not None:
-                    t = (at+lastTime)/2.0
-                    intervals[lastStatus].append((lastTime,t))
-                    intervals[success].append((t,at))
-                lastStatus = success
-                lastTime = at
-            downIntervals = IntervalSet(intervals[0])
-            upIntervals = IntervalSet(intervals[1])
-            downIntervals *= myIntervals
-            upIntervals *= myIntervals
-
-            for s,e,intervalID in calcIntervals:
-                uptime = (upIntervals*IntervalSet([(s,e)])).spanLength()
-                downtime = (downIntervals*IntervalSet([(s,e)])).spanLength()
-                if uptime < 1 and downtime < 1:
+        # Okay, now everybody else.  Rather than sorting every attempt in
+        # IntervalSets, we walk through the new attempts in order, and
+        # add each span of time we learn about to a running total for the
+        # interval containing it.
+        added = {} # map from (interval start, end, serverID) to [down, up]
+        def addSpan(lo, hi, status, serverID, added=added,
+                    myIntervalList=myIntervalList, schedule=self._intervals):
+            for upAt, downAt in myIntervalList:
+                if downAt <= lo: continue
+                if upAt >= hi: break
+                a = max(lo, upAt)
+                b = min(hi, downAt)
+                while a < b:
+                    s, e = schedule.getIntervalContaining(a)
+                    end = min(b, e)
+                    try:
+                        totals = added[(s,e,serverID)]
+                    except KeyError:
+                        totals = added[(s,e,serverID)] = [0.0, 0.0]
+                    totals[status] += end - a
+                    a = end
+
+        cur.execute("SELECT rowid, server, at, success FROM connectionAttempt"
+                    " WHERE rowid > ? ORDER BY server, at", (lastRowID,))
+        lastServer = None
+        lastStatus = lastTime = None
+        newRowID = lastRowID
+        changed = {}
+        for rowid, serverID, at, success in cur:
+            assert success in (0,1)
+            newRowID = max(rowid, newRowID)
+            if serverID != lastServer:
+                if lastServer is not None:
+                    changed[lastServer] = (lastTime, lastStatus)
+                lastServer = serverID
+                lastTime, lastStatus = progress.get(serverID, (None, None))
+            if lastTime is None:
+                if at < startTime:
                     continue
-                fraction = float(uptime)/(uptime+downtime)
-                self._setUptime((intervalID, serverID), (fraction,))
+            elif at < lastTime:
+                # We've already gone past this attempt.
+                continue
+            upAt, downAt = myIntervals.getIntervalContaining(at)
+            #if upAt == None:
+            #    # Event outside edge of interval.  This means that
+            #    # it happened after a heartbeat, but we never actually
+            #    # shut down.  That's fine.
+            #    pass
+            if lastTime is None or (upAt and upAt > lastTime):
+                lastTime = upAt
+                lastStatus = None
+            if lastStatus is not None:
+                t = (at+lastTime)/2.0
+                addSpan(lastTime, t, lastStatus, serverID)
+                addSpan(t, at, success, serverID)
+            lastStatus = success
+            lastTime = at
+        if lastServer is not None:
+            changed[lastServer] = (lastTime, lastStatus)
+
+        # Save our progress, and recompute the uptimes for every interval
+        # that has changed.
+        for serverID, (at, status) in changed.items():
+            if at is not None:
+                self._setUptimeProgress((serverID,), (at, status))
+        self._setWatermark(("connectionAttempt",), (newRowID,))
+        for (s, e, serverID), (down, up) in added.items():
+            intervalID = self._getIntervalID(s,e)
+            cur.execute("SELECT up, down FROM uptimeAccumulated "
+                        "WHERE interval = ? AND server = ?",
+                        (intervalID, serverID))
+            r = cur.fetchall()
+            if r:
+                up += r[0][0]
+                down += r[0][1]
+            self._setUptimeAccumulated((intervalID, serverID), (up, down))
+            if up < 1 and down < 1:
+                continue
+            fraction = float(up)/(up+down)
+            self._setUptime((intervalID, serverID), (fraction,))
 
     def calculateUptimes(self, startAt, endAt, now=None):
         """Calculate the uptimes for all servers for all intervals between
@@ -746,8 +929,17 @@ class PingLog:
         finally:
             self._lock.release()
         serverIdentities.sort()
-        self._calculateUptimes(serverIdentities, startAt, endAt, now=now)
-        self._db.getConnection().commit()
+        self.heartbeat(now)
+        # Our partial results are only consistent with our watermarks if we
+        # update them all in a single transaction.
+        self.flush()
+        self._beginWrite()
+        try:
+            self._calculateUptimes(serverIdentities, startAt, endAt, now=now)
+        except:
+            self._abortWrite()
+            raise
+        self.flush()
 
     def getUptimes(self, startAt, endAt):
         """Return uptimes for all servers overlapping [startAt, endAt],
@@ -763,7 +955,7 @@ class PingLog:
                     (self._db.time(startAt), self._db.time(endAt)))
         for s,e,i,u in cur:
             result.setdefault((s,e), {})[self._db.decodeIdentity(i)] = u
-        self._db.getConnection().commit()
+        self.flush()
         return result
 
     def _roundLatency(self, latency):
@@ -787,11 +979,15 @@ class PingLog:
     _WEIGHT_AGE = [ 1, 2, 2, 3, 5, 8, 9, 10, 10, 10, 10, 5 ]
     _PING_GRANULARITY = 24*60*60
     def _calculateOneHopResult(self, serverIdentity, startTime, endTime,
-                                now=None, calculateOverallResults=1):
+                                now=None, calculateOverallResults=1,
+                                pings=None):
         """Calculate the latency and reliablity for a given server on
            intervals between startTime and endTime, inclusive.  If
            calculateOverallResults is true, also compute the current overall
-           results for that server.
+           results for that server.  If 'pings' is provided, it is a list
+           of the (sentat, received) values for all the one-hop pings we
+           sent to that server during those intervals; otherwise, we look
+           them up in the database.
         """
         # commit when done; serverName must exist.
         cur = self._db.getCursor()
@@ -813,10 +1009,12 @@ class PingLog:
         dailyLatencies = [[] for _ in xrange(nPeriods)]
         nSent = [0]*nPeriods
         nPings = 0
-        cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
-                    " AND sentat >= ? AND sentat <= ?",
-                    (serverID, startTime, endTime))
-        for sent,received in cur:
+        if pings is None:
+            cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
+                        " AND sentat >= ? AND sentat <= ?",
+                        (serverID, startTime, endTime))
+            pings = cur.fetchall()
+        for sent,received in pings:
             pIdx = floorDiv(sent-startTime, self._PING_GRANULARITY)
             nSent[pIdx] += 1
             nPings += 1
@@ -846,10 +1044,7 @@ class PingLog:
         nReceived = [0]*nPeriods
         perTotalWeights = [0]*nPeriods
         perTotalWeighted = [0]*nPeriods
-        cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
-                    " AND sentat >= ? AND sentat <= ?",
-                    (serverID, startTime, endTime))
-        for sent,received in cur:
+        for sent,received in pings:
             pIdx = floorDiv(sent-startTime, self._PING_GRANULARITY)
             if received:
                 nReceived[pIdx] += 1
@@ -918,38 +1113,66 @@ class PingLog:
         if now is None:
             now = time.time()
         serverIdentities.sort()
+
+        # Look up all the one-hop pings in a single pass, rather than
+        # querying the database once per server.  These are the same
+        # intervals that _calculateOneHopResult will use.
+        intervals = self._intervals.getIntervals(
+            now - (len(self._WEIGHT_AGE)*self._WEIGHT_AGE_PERIOD), now)
+        pingsByPath = {}
+        cur = self._db.getCursor()
+        cur.execute("SELECT path, sentat, received FROM ping"
+                    " WHERE sentat >= ? AND sentat <= ?",
+                    (intervals[0][0], intervals[-1][1]))
+        for path, sent, received in cur:
+            pingsByPath.setdefault(str(path), []).append((sent, received))
+
         reliability = {}
+        self._beginWrite()
         for s in serverIdentities:
             if s in ('<self>','<unknown>'): continue
             # For now, always calculate overall results.
+            pings = pingsByPath.get(str(self._getServerID(s)), [])
             r = self._calculateOneHopResult(s,now,now,now,
-                                             calculateOverallResults=1)
+                                             calculateOverallResults=1,
+                                             pings=pings)
             reliability[s] = r
-        self._db.getConnection().commit()
+        self.flush()
         self._lock.acquire()
         try:
             self._serverReliability.update(reliability)
         finally:
             self._lock.release()
 
-    def _calculate2ChainStatus(self, since, s1, s2, now=None):
+    def _calculate2ChainStatus(self, since, s1, s2, now=None, counts=None):
         """Helper: Calculate the status (broken/interesting/both/neither) for
            a chain of the servers 's1' and 's2' (given as identity digests),
            considering pings sent since 'since'.  Return a tuple of (number of
            pings sent, number of those pings received, is-broken,
            is-interesting).  Does not commit the current transaction.
+
+           If 'counts' is provided, it is a map from path to a tuple of the
+           number of pings sent along that path since 'since', and the
+           number of those pings received.  Paths not in 'counts' have had
+           no pings sent along them.
         """
         # doesn't commit.
         cur = self._db.getCursor()
         path = "%s,%s"%(self._getServerID(s1),self._getServerID(s2))
-        cur.execute("SELECT count() FROM ping WHERE path = ?"
-                    " AND sentat >= ?",
-                    (path,self._db.time(since)))
-        nSent, = cur.fetchone()
-        cur.execute("SELECT count() FROM ping WHERE path = ?"
-                    " AND sentat >= ? AND received > 0",
-                    (path,since))
-        nReceived, = cur.fetchone()
+        if counts is None:
+            cur.execute("SELECT count() FROM ping WHERE path = ?"
+                        " AND sentat >= ?",
+                        (path,self._db.time(since)))
+            nSent, = cur.fetchone()
+            cur.execute("SELECT count() FROM ping WHERE path = ?"
+                        " AND sentat >= ? AND received > 0",
+                        (path,since))
+            nReceived, = cur.fetchone()
+        else:
+            nSent, nReceived = counts.get(path, (0,0))
+        if nSent == 0:
+            # No pings, so no expectations: we'd like to know more.
+            return 0, 0, 0, 1
         cur.execute("SELECT SUM(r1.reliability * r2.reliability) "
                    "FROM ping, echolotOneHopResult as r1, "
                    "   echolotOneHopResult as r2, statsInterval "
@@ -998,13 +1221,25 @@ class PingLog:
         since = now - self._CHAIN_PING_HORIZON
         serverIdentities.sort()
 
+        # Count the pings along every path at once; most chains will have
+        # no pings at all, and need no further queries.
+        counts = {}
+        cur = self._db.getCursor()
+        cur.execute("SELECT path, count(), "
+                    "  SUM(CASE WHEN received > 0 THEN 1 ELSE 0 END) "
+                    "FROM ping WHERE sentat >= ? GROUP BY path",
+                    (self._db.time(since),))
+        for path, nSent, nReceived in cur:
+            counts[str(path)] = (nSent, nReceived)
+
+        self._beginWrite()
         for s1 in serverIdentities:
             if s1 in ('<self>','<unknown>'): continue
             for s2 in serverIdentities:
                 if s2 == ('<self>','<unknown>'): continue
                 p = "%s,%s"%(s1,s2)
                 nS, nR, isBroken, isInteresting = \
-                    self._calculate2ChainStatus(since, s1, s2)
+                    self._calculate2ChainStatus(since, s1, s2, counts=counts)
                 if isBroken:
                     brokenChains[p] = 1
                 if isInteresting:
@@ -1014,7 +1249,7 @@ class PingLog:
                     (self._getServerID(s1), self._getServerID(s2)),
                     (self._db.time(now), nS, nR, self._db.bool(isBroken),
                      self._db.bool(isInteresting)))
-        self._db.getConnection().commit()
+        self.flush()
 
         self._lock.acquire()
         try:
@@ -1110,7 +1345,7 @@ class PingLog:
             print >>f, "   '%s,%s',"%(s1,s2)
         print >>f, "]"
         print >>f, "\n"
-        self._db.getConnection().commit()
+        self.flush()
 
     def calculateAll(self, outFname=None, now=None):
         """Recalculate all statistics, writing the results into a file called
@@ -1118,6 +1353,8 @@ class PingLog:
            database.
         """
         if now is None: now=time.time()
+        # Make sure that every event logged so far is in the database.
+        self.flush()
         LOG.info("Computing ping results.")
         LOG.info("Starting to compute server uptimes.")
         self.calculateUptimes(now-24*60*60*12, now)
@@ -1511,6 +1748,68 @@ def canRunPinger():
     """
     return sys.version_info[:2] >= (2,2) and sqlite3_imported
 
+class PingLogWriterThread(mixminion.ThreadUtils.ProcessingThread):
+    """A ProcessingThread to run all the calls to a PingLog, when the
+       underlying database is only safe to use from one thread at a time.
+
+       The PingLog groups the events it logs into batch transactions; when
+       no more calls arrive, this thread makes sure that the open batch is
+       still committed within PingLog.BATCH_MAX_DELAY seconds.
+    """
+    ## Fields:
+    # pingLog: the PingLog whose batches we commit, or None.
+    def __init__(self, name="database thread"):
+        mixminion.ThreadUtils.ProcessingThread.__init__(self, name)
+        self.mqueue = mixminion.ThreadUtils.TimeoutQueue()
+        self.pingLog = None
+
+    def setPingLog(self, pingLog):
+        """Commit the batch transactions of 'pingLog' when they are due."""
+        self.pingLog = pingLog
+
+    def waitForFlush(self, timeout=None):
+        """Block until every call queued so far has been run, and its
+           results have been committed to the database.  Return true on
+           success, and false if we gave up after 'timeout' seconds."""
+        done = threading.Event()
+        def flush(self=self, done=done):
+            if self.pingLog is not None:
+                self.pingLog.flush()
+            done.set()
+        self.addJob(flush)
+        done.wait(timeout)
+        return done.isSet()
+
+    def run(self):
+        """Internal: main body of the database thread."""
+        ProcessingThread = mixminion.ThreadUtils.ProcessingThread
+        QueueEmpty = mixminion.ThreadUtils.QueueEmpty
+        try:
+            try:
+                while 1:
+                    deadline = None
+                    if self.pingLog is not None:
+                        deadline = self.pingLog.getFlushDeadline()
+                    if deadline is None:
+                        job = self.mqueue.get()
+                    else:
+                        try:
+                            job = self.mqueue.get(1,
+                                           max(deadline-time.time(), 0.001))
+                        except QueueEmpty:
+                            self.pingLog.flush()
+                            continue
+                    job()
+            except ProcessingThread._Shutdown:
+                LOG.info("Shutting down %s",self.threadName)
+                if self.pingLog is not None:
+                    self.pingLog.flush()
+                return
+        except:
+            LOG.error_exc(sys.exc_info(),
+                          "Exception in %s; shutting down thread.",
+                          self.threadName)
+
 # Map from database type name to databae implementation class.
 DATABASE_CLASSES = { 'sqlite' : SQLiteDatabase }
 
@@ -1520,7 +1819,9 @@ def openPingLog(config, location=None, databaseThread=None):
        store the files from 'config'.  If databaseThread is provided and the
        databse does not do well with multithreading (either no locking, or
        locking too coarse-grained to use), then background all calls to
-       PingLog in databaseThread.
+       PingLog in databaseThread.  If databaseThread is a
+       PingLogWriterThread, it will also commit the PingLog's pending
+       writes when they are due.
     """
 
     # FFFF eventually, we should maybe support more than pysqlite.  But let's
@@ -1534,6 +1835,8 @@ def openPingLog(config, location=None, databaseThread=None):
     log = PingLog(db)
 
     if db.LOCKING_IS_COARSE and databaseThread is not None:
+        if isinstance(databaseThread, PingLogWriterThread):
+            databaseThread.setPingLog(log)
         log = mixminion.ThreadUtils.BackgroundingDecorator(databaseThread, log)
 
     return log
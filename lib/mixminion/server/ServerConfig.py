@@ -9,8 +9,10 @@ __all__ = [ "ServerConfig" ]
 
 import operator
 import os
+import socket
 
 import mixminion.Config
+import mixminion.server.HashLog
 import mixminion.server.Modules
 from mixminion.Config import ConfigError
 from mixminion.Common import LOG
@@ -89,6 +91,23 @@ class ServerConfig(mixminion.Config._ConfigFile):
         if [e for e in self._sectionEntries['Incoming/MMTP']
             if e[0] in ('Allow', 'Deny')]:
             LOG.warn("Allow/deny are not yet supported")
+        if self['Server'].get('SharedHashLogs') and \
+               mixminion.server.HashLog.fcntl is None:
+            raise ConfigError(
+                "SharedHashLogs is not supported on this platform.")
+        if server['PacketTracing'] and not (server['Metrics'] or
+                                            server['PacketTraceFile']):
+            LOG.warn("PacketTracing is on, but neither Metrics nor "
+                     "PacketTraceFile is set; traces will go nowhere.")
+
+        fe = self['Incoming/MMTP'].get('FrontEndProcesses', 0)
+        if fe < 0:
+            raise ConfigError("FrontEndProcesses must be nonnegative.")
+        if fe and not (hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX')):
+            raise ConfigError(
+                "FrontEndProcesses is not supported on this platform.")
+        if self['Incoming/MMTP'].get('SessionCacheSize', 0) < 0:
+            raise ConfigError("SessionCacheSize must be nonnegative.")
 
         if not self['Outgoing/MMTP'].get('Enabled'):
             LOG.warn("Disabling outgoing MMTP is not yet supported.")
@@ -222,6 +241,9 @@ class ServerConfig(mixminion.Config._ConfigFile):
     def getStatsFile(self):
         """Return the configured stats file location."""
         return self._get_fname("Server", "StatsFile", "stats")
+    def getMetricsFile(self):
+        """Return the configured metrics file location."""
+        return self._get_fname("Server", "MetricsFile", "metrics")
     def getKeyDir(self):
         """Return the configured key directory"""
         return self._get_fname("Server", "KeyDir", "keys")
@@ -336,12 +358,19 @@ SERVER_SYNTAX =  {
                      'LogStats' : ('ALLOW', "boolean", 'yes'),
                      'StatsInterval' : ('ALLOW', "interval",
                                         "1 day"),
+                     'Metrics' : ('ALLOW', "boolean", "no"),
+                     'MetricsFile' : ('ALLOW', "filename", None),
+                     'MetricsInterval' : ('ALLOW', "interval", "1 minute"),
+                     'PacketTracing' : ('ALLOW', "boolean", "no"),
+                     'PacketTraceRate' : ('ALLOW', "fraction", "1%"),
+                     'PacketTraceFile' : ('ALLOW', "filename", None),
                      'EncryptIdentityKey' :('ALLOW', "boolean", "no"),
                      'IdentityKeyBits': ('ALLOW', "int", "2048"),
                      'PublicKeyLifetime' : ('ALLOW', "interval",
                                             "30 days"),
                      'PublicKeyOverlap': ('ALLOW', "interval",
                                           "24 hours"),
+                     'SharedHashLogs' : ('ALLOW', "boolean", "no"),
                      'EncryptPrivateKey' : ('ALLOW', "boolean", "no"),
                      'Mode' : ('REQUIRE', "serverMode", "local"),
                      'Nickname': ('REQUIRE', "nickname", None),
@@ -355,6 +384,7 @@ SERVER_SYNTAX =  {
                      'MixPoolRate' : ('ALLOW', "fraction", "60%"),
                      'MixPoolMinSize' : ('ALLOW', "int", "5"),
 		     'Timeout' : ('ALLOW', "interval", "5 min"),
+                     'AsyncDNS' : ('ALLOW', "boolean", "no"),
                      'MaxBandwidth' : ('ALLOW', "size", None),
                      'MaxBandwidthSpike' : ('ALLOW', "size", None),
                      },
@@ -385,6 +415,8 @@ SERVER_SYNTAX =  {
                           'ListenIP' : ('ALLOW', "IP", None),
                           'ListenPort' : ('ALLOW', "int", None),
                           'ListenIP6' : ('ALLOW', "IP6", None),
+                          'FrontEndProcesses' : ('ALLOW', "int", "0"),
+                          'SessionCacheSize' : ('ALLOW', "int", "1024"),
   		          'Allow' : ('ALLOW*', "addressSet_allow", None),
                           'Deny' : ('ALLOW*', "addressSet_deny", None)
 			 },
@@ -392,6 +424,7 @@ SERVER_SYNTAX =  {
                             'Retry' : ('ALLOW', "intervalList",
                               "every 1 hour for 1 day, 7 hours for 5 days"),
                            'MaxConnections' : ('ALLOW', 'int', '16'),
+                           'ResumeSessions' : ('ALLOW', 'boolean', 'yes'),
                            'Allow' : ('ALLOW*', "addressSet_allow", None),
                            'Deny' : ('ALLOW*', "addressSet_deny", None) },
         # FFFF Missing: Queue-Size / Queue config options
@@ -7,7 +7,7 @@
    """
 #FFFF We need support for encrypting private keys.
 
-__all__ = [ "ServerKeyring", "generateServerDescriptorAndKeys",
+__all__ = [ "ServerKeyring", "KeyPool", "generateServerDescriptorAndKeys",
             "generateCertChain" ]
 
 import os
@@ -22,6 +22,7 @@ import urllib2
 
 import mixminion._minionlib
 import mixminion.Crypto
+import mixminion.MMTPClient
 import mixminion.NetUtils
 import mixminion.Packet
 import mixminion.server.HashLog
@@ -64,6 +65,13 @@ CERTIFICATE_EXPIRY_SLOPPINESS = 2*60*60
 # DOCDOC
 CERTIFICATE_LIFETIME = 24*60*60
 
+# How many packet keys should a KeyPool keep ready?
+POOLED_PACKET_KEYS = 2
+
+# How much should a KeyPool lower the priority of the process that
+# generates Diffie-Hellman parameters?
+DH_NICENESS = 10
+
 #----------------------------------------------------------------------
 class ServerKeyring:
     """A ServerKeyring remembers current and future keys, descriptors, and
@@ -82,6 +90,7 @@ class ServerKeyring:
     # currentKeys: None, if we haven't checked for currently live keys, or
     #      a list of currently live ServerKeyset objects.
     # dhFile: pathname to file holding diffie-helman parameters.
+    # keyPool: None, or a KeyPool that generates keys for us ahead of time.
     # _lock: A lock to prevent concurrent key generation or rotation.
 
     def __init__(self, config):
@@ -95,6 +104,7 @@ class ServerKeyring:
         self.homeDir = config.getBaseDir()
         self.keyDir = config.getKeyDir()
         self.hashDir = os.path.join(config.getWorkDir(), 'hashlogs')
+        mixminion.server.HashLog.configureHashLogs(config)
         self.dhFile = os.path.join(config.getWorkDir(), 'tls', 'dhparam')
         self.certFile = os.path.join(config.getWorkDir(), "cert_chain")
         self.keyOverlap = config['Server']['PublicKeyOverlap'].getSeconds()
@@ -103,7 +113,11 @@ class ServerKeyring:
         self.currentKeys = None
         self._tlsContext = None #DOCDOC
         self._tlsContextExpires = -1 #DOCDOC
+        # (certificate file, private key, DH file) for self._tlsContext;
+        # MMTP front-end processes need these to build their own contexts.
+        self._tlsKeyInfo = None
         self.pingerSeed = None
+        self.keyPool = None
         self.checkKeys()
 
     def checkKeys(self):
@@ -376,12 +390,16 @@ class ServerKeyring:
             LOG.info("Generating key %s to run from %s through %s (GMT)",
                      keyname, formatDate(startAt),
                      formatDate(nextStart-3600))
+            packetKey = None
+            if self.keyPool is not None:
+                packetKey = self.keyPool.getPacketKey()
             generateServerDescriptorAndKeys(config=self.config,
                                             identityKey=self.getIdentityKey(),
                                             keyname=keyname,
                                             keydir=self.keyDir,
                                             hashdir=self.hashDir,
-                                            validAt=startAt)
+                                            validAt=startAt,
+                                            packetKey=packetKey)
             startAt = nextStart
 
         self.checkKeys()
@@ -473,11 +491,23 @@ class ServerKeyring:
 
         return keysets
 
+    def createKeyPool(self, nPacketKeys=POOLED_PACKET_KEYS):
+        """Create a KeyPool to generate keys for this keyring ahead of
+           time, and start generating Diffie-Hellman parameters if we
+           don't have any.  The caller must start the pool's thread.
+
+           Because this may fork, call it before starting any threads."""
+        self.keyPool = KeyPool(self, nPacketKeys)
+        self.keyPool.startDHParameters()
+        return self.keyPool
+
     def _getDHFile(self):
         """Return the filename for the diffie-helman parameters for the
            server.  Creates the file if it doesn't yet exist."""
         dhdir = os.path.split(self.dhFile)[0]
         createPrivateDir(dhdir)
+        if self.keyPool is not None:
+            self.keyPool.waitForDHParameters()
         if not os.path.exists(self.dhFile):
             # ???? This is only using 512-bit Diffie-Hellman!  That isn't
             # ???? remotely enough.
@@ -494,22 +524,37 @@ class ServerKeyring:
         """Create and return a TLS context."""
         if now is None:
             now = time.time()
-        mmtpKey = mixminion.Crypto.pk_generate(MMTP_KEY_BYTES*8)
+        creds = None
+        if self.keyPool is not None:
+            creds = self.keyPool.getTLSCredentials(now)
+        if creds is not None:
+            # The pool has already made a key and certificate chain for
+            # a context starting about now.
+            when, mmtpKey, certFile = creds
+            replaceFile(certFile, self.certFile)
+            expires = when + CERTIFICATE_LIFETIME
+        else:
+            mmtpKey = mixminion.Crypto.pk_generate(MMTP_KEY_BYTES*8)
 
-        certStarts = now - CERTIFICATE_EXPIRY_SLOPPINESS
-        expires = now + CERTIFICATE_LIFETIME
-        certEnds = now + CERTIFICATE_LIFETIME + CERTIFICATE_EXPIRY_SLOPPINESS
+            certStarts = now - CERTIFICATE_EXPIRY_SLOPPINESS
+            expires = now + CERTIFICATE_LIFETIME
+            certEnds = now + CERTIFICATE_LIFETIME + \
+                       CERTIFICATE_EXPIRY_SLOPPINESS
 
-        tmpName = self.certFile + "_tmp"
-        generateCertChain(tmpName, mmtpKey, self.getIdentityKey(),
-                          self.nickname, certStarts, certEnds)
-        replaceFile(tmpName, self.certFile)
+            tmpName = self.certFile + "_tmp"
+            generateCertChain(tmpName, mmtpKey, self.getIdentityKey(),
+                              self.nickname, certStarts, certEnds)
+            replaceFile(tmpName, self.certFile)
 
         self._tlsContext = (
                     mixminion._minionlib.TLSContext_new(self.certFile,
                                                         mmtpKey,
-                                                        self._getDHFile()))
+                                                        self._getDHFile(),
+                                       **getTLSSessionOptions(self.config)))
         self._tlsContextExpires = expires
+        self._tlsKeyInfo = (self.certFile, mmtpKey, self._getDHFile())
+        if self.keyPool is not None:
+            self.keyPool.setNextTLSContextTime(expires)
         return self._tlsContext
 
     def _getTLSContext(self, force=0, now=None):
@@ -521,9 +566,13 @@ class ServerKeyring:
             return self._tlsContext
 
     def updateMMTPServerTLSContext(self,mmtpServer,force=0,now=None):
-        """DOCDOC"""
+        """Give 'mmtpServer' our current TLS context, generating a new one
+           if the old one has expired or if 'force' is true.  A new context
+           starts with an empty session cache, so clients can't resume
+           sessions made under the old key.  Return the time at which
+           the context expires."""
         context = self._getTLSContext(force=force,now=now)
-        mmtpServer.setServerContext(context)
+        mmtpServer.setServerContext(context, self._tlsKeyInfo)
         return self._tlsContextExpires
 
     def updateKeys(self, packetHandler, statusFile=None,when=None):
@@ -628,6 +677,216 @@ class ServerKeyring:
     def unlock(self):
         self._lock.release()
 
+#----------------------------------------------------------------------
+class KeyPool(threading.Thread):
+    """A KeyPool generates keys for a ServerKeyring before it needs them,
+       so that key rotation doesn't stall the server while it waits for
+       RSA key generation.  It keeps a few packet keys ready, along with
+       an MMTP key and certificate chain for the next TLS context, and it
+       generates Diffie-Hellman parameters in a low-priority child
+       process.
+
+       The RSA and certificate work happens in the pool's own thread;
+       those operations release the interpreter lock, so they don't hold
+       up the rest of the server.  Pooled keys stay in memory until
+       they're used, so an unused private key never reaches the disk.
+    """
+    ## Fields:
+    # keyring: The ServerKeyring we're generating keys for.
+    # nPacketKeys: How many packet keys we try to keep ready.
+    # packetKeys: A list of ready-made packet keys.
+    # nextTLSTime: None, or the time at which the keyring will next
+    #    want a new TLS context.
+    # tlsCredentials: None, or a (when, mmtpKey) tuple for a TLS context
+    #    to start at 'when'.  Its certificate chain is in nextCertFile.
+    # nextCertFile: Filename for the pregenerated certificate chain.
+    # dhPid: None, or the process ID of a child process that is writing
+    #    Diffie-Hellman parameters to dhTmpFile.  Only used by the thread
+    #    that created the pool.
+    # _cond: A Condition to protect the other fields; notified when a key
+    #    is taken from the pool, or when the pool should stop.
+    # _stop: True iff we've been told to shut down.
+    def __init__(self, keyring, nPacketKeys=POOLED_PACKET_KEYS):
+        """Create a new KeyPool to generate keys for 'keyring', keeping
+           'nPacketKeys' packet keys ready.  Call start() to begin
+           generating RSA keys."""
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.keyring = keyring
+        self.nPacketKeys = nPacketKeys
+        self.packetKeys = []
+        self.nextTLSTime = None
+        self.tlsCredentials = None
+        self.nextCertFile = keyring.certFile + "_next"
+        self.dhTmpFile = keyring.dhFile + "_tmp"
+        self.dhPid = None
+        self._cond = threading.Condition()
+        self._stop = 0
+
+    def startDHParameters(self):
+        """If the keyring has no Diffie-Hellman parameters, start a child
+           process to generate them at low priority.  Unlike our other
+           operations, generating DH parameters holds the interpreter lock,
+           so we can't do it in a thread.
+
+           Because this forks, call it before starting any threads."""
+        if (self.dhPid is not None or os.path.exists(self.keyring.dhFile)
+            or not hasattr(os, 'fork')):
+            return
+        createPrivateDir(os.path.split(self.dhTmpFile)[0])
+        LOG.info("Generating Diffie-Helman parameters for TLS in background")
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                try:
+                    os.nice(DH_NICENESS)
+                except (AttributeError, OSError):
+                    pass
+                mixminion._minionlib.generate_dh_parameters(
+                    self.dhTmpFile, verbose=0)
+                status = 0
+            finally:
+                os._exit(status)
+        self.dhPid = pid
+
+    def waitForDHParameters(self):
+        """If we're generating Diffie-Hellman parameters, wait until we're
+           done, and put them in the keyring's DH file."""
+        if self.dhPid is None:
+            return
+        try:
+            os.waitpid(self.dhPid, 0)
+        except OSError, e:
+            # Somebody else may have reaped our child for us.
+            if e.errno != errno.ECHILD:
+                raise
+        self.dhPid = None
+        if os.path.exists(self.dhTmpFile) and \
+               os.stat(self.dhTmpFile).st_size:
+            replaceFile(self.dhTmpFile, self.keyring.dhFile)
+            LOG.info("...done generating Diffie-Helman parameters")
+        else:
+            LOG.warn("Couldn't generate Diffie-Helman parameters "
+                     "in background")
+            tryUnlink(self.dhTmpFile)
+
+    def getPacketKey(self):
+        """Return a fresh packet key from the pool, or None if we have
+           none ready."""
+        self._cond.acquire()
+        try:
+            if not self.packetKeys:
+                LOG.debug("No pregenerated packet keys are ready")
+                return None
+            key = self.packetKeys.pop(0)
+            self._cond.notify()
+            return key
+        finally:
+            self._cond.release()
+
+    def setNextTLSContextTime(self, when):
+        """Tell the pool that the keyring will want a new TLS context at
+           'when'."""
+        self._cond.acquire()
+        try:
+            self.nextTLSTime = when
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def getTLSCredentials(self, now):
+        """If we have an MMTP key and certificate chain for a TLS context
+           to start close enough to 'now', return a (when, mmtpKey,
+           certFile) tuple for them, where 'when' is the time they were
+           made for.  The caller must move the chain out of 'certFile'.
+           Otherwise return None."""
+        self._cond.acquire()
+        try:
+            if self.tlsCredentials is None:
+                return None
+            when, mmtpKey = self.tlsCredentials
+            if now < when - CERTIFICATE_EXPIRY_SLOPPINESS/2:
+                # Too early; keep them for later.
+                return None
+            # The keyring is about to make a new context, and will tell us
+            # when it wants the one after that.
+            self.tlsCredentials = self.nextTLSTime = None
+            if now > when + CERTIFICATE_EXPIRY_SLOPPINESS/2:
+                LOG.debug("Discarding out-of-date pregenerated TLS key")
+                return None
+            return when, mmtpKey, self.nextCertFile
+        finally:
+            self._cond.release()
+
+    def shutdown(self):
+        """Tell this thread to stop once it has generated its current
+           key."""
+        self._cond.acquire()
+        try:
+            self._stop = 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _needTLSCredentials(self):
+        """Helper: return true iff we should generate a key and certificate
+           chain for the next TLS context.  Caller must hold _cond."""
+        return (self.nextTLSTime is not None and
+                (self.tlsCredentials is None or
+                 self.tlsCredentials[0] != self.nextTLSTime))
+
+    def run(self):
+        """Main loop for the pool: wait until the pool needs a key, then
+           generate it."""
+        try:
+            while 1:
+                self._cond.acquire()
+                try:
+                    while (not self._stop and
+                           len(self.packetKeys) >= self.nPacketKeys and
+                           not self._needTLSCredentials()):
+                        self._cond.wait()
+                    if self._stop:
+                        break
+                    needPacketKey = len(self.packetKeys) < self.nPacketKeys
+                    when = self.nextTLSTime
+                finally:
+                    self._cond.release()
+
+                if needPacketKey:
+                    key = mixminion.Crypto.pk_generate(PACKET_KEY_BYTES*8)
+                    self._cond.acquire()
+                    self.packetKeys.append(key)
+                    self._cond.release()
+                else:
+                    self._generateTLSCredentials(when)
+
+            LOG.info("Key pool shutting down.")
+        except:
+            LOG.error_exc(sys.exc_info(),
+                          "Exception while generating keys; shutting down "
+                          "key pool.")
+
+    def _generateTLSCredentials(self, when):
+        """Helper: generate an MMTP key, and a certificate chain for a TLS
+           context starting at 'when'."""
+        mmtpKey = mixminion.Crypto.pk_generate(MMTP_KEY_BYTES*8)
+        certStarts = when - CERTIFICATE_EXPIRY_SLOPPINESS
+        certEnds = when + CERTIFICATE_LIFETIME + CERTIFICATE_EXPIRY_SLOPPINESS
+        tmpName = self.nextCertFile + "_tmp"
+        # The keyring doesn't make the work directory until it builds its
+        # first TLS context, which may well be after we run.
+        createPrivateDir(os.path.dirname(self.nextCertFile))
+        generateCertChain(tmpName, mmtpKey, self.keyring.getIdentityKey(),
+                          self.keyring.nickname, certStarts, certEnds)
+        self._cond.acquire()
+        try:
+            replaceFile(tmpName, self.nextCertFile)
+            self.tlsCredentials = (when, mmtpKey)
+        finally:
+            self._cond.release()
+
 #----------------------------------------------------------------------
 class ServerKeyset:
     """A set of expirable keys for use by a server.
@@ -957,7 +1216,8 @@ def checkDescriptorConsistency(info, config, log=1, isPublished=1):
 
 def generateServerDescriptorAndKeys(config, identityKey, keydir, keyname,
                                     hashdir, validAt=None, now=None,
-                                    useServerKeys=0, validUntil=None):
+                                    useServerKeys=0, validUntil=None,
+                                    packetKey=None):
     """Generate and sign a new server descriptor, and generate all the keys to
        go with it.
 
@@ -971,6 +1231,8 @@ def generateServerDescriptorAndKeys(config, identityKey, keydir, keyname,
                (keydir,keyname,hashdir) rather than generating a fresh one.
           validUntil -- Time at which the generated descriptor should
                expire.
+          packetKey -- If provided, a freshly generated packet key to use
+               for the new key set.
     """
     if useServerKeys:
         serverKeys = ServerKeyset(keydir, keyname, hashdir)
@@ -978,7 +1240,8 @@ def generateServerDescriptorAndKeys(config, identityKey, keydir, keyname,
         packetKey = serverKeys.packetKey
     else:
         # First, we generate both of our short-term keys...
-        packetKey = mixminion.Crypto.pk_generate(PACKET_KEY_BYTES*8)
+        if packetKey is None:
+            packetKey = mixminion.Crypto.pk_generate(PACKET_KEY_BYTES*8)
 
         # ...and save them to disk, setting up our directory structure while
         # we're at it.
@@ -1291,6 +1554,14 @@ def generateCertChain(filename, mmtpKey, identityKey, nickname,
     os.unlink(fname)
     writeFile(filename, certText+identityCertText, 0600)
 
+def getTLSSessionOptions(config):
+    """Return a dict of keyword arguments for TLSContext_new to configure
+       the session cache for a server TLS context, as specified by
+       'config'."""
+    return { 'sessionCacheSize' :
+                 config['Incoming/MMTP'].get('SessionCacheSize', 0),
+             'sessionTimeout' : mixminion.MMTPClient.SESSION_LIFETIME }
+
 def getPlatformSummary():
     """Return a string describing the current software and platform."""
     if hasattr(os, "uname"):
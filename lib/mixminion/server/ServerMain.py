@@ -44,6 +44,7 @@
 
 __all__ = [ 'MixminionServer' ]
 
+import cPickle
 import errno
 import getopt
 import os
@@ -180,26 +181,51 @@ class IncomingQueue(mixminion.Filestore.StringStore):
         """
         self.pingLog = pingLog
 
-    def queuePacket(self, pkt):
-        """Add a packet for delivery"""
+    def queuePacket(self, pkt, traceID=None):
+        """Add a packet for delivery.  If 'traceID' is provided, it is the
+           ID that EventStats.tracer gave the packet."""
         h = mixminion.Filestore.StringStore.queueMessage(self, pkt)
         LOG.trace("Inserting packet IN:%s into incoming queue", h)
         assert h is not None
+        if traceID is not None:
+            EventStats.tracer.stamp(traceID, "Store")
         self.processingThread.addJob(
-            lambda self=self, h=h: self.__deliverPacket(h))
+            lambda self=self, h=h, t=traceID: self.__deliverPacket(h, t))
+
+    def queuePackets(self, pkts, traceIDs=None):
+        """Add a list of packets for delivery, and sync them to disk before
+           returning.  If 'traceIDs' is provided, it is a list of the
+           packets' trace IDs, or None for packets we aren't tracing."""
+        hs = mixminion.Filestore.StringStore.queueMessages(self, pkts)
+        if traceIDs is None:
+            traceIDs = [None] * len(hs)
+        for h, traceID in zip(hs, traceIDs):
+            LOG.trace("Inserting packet IN:%s into incoming queue", h)
+            if traceID is not None:
+                EventStats.tracer.stamp(traceID, "Store")
+            self.processingThread.addJob(
+                lambda self=self, h=h, t=traceID: self.__deliverPacket(h, t))
 
     def queueMessage(self, m):
         # Never call this directly.
         assert 0
 
-    def __deliverPacket(self, handle):
+    def __deliverPacket(self, handle, traceID=None):
         """Process a single packet with a given handle, and insert it into
            the Mix pool.  This function is called from within the processing
            thread."""
         ph = self.packetHandler
+        if traceID is not None:
+            tracer = EventStats.tracer
+            tracer.stamp(traceID, "Wait")
         packet = self.messageContents(handle)
         try:
+            start = time.time()
             res = ph.processPacket(packet)
+            EventStats.metrics.observe("PacketProcessingTime",
+                                       time.time()-start)
+            if traceID is not None:
+                tracer.stamp(traceID, "Crypto")
             if res is None:
                 # Drop padding before it gets to the mix.
                 LOG.debug("Padding packet IN:%s dropped", handle)
@@ -219,7 +245,9 @@ class IncomingQueue(mixminion.Filestore.StringStore):
                         #XXXX008 defer decoding to module; don't do it here.
                         res.decode()
 
-                self.mixPool.queueObject(res)
+                self.mixPool.queueObject(res, traceID)
+                # The mix pool takes over the trace from here.
+                traceID = None
                 self.removeMessage(handle)
                 LOG.debug("Processed packet IN:%s; inserting into mix pool",
                           handle)
@@ -237,6 +265,9 @@ class IncomingQueue(mixminion.Filestore.StringStore):
             LOG.error_exc(sys.exc_info(),
                     "Unexpected error when processing IN:%s", handle)
             self.removeMessage(handle)
+        if traceID is not None:
+            # The packet didn't make it to the mix pool.
+            tracer.finish(traceID)
 
 class MixPool:
     """Wraps a mixminion.server.ServerQueue.*MixPool to send packets
@@ -283,9 +314,24 @@ class MixPool:
         """Release the lock on the underlying pool"""
         self.queue.unlock()
 
-    def queueObject(self, obj):
-        """Insert an object into the pool."""
-        return self.queue.queueObject(obj)
+    def queueObject(self, obj, traceID=None):
+        """Insert an object into the pool.  If 'traceID' is provided, it is
+           the packet's ID from EventStats.tracer: we tell the tracer to
+           follow the packet before mix() can see it."""
+        if traceID is None:
+            return self.queue.queueObject(obj)
+        tracer = EventStats.tracer
+        f, handle = self.queue.openNewMessage()
+        try:
+            cPickle.dump(obj, f, 1)
+            tracer.stamp(traceID, "Pool")
+            tracer.follow(traceID, "MIX:"+handle)
+            self.queue.finishMessage(f, handle)
+        except:
+            tracer.take("MIX:"+handle)
+            tracer.finish(traceID)
+            raise
+        return handle
 
     def count(self):
         "Return the number of packets in the pool"
@@ -307,11 +353,26 @@ class MixPool:
         LOG.debug("%s packets in the mix pool; delivering %s.",
                   self.queue.count(), len(handles))
 
+        metrics = EventStats.metrics
+        tracer = EventStats.tracer
+        now = time.time()
         for h in handles:
+            if tracer.enabled:
+                traceID = tracer.take("MIX:"+h)
+            else:
+                traceID = None
             try:
                 packet = self.queue.getObject(h)
             except mixminion.Filestore.CorruptedFile:
+                if traceID is not None:
+                    tracer.finish(traceID)
                 continue
+            if traceID is not None:
+                tracer.stamp(traceID, "Mix")
+            if metrics.enabled:
+                arrived = self.queue.getArrivalTime(h)
+                if arrived is not None:
+                    metrics.observe("MixDelay", now-arrived)
             if packet.isDelivery():
                 h2 = self.moduleManager.queueDecodedMessage(packet)
                 if h2:
@@ -319,11 +380,17 @@ class MixPool:
                               , h, h2)
                 else:
                     LOG.debug("  (exit modules received packet MIX:%s without queueing.)", h)
+                if traceID is not None:
+                    tracer.stamp(traceID, "Queue")
+                    tracer.finish(traceID)
             else:
                 address = packet.getAddress()
                 h2 = self.outgoingQueue.queueDeliveryMessage(packet, address)
                 LOG.debug("  (sending packet MIX:%s to MMTP server as OUT:%s)"
                           , h, h2)
+                if traceID is not None:
+                    tracer.stamp(traceID, "Queue")
+                    tracer.follow(traceID, "OUT:"+h2)
             # In any case, we're through with this packet now.
             self.queue.removeMessage(h)
 
@@ -368,6 +435,33 @@ class OutgoingQueue(mixminion.server.ServerQueue.PerAddressDeliveryQueue):
         self.incomingQueue = incoming
         self.pingGenerator = pingGenerator
 
+    def deliverySucceeded(self, handle, now=None):
+        tracer = EventStats.tracer
+        if tracer.enabled:
+            traceID = tracer.take("OUT:"+handle)
+            if traceID is not None:
+                tracer.stamp(traceID, "Deliver")
+                tracer.finish(traceID)
+        mixminion.server.ServerQueue.PerAddressDeliveryQueue.deliverySucceeded(
+            self, handle, now)
+
+    def removeMessage(self, handle):
+        # However a packet leaves the queue (delivered, failed, or expired),
+        # we're done tracing it.
+        tracer = EventStats.tracer
+        if tracer.enabled:
+            tracer.finish(tracer.take("OUT:"+handle))
+        mixminion.server.ServerQueue.PerAddressDeliveryQueue.removeMessage(
+            self, handle)
+
+    def removeAll(self, secureDeleteFn=None):
+        tracer = EventStats.tracer
+        if tracer.enabled:
+            for h in self.store.getAllMessages():
+                tracer.finish(tracer.take("OUT:"+h))
+        mixminion.server.ServerQueue.PerAddressDeliveryQueue.removeAll(
+            self, secureDeleteFn)
+
     def _deliverMessages(self, msgList):
         "Implementation of abstract method from DeliveryQueue."
         # Map from addr -> [ (handle, msg) ... ]
@@ -414,19 +508,112 @@ class _MMTPServer(mixminion.server.MMTPServer.MMTPAsyncServer):
     ## Fields:
     # incomingQueue -- a Queue to hold packetts we receive
     # outgoingQueue -- a DeliveryQueue to hold packets to be sent.
+    # incomingWriter -- an IncomingWriterThread to store the packets we
+    #     receive, or None if we store them ourselves.
     def __init__(self, config, servercontext):
         mixminion.server.MMTPServer.MMTPAsyncServer.__init__(
             self, config, servercontext)
 
-    def connectQueues(self, incoming, outgoing):
+    def connectQueues(self, incoming, outgoing, incomingWriter=None):
         self.incomingQueue = incoming
         self.outgoingQueue = outgoing
+        self.incomingWriter = incomingWriter
+        self.deferAcks = (incomingWriter is not None)
 
-    def onPacketReceived(self, pkt):
-        self.incomingQueue.queuePacket(pkt)
+    def onPacketReceived(self, pkt, ack=None):
+        traceID = EventStats.tracer.start()
+        if ack is None:
+            self.incomingQueue.queuePacket(pkt, traceID)
+        else:
+            self.incomingWriter.queuePacket(pkt,
+                lambda ok, self=self, ack=ack: self.releaseAck(ack, ok),
+                traceID)
         # FFFF Replace with server.
         EventStats.log.receivedPacket()
 
+#----------------------------------------------------------------------
+class IncomingWriterThread(threading.Thread):
+    """Thread that stores received packets in the IncomingQueue, so that
+       a slow disk doesn't stall the main loop.
+
+       Packets are stored in groups: whenever the thread is idle, it takes
+       every packet that has arrived since its last write (up to
+       MAX_BATCH), and syncs them to disk together.  Only then does it tell
+       the MMTP server to acknowledge them.
+    """
+    # Fields:
+    #   mqueue: A ClearableQueue holding (packet, callback, traceID) tuples,
+    #     or None to indicate a shutdown.  The callback is invoked with a
+    #     true value once the packet is stored, or a false value if we
+    #     couldn't store it.  The traceID is the packet's ID from
+    #     EventStats.tracer, or None.
+    #   incomingQueue: The IncomingQueue to hold the packets.
+
+    # Largest number of packets to store at once.
+    MAX_BATCH = 64
+    # Largest number of packets that may be waiting to be stored.  When
+    # there are this many, the main thread blocks until we catch up.
+    MAX_PENDING = 256
+    def __init__(self, incomingQueue):
+        threading.Thread.__init__(self)
+        self.mqueue = ClearableQueue(self.MAX_PENDING)
+        self.incomingQueue = incomingQueue
+
+    def queuePacket(self, pkt, callback, traceID=None):
+        """Schedule the packet 'pkt' to be stored, and invoke 'callback'
+           when we're done."""
+        self.mqueue.put((pkt, callback, traceID))
+
+    def shutdown(self):
+        """Tell this thread to shut down once it has stored all pending
+           packets."""
+        LOG.info("Telling incoming writer thread to shut down.")
+        self.mqueue.put(None)
+
+    def run(self):
+        """implementation of the writer thread's main loop: waits for
+           packets to store, and stores them in batches."""
+        try:
+            running = 1
+            while running:
+                batch = [ self.mqueue.get() ]
+                try:
+                    while len(batch) < self.MAX_BATCH:
+                        batch.append(self.mqueue.get(0))
+                except QueueEmpty:
+                    pass
+                if None in batch:
+                    running = 0
+                    batch = [ item for item in batch if item is not None ]
+                if batch:
+                    self._storeBatch(batch)
+            LOG.info("Incoming writer thread shutting down.")
+        except:
+            LOG.error_exc(sys.exc_info(),
+                          "Exception while storing incoming packets; "
+                          "shutting down thread.")
+
+    def _storeBatch(self, batch):
+        """Helper: store all the packets in 'batch', a list of (packet,
+           callback, traceID) tuples, and invoke their callbacks."""
+        metrics = EventStats.metrics
+        start = time.time()
+        try:
+            self.incomingQueue.queuePackets(
+                [ pkt for pkt, _, _ in batch ],
+                [ traceID for _, _, traceID in batch ])
+            ok = 1
+        except (IOError, OSError), e:
+            LOG.error("Couldn't store %s incoming packets: %s", len(batch), e)
+            ok = 0
+            for _, _, traceID in batch:
+                if traceID is not None:
+                    EventStats.tracer.finish(traceID)
+        metrics.observe("IncomingCommitTime", time.time()-start)
+        metrics.observe("IncomingCommitBatchSize", len(batch))
+        for _, callback, _ in batch:
+            callback(ok)
+
 #----------------------------------------------------------------------
 class CleaningThread(threading.Thread):
     """Thread that handles file deletion.  Some methods of secure deletion
@@ -516,6 +703,11 @@ def installSignalHandlers():
         signal.signal(signal.SIGHUP, _sigHupHandler)
     signal.signal(signal.SIGTERM, _sigTermHandler)
 
+# The main loop sleeps until the next scheduled event, but never for more
+# than MAX_POLL_INTERVAL seconds at a time, so that it notices promptly if
+# one of our threads has died.  (This is how often the old loop checked.)
+MAX_POLL_INTERVAL = mixminion.server.MMTPServer.SelectAsyncServer.TICK_INTERVAL
+
 class MixminionServer(Scheduler):
     """Wraps and drives all the queues, and the async net server.  Handles
        all timed events."""
@@ -544,6 +736,8 @@ class MixminionServer(Scheduler):
     #    be slow.  (If the database has good locking, this is only statistics
     #    recomputation.  If the database has dumb locking, this is all
     #    database activity.)
+    # keyPool: A ServerKeys.KeyPool thread that generates keys before the
+    #    keyring needs them.
     # lockFile: An instance of Lockfile to prevent multiple servers from
     #    running in the same directory.  The filename for this lock is
     #    stored in self.pidFile.
@@ -605,6 +799,11 @@ class MixminionServer(Scheduler):
 "server generate new ones.  [Messages sent to the old keys will be lost].\n"
 "The original error message was '%s'.")%e)
 
+        # Start generating DH parameters (if we need them) while we make
+        # any other keys we need.  This forks, so it has to happen before
+        # we start any threads.
+        self.keyPool = self.keyring.createKeyPool()
+
         self.keyring.removeDeadKeys()
         self.keyring.createKeysAsNeeded()
         self.keyring.checkDescriptorConsistency()
@@ -667,7 +866,8 @@ class MixminionServer(Scheduler):
         if pingerEnabled and mixminion.server.Pinger.canRunPinger():
             #FFFF Later, enable this stuff anyway, to make R-G-B mixing work.
             LOG.debug("Initializing database thread for pinger")
-            self.databaseThread = ProcessingThread("database thread")
+            self.databaseThread = \
+                mixminion.server.Pinger.PingLogWriterThread("database thread")
 
             LOG.debug("Initializing ping log")
             self.pingLog = mixminion.server.Pinger.openPingLog(
@@ -682,10 +882,25 @@ class MixminionServer(Scheduler):
             self.pingGenerator = None
             self.databaseThread = None
 
+        LOG.debug("Registering queue size metrics")
+        metrics = EventStats.metrics
+        metrics.addGauge("IncomingQueueSize", self.incomingQueue.count)
+        metrics.addGauge("MixPoolSize", self.mixPool.count)
+        metrics.addGauge("OutgoingQueueSize", self.outgoingQueue.count)
+        for name, queue in self.moduleManager.queues.items():
+            if hasattr(queue, 'count'):
+                metrics.addGauge('DeliveryQueueSize{module="%s"}'%name,
+                                 queue.count)
+
         self.cleaningThread = CleaningThread()
         self.processingThread = ProcessingThread()
+        self.incomingWriter = IncomingWriterThread(self.incomingQueue)
 
-        self.dnsCache = mixminion.server.DNSFarm.DNSCache()
+        if self.config['Server'].get('AsyncDNS', 0):
+            self.dnsCache = mixminion.server.DNSFarm.AsyncDNSCache(
+                self.mmtpServer)
+        else:
+            self.dnsCache = mixminion.server.DNSFarm.DNSCache()
 
         LOG.debug("Connecting queues")
         self.incomingQueue.connectQueues(mixPool=self.mixPool,
@@ -696,7 +911,8 @@ class MixminionServer(Scheduler):
                                          incoming=self.incomingQueue,
                                          pingGenerator=self.pingGenerator)
         self.mmtpServer.connectQueues(incoming=self.incomingQueue,
-                                      outgoing=self.outgoingQueue)
+                                      outgoing=self.outgoingQueue,
+                                      incomingWriter=self.incomingWriter)
         self.mmtpServer.connectDNSCache(self.dnsCache)
         if self.pingGenerator is not None:
             assert self.pingLog
@@ -706,15 +922,24 @@ class MixminionServer(Scheduler):
                                        keyring=self.keyring)
             self.pingGenerator.scheduleAllPings(time.time())
 
-        if self.databaseThread is not None:
-            self.databaseThread.start()
         if self.pingLog is not None:
             self.incomingQueue.setPingLog(self.pingLog)
             self.mmtpServer.connectPingLog(self.pingLog)
 
+        # We need to fork the front ends before we start any threads.
+        nFrontEnds = config['Incoming/MMTP'].get('FrontEndProcesses', 0)
+        if nFrontEnds:
+            LOG.debug("Starting %s MMTP front ends", nFrontEnds)
+            self.mmtpServer.startFrontEnds(nFrontEnds, config)
+
+        if self.databaseThread is not None:
+            self.databaseThread.start()
+
         self.cleaningThread.start()
         self.processingThread.start()
+        self.incomingWriter.start()
         self.moduleManager.startThreading()
+        self.keyPool.start()
 
     def updateKeys(self, lock=1):
         """Change the keys used by the PacketHandler and MMTPServer objects
@@ -771,6 +996,12 @@ class MixminionServer(Scheduler):
                              time.time()+3600)
             reschedulePings = 0
 
+        # Look up the servers' hostnames now, so we don't have to wait for
+        # them when we deliver packets.
+        self.dnsCache.prefetch([ s.getHostname()
+                                 for s in self.dirClient.getAllServers()
+                                 if s.getHostname() ])
+
         if reschedulePings:
             if self.pingGenerator:
                 self.pingGenerator.directoryUpdated()
@@ -805,6 +1036,16 @@ class MixminionServer(Scheduler):
                 EventStats.log.getNextRotation(),
                 _rotateStats))
 
+        if EventStats.metrics.getNextExport():
+            self.scheduleEvent(RecurringComplexEvent(
+                EventStats.metrics.getNextExport(),
+                EventStats.metrics.export))
+
+        if EventStats.tracer.getNextExport():
+            self.scheduleEvent(RecurringComplexEvent(
+                EventStats.tracer.getNextExport(),
+                EventStats.tracer.export))
+
         def _tryTimeout(self=self):
             self.mmtpServer.tryTimeout()
             self.dnsCache.cleanCache()
@@ -869,40 +1110,49 @@ class MixminionServer(Scheduler):
         if self.config['Server'].get("Daemon",1):
             closeUnusedFDs()
 
-        SCHEDULE_INTERVAL = 60
-        TICK_INTERVAL = self.mmtpServer.TICK_INTERVAL
         while 1:
+            # Run every event that's due, and retry any lost DNS queries.
+            now = time.time()
+            self.processEvents(now)
+            self.dnsCache.checkTimeouts(now)
+
+            # Sleep until the next event is due, or until we have network
+            # events to handle.
             now = time.time()
-            nextEvent = now + SCHEDULE_INTERVAL
-            timeLeft = SCHEDULE_INTERVAL
-            nextTick = now+TICK_INTERVAL
-            while timeLeft > 0:
-                # Handle pending network events
-                self.mmtpServer.process(TICK_INTERVAL)
-                # Check for signals
-                if STOPPING:
-                    LOG.info("Caught SIGTERM; shutting down.")
-                    return
-                elif GOT_HUP:
-                    LOG.info("Caught SIGHUP")
-                    self.doReset()
-                    GOT_HUP = 0
-                # Make sure that our worker threads are still running.
-                if not (self.cleaningThread.isAlive() and
-                        self.processingThread.isAlive() and
-                        self.moduleManager.thread.isAlive()):
-                    LOG.fatal("One of our threads has halted; shutting down.")
-                    return
-
-                # Calculate remaining time until the next event.
-                now = time.time()
-                if now > nextTick:
-                    self.mmtpServer.tick()
-                    nextTick = now+TICK_INTERVAL
-                timeLeft = nextEvent - now
-
-            # An event has fired.
-            self.processEvents()
+            wakeAt = now + MAX_POLL_INTERVAL
+            nextEvent = self.firstEventTime()
+            if nextEvent != -1 and nextEvent < wakeAt:
+                wakeAt = nextEvent
+            nextCheck = self.dnsCache.getNextTimeoutCheck()
+            if nextCheck is not None and nextCheck < wakeAt:
+                wakeAt = nextCheck
+            self.mmtpServer.process(max(0, wakeAt-now))
+
+            # Check for signals
+            if STOPPING:
+                LOG.info("Caught SIGTERM; shutting down.")
+                return
+            elif GOT_HUP:
+                LOG.info("Caught SIGHUP")
+                self.doReset()
+                GOT_HUP = 0
+            # Make sure that our worker threads are still running.
+            if not (self.cleaningThread.isAlive() and
+                    self.processingThread.isAlive() and
+                    self.incomingWriter.isAlive() and
+                    self.moduleManager.thread.isAlive()):
+                LOG.fatal("One of our threads has halted; shutting down.")
+                return
+            if self.mmtpServer.frontEnds is not None and \
+                   not self.mmtpServer.frontEnds.isAlive():
+                LOG.fatal("One of our MMTP front ends has halted; shutting down.")
+                return
+
+    def eventFinished(self):
+        # A background event is done, and may want to run before we would
+        # otherwise wake up.
+        if self.mmtpServer.wakeup is not None:
+            self.mmtpServer.wakeup.wakeup()
 
     def doReset(self):
         """Called when server receives SIGHUP.  Flushes logs to disk,
@@ -968,14 +1218,21 @@ class MixminionServer(Scheduler):
         """Release all resources; close all files."""
         if self.pingLog is not None:
             self.pingLog.shutdown()
+        # Stop receiving packets, then store the packets we've already
+        # received before we stop processing them.
+        self.mmtpServer.stopFrontEnds()
+        self.incomingWriter.shutdown()
+        self.incomingWriter.join()
         self.cleaningThread.shutdown()
         self.processingThread.shutdown()
         self.moduleManager.shutdown()
+        self.keyPool.shutdown()
         if self.databaseThread: self.databaseThread.shutdown(flush=0)
 
         self.cleaningThread.join()
         self.processingThread.join()
         self.moduleManager.join()
+        self.keyPool.join()
         if self.databaseThread: self.databaseThread.join()
 
         self.packetHandler.close()
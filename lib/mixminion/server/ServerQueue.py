@@ -797,6 +797,7 @@ class TimedMixPool(mixminion.Filestore.ObjectStore):
            every 'interval' seconds."""
         mixminion.Filestore.ObjectStore.__init__(
             self, location, create=1, scrub=1)
+        self.useIndex()
         self.interval = interval
 
     def getBatch(self):
@@ -892,10 +893,7 @@ class _BinomialMixin:
         return  n / float(count)
 
     def getBatch(self):
-        msgProbability = self._getFraction()
-        rng = getCommonPRNG()
-        return rng.shuffle([ h for h in self.getAllMessages()
-                             if rng.getFloat() < msgProbability ])
+        return self.pickWithProbability(self._getFraction())
 
 
 class BinomialCottrellMixPool(_BinomialMixin,CottrellMixPool):
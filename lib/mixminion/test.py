@@ -16,16 +16,19 @@ import base64
 import cPickle
 import cStringIO
 import gzip
+import httplib
 import operator
 import os
 import re
 import socket
+import signal
 import stat
 import struct
 import sys
 import threading
 import time
 import types
+import urllib
 from string import atoi
 
 # Not every post-2.0 version of Python has a working 'unittest' module, so
@@ -49,6 +52,8 @@ from mixminion.testSupport import mix_mktemp, suspendLog, resumeLog, \
      getReplacedFunctionCallLog, clearReplacedFunctionCallLog
 
 import mixminion.BuildMessage as BuildMessage
+import mixminion.ClientAgent
+import mixminion.ClientDirectory
 import mixminion.ClientMain
 import mixminion.ClientUtils
 import mixminion.Config
@@ -72,13 +77,14 @@ import mixminion.directory.ServerList
 import mixminion.directory.ServerInbox
 import mixminion.directory.DirFormats
 import mixminion.directory.DirMain
+import mixminion.directory.DirSubmit
 import mixminion.directory.Directory
 from mixminion.Common import *
 from mixminion.Common import Log, _FileLogHandler, _ConsoleLogHandler
 from mixminion.Config import _ConfigFile, ConfigError, _parseInt
 from mixminion.Crypto import *
 from mixminion.Packet import *
-from mixminion.server.HashLog import HashLog
+from mixminion.server.HashLog import HashLog, MappedHashLog
 from mixminion.server.Modules import *
 from mixminion.server.PacketHandler import *
 from mixminion.server.ServerQueue import *
@@ -570,6 +576,36 @@ class MiscTests(TestCase):
         eq(21, fromSquareToSquare.spanLength())
         eq(33, fromFibToFib.spanLength())
 
+        # intersectionLengths
+        eq([], fromSquareToSquare.intersectionLengths([]))
+        eq([0,0], nil.intersectionLengths([(1,10),(10,20)]))
+        eq([2,7,6,1,0], fromSquareToSquare.intersectionLengths(
+            [(0,3),(3,15),(15,30),(35,50),(50,60)]))
+        # Overlapping intervals work too.
+        eq([21,6,9], fromSquareToSquare.intersectionLengths(
+            [(0,100),(1,12),(12,30)]))
+        for a in (fromPrimeToPrime, fromSquareToSquare, fromFibToFib):
+            days = [ (n, n+7) for n in xrange(0, 70, 7) ]
+            eq(a.intersectionLengths(days),
+               [ (a*IntervalSet([d])).spanLength() for d in days ])
+
+        # addInterval, containsInterval
+        for a in (nil, fromPrimeToPrime, fromSquareToSquare, fromFibToFib):
+            for s, e in [(0,1),(3,9),(8,8),(19,23),(4,40),(60,70),(-5,2)]:
+                b = a.copy()
+                b.addInterval(s, e)
+                self._intervalEq(b, a+IntervalSet([(s,e)]))
+                self.assertEquals(a.containsInterval(s, e),
+                                  IntervalSet([(s,e)]) in a)
+        a = IntervalSet()
+        for s, e in [(10,20),(30,40),(20,30),(5,6),(50,50),(6,7)]:
+            a.addInterval(s, e)
+        self._intervalEq(a, [(5,7),(10,40)])
+        self.assert_(a.containsInterval(10,40))
+        self.assert_(a.containsInterval(12,12))
+        self.assert_(not a.containsInterval(6,11))
+        self.assert_(not a.containsInterval(0,1))
+
     def _intervalEq(self, a, *others):
         eq = self.assertEquals
         for b in others:
@@ -1313,6 +1349,16 @@ class CryptoTests(TestCase):
         for i in xrange(100):
             self.failUnless(0 <= PRNG.getFloat() < 1)
 
+        # getInts and getFloats give the same values as getInt and getFloat.
+        P1, P2 = AESCounterPRNG(key), AESCounterPRNG(key)
+        for max in 1, 10, 1000, 0x2aaaaaab:
+            self.assertEquals(P1.getInts(max, 1000),
+                              [ P2.getInt(max) for _ in xrange(1000) ])
+        self.assertEquals(P1.getInts(10, 0), [])
+        self.assertEquals(P1.getFloats(100),
+                          [ P2.getFloat() for _ in xrange(100) ])
+        self.assertEquals(P1.getBytes(10), P2.getBytes(10))
+
         # Test the pick method
         lst = [1, 2, 3]
         count = [0,0,0,0]
@@ -1785,6 +1831,115 @@ class HashLogTests(TestCase):
 
         h[0].close()
 
+    def test_mappedHashlog(self):
+        import mixminion.server.HashLog as HL
+        if HL.fcntl is None:
+            print "[Skipping shared hashlog tests: no fcntl]",
+            return
+        fname = mix_mktemp(".hlog")
+        eq = self.assertEquals
+        hashes = [ sha1(str(i)) for i in xrange(1000) ]
+
+        # Start with a single-bucket table, so we have to grow it.
+        h = MappedHashLog(fname, "Xyzzy", nBuckets=1)
+        self.failIf(h.seenHash("a"*20))
+        self.failIf(h.seenHash("\000"*20))
+        h.logHash("a"*20)
+        h.logHash("\000"*20)
+        self.failUnless(h.seenHash("a"*20))
+        self.failUnless(h.seenHash("\000"*20))
+        self.failIf(h.seenHash("\000"*19+"a"))
+        eq(h.checkAndLogHash("a"*20), 1)
+        eq(h.checkAndLogHash("b"*20), 0)
+        eq(h.checkAndLogHash("b"*20), 1)
+        for x in hashes[:500]:
+            eq(h.checkAndLogHash(x), 0)
+        self.failUnless(h.nBuckets >= 500/(16*.75))
+        for x in hashes[:500]:
+            self.failUnless(h.seenHash(x))
+        self.failIf(h.seenHash(hashes[500]))
+        h.close()
+        # Every digest is logged once.
+        eq(os.stat(fname+".log")[stat.ST_SIZE], 28+503*20)
+
+        # Reopen; everything is still there.
+        h = MappedHashLog(fname, "Xyzzy")
+        for x in hashes[:500]+["a"*20, "b"*20, "\000"*20]:
+            self.failUnless(h.seenHash(x))
+        self.failIf(h.seenHash(hashes[500]))
+        # Digests logged after the last sync survive when the table is
+        # reopened.
+        for x in hashes[500:600]:
+            h.logHash(x)
+        h.table[32:36] = struct.pack("!L", 28)
+        h._closeTable()
+        os.close(h.logFD)
+        os.close(h.lockFD)
+        os.unlink(fname+".map")
+        h = MappedHashLog(fname, "Xyzzy")
+        for x in hashes[:600]:
+            self.failUnless(h.seenHash(x))
+        self.failIf(h.seenHash(hashes[600]))
+        h.close()
+
+        # A partial entry at the end of the log is discarded.
+        f = open(fname+".log", 'ab')
+        f.write("XXXX")
+        f.close()
+        try:
+            suspendLog()
+            h = MappedHashLog(fname, "Xyzzy")
+        finally:
+            s = resumeLog()
+        self.assert_(stringContains(s, "partial entry"))
+        self.failUnless(h.seenHash(hashes[599]))
+        h.close()
+        eq(os.stat(fname+".log")[stat.ST_SIZE], 28+603*20)
+
+        # The wrong key is an error.
+        self.assertRaises(MixFatalError, MappedHashLog, fname, "Plugh")
+
+        # Another process sharing the log sees our digests, and we see its.
+        if not hasattr(os, 'fork'):
+            return
+        h = MappedHashLog(fname, "Xyzzy")
+        # (Earlier tests may have installed a SIGCHLD handler that would
+        # reap our child before we can.)
+        oldHandler = signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Child.
+            os.close(r)
+            try:
+                h2 = MappedHashLog(fname, "Xyzzy")
+                n = 0
+                for x in hashes[500:]:
+                    if not h2.checkAndLogHash(x):
+                        n += 1
+                h2.close()
+                os.write(w, str(n))
+            finally:
+                os._exit(0)
+        os.close(w)
+        n = 0
+        for x in hashes[700:]:
+            if not h.checkAndLogHash(x):
+                n += 1
+        os.waitpid(pid, 0)
+        signal.signal(signal.SIGCHLD, oldHandler)
+        result = os.read(r, 100)
+        os.close(r)
+        # Between us, we added each of the 400 new digests exactly once.
+        eq(n + int(result), 400)
+        for x in hashes:
+            self.failUnless(h.seenHash(x))
+        h.close()
+        h = MappedHashLog(fname, "Xyzzy")
+        for x in hashes:
+            self.failUnless(h.seenHash(x))
+        h.close()
+
 #----------------------------------------------------------------------
 class NetUtilTests(TestCase):
     def testGetIP(self):
@@ -2617,6 +2772,34 @@ class BuildMessageTests(TestCase):
         repl2_bad = repl2[:-1] + chr(ord(repl2[-1])^0xaa)
         self.assertPayloadDecodesTo(None, repl2_bad, repl2tag, None, passwd)
 
+        # Now decode them all at once with a PayloadDecoder.
+        packets = [ (encoded1, "zzzz"*5), (efwd_p, efwd_t),
+                    (repl2, repl2tag), (efwd_pbad, efwd_t),
+                    (repl2_bad, repl2tag), (repl2, "\xff"+repl2tag[1:]) ]
+        userKeys = [ ("", "z"*20), ("Fred", passwd), ("Joe", passwd) ]
+        for nThreads in (1, 3):
+            decoder = BuildMessage.PayloadDecoder(rsa1, userKeys, nThreads)
+            self.assertEquals(len(decoder.userKeys), 2)
+            self.assertEquals(decoder.getCandidates(repl2tag),
+                              [ ("Fred", passwd, passwd+"Validate") ])
+            self.assertEquals(decoder.getCandidates("\xff"+repl2tag[1:]), [])
+            try:
+                suspendLog("INFO")
+                results = decoder.decodeAll(packets)
+            finally:
+                resumeLog()
+            self.assertEquals(len(results), 6)
+            for p, nym, err in results[:3]:
+                self.assertEquals(err, None)
+                self.assertEquals(payload, p.getUncompressedContents())
+            self.assertEquals([ r[1] for r in results ],
+                              [ [], [], ["Fred"], [], [], [] ])
+            self.assertEquals(results[3][0], None)
+            self.assert_(stringContains(results[3][2], "Invalid checksum"))
+            self.assertEquals(results[4], (None, [], None))
+            self.assertEquals(results[5], (None, [], None))
+        self.assertEquals(BuildMessage.PayloadDecoder().decodeAll([]), [])
+
 #----------------------------------------------------------------------
 # Having tested BuildMessage without using PacketHandler, we can now use
 # BuildMessage to see whether PacketHandler is doing the right thing.
@@ -3106,6 +3289,18 @@ class FilestoreTests(FStoreTestBase):
         self.assertEquals(queue1.count(), 41)
         self.assert_(not os.path.exists(os.path.join(self.d2, "msg_"+h)))
 
+        # test 'queueMessages'
+        hs = queue1.queueMessages([ "Batch %s"%i for i in range(5) ])
+        self.assertEquals(len(hs), 5)
+        self.assertEquals(queue1.count(), 46)
+        self.assertEquals(queue1.messageContents(hs[3]), "Batch 3")
+        self.assertEquals(queue1.queueMessages([]), [])
+        # If any message can't be written, none of them get queued.
+        self.failUnlessRaises(TypeError, queue1.queueMessages,
+                              [ "Batch 6", None ])
+        self.assertEquals(queue1.count(), 46)
+        for h in hs: queue1.removeMessage(h)
+
         # Test object functionality
         obj = [ ("A pair of strings", "in a tuple in a list") ]
         h1 = queue1.queueObject(obj)
@@ -3120,6 +3315,119 @@ class FilestoreTests(FStoreTestBase):
         queue1.cleanQueue(self.unlink)
         queue2.cleanQueue(self.unlink)
 
+    def testPoolIndex(self):
+        PoolIndex = mixminion.Filestore.PoolIndex
+        eq = self.assertEquals
+        rng = AESCounterPRNG("a"*16)
+
+        idx = PoolIndex([ (10, "C"), (5, "A"), (7, "B") ])
+        eq(idx.count(), 3)
+        eq(idx.getHandles(), ["A", "B", "C"])
+        eq(idx.countBefore(7), 1)
+        eq(idx.countBefore(8), 2)
+        eq(idx.countBefore(100), 3)
+        # Add enough messages to make the index compact and grow.
+        for i in xrange(100):
+            idx.add("m%s"%i, 20+i)
+        for i in xrange(0, 100, 2):
+            idx.remove("m%s"%i)
+        idx.remove("B")
+        idx.remove("nonesuch")
+        idx.add("A", 1000)
+        eq(idx.count(), 52)
+        eq(idx.getHandles()[:3], ["A", "C", "m1"])
+        eq(idx.countBefore(30), 7)
+        # A clock that goes backwards doesn't confuse us.
+        idx.add("late", 0)
+        eq(idx.countBefore(119), 51)
+        eq(idx.countBefore(120), 53)
+        eq(idx.getArrivalTime("late"), 119)
+        eq(idx.getArrivalTime("m1"), 21)
+        eq(idx.getArrivalTime("B"), None)
+        for i in xrange(100, 200):
+            idx.add("m%s"%i, 20+i)
+        eq(idx.count(), 153)
+
+        handles = idx.getHandles()
+        self.assertUnorderedEq(idx.pickRandom(rng), handles)
+        for n in 40, 10:
+            b = idx.pickRandom(rng, n)
+            eq(len(b), n)
+            self.assertUnorderedEq(b+[h for h in handles if h not in b],
+                                   handles)
+            self.failIf(b == idx.pickRandom(rng, n))
+        # Picking doesn't remove anything.
+        eq(idx.count(), 153)
+        eq(idx.getHandles(), handles)
+        self.assertUnorderedEq(idx.pickRandom(rng, 10, before=30),
+                               ["A", "C", "m1", "m3", "m5", "m7", "m9"])
+        b = idx.pickRandom(rng, 3, before=30)
+        eq(len(b), 3)
+        for h in b:
+            self.assert_(h in ["A", "C", "m1", "m3", "m5", "m7", "m9"])
+
+        eq(idx.pickWithProbability(rng, 0), [])
+        self.assertUnorderedEq(idx.pickWithProbability(rng, 1.0), handles)
+        for p, lo, hi in (.2, 10, 50), (.05, 1, 20):
+            sizes = []
+            for _ in xrange(20):
+                b = idx.pickWithProbability(rng, p)
+                for h in b:
+                    self.assert_(idx.slots.has_key(h))
+                    self.assertEquals(1, b.count(h))
+                sizes.append(len(b))
+            sizes.sort()
+            self.failIf(sizes[0] == sizes[-1])
+            self.assert_(lo < sizes[10] < hi)
+        # A PRNG may return 1.0 from getFloat(); we just draw again.
+        class FakePRNG:
+            def __init__(self, floats):
+                self.floats = floats
+            def getFloat(self):
+                return self.floats.pop(0)
+            def shuffle(self, lst):
+                return lst
+        eq(len(idx.pickWithProbability(FakePRNG([1.0, 0.0, 1.0, .999999]),
+                                       .05)), 1)
+
+        for h in handles:
+            idx.remove(h)
+        eq(idx.count(), 0)
+        eq(idx.pickRandom(rng, 5), [])
+        eq(idx.pickWithProbability(rng, .5), [])
+
+        # Now try a filestore that uses an index.
+        d = mix_mktemp("qi")
+        queue = mixminion.Filestore.StringStore(d, create=1)
+        h1 = queue.queueMessage("A")
+        # Without an index, we ask the filesystem when a message arrived.
+        os.utime(queue.getMessagePath(h1), (100, 100))
+        eq(queue.getArrivalTime(h1), 100)
+        queue.useIndex()
+        now = time.time()
+        h2 = queue.queueMessage("B")
+        h3 = queue.queueMessage("C")
+        eq(queue.count(), 3)
+        eq(queue.getArrivalTime(h1), 100)
+        self.assert_(now-1 <= queue.getArrivalTime(h3) <= time.time())
+        eq(queue.getArrivalTime("nonesuch"), None)
+        self.assertUnorderedEq(queue.getAllMessages(), [h1,h2,h3])
+        eq(queue.countBefore(time.time()+10), 3)
+        eq(queue.countBefore(0), 0)
+        eq(queue.pickRandom(5, before=0), [])
+        queue.removeMessage(h2)
+        eq(queue.count(), 2)
+        self.assertUnorderedEq(queue.pickRandom(), [h1,h3])
+        self.assertUnorderedEq(queue.pickWithProbability(1), [h1,h3])
+        # Somebody else adds a message; recounting notices.
+        mixminion.Filestore.StringStore(d).queueMessage("D")
+        eq(queue.count(), 2)
+        eq(queue.count(1), 3)
+        eq(len(queue.getAllMessages()), 3)
+        queue.removeAll(self.unlink)
+        eq(queue.count(), 0)
+        eq(queue.getAllMessages(), [])
+
     def testMetadataStores(self):
         d_d = mix_mktemp("q_md")
         Store = mixminion.Filestore.StringMetadataStore
@@ -3896,7 +4204,7 @@ TEST_PORT = 40199
 
 dhfile = pkfile = certfile = None
 
-def _getTLSContext(isServer):
+def _getTLSContext(isServer, sessionCacheSize=0):
     "Helper function: create a new TLSContext object."
     global dhfile
     global pkfile
@@ -3938,7 +4246,8 @@ def _getTLSContext(isServer):
                               time.time(), time.time()+365*24*60*60)
 
         pk = _ml.rsa_PEM_read_key(open(pkfile, 'r'), 0)
-        return _ml.TLSContext_new(certfile, pk, dhfile)
+        return _ml.TLSContext_new(certfile, pk, dhfile,
+                                  sessionCacheSize=sessionCacheSize)
     else:
         return _ml.TLSContext_new()
 
@@ -3947,7 +4256,7 @@ def _getTLSContextKeyID():
     keyid = sha1(ident.encode_key(1))
     return keyid
 
-def _getMMTPServer(minimal=0,reject=0,port=TEST_PORT):
+def _getMMTPServer(minimal=0,reject=0,port=TEST_PORT,sessions=0):
     """Helper function: create a new MMTP server with a listener connection
        Return a tuple of AsyncServer, ListenerConnection, list of received
        messages, and keyid."""
@@ -3957,7 +4266,7 @@ def _getMMTPServer(minimal=0,reject=0,port=TEST_PORT):
         m.append(pkt)
     server.nJunkPackets = 0
     def junkCallback(server=server): server.nJunkPackets += 1
-    def conFactory(sock, context=_getTLSContext(1),
+    def conFactory(sock, context=_getTLSContext(1,sessions),
                    receiveMessage=receivedHook,junkCallback=junkCallback,
                    reject=reject,server=server):
         tls = context.sock(sock, serverMode=1)
@@ -4116,6 +4425,344 @@ class MMTPTests(TestCase):
         self.assert_(passed < 2)
         self.assert_(timedout)
 
+    def testFairBandwidth(self):
+        class FakeCon:
+            def __init__(self, fd, outbuflen):
+                self.fd = fd
+                self.outbuflen = outbuflen
+                self.written = 0
+            def fileno(self):
+                return self.fd
+            def getStatus(self):
+                return 0, self.outbuflen > 0, 1
+            def process(self, r, w, x, cap):
+                n = 0
+                if w:
+                    n = self.outbuflen
+                    if cap is not None:
+                        n = min(cap, n)
+                    self.outbuflen -= n
+                    self.written += n
+                return 0, self.outbuflen > 0, 1, n
+        server = mixminion.server.MMTPServer.SelectAsyncServer()
+        server._isMetered = lambda c: 1
+        Q = server.QUANTUM
+        server.setBandwidth(20*Q, 20*Q)
+        self.assertEquals(server.writeBucket, 10*Q)
+        bulk = [ FakeCon(fd, 1L<<40) for fd in 1,2,3 ]
+        ack = FakeCon(4, 30)
+        for c in bulk+[ack]:
+            server.register(c)
+
+        # The acknowledgment goes first; each bulk writer gets a quantum
+        # on every pass, until the bucket is empty.
+        active = [ (c.fd, c, 0, 1, 0) for c in [ack]+bulk ]
+        server._processActive(active)
+        self.assertEquals(ack.written, 30)
+        self.assertEquals(server.state[4], (0,0))
+        self.assertEquals([ c.written for c in bulk ], [Q, Q, Q])
+        self.assertEquals(server.throttled, (0,0))
+        while not server.throttled[1]:
+            server._processActive([ (c.fd, c, 0, 1, 0) for c in bulk ])
+        self.assert_(abs(sum([c.written for c in bulk]) - (10*Q-30)) < 600)
+        self.assert_(server.writeBucket < server.PRIORITY_WRITE_LEN)
+        # While we're throttled, we don't wait to write bulk data, but we
+        # still read, and still write acknowledgments.
+        self.assertEquals(server._getInterest(bulk[0], 1, 1), (1, 0))
+        ack.outbuflen = 30
+        self.assertEquals(server._getInterest(ack, 1, 1), (1, 1))
+        # We wake up when there's enough bandwidth for another quantum.
+        t = server._refill(10, now=server.lastRefill)
+        self.assertFloatEq(t, (Q-server.writeBucket) / (10.0*Q))
+
+        # Over many rounds, each bulk writer gets the same share.
+        for _ in xrange(30):
+            server.writeBucket = 10*Q
+            server._processActive([ (c.fd, c, 0, 1, 0) for c in bulk ])
+        written = [ c.written for c in bulk ]
+        self.assert_(max(written)-min(written) <= 2*Q)
+        self.assert_(sum(written) >= 30*3*Q)
+
+        # Without a limit, everybody writes everything.
+        server.setBandwidth(None)
+        self.assertEquals(server.throttled, (0,0))
+        small = FakeCon(5, 100000)
+        server.register(small)
+        server._processActive([(5, small, 0, 1, 0)])
+        self.assertEquals(small.written, 100000)
+        self.failIf(server.connections.has_key(5) and server.state[5][1])
+
+    def testSessionResumption(self):
+        self.doTest(self._testSessionResumption)
+
+    def testTLSSessionCache(self):
+        cache = mixminion.MMTPClient.TLSSessionCache(maxSessions=3,
+                                                     lifetime=100)
+        now = time.time()
+        a, b, c, d = [ ("10.0.0.%s"%i, 48099, "Z"*20) for i in 1,2,3,4 ]
+        self.assertEquals(cache.get(a), None)
+        cache.put(a, "session-a", now)
+        cache.put(b, "session-b", now+10)
+        self.assertEquals(cache.get(a, now+50), "session-a")
+        # Sessions expire.
+        self.assertEquals(cache.get(a, now+101), None)
+        self.assertEquals(cache.sessions.keys(), [b])
+        # When the cache is full, expired sessions go first...
+        cache.put(a, "session-a", now)
+        cache.put(c, "session-c", now+20)
+        cache.put(d, "session-d", now+101)
+        self.assertEquals(cache.get(a, now+101), None)
+        self.assertEquals(cache.get(d, now+101), "session-d")
+        # ...then the ones that would expire soonest.
+        cache.put(a, "session-a2", now+102)
+        self.assertEquals(cache.get(b, now+102), None)
+        self.assertEquals(len(cache.sessions), 3)
+        self.assertEquals(cache.get(a, now+102), "session-a2")
+        # Replacing a session doesn't evict anything.
+        cache.put(a, "session-a3", now+102)
+        self.assertEquals(len(cache.sessions), 3)
+        cache.remove(a)
+        cache.remove(a)
+        self.assertEquals(cache.get(a, now+102), None)
+        cache.clear()
+        self.assertEquals(cache.sessions, {})
+
+    def _testSessionResumption(self):
+        server, listener, packetsIn, keyid = _getMMTPServer(sessions=16)
+        self.listener = listener
+        self.server = server
+
+        class ClientCon(mixminion.MMTPClient.MMTPClientConnection):
+            reused = None
+            def onConnected(self):
+                self.reused = self.tls.session_reused()
+                mixminion.MMTPClient.MMTPClientConnection.onConnected(self)
+        sessionCache = mixminion.MMTPClient.TLSSessionCache()
+        certCache = mixminion.MMTPClient.PeerCertificateCache()
+        context = _getTLSContext(0)
+        packets = ["helloxxx"*4096, "helloyyy"*4096]
+        reused = []
+        # The first connection does a full handshake; the second resumes
+        # its session.
+        for i in xrange(2):
+            client = mixminion.server.MMTPServer.AsyncServer()
+            con = ClientCon(socket.AF_INET, "127.0.0.1", TEST_PORT, keyid,
+                            context=context, certCache=certCache,
+                            sessionCache=sessionCache)
+            con.addPacket(FakeDeliverable(packets[i]))
+            client.register(con)
+            for _ in xrange(200):
+                if con.sock is None:
+                    break
+                client.process(0.05)
+                server.process(0.05)
+            reused.append(con.reused)
+
+        self.assertEquals(packetsIn, packets)
+        self.assertEquals(reused, [0, 1])
+        self.assertEquals(len(sessionCache.sessions), 1)
+
+    def testFrontEndPool(self):
+        import mixminion.server.MMTPFrontEnd as FE
+        if not FE.canRunFrontEnds():
+            return
+        class FakeServer(mixminion.server.MMTPServer.AsyncServer):
+            def __init__(self):
+                mixminion.server.MMTPServer.AsyncServer.__init__(self)
+                self.deferAcks = 1
+                self.pingLog = None
+                self.received = []
+            def onPacketReceived(self, pkt, ack=None):
+                self.received.append((pkt, ack))
+        class FakeDeliverable:
+            def __init__(self):
+                self.result = None
+            def succeeded(self):
+                self.result = "OK"
+            def failed(self, retriable=0):
+                self.result = ("FAIL", retriable)
+            def getContents(self):
+                return "Z"*(1<<15)
+            def isJunk(self):
+                return 0
+        server = FakeServer()
+        pool = FE.FrontEndPool(server)
+        core, worker = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        fe = FE._FrontEnd(-1, None)
+        fe.channel = FE._Channel(core, server,
+                                 lambda t,b,pool=pool,fe=fe:
+                                       pool._handleMessage(fe, t, b),
+                                 lambda pool=pool,fe=fe: pool._closed(fe))
+        server.register(fe.channel)
+        # The worker side of the channel just records what it gets.
+        got = []
+        wChannel = FE._Channel(worker, server,
+                               lambda t,b,got=got: got.append((t,b)),
+                               lambda: None)
+        server.register(wChannel)
+        def pump(test, server=server):
+            for _ in xrange(100):
+                if test(): return
+                server.process(0.05)
+        try:
+            # Packets from the worker reach the server, in order, with
+            # acknowledgments that go back to the right worker.
+            pkt1, pkt2 = "X"*(1<<15), "Y"*(1<<15)
+            wChannel.send(FE.MSG_PACKET, "\0\0\0\1"+pkt1)
+            wChannel.send(FE.MSG_PACKET, "\0\0\0\2"+pkt2)
+            pump(lambda server=server: len(server.received) == 2)
+            self.assertEquals([p for p,a in server.received], [pkt1, pkt2])
+            server.received[1][1].release(0)
+            server.received[0][1].release(1)
+            pump(lambda got=got: len(got) == 2)
+            self.assertEquals(got, [(FE.MSG_ACK, "\0\0\0\2\0"),
+                                    (FE.MSG_ACK, "\0\0\0\1\1")])
+
+            # Outgoing packets go to the worker, and it reports the results.
+            del got[:]
+            ds = [ FakeDeliverable() for _ in xrange(3) ]
+            pool.frontEnds.append(fe)
+            server._isKnownServer = lambda keyID: keyID == "Z"*20
+            pool.sendPackets(socket.AF_INET, "10.0.0.1", 48099, "Z"*20, ds,
+                             "server")
+            pump(lambda got=got: len(got) == 1)
+            self.assertEquals(got[0][0], FE.MSG_DELIVER)
+            family, ip, port, keyID, name, known, pkts = \
+                    cPickle.loads(got[0][1])
+            self.assertEquals((ip, port, name, known),
+                              ("10.0.0.1", 48099, "server", 1))
+            self.assertEquals(len(pkts), 3)
+            wChannel.send(FE.MSG_RESULT, pkts[0][0]+"\x01\x00")
+            wChannel.send(FE.MSG_RESULT, pkts[1][0]+"\x00\x00")
+            pump(lambda ds=ds: ds[1].result is not None)
+            self.assertEquals(ds[0].result, "OK")
+            self.assertEquals(ds[1].result, ("FAIL", 0))
+            self.assertEquals(ds[2].result, None)
+
+            # Keys only go out to the front ends when they change.
+            del got[:]
+            k1, k2 = getRSAKey(0,1024), getRSAKey(1,1024)
+            pool.setKeys(("cert", k1, "dh"))
+            pool.setKeys(("cert", k1, "dh"))
+            pool.setKeys(("cert", k2, "dh"))
+            pump(lambda got=got: len(got) == 2)
+            server.process(0.05)
+            self.assertEquals([t for t,b in got], [FE.MSG_KEYS]*2)
+            self.assertEquals(cPickle.loads(got[1][1])[1],
+                              Crypto.pk_encode_private_key(k2))
+
+            # If the worker goes away, its undelivered packets are retried.
+            suspendLog()
+            try:
+                wChannel.close()
+                pump(lambda fe=fe: fe.channel.isShutdown())
+            finally:
+                s = resumeLog()
+            self.assert_(stringContains(s, "front end -1 has exited"))
+            self.assertEquals(ds[2].result, ("FAIL", 1))
+            self.failIf(pool.isAlive())
+        finally:
+            wChannel.close()
+            fe.channel.close()
+
+    def testDeferredAcks(self):
+        MMTPServer = mixminion.server.MMTPServer
+        ServerMain = mixminion.server.ServerMain
+        class FakeIncomingQueue:
+            def __init__(self):
+                self.batches = []
+                self.fail = 0
+            def queuePackets(self, pkts, traceIDs=None):
+                if self.fail:
+                    raise IOError("Disk full")
+                self.batches.append(pkts)
+        class AckServer(ServerMain._MMTPServer):
+            # Just enough of an MMTP server to hand off packets and
+            # release their acknowledgments.
+            def __init__(self):
+                self.connections = {}
+                self.ackQueue = mixminion.ThreadUtils.MessageQueue()
+                self.wakeup = None
+                self.nReleased = 0
+            def releaseAck(self, ack, ok):
+                ServerMain._MMTPServer.releaseAck(self, ack, ok)
+                self.nReleased += 1
+        incoming = FakeIncomingQueue()
+        writer = ServerMain.IncomingWriterThread(incoming)
+        server = AckServer()
+        server.connectQueues(incoming=None, outgoing=None,
+                             incomingWriter=writer)
+        self.assert_(server.deferAcks)
+        sock, other = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        con = MMTPServer.MMTPServerConnection(sock, None,
+                                              server.onPacketReceived,
+                                              serverName="client",
+                                              deferAcks=1)
+        con.protocolWritten(0)
+        maxUnacked = con.MAX_UNACKED_PACKETS
+        pkts = [ ("%04d"%i)*(1<<13) for i in xrange(maxUnacked+3) ]
+        def waitForReleases(n, server=server):
+            for _ in xrange(200):
+                if server.nReleased >= n: return
+                time.sleep(.05)
+        try:
+            for pkt in pkts:
+                con.inbuf.append(MMTPServer.SEND_CONTROL+pkt+
+                                 sha1(pkt+"SEND"))
+                con.inbuflen += con.MESSAGE_LEN
+            con.onDataRead()
+            # We stop reading once too many packets are waiting to be stored,
+            # and acknowledge nothing until they are.
+            self.assert_(con._throttled)
+            self.assertEquals(con.wantRead, 0)
+            self.assertEquals(con.inbuflen, 3*con.MESSAGE_LEN)
+            self.assertEquals(len(con._acks), maxUnacked)
+            self.assertEquals(con.outbuf, [])
+
+            writer.start()
+            waitForReleases(maxUnacked)
+            self.assertEquals(incoming.batches, [pkts[:maxUnacked]])
+            released = []
+            for _ in xrange(maxUnacked):
+                released.append(server.ackQueue.get(block=0))
+            # Acknowledgments go out in the order we got the packets, no
+            # matter what order they're released in.
+            incoming.fail = 1
+            released.reverse()
+            for ack, ok in released[:-1]:
+                self.assert_(ok)
+                ack.release(ok)
+            self.assertEquals(con.outbuf, [])
+            self.assert_(con._throttled)
+            ack, ok = released[-1]
+            suspendLog()
+            try:
+                ack.release(ok)
+                self.assertEquals(con.outbuf,
+                       [ MMTPServer.RECEIVED_CONTROL+sha1(pkt+"RECEIVED")
+                         for pkt in pkts[:maxUnacked] ])
+                # Once they're out, we read the rest of the packets.
+                self.failIf(con._throttled)
+                self.assertEquals(con.wantRead, 1)
+                self.assertEquals(con.inbuflen, 0)
+                # If we can't store them, we reject them.
+                waitForReleases(maxUnacked+3)
+            finally:
+                s = resumeLog()
+            self.assert_(stringContains(s, "Couldn't store"))
+            del con.outbuf[:]
+            server._releaseQueuedAcks()
+            self.assertEquals(con.outbuf,
+                       [ MMTPServer.REJECTED_CONTROL+sha1(pkt+"REJECTED")
+                         for pkt in pkts[maxUnacked:] ])
+            self.assertEquals(con._acks, [])
+        finally:
+            if writer.isAlive():
+                writer.shutdown()
+                writer.join()
+            sock.close()
+            other.close()
+
     def _testNonblockingTransmission(self):
         server, listener, packetsIn, keyid = _getMMTPServer()
         self.listener = listener
@@ -4429,6 +5076,25 @@ IntRS=5
         self.assertEquals(f['Sec1']['Foo'], "Bar")
         self.assertEquals(f['Sec3']['IntRS'], 9)
 
+        # The single-pass reader for restricted files gives the same
+        # results as reading them a line at a time, good or bad.
+        for s in ("[Sec1]\n Foo :  Bar  \nBaz:\n[ Sec3 ]x\nIntRS:9",
+                  "[Sec1]\nFoo: a:b\n", "[Sec1]\nFoo: a\n\n",
+                  "Foo: Bar\n", "[Sec1]\n: x\n", "[Sec1]\nFoo: Bar\v\n",
+                  "[Sec 1]\n", "[Sec1]\n#Foo: Bar\n", " \n", ""):
+            r = []
+            for fn in (mixminion.Config._readRestrictedConfigFile,
+                       mixminion.Config._readRestrictedConfigFileByLine):
+                try:
+                    r.append(fn(s))
+                except ConfigError, e:
+                    r.append(str(e))
+            self.assertEquals(r[0], r[1])
+        self.assertEquals(mixminion.Config._readRestrictedConfigFile(
+            "[Sec1]\n Foo :  Bar  \nBaz:\n[ Sec3 ]x\nIntRS:9"),
+            [ ("Sec1", [("Foo", "Bar", 2), ("Baz", "", 3)]),
+              ("Sec3", [("IntRS", "9", 5)]) ])
+
     def testBadFiles(self):
         def fails(string, self=self):
             self.failUnlessRaises(ConfigError, TestConfigFile, None, string)
@@ -4568,6 +5234,12 @@ IntRS=5
         # Hex
         self.assertEquals(C._parseHex(" C0D0"), "\xC0\xD0")
         self.assertEquals(C._parseHex(" C0\n D 0"), "\xC0\xD0")
+        # Public keys are only decoded once.
+        pk = getRSAKey(0,1024)
+        enc = formatBase64(pk_encode_public_key(pk))
+        k1 = C._parsePublicKey(enc)
+        self.assertEquals(pk_get_modulus(k1), pk_get_modulus(pk))
+        self.assert_(C._parsePublicKey(" "+enc) is k1)
         # Date
         tm = C._parseDate("2002/05/30")
         self.assertEquals(time.gmtime(tm)[:6], (2002,5,30,0,0,0))
@@ -5052,6 +5724,24 @@ IP: 192.168.0.99
         self.assert_(not bobs[1].isSupersededBy([]))
         self.assert_(not bobs[1].isSupersededBy([bobs[1]]))
         self.assert_(not bobs[1].isSupersededBy([freds[2]]))
+        # getSupersededServers must agree with isSupersededBy.
+        everyone = bobs + freds + bobs[2:4]
+        self.assertEquals(
+            mixminion.ServerInfo.getSupersededServers(everyone),
+            [ s for s in everyone if s.isSupersededBy(everyone) ])
+        self.assertEquals(
+            mixminion.ServerInfo.getSupersededServers([bobs[1],bobs[3]]),
+            [])
+        self.assertEquals(mixminion.ServerInfo.getSupersededServers([]), [])
+        # Entries published together never supersede one another.
+        findSuperseded = mixminion.ServerInfo.findSuperseded
+        self.assertEquals(findSuperseded(
+            [("a",10,0,100,"x"), ("a",10,0,50,"y"), ("a",20,0,60,"z"),
+             ("a",30,40,100,"w"), ("b",40,0,100,"v"), ("a",5,3,3,"u")]),
+            ["x", "y", "u"])
+        self.assertEquals(findSuperseded(
+            [("a",20,0,60,"z"), ("a",10,0,100,"x"), ("a",30,61,100,"w")]),
+            [])
 
         # Test whether we ignore server descriptors with unknown versions.
         try:
@@ -5129,6 +5819,87 @@ IP: 192.168.100.4
         info3 = key3.getServerDescriptor()
         eq(info3['Incoming/MMTP']['Hostname'], "Theserver4")
 
+    def testCompactServerInfo(self):
+        eq = self.assertEquals
+        SI = mixminion.ServerInfo.ServerInfo
+        CSI = mixminion.ServerInfo.CompactServerInfo
+        examples = getExampleServerDescriptors()
+        bobs = [ SI(string=s, _keepContents=1) for s in examples["Bob"] ]
+        cbobs = [ CSI(s) for s in bobs ]
+        now = time.time()
+
+        # A CompactServerInfo answers just like the ServerInfo it came from.
+        for s, c in zip(bobs, cbobs):
+            for fn in ("getNickname", "getDigest", "getHostname", "getPort",
+                       "getKeyDigest", "getIdentityDigest", "getPublished",
+                       "getValidAfter", "getValidUntil", "getCaps",
+                       "getIncomingMMTPProtocols", "getOutgoingMMTPProtocols",
+                       "getPacketVersions", "supportsPacketVersion",
+                       "isValidated", "getIdentityFingerprint",
+                       "getSoftware"):
+                eq(getattr(s, fn)(), getattr(c, fn)())
+            eq(s.getRoutingInfo().pack(), c.getRoutingInfo().pack())
+            eq(s.isValidAt(now), c.isValidAt(now))
+            eq(s.isSupersededBy(bobs), c.isSupersededBy(cbobs))
+            self.assert_(c.isSameDescriptorAs(s) and s.isSameDescriptorAs(c))
+            self.assert_(not c.isNewerThan(s) and not s.isNewerThan(c))
+            self.assert_(pk_same_public_key(s.getIdentity(), c.getIdentity()))
+            self.assert_(pk_same_public_key(s.getPacketKey(),
+                                            c.getPacketKey()))
+            eq(c['Delivery/MBOX'], s['Delivery/MBOX'])
+            eq(c.get('Delivery/SMTP'), s.get('Delivery/SMTP'))
+            eq(c.getFeature('Delivery/MBOX','Maximum-Size'),
+               s.getFeature('Delivery/MBOX','Maximum-Size'))
+            eq(c.getFeature('-','caps'), s.getFeature('-','caps'))
+            # Other sections come from parsing the text again.
+            self.failIf(c.holdsSection('Testing'))
+            eq(c['Testing'], s['Testing'])
+            eq(c.get('Nonesuch', 3), 3)
+            eq(c.getFeature('Server','Contact'),
+               s.getFeature('Server','Contact'))
+        eq(mixminion.ServerInfo.getSupersededServers(cbobs),
+           [ c for c in cbobs if c.isSupersededBy(cbobs) ])
+
+        # Values that descriptors have in common are only stored once.
+        self.assert_(cbobs[0]._identity is cbobs[1]._identity)
+        self.assert_(cbobs[0]._nickname is cbobs[1]._nickname)
+
+        # Pickling.
+        for binary in 0, 1:
+            c = cPickle.loads(cPickle.dumps(cbobs[1], binary))
+            eq(c.getDigest(), cbobs[1].getDigest())
+            eq(c._originalContents, examples["Bob"][1])
+            self.assert_(c._identity is cbobs[1]._identity)
+            self.assert_(c.isSupersededBy(cbobs))
+        self.assertRaises(ValueError, c.__setstate__, ("X", 1))
+
+        # Checking which exits support an address doesn't parse anything
+        # again.
+        exits = []
+        for name in "Joe", "Lola", "Fred":
+            exits.extend([ SI(string=s, _keepContents=1)
+                           for s in examples[name] ])
+        cexits = [ CSI(s) for s in exits ]
+        parseAddress = mixminion.ClientDirectory.parseAddress
+        email = parseAddress("smtp:foo@bar.com")
+        email.setHeaders({"FROM" : "Alice"})
+        email.setExitSize(20*1024)
+        fragEmail = parseAddress("foo@bar.com")
+        fragEmail.setFragmented(1, 3)
+        mbox = parseAddress("mbox:bob")
+        parsed = []
+        getServerInfo = CSI.__dict__['getServerInfo']
+        CSI.getServerInfo = lambda self, parsed=parsed: parsed.append(self)
+        try:
+            for addr in email, fragEmail, mbox:
+                eq(map(addr.isSupportedByServer, cexits),
+                   map(addr.isSupportedByServer, exits))
+        finally:
+            CSI.getServerInfo = getServerInfo
+        eq(parsed, [])
+        self.assert_(email.isSupportedByServer(cexits[0]))
+        self.failIf(mbox.isSupportedByServer(cexits[0]))
+
 
 #----------------------------------------------------------------------
 # Directories
@@ -5356,6 +6127,259 @@ class DirectoryServerTests(TestCase):
             id0, voters, va,
             [ ("voter1",s_vote1), ("voter2",s_vote2), ("voter3",s_vote3) ],
             vd1)
+        consensus = SI.SignedDirectory(string=s_voted1)
+        self.assertEquals(consensus['Directory-Info']['Status'], "consensus")
+        self.assertEquals(consensus.getSigners(), [(keyid0, ub0)])
+        self.assert_(DF.serverListIsSorted(consensus.getAllServers()))
+        # Every descriptor we validated is now in vd1.
+        for s in consensus.getAllServers():
+            self.assert_(vd1.has_key(s.getDigest()))
+
+        # Checking the votes in several processes gives the same result;
+        # so does giving a vote more than once.  A vote with a broken
+        # descriptor is dropped.
+        def unsigned(d):
+            return d[d.index("[Directory-Info]"):]
+        broken = s_vote3.replace("\nPublished: ", "\nPublished: X", 1)
+        s_voted2 = DF.generateConsensusDirectory(
+            id0, voters, va,
+            [ ("voter1",s_vote1), ("voter2",s_vote2), ("voter3",s_vote3),
+              ("voter3b",s_vote3), ("voter4",broken) ],
+            nWorkers=3)
+        self.assertEquals(unsigned(s_voted1), unsigned(s_voted2))
+
+        # The fork-based map works, and reports errors from workers.
+        self.assertEquals(DF._forkMap(lambda x: x*x, range(10), 3),
+                          [ x*x for x in range(10) ])
+        self.assertRaises(MixError, DF._forkMap, lambda x: 1/x,
+                          [1,2,0,3], 2)
+
+    def testServerStore(self):
+        eq = self.assertEquals
+        DF = mixminion.directory.DirFormats
+        SI = mixminion.ServerInfo.ServerInfo
+        ServerStore = mixminion.directory.ServerList.ServerStore
+        examples = getExampleServerDescriptors()
+        d = mix_mktemp()
+        storeDir = os.path.join(d, "servers")
+        dbFile = os.path.join(d, "status")
+        createPrivateDir(d)
+
+        # Check the interval index against a linear scan.
+        idx = mixminion.directory.ServerList._IntervalIndex()
+        ivals = {}
+        rng = Crypto.getCommonPRNG()
+        for i in xrange(200):
+            start = rng.getInt(1000)
+            ivals[i] = (start, start+1+rng.getInt(100))
+            idx.add(i, ivals[i][0], ivals[i][1])
+        idx.remove(7)
+        del ivals[7]
+        for lo, hi in (0,1), (10,20), (500,501), (999,2000), (0,2000):
+            expected = [ k for k,(s,e) in ivals.items() if s < hi and e > lo ]
+            self.assertUnorderedEq(idx.getOverlapping(lo, hi), expected)
+
+        # Add some servers, and look them up by the indices.
+        store = ServerStore(storeDir, dbFile)
+        servers = {}
+        for nick, n in ("Fred",1), ("Fred",2), ("Lola",0), ("Lola",1), \
+                ("Joe",0):
+            si = SI(string=examples[nick][n], _keepContents=1)
+            servers[store.addServer(si)] = si
+        fredKeys = [ k for k,s in servers.items()
+                     if s.getNickname() == 'Fred' ]
+        self.assertUnorderedEq(store.getByNickname("Fred"), fredKeys)
+        eq(store.getByNickname("fred"), [])
+        eq(store.getByNickname("nobody"), [])
+        joe = [ s for s in servers.values() if s.getNickname() == 'Joe' ][0]
+        self.assert_(store._getKey(joe.getDigest()) in
+                     store.getByIdentityDigest(joe.getKeyDigest()))
+        now = time.time()
+        def live(startAt, endAt, servers=servers):
+            return [ k for k,s in servers.items()
+                     if s['Server']['Valid-After'] < endAt and
+                        s['Server']['Valid-Until'] > startAt ]
+        liveNow = live(now, now+1)
+        self.assertUnorderedEq(store.getByLiveness(now, now+1), liveNow)
+        self.assertUnorderedEq(store.getByLiveness(0, now*2), servers.keys())
+        for s in servers.values():
+            self.assert_(store._validatedDigests.has_key(s.getDigest()))
+        c = store.loadServer(store._getKey(joe.getDigest()))
+        self.assert_(isinstance(c, mixminion.ServerInfo.CompactServerInfo))
+        self.assert_(c.isSameDescriptorAs(joe))
+        self.assert_(store.loadServer(store._getKey(joe.getDigest())) is c)
+        # Cleaning drops cached descriptors we no longer hold.
+        store._parsed["X"*27] = c
+        store._texts["X"*27] = c._originalContents
+        store.clean()
+        self.assert_(not store._parsed.has_key("X"*27))
+        self.assert_(not store._texts.has_key("X"*27))
+        self.assert_(store._parsed.has_key(store._getKey(joe.getDigest())))
+
+        # Server text comes out in directory order, and is reused when
+        # nothing has changed.
+        text = store.getServerText(liveNow)
+        eq(text, "".join([ s._originalContents for s in DF.sortServerList(
+            [ servers[k] for k in liveNow ]) ]))
+        self.assert_(store.getServerText(liveNow) is text)
+
+        # Reopen the store: the indices should come back from disk.
+        store.close()
+        self.assert_(os.path.exists(dbFile+".idx"))
+        store = ServerStore(storeDir, dbFile)
+        eq(store._indexDirty, 0)
+        self.assertUnorderedEq(store.getByNickname("Fred"), fredKeys)
+        self.assertUnorderedEq(store.getByLiveness(now, now+1), liveNow)
+        for s in servers.values():
+            self.assert_(store._validatedDigests.has_key(s.getDigest()))
+
+        # Deleting a server removes it from every index.
+        store.delServer(fredKeys[0])
+        eq(store.getByNickname("Fred"), fredKeys[1:])
+        self.assert_(fredKeys[0] not in store.getByLiveness(0, now*2))
+        store.close()
+
+        # If the index doesn't match the status cache, we rebuild it.
+        store = ServerStore(storeDir, dbFile)
+        eq(store._indexDirty, 0)
+        store._statusDB[fredKeys[0]] = \
+                 store._statusDB.get(fredKeys[1])
+        store._statusDB.close()
+        store = ServerStore(storeDir, dbFile)
+        eq(store._indexDirty, 1)
+        eq(len(store.getByNickname("Fred")), 2)
+        store.close()
+
+        # Publishing a compressed directory.
+        fn = os.path.join(d, "dir")
+        writeFile(fn, text)
+        mixminion.directory.DirMain.publishFile(fn, fn+".gz")
+        eq(readPossiblyGzippedFile(fn+".gz"), text)
+        self.assert_(not os.path.exists(fn+".gz.tmp"))
+
+    def testSubmissionQueue(self):
+        eq = self.assertEquals
+        DS = mixminion.directory.DirSubmit
+        ServerQueuedException = \
+                mixminion.directory.ServerInbox.ServerQueuedException
+        examples = getExampleServerDescriptors()
+        class FakeInbox:
+            def __init__(self):
+                self.received = []
+            def acceptServer(self, server, source):
+                self.received.append(server.getNickname())
+                if server.getNickname() == 'Lola':
+                    raise ServerQueuedException("Queued for checking")
+                elif server.getNickname() == 'Joe':
+                    raise UIError("I don't like Joe")
+                return 1
+        inbox = FakeInbox()
+        d = mix_mktemp()
+
+        # Descriptors queued while nobody is checking them stay on disk.
+        q = DS.SubmissionQueue(inbox, d)
+        id0, = q.submit([examples['Lola'][1]], "src0")
+        eq(q.getStatus(id0)[0], "queued")
+        eq(q.store.count(), 1)
+
+        q = DS.SubmissionQueue(inbox, d, nThreads=2)
+        q.start()
+        try:
+            eq(q.waitFor(id0, 30), ("pending", "Queued for checking"))
+            texts = [ examples['Fred'][1], examples['Joe'][0],
+                      examples['Fred'][1], "[Server]\nNickname: x\n" ]
+            ids = q.submit(texts, "src1")
+            eq(ids[0], ids[2])
+            eq(ids[0], DS.getSubmissionID(examples['Fred'][1]))
+            results = [ q.waitFor(id, 30) for id in ids ]
+            eq(results[0], ("accepted", "Accepted."))
+            eq(results[1], ("rejected", "I don't like Joe"))
+            eq(results[2], results[0])
+            eq(results[3][0], "rejected")
+            self.assertStartsWith(results[3][1],
+                                  "Server descriptor was not valid")
+            # (Two workers: Fred and Joe may be checked in either order.)
+            eq(inbox.received[0], "Lola")
+            self.assertUnorderedEq(inbox.received[1:], ["Fred", "Joe"])
+            eq(q.getStatus("0"*40), ("unknown", "No such submission"))
+
+            # Submitting again is answered from the cache.
+            q.submit([examples['Fred'][1]], "src2")
+            eq(q.getStatus(ids[0])[0], "accepted")
+            eq(len(inbox.received), 3)
+
+            # Try it over HTTP.  (With one handler slot, the second
+            # request only gets handled if the first one gave its slot
+            # back.)
+            server = DS._ThreadingHTTPServer(("127.0.0.1", 0),
+                                             DS.SubmissionHandler,
+                                             maxHandlers=1)
+            server.submissions = q
+            t = threading.Thread(target=server.handle_request)
+            t.start()
+            def request(method, path, body=None,
+                        port=server.server_address[1]):
+                conn = httplib.HTTPConnection("127.0.0.1", port)
+                conn.request(method, path, body,
+                    {"Content-Type": "application/x-www-form-urlencoded"})
+                r = conn.getresponse()
+                reply = r.read()
+                conn.close()
+                return reply
+            reply = request("POST", "/publish", urllib.urlencode(
+                [("desc", examples['Alice'][0]), ("desc", texts[0])]))
+            t.join()
+            aliceID = DS.getSubmissionID(examples['Alice'][0])
+            self.assert_(stringContains(reply, "Submission: %s\n"%aliceID))
+            self.assert_(stringContains(reply, DS.formatStatus(
+                ids[0], "accepted", "Accepted.")))
+            q.waitFor(aliceID, 30)
+            t = threading.Thread(target=server.handle_request)
+            t.start()
+            reply = request("GET", "/status?id=%s&id=%s"%(aliceID,ids[1]))
+            t.join()
+            server.server_close()
+            eq(reply, DS.formatStatus(aliceID, "accepted", "Accepted.")+
+                      DS.formatStatus(ids[1], "rejected",
+                                      "I don't like Joe"))
+        finally:
+            q.shutdown()
+        eq(q.store.count(1), 0)
+
+        # When too many descriptors are waiting, new ones are turned away
+        # until there's room, and aren't remembered as submitted.
+        q = DS.SubmissionQueue(inbox, mix_mktemp())
+        try:
+            replaceAttribute(DS, "MAX_QUEUED", 1)
+            fredID, aliceID = q.submit([examples['Fred'][1],
+                                        examples['Alice'][0]], "src3")
+            eq(q.getStatus(fredID)[0], "queued")
+            eq(q.getStatus(aliceID)[0], "busy")
+            q.submit([examples['Alice'][0]], "src3")
+            eq(q.getStatus(aliceID)[0], "busy")
+            eq(q.store.count(), 1)
+            replaceAttribute(DS, "MAX_QUEUED", 2)
+            q.submit([examples['Alice'][0]], "src3")
+            eq(q.getStatus(aliceID)[0], "queued")
+            eq(q.store.count(), 2)
+            eq(q.nQueued, 2)
+
+            # Old results and digests are forgotten; queued ones aren't.
+            now = time.time()
+            old = now - DS.STATUS_LIFETIME - 10
+            q.status["A"*40] = ("accepted", "Accepted.", old)
+            q.status["B"*40] = ("rejected", "No.", now-20)
+            q.status["C"*40] = ("accepted", "Accepted.", now-10)
+            q.status[fredID] = ("queued", "Waiting to be checked", old)
+            q.validatedDigests["d1"] = old
+            q.validatedDigests["d2"] = now
+            replaceAttribute(DS, "MAX_STATUS_ENTRIES", 1)
+            q._expire(now)
+            self.assertUnorderedEq(q.status.keys(),
+                                   [fredID, aliceID, "C"*40])
+            eq(q.validatedDigests.keys(), ["d2"])
+        finally:
+            undoReplacedAttributes()
 
     def testVoteFile(self):
         VF = mixminion.directory.Directory.VoteFile
@@ -5566,6 +6590,144 @@ class EventStatsTests(TestCase):
         ES.log._setNextRotation(now=pm+7200)
         eq(ES.log.getNextRotation(), pm+7200)
 
+    def testMetrics(self):
+        import mixminion.server.EventStats as ES
+        eq = self.assertEquals
+        tm = time.time()
+        ES.configureMetrics({'Server': {'Metrics' : 0}})
+        self.failUnless(isinstance(ES.metrics, ES.NilMetrics))
+        self.failIf(ES.metrics.enabled)
+        ES.metrics.incr("X")
+        ES.metrics.observe("Y", 3)
+        eq(ES.metrics.getNextExport(), 0)
+
+        # The directory gets made if needed, and may be readable by others.
+        d = mix_mktemp()
+        os.mkdir(d, 0755)
+        fname = os.path.join(d, "sub", "metrics")
+        m = ES.Metrics(fname, 60, now=tm)
+        self.failUnless(os.path.isdir(os.path.join(d, "sub")))
+        self.failUnless(m.enabled)
+        eq(m.getNextExport(), tm+60)
+        # Counters from different threads get added together.
+        m.incr("Packets")
+        m.incr("Packets", 2)
+        def _worker(m=m):
+            m.incr("Packets", 10)
+            m.observe("Delay", 2)
+        t = threading.Thread(target=_worker)
+        t.start()
+        t.join()
+        eq(len(m._perThread), 2)
+        eq(m.getCounters(), { "Packets" : 13 })
+        # Histograms too.
+        m.observe("Delay", .0001)
+        m.observe("Delay", 2)
+        m.observe("Delay", 1e9)
+        h = m.getHistograms()["Delay"]
+        eq(h.count, 4)
+        self.assertFloatEq(h.total, 1e9+4.0001)
+        eq(h.buckets[0], 1)
+        eq(h.buckets[ES.HISTOGRAM_BUCKETS.index(5)], 2)
+        eq(h.buckets[-1], 1)
+        # Gauges are only read when needed; failing gauges are skipped.
+        q = [1,2,3]
+        m.addGauge("QueueSize", lambda q=q: len(q))
+        m.addGauge("Broken", lambda: 1/0)
+        del q[0]
+        suspendLog()
+        try:
+            eq(m.getGauges(), { "QueueSize" : 2 })
+        finally:
+            resumeLog()
+        # Export.
+        suspendLog()
+        try:
+            eq(m.export(now=tm+60), tm+120)
+        finally:
+            resumeLog()
+        eq(m.getNextExport(), tm+120)
+        lines = readFile(fname).split("\n")
+        self.failUnless(lines[0].startswith("# Mixminion server metrics at"))
+        eq(lines[1:4], ["Uptime 60", "Packets 13", "QueueSize 2"])
+        self.failUnless('Delay_bucket{le="0.001"} 1' in lines)
+        self.failUnless('Delay_bucket{le="5"} 3' in lines)
+        self.failUnless('Delay_bucket{le="+Inf"} 4' in lines)
+        self.failUnless("Delay_count 4" in lines)
+
+    def testPacketTracer(self):
+        import mixminion.server.EventStats as ES
+        eq = self.assertEquals
+        tm = time.time()
+        ES.configureTracing({'Server': {'PacketTracing' : 0}})
+        self.failUnless(isinstance(ES.tracer, ES.NilPacketTracer))
+        self.failIf(ES.tracer.enabled)
+        eq(ES.tracer.start(), None)
+        eq(ES.tracer.take("MIX:x"), None)
+        eq(ES.tracer.getNextExport(), 0)
+
+        d = mix_mktemp()
+        os.mkdir(d, 0755)
+        fname = os.path.join(d, "sub", "traces")
+        t = ES.PacketTracer(.25, ringSize=8, maxActive=3, filename=fname,
+                            interval=60, now=tm)
+        self.failUnless(os.path.isdir(os.path.join(d, "sub")))
+        self.failUnless(t.enabled)
+        eq(t.period, 4)
+        eq(t.getNextExport(), tm+60)
+        # We trace every fourth packet.
+        ids = [ t.start() for _ in xrange(8) ]
+        eq(ids, [None]*3+[1]+[None]*3+[2])
+        # Stage times go into the metrics.
+        oldMetrics = ES.metrics
+        ES.metrics = m = ES.Metrics(os.path.join(mix_mktemp(), "m"), 60)
+        try:
+            t.stamp(1, "Store")
+            t.stamp(1, "Wait")
+            t.follow(1, "MIX:abc")
+            eq(t.take("MIX:abc"), 1)
+            eq(t.take("MIX:abc"), None)
+            t.stamp(1, "Mix")
+            t.finish(1)
+            # Stamps for finished packets are ignored.
+            t.stamp(1, "Queue")
+            t.follow(1, "OUT:abc")
+            eq(t.take("OUT:abc"), None)
+        finally:
+            ES.metrics = oldMetrics
+        h = m.getHistograms()
+        names = h.keys()
+        names.sort()
+        eq(names, ["StageMixTime", "StageStoreTime", "StageWaitTime"])
+        eq(h["StageWaitTime"].count, 1)
+        eq([ (r[0], r[1]) for r in t.getRecords() ],
+           [ (1, "Received"), (2, "Received"), (1, "Store"), (1, "Wait"),
+             (1, "Mix") ])
+        # The ring only holds the most recent stamps.
+        for _ in xrange(5):
+            t.stamp(2, "Crypto")
+        recs = t.getRecords()
+        eq(len(recs), 8)
+        eq((recs[0][0], recs[0][1]), (1, "Store"))
+        eq([ r[1] for r in recs[-5:] ], ["Crypto"]*5)
+        # If too many packets are in flight, we forget them all.
+        t.follow(2, "MIX:def")
+        for _ in xrange(8):
+            t.start()
+        eq(len(t._last), 3)
+        for _ in xrange(3):
+            eq(t.start(), None)
+        eq(t.start(), 5)
+        eq(t._last.keys(), [5])
+        eq(t.take("MIX:def"), None)
+        # Export.
+        eq(t.export(now=tm+60), tm+120)
+        lines = readFile(fname).split("\n")
+        self.failUnless(lines[0].startswith("# Mixminion packet traces at"))
+        eq(lines[1], "# Tracing 1 packet in 4; 8 stamps remembered")
+        self.failUnless([l for l in lines if l.startswith("# Crypto 5 ")])
+        self.failUnless(lines[-2].startswith("5 Received "))
+
 #----------------------------------------------------------------------
 # Modules and ModuleManager
 
@@ -6475,6 +7637,63 @@ class ServerKeysTests(TestCase):
             # Test getTLSContext
             keyring._getTLSContext()
 
+    def testKeyPool(self):
+        keyring = _getServerKeyring()
+        keyring.getIdentityKey()
+        # The pool has to make the work directory for itself.
+        workDir = keyring.config.getWorkDir()
+        self.failIf(os.path.exists(workDir))
+        pool = mixminion.server.ServerKeys.KeyPool(keyring, 1)
+        keyring.keyPool = pool
+        now = time.time()
+        when = now + 3*60*60
+        pool.setNextTLSContextTime(when)
+        pool.start()
+        try:
+            # Wait for the pool to fill up.
+            for _ in xrange(600):
+                pool._cond.acquire()
+                full = pool.packetKeys and pool.tlsCredentials
+                pool._cond.release()
+                if full: break
+                time.sleep(0.1)
+            self.assert_(full)
+            self.assertEquals(1, len(pool.packetKeys))
+            pooledKey = pool.packetKeys[0]
+
+            # New keysets take their packet keys from the pool.
+            try:
+                overrideDNS({"Theserver5" : '10.0.0.1'})
+                clearReplacedFunctionCallLog()
+                replaceFunction(mixminion.server.ServerKeys,
+                         "generateServerDescriptorAndKeys",
+                         mixminion.server.ServerKeys.generateServerDescriptorAndKeys)
+                keyring.createKeys(1, now)
+                calls = getReplacedFunctionCallLog()[:]
+            finally:
+                undoReplacedAttributes()
+                clearReplacedFunctionCallLog()
+            self.assertEquals(1, len(calls))
+            self.assert_(calls[0][2]['packetKey'] is pooledKey)
+            keyset = keyring.getServerKeysets(now)[0]
+            self.assertEquals(Crypto.pk_get_modulus(pooledKey),
+                        Crypto.pk_get_modulus(keyset.getPacketKey()))
+
+            # TLS credentials are only handed out near the time they
+            # were made for.
+            self.assertEquals(None, pool.getTLSCredentials(now))
+            self.assert_(pool.tlsCredentials)
+            w, mmtpKey, fn = pool.getTLSCredentials(when+60)
+            self.assertEquals(w, when)
+            self.assertEquals(mmtpKey.get_modulus_bytes(), 128)
+            self.assert_(os.path.exists(fn))
+            self.assertEquals(workDir, os.path.dirname(fn))
+            self.assertEquals(None, pool.tlsCredentials)
+            self.assertEquals(None, pool.getTLSCredentials(when+60))
+        finally:
+            pool.shutdown()
+            pool.join()
+
 #----------------------------------------------------------------------
 class DNSFarmTests(TestCase):
     def testDNSCache(self):
@@ -6550,6 +7769,164 @@ class DNSFarmTests(TestCase):
             undoReplacedAttributes()
             mixminion.NetUtils._PROTOCOL_SUPPORT = None
 
+    def testAsyncDNSCache(self):
+        import mixminion.server.DNSFarm as DNSFarm
+        # A tiny DNS server that knows A records for a few names.
+        records = { 'foo.example.com' : ('10.2.4.11', 3600),
+                    'bar.example.com' : ('10.99.22.8', 5),
+                    'big.example.com' : (None, 0) }
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.setblocking(0)
+        queries = []
+        ports = []
+        def serve(server=server, records=records, queries=queries,
+                  ports=ports):
+            while 1:
+                try:
+                    msg, addr = server.recvfrom(512)
+                except socket.error:
+                    return
+                ports.append(addr[1])
+                qid, = struct.unpack("!H", msg[:2])
+                pos, labels = 12, []
+                while ord(msg[pos]):
+                    labels.append(msg[pos+1:pos+1+ord(msg[pos])])
+                    pos += ord(msg[pos])+1
+                question = msg[12:pos+5]
+                qtype, = struct.unpack("!H", msg[pos+1:pos+3])
+                name = ".".join(labels)
+                queries.append((name, qtype))
+                rr = ""
+                if not records.has_key(name):
+                    # NXDOMAIN, with an SOA record whose minimum is 30.
+                    hdr = struct.pack("!HHHHHH", qid, 0x8183, 1, 0, 1, 0)
+                    soa = "\x00"*22 + struct.pack("!L", 30)
+                    rr = "\xc0\x0c" + struct.pack("!HHLH", 6, 1, 600,
+                                                  len(soa)) + soa
+                elif records[name][0] is None:
+                    # Too many answers to fit; set the TC bit.
+                    hdr = struct.pack("!HHHHHH", qid, 0x8380, 1, 0, 0, 0)
+                elif qtype == 1:
+                    ip, ttl = records[name]
+                    hdr = struct.pack("!HHHHHH", qid, 0x8180, 1, 1, 0, 0)
+                    rr = "\xc0\x0c" + struct.pack("!HHLH", 1, 1, ttl, 4) + \
+                         socket.inet_aton(ip)
+                else:
+                    hdr = struct.pack("!HHHHHH", qid, 0x8180, 1, 0, 0, 0)
+                server.sendto(hdr+question+rr, addr)
+
+        receiveDict = {}
+        def callback(name,val,receiveDict=receiveDict):
+            receiveDict[name]=val
+        mixminion.NetUtils._PROTOCOL_SUPPORT = (1,0)
+        asyncServer = mixminion.server.MMTPServer.AsyncServer()
+        cache = DNSFarm.AsyncDNSCache(asyncServer,
+                                      nameservers=[server.getsockname()])
+        def step(cache=cache, serve=serve, asyncServer=asyncServer):
+            cache.checkTimeouts()
+            time.sleep(0.01)
+            serve()
+            asyncServer.process(0.01)
+        def pump(n, step=step, receiveDict=receiveDict):
+            end = time.time()+5
+            while len(receiveDict) < n and time.time() < end:
+                step()
+        try:
+            cache.lookup('foo.example.com', callback)
+            cache.lookup('foo.example.com', callback)
+            cache.lookup('nowhere.example.com', callback)
+            cache.lookup('1.2.3.4', callback)
+            self.assertEquals(cache.getNonblocking('foo.example.com'),
+                              DNSFarm.PENDING)
+            pump(3)
+            self.assertEquals(receiveDict['foo.example.com'][:2],
+                              (socket.AF_INET, '10.2.4.11'))
+            self.assertEquals(receiveDict['nowhere.example.com'][0], "NOENT")
+            self.assertEquals(receiveDict['1.2.3.4'][:2],
+                              (socket.AF_INET, '1.2.3.4'))
+            # Only one query was sent per name, each from its own port.
+            self.assertEquals(len(queries), 2)
+            self.assertNotEquals(ports[0], ports[1])
+            # Once answered, a query's socket is closed and forgotten.
+            self.assertEquals({}, cache.queries)
+            self.assertEquals({}, asyncServer.connections)
+            self.assertEquals(cache.getNameByAddressNonblocking('10.2.4.11'),
+                              'foo.example.com')
+
+            # Answers come from the cache, positive and negative.
+            receiveDict.clear()
+            cache.lookup('foo.example.com', callback)
+            cache.lookup('nowhere.example.com', callback)
+            self.assertEquals(len(receiveDict), 2)
+            self.assertEquals(len(queries), 2)
+            # The negative answer lasts as long as the SOA said.
+            now = time.time()
+            self.assert_(25 <= cache.expires['nowhere.example.com']-now <= 30)
+            # A long TTL is cut down to MAX_ENTRY_TTL...
+            self.assert_(DNSFarm.MAX_ENTRY_TTL-10 <=
+                         cache.expires['foo.example.com']-now <=
+                         DNSFarm.MAX_ENTRY_TTL)
+
+            # Prefetching looks up unknown names only.
+            receiveDict.clear()
+            cache.prefetch(['foo.example.com', 'bar.example.com', '1.2.3.4'])
+            self.assertEquals(cache.getNonblocking('bar.example.com'),
+                              DNSFarm.PENDING)
+            for _ in xrange(100):
+                step()
+                if cache.getNonblocking('bar.example.com') is not \
+                       DNSFarm.PENDING: break
+            self.assertEquals(len(queries), 3)
+            self.assertEquals(queries[-1], ('bar.example.com', 1))
+            self.assertEquals(cache.getNonblocking('bar.example.com')[:2],
+                              (socket.AF_INET, '10.99.22.8'))
+            # ...and a short one is raised to MIN_ANSWER_TTL.
+            self.assert_(cache.expires['bar.example.com']-now >=
+                         DNSFarm.MIN_ANSWER_TTL-1)
+
+            # Expired entries are looked up again.
+            cache.expires['foo.example.com'] = now-1
+            self.assertEquals(cache.getNonblocking('foo.example.com')[0],
+                              socket.AF_INET)
+            cache.lookup('foo.example.com', callback)
+            pump(1)
+            self.assertEquals(len(queries), 4)
+            self.assertEquals(receiveDict['foo.example.com'][1], '10.2.4.11')
+            cache.cleanCache(now+5000)
+            self.assertEquals(cache.getNonblocking('foo.example.com'), None)
+
+            # Truncated answers go to the system resolver, and aren't
+            # taken as a sign that the name has no addresses.
+            replaceFunction(mixminion.NetUtils, "getIP",
+                      lambda name: (socket.AF_INET, '10.0.0.7', time.time()))
+            try:
+                cache.lookup('big.example.com', callback)
+                pump(2)
+            finally:
+                undoReplacedAttributes()
+                clearReplacedFunctionCallLog()
+            self.assertEquals(queries[-1], ('big.example.com', 1))
+            self.assertEquals(receiveDict['big.example.com'][:2],
+                              (socket.AF_INET, '10.0.0.7'))
+
+            # Unanswered queries are retried, then abandoned.
+            server.close()
+            cache.lookup('lost.example.com', callback)
+            cache.checkTimeouts()
+            self.assertEquals(1, len(asyncServer.connections))
+            for i in xrange(DNSFarm.DNS_MAX_TRIES):
+                self.assertEquals(cache.getNonblocking('lost.example.com'),
+                                  DNSFarm.PENDING)
+                cache.checkTimeouts(time.time() +
+                                    (i+1)*DNSFarm.DNS_RETRY_INTERVAL + 1)
+            self.assertEquals(receiveDict['lost.example.com'][0], "NOENT")
+            self.assertEquals({}, asyncServer.connections)
+        finally:
+            cache.shutdown()
+            server.close()
+            mixminion.NetUtils._PROTOCOL_SUPPORT = None
+
 #----------------------------------------------------------------------
 
 class ServerMainTests(TestCase):
@@ -6583,6 +7960,45 @@ class ServerMainTests(TestCase):
         s.processEvents(tm+5)
         self.assertEquals(["c", "d", "b", "c" ], lst)
 
+        # Complex events run when they ask to, and stop when they return -1.
+        s = _Scheduler()
+        times = [ tm+30, tm+10, -1 ]
+        def e(lst=lst, times=times):
+            lst.append('e')
+            return times.pop(0)
+        del lst[:]
+        s.scheduleRecurringComplex(tm+5, "E", e)
+        s.scheduleOnce(tm+20, "A", a)
+        self.assertEquals(s.firstEventTime(), tm+5)
+        s.processEvents(tm+5)
+        self.assertEquals(s.firstEventTime(), tm+20)
+        s.processEvents(tm+25)
+        self.assertEquals(s.firstEventTime(), tm+30)
+        s.processEvents(tm+30)
+        # 'e' now wants to run at tm+10, which has already passed.
+        self.assertEquals(s.firstEventTime(), tm+10)
+        s.processEvents(tm+31)
+        self.assertEquals(s.firstEventTime(), -1)
+        self.assertEquals(['e', 'a', 'e', 'e'], lst)
+
+        # Background events aren't rescheduled until they finish.
+        jobs = []
+        finished = []
+        s = _Scheduler()
+        s.eventFinished = lambda finished=finished: finished.append(1)
+        del lst[:]
+        s.scheduleEvent(mixminion.ScheduleUtils.RecurringBackgroundEvent(
+            tm-50, jobs.append, b, 100))
+        s.processEvents(tm-49)
+        self.assertEquals(len(jobs), 1)
+        self.assertEquals(s.firstEventTime(), -1)
+        s.processEvents(tm-48)
+        self.assertEquals(len(jobs), 1)
+        jobs[0]()
+        self.assertEquals(['b'], lst)
+        self.assertEquals([1], finished)
+        self.assertEquals(s.firstEventTime(), tm+50)
+
     def testMixPool(self):
         ServerConfig = mixminion.server.ServerConfig.ServerConfig
         MixPool = mixminion.server.ServerMain.MixPool
@@ -6621,8 +8037,96 @@ class ServerMainTests(TestCase):
         self.assertEquals(pool.queue.minSend, 1)
         self.assertFloatEq(pool.queue.sendRate, .4)
 
+        # A traced packet is followed before the mix can see it.
+        import mixminion.server.EventStats as ES
+        oldTracer = ES.tracer
+        ES.tracer = t = ES.PacketTracer(1.0)
+        try:
+            seen = []
+            def follow(traceID, key, pool=pool, seen=seen, orig=t.follow):
+                seen.append(pool.queue.getAllMessages())
+                orig(traceID, key)
+            t.follow = follow
+            traceID = t.start()
+            h = pool.queueObject("Packet", traceID)
+            self.assertEquals(seen, [[]])
+            self.assertEquals(pool.queue.getAllMessages(), [h])
+            self.assertEquals(t.getRecords()[-1][:2], (traceID, "Pool"))
+            self.assertEquals(t.take("MIX:"+h), traceID)
+        finally:
+            ES.tracer = oldTracer
+
         # FFFF test other mix pool behavior
 
+    def testOutgoingQueueTracing(self):
+        import mixminion.server.EventStats as ES
+        eq = self.assertEquals
+        OutgoingQueue = mixminion.server.ServerMain.OutgoingQueue
+        start = time.time()
+        q = OutgoingQueue(mix_mktemp(), "Z"*20)
+        q.setRetrySchedule([3600, 3600])
+        oldTracer = ES.tracer
+        ES.tracer = t = ES.PacketTracer(1.0)
+        try:
+            hs = []
+            for i in xrange(4):
+                h = q.queueDeliveryMessage("Packet %s"%i, _TestAddr("A"),
+                                           start)
+                t.follow(t.start(), "OUT:"+h)
+                hs.append(h)
+            eq(len(t._byKey), 4)
+            # Delivered packets get one last stamp.
+            q.deliverySucceeded(hs[0], now=start)
+            eq(t.getRecords()[-1][1], "Deliver")
+            eq(len(t._last), 3)
+            # Packets that expire are dropped.
+            q.removeExpiredMessages(start+3*3600)
+            eq(q.count(), 0)
+            eq(t._byKey, {})
+            eq(t._last, {})
+        finally:
+            ES.tracer = oldTracer
+            q.close()
+
+    def testIncomingWriter(self):
+        IncomingWriterThread = mixminion.server.ServerMain.IncomingWriterThread
+        class FakeIncomingQueue:
+            def __init__(self):
+                self.batches = []
+            def queuePackets(self, pkts, traceIDs=None):
+                if "bad" in pkts:
+                    raise IOError("Disk full")
+                self.batches.append(pkts)
+        incoming = FakeIncomingQueue()
+        writer = IncomingWriterThread(incoming)
+        results = []
+        def done(ok, name, results=results):
+            results.append((name, ok))
+        # Queue everything before we start, so it's all stored at once.
+        for i in xrange(3):
+            writer.queuePacket("pkt%s"%i,
+                               lambda ok,i=i,done=done: done(ok,"pkt%s"%i))
+        writer.start()
+        try:
+            for _ in xrange(100):
+                if len(results) == 3: break
+                time.sleep(.05)
+            suspendLog()
+            try:
+                writer.queuePacket("bad", lambda ok,done=done: done(ok,"bad"))
+                writer.shutdown()
+                writer.join()
+            finally:
+                s = resumeLog()
+        finally:
+            if writer.isAlive():
+                writer.shutdown()
+        self.assertEquals(incoming.batches, [["pkt0", "pkt1", "pkt2"]])
+        self.assertEquals(results, [("pkt0",1),("pkt1",1),("pkt2",1),
+                                    ("bad",0)])
+        self.assert_(stringContains(s,
+                                    "[ERROR] Couldn't store 1 incoming packets"))
+
 #----------------------------------------------------------------------
 
 _EXAMPLE_DESCRIPTORS = {} # name->list of str
@@ -7275,7 +8779,8 @@ class ClientDirectoryTests(TestCase):
         lola = ks.getServerInfo("Lola")
 
         def pathIs(p, exp, self=self):
-            if isinstance(p[0],mixminion.ServerInfo.ServerInfo):
+            if (isinstance(p[0],mixminion.ServerInfo.ServerInfo) or
+                isinstance(p[0],mixminion.ServerInfo.CompactServerInfo)):
                 p1, p2 = p, ()
                 exp1, exp2 = exp, ()
             else:
@@ -7527,7 +9032,8 @@ class ClientDirectoryTests(TestCase):
                 m = re.search(r"^Digest: (\S+)\n", s, re.M)
                 assert m
                 ds.append(base64.decodestring(m.group(1)))
-            elif isinstance(s, mixminion.ServerInfo.ServerInfo):
+            elif (isinstance(s, mixminion.ServerInfo.ServerInfo) or
+                  isinstance(s, mixminion.ServerInfo.CompactServerInfo)):
                 ds.append(s.getDigest())
             else:
                 return 0
@@ -7612,6 +9118,160 @@ class ClientMainTests(TestCase):
             s = resumeLog()
         self.assert_(stringContains(s, "Incorrect password"))
 
+    def testLazyImports(self):
+        # Loading the client code shouldn't load the modules that only a
+        # few commands need.
+        libdir = os.path.split(os.path.split(mixminion.__file__)[0])[0]
+        prog = ("import sys; sys.path.insert(0, %r); "
+                "import mixminion.ClientMain; "
+                "print [ m for m in ('BuildMessage', 'ClientDirectory', "
+                "'MMTPClient') if sys.modules.has_key('mixminion.'+m) ]"
+                ) % libdir
+        f = os.popen('%s -c "%s"' % (sys.executable, prog))
+        out = f.read()
+        f.close()
+        self.assertEquals(out.strip(), "[]")
+
+    def testClientAgent(self):
+        eq = self.assertEquals
+        userdir = mix_mktemp()
+        cfgName = mix_mktemp()
+        writeFile(cfgName, "[Host]\n[User]\nUserDir: %s\n[DirectoryServers]\n"
+                  % userdir)
+        sockName = os.path.join(mix_mktemp(), "agent")
+        agent = mixminion.ClientAgent.ClientAgent(sockName)
+
+        # A fake command, to see what the agent passes along.
+        def echo(cmd, args):
+            print cmd, " ".join(args)
+            print sys.stdin.read()
+            if args and args[0] == 'fail':
+                raise UIError("It failed")
+            sys.exit(len(args))
+        agent.commands['echo'] = echo
+        cwd = os.getcwd()
+        status, out, err = agent.runCommand(cwd, "mixminion echo", "echo",
+                                            ["a", "b"], "Hello")
+        eq(status, 2)
+        eq(out, "mixminion echo a b\nHello\n")
+        eq(err, "")
+        status, out, err = agent.runCommand(cwd, "mixminion echo", "echo",
+                                            ["fail"])
+        eq(status, 1)
+        self.assert_(stringContains(err, "[ERROR] It failed"))
+        eq(agent.runCommand(cwd, "mixminion x", "unittests", [])[0], 1)
+
+        # Run a real command twice: the second time, the client is reused.
+        status, out, err = agent.runCommand(cwd, "mixminion flush", "flush",
+                                            ["-f", cfgName])
+        eq(status, 0)
+        env = agent.getEnv(cfgName)
+        client = env.client
+        self.assert_(client is not None)
+        self.assert_(env.config['User']['UserDir'] == userdir)
+        status, out, err = agent.runCommand(cwd, "mixminion flush", "flush",
+                                            ["-f", cfgName])
+        eq(status, 0)
+        self.assert_(agent.getEnv(cfgName) is env)
+        self.assert_(env.client is client)
+        # Options that name fds in the caller's process are rejected.
+        status, out, err = agent.runCommand(cwd, "mixminion flush", "flush",
+                                        ["-f", cfgName, "--status-fd", "1"])
+        eq(status, 1)
+        self.assert_(stringContains(err, "can't be used through the agent"))
+        self.assert_(mixminion.ClientMain._AGENT is None)
+
+        # Now go through the socket.
+        agent.listen()
+        t = threading.Thread(target=agent.run)
+        t.start()
+        saved = sys.stdout, sys.stderr
+        try:
+            sys.stdout = sys.stderr = output = cStringIO.StringIO()
+            status = mixminion.ClientAgent.forwardCommand(
+                sockName, ["/bin/mixminion", "echo", "x"], stdin="Data")
+        finally:
+            sys.stdout, sys.stderr = saved
+            self.assert_(mixminion.ClientAgent.stopAgent(sockName))
+            t.join()
+            agent.close()
+        eq(status, 1)
+        eq(output.getvalue(), "mixminion echo x\nData\n")
+        self.failIf(os.path.exists(sockName))
+
+        # With no agent, the thin client gives up.
+        try:
+            sys.stderr = cStringIO.StringIO()
+            status = mixminion.ClientAgent.forwardCommand(
+                sockName, ["/bin/mixminion", "echo"], stdin="")
+        finally:
+            sys.stderr = saved[1]
+        eq(status, None)
+        self.failIf(mixminion.ClientAgent.stopAgent(sockName))
+
+    def testGatewayBackend(self):
+        # The mail gateway proxies in etc/ use mmUtils.
+        topdir = os.path.split(os.path.split(os.path.split(
+            mixminion.__file__)[0])[0])[0]
+        etcdir = os.path.join(topdir, "etc")
+        if not os.path.exists(os.path.join(etcdir, "mmUtils.py")):
+            # We're not running from a source tree.
+            return
+        sys.path.insert(0, etcdir)
+        try:
+            import mmUtils
+        finally:
+            del sys.path[0]
+        eq = self.assertEquals
+
+        # The in-process backend decodes messages to a string.
+        userdir = mix_mktemp()
+        cfgName = mix_mktemp()
+        writeFile(cfgName, "[Host]\n[User]\nUserDir: %s\n[DirectoryServers]\n"
+                  % userdir)
+        backend = mmUtils.InProcessBackend("pwd", cfgName, queueOnly=1)
+        msg = TextEncodedMessage("Hello, whirled\n", "TXT").pack()
+        eq(backend.decode("Nothing to see here\n"), "")
+        eq(backend.decode("From: alice\n\n"+msg), "Hello, whirled\n\n")
+        # The configuration stays loaded between messages.
+        env = backend.env
+        eq(backend.decode(msg), "Hello, whirled\n\n")
+        self.assert_(backend.env is env)
+        self.assert_(env.config['User']['UserDir'] == userdir)
+
+        # The store imports the old pickled files once.
+        d = mix_mktemp()
+        os.mkdir(d, 0700)
+        cPickle.dump(["h1"], open(os.path.join(d, "seen_files.dat"), "wb"))
+        cPickle.dump({"id1" : ["S1", "S2"]},
+                     open(os.path.join(d, "surb_file.dat"), "wb"))
+        store = mmUtils.GatewayStore(d)
+        self.failIf(os.path.exists(os.path.join(d, "seen_files.dat")))
+        self.failIf(os.path.exists(os.path.join(d, "surb_file.dat")))
+        self.assert_(store.isSeen("h1"))
+        self.failIf(store.isSeen("h2"))
+        store.markSeen(["h2", "h3"])
+        eq(store.peekSURB("id1"), "S1")
+        store.useSURB("id1")
+        eq(store.peekSURB("id1"), "S2")
+        # Adding reply blocks for an ID replaces the old ones.
+        store.addSURBs("id2", ["A", "B"])
+        store.addSURBs("id2", ["C"])
+        eq(store.peekSURB("id2"), "C")
+        self.failIf(store.hasSURBs("id3"))
+        eq(store.peekSURB("id3"), None)
+        store.close()
+
+        # Everything survives reopening.
+        store = mmUtils.GatewayStore(d)
+        self.assert_(store.isSeen("h1") and store.isSeen("h3"))
+        eq(store.peekSURB("id1"), "S2")
+        store.useSURB("id1")
+        self.failIf(store.hasSURBs("id1"))
+        store.useSURB("id2")
+        eq(store.peekSURB("id2"), None)
+        store.close()
+
     def testMixminionClient(self):
         # Create and configure a MixminionClient object...
         parseAddress = mixminion.ClientDirectory.parseAddress
@@ -7957,6 +9617,13 @@ wanted to play with the new experimental built-in pinger code.]"""
         log.queuedPing("<>"*10, [id0], now=t+32)
         log.connected(id0,now=t+60)
         log.connected(id1,now=t+60.2)
+        # Calculate uptimes partway through; the rest of the calculation
+        # will only look at the new connection attempts.
+        interval = (previousMidnight(t), succeedingMidnight(t))
+        log.calculateUptimes(t,t+65,now=t+65)
+        ups = log.getUptimes(t,t+65)
+        # So far, id1 was down from 20..25, and up from 25..60.
+        self.assertFloatEq(ups[interval][id1], 35/40.)
         log.connectFailed(id1,now=t+70)
         log.connected(id0,now=t+90)
         log.gotPing("\x00Z"*10, now=t+130)
@@ -7972,7 +9639,6 @@ wanted to play with the new experimental built-in pinger code.]"""
         log.heartbeat(t+200)
         log.calculateUptimes(t,t+200,now=t+200)
         ups = log.getUptimes(t,t+200)
-        interval = (previousMidnight(t), succeedingMidnight(t))
 
         # I've been up 200 seconds this day, of which not all has passed.
         self.assertFloatEq(ups[interval]['<self>'],
@@ -7985,6 +9651,9 @@ wanted to play with the new experimental built-in pinger code.]"""
         self.assertFloatEq(ups[interval][id1], 40/50.)
         # id2 was only down once in the interval; we refuse to extrapolate.
         self.assert_(not ups[interval].has_key(id2))
+        # Recalculating without new attempts changes nothing.
+        log.calculateUptimes(t,t+200,now=t+200)
+        self.assertEquals(log.getUptimes(t,t+200), ups)
 
         log.calculateChainStatus(now=t+200)
         log.calculateAll(now=t+200)
@@ -8006,6 +9675,63 @@ wanted to play with the new experimental built-in pinger code.]"""
         log.rotate(t+15*24*60*60,t+30*24*60*60)
         log.close()
 
+    def testPingLogWriter(self):
+        P = mixminion.server.Pinger
+        if not P.canRunPinger():
+            return
+        import sqlite3
+        d = mix_mktemp()
+        os.mkdir(d,0700)
+        loc = os.path.join(d, "db")
+        t = time.time()
+        ids = [ "%020d"%n for n in xrange(10) ]
+        nBatch = P.PingLog.BATCH_MAX_ROWS
+        def count(loc=loc):
+            # Count the attempts visible to another connection.
+            c = sqlite3.connect(loc)
+            n, = c.execute("SELECT count() FROM connectionAttempt").fetchone()
+            c.close()
+            return n
+
+        # Events are batched until we flush.
+        log = P.openPingLog(None,location=loc)
+        log.startup(now=t)
+        self.assertEquals(log.getFlushDeadline(), None)
+        log.connected(ids[0], now=t+1)
+        self.assert_(log.getFlushDeadline() is not None)
+        self.assertEquals(count(), 0)
+        log.flush()
+        self.assertEquals(log.getFlushDeadline(), None)
+        self.assertEquals(count(), 1)
+        # ... or until the batch is full.
+        for n in xrange(nBatch):
+            log.connected(ids[n%10], now=t+2)
+        self.assertEquals(count(), 1+nBatch)
+        log.close()
+
+        # Now try it with a writer thread.
+        thread = P.PingLogWriterThread()
+        log = P.openPingLog(None,location=loc,databaseThread=thread)
+        log._baseObject.BATCH_MAX_DELAY = 0.1
+        thread.start()
+        try:
+            log.startup(now=t)
+            for n in xrange(1000):
+                log.connected(ids[n%10], success=n%2, now=t+n)
+            self.assert_(thread.waitForFlush(30))
+            self.assertEquals(count(), 1001+nBatch)
+            # A lone event gets committed once its batch is old enough.
+            log.connected(ids[1], now=t+2000)
+            for _ in xrange(50):
+                if count() == 1002+nBatch:
+                    break
+                time.sleep(0.1)
+            self.assertEquals(count(), 1002+nBatch)
+        finally:
+            thread.shutdown(flush=0)
+            thread.join()
+            log._baseObject.close()
+
 #----------------------------------------------------------------------
 
 def initializeGlobals():
@@ -1246,7 +1246,7 @@ mm_generate_cert(PyObject *self, PyObject *args, PyObject *kwargs)
         X509_NAME *name = NULL;
         X509_NAME *name_issuer = NULL;
         int nid;
-        PyObject *retval;
+        int ok;
         time_t _time;
 
         if (!PyArg_ParseTupleAndKeywords(args, kwargs,
@@ -1321,13 +1321,11 @@ mm_generate_cert(PyObject *self, PyObject *args, PyObject *kwargs)
         if (!(PEM_write_bio_X509(out, x509)))
                 goto error;
 
-        retval = Py_None;
-        Py_INCREF(Py_None);
+        ok = 1;
         goto done;
 
 error:
-        retval = NULL;
-        mm_SSL_ERR(1);
+        ok = 0;
  done:
         if (out)
                 BIO_free(out);
@@ -1347,7 +1345,15 @@ error:
                 EVP_PKEY_free(pkey_sign);
 
         Py_END_ALLOW_THREADS
-        return retval;
+
+        /* We can only touch Python objects once we hold the interpreter
+           lock again. */
+        if (!ok) {
+                mm_SSL_ERR(1);
+                return NULL;
+        }
+        Py_INCREF(Py_None);
+        return Py_None;
 }
 
 /*
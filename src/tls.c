@@ -109,19 +109,29 @@ typedef struct mm_TLSSock {
 #define mm_TLSSock_Check(v) ((v)->ob_type == &mm_TLSSock_Type)
 
 const char mm_TLSContext_new__doc__[] =
-   "TLSContext([certfile, [rsa, [dhfile] ] ] )\n\n"
+   "TLSContext([certfile, [rsa, [dhfile, [sessionCacheSize, \n"
+   "           [sessionTimeout] ] ] ] ] )\n\n"
    "Allocates a new TLSContext object.  The files, if provided, are used\n"
    "contain the PEM-encoded X509 public keys, private key, and DH\n"
    "parameters for this context.\n\n"
    "If a cert is provided, assume we're working in server mode, and allow\n\n"
+   "If sessionCacheSize is positive, a server-mode context remembers up to\n"
+   "that many sessions (for up to sessionTimeout seconds) so that clients\n"
+   "can resume them.  Otherwise, sessions are never resumed.\n\n"
    "LIMITATION: We don\'t expose any more features than Mixminion needs.\n";
 
+/* Session ID context for resumable server sessions. */
+#define MM_SESSION_ID_CONTEXT "mixminion-mmtp"
+
 PyObject*
 mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
 {
-        static char *kwlist[] = { "certfile", "rsa", "dhfile", NULL };
+        static char *kwlist[] = { "certfile", "rsa", "dhfile",
+                                  "sessionCacheSize", "sessionTimeout",
+                                  NULL };
         char *certfile = NULL, *dhfile=NULL;
         mm_RSA *rsa = NULL;
+        int sessionCacheSize = 0, sessionTimeout = 600;
         int err = 0;
 
         SSL_METHOD *method = NULL;
@@ -132,11 +142,14 @@ mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
         EVP_PKEY *pkey = NULL;
         mm_TLSContext *result;
 
-        if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|sO!s:TLSContext_new",
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                         "|sO!sii:TLSContext_new",
                                          kwlist,
                                          &certfile,
                                          &mm_RSA_Type, &rsa,
-                                         &dhfile))
+                                         &dhfile,
+                                         &sessionCacheSize,
+                                         &sessionTimeout))
                 return NULL;
 
         Py_BEGIN_ALLOW_THREADS;
@@ -161,8 +174,22 @@ mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
         if (!err && certfile &&
             !SSL_CTX_use_certificate_chain_file(ctx,certfile))
                 err = 1;
-        if (!err)
+        if (!err && certfile && sessionCacheSize > 0) {
+                SSL_CTX_set_session_cache_mode(ctx, SSL_SESS_CACHE_SERVER);
+                SSL_CTX_sess_set_cache_size(ctx, sessionCacheSize);
+                SSL_CTX_set_timeout(ctx, sessionTimeout);
+                if (!SSL_CTX_set_session_id_context(ctx,
+                          (const unsigned char*)MM_SESSION_ID_CONTEXT,
+                          sizeof(MM_SESSION_ID_CONTEXT)-1))
+                        err = 1;
+        } else if (!err) {
                 SSL_CTX_set_session_cache_mode(ctx, SSL_SESS_CACHE_OFF);
+#ifdef SSL_OP_NO_TICKET
+                /* Don't let clients resume with tickets, either. */
+                if (certfile)
+                        SSL_CTX_set_options(ctx, SSL_OP_NO_TICKET);
+#endif
+        }
         if (!err && rsa) {
                 if (!(_rsa = RSAPrivateKey_dup(rsa->rsa)) ||
                     !(pkey = EVP_PKEY_new()))
@@ -815,6 +842,92 @@ mm_TLSSock_get_num_bytes_raw(PyObject *self, PyObject* args, PyObject *kwargs)
         return PyInt_FromLong((long)(r+w));
 }
 
+static char mm_TLSSock_get_session__doc__[] =
+"tlssock.get_session()\n\n"
+"Return an opaque string encoding the session for this connection, to be\n"
+"passed to set_session on a later connection to the same server.  Returns\n"
+"None if there is no session yet.\n";
+
+static PyObject*
+mm_TLSSock_get_session(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+        SSL *ssl;
+        SSL_SESSION *session;
+        unsigned char *out;
+        PyObject *result;
+        int len;
+
+        assert(mm_TLSSock_Check(self));
+        FAIL_IF_ARGS();
+        ssl = ((mm_TLSSock*)self)->ssl;
+
+        if (!(session = SSL_get_session(ssl))) {
+                Py_INCREF(Py_None);
+                return Py_None;
+        }
+        if ((len = i2d_SSL_SESSION(session, NULL)) <= 0) {
+                mm_SSL_ERR(0);
+                return NULL;
+        }
+        if (!(result = PyString_FromStringAndSize(NULL, len)))
+                return NULL;
+        out = (unsigned char*)PyString_AS_STRING(result);
+        if (i2d_SSL_SESSION(session, &out) != len) {
+                Py_DECREF(result);
+                mm_SSL_ERR(0);
+                return NULL;
+        }
+        return result;
+}
+
+static char mm_TLSSock_set_session__doc__[] =
+"tlssock.set_session(session)\n\n"
+"Try to resume a session returned by get_session on an earlier connection\n"
+"to the same server.  Must be called before connect().  Raises TLSError\n"
+"if the session can't be decoded.\n";
+
+static PyObject*
+mm_TLSSock_set_session(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+        static char *kwlist[] = { "session", NULL };
+        SSL *ssl;
+        SSL_SESSION *session;
+        const unsigned char *in;
+        int len, r;
+
+        assert(mm_TLSSock_Check(self));
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#:set_session",
+                                         kwlist, &in, &len))
+                return NULL;
+        ssl = ((mm_TLSSock*)self)->ssl;
+
+        if (!(session = d2i_SSL_SESSION(NULL, &in, len))) {
+                mm_SSL_ERR(0);
+                return NULL;
+        }
+        r = SSL_set_session(ssl, session);
+        SSL_SESSION_free(session);
+        if (!r) {
+                mm_SSL_ERR(0);
+                return NULL;
+        }
+        Py_INCREF(Py_None);
+        return Py_None;
+}
+
+static char mm_TLSSock_session_reused__doc__[] =
+"tlssock.session_reused()\n\n"
+"Return true iff the handshake on this connection resumed an earlier\n"
+"session.\n";
+
+static PyObject*
+mm_TLSSock_session_reused(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+        assert(mm_TLSSock_Check(self));
+        FAIL_IF_ARGS();
+        return PyInt_FromLong(SSL_session_reused(((mm_TLSSock*)self)->ssl));
+}
+
 static PyMethodDef mm_TLSSock_methods[] = {
         METHOD(mm_TLSSock, accept),
         METHOD(mm_TLSSock, connect),
@@ -830,6 +943,9 @@ static PyMethodDef mm_TLSSock_methods[] = {
         METHOD(mm_TLSSock, renegotiate),
         METHOD(mm_TLSSock, get_num_bytes_raw),
         METHOD(mm_TLSSock, get_cert_lifetime),
+        METHOD(mm_TLSSock, get_session),
+        METHOD(mm_TLSSock, set_session),
+        METHOD(mm_TLSSock, session_reused),
         { NULL, NULL }
 };
 